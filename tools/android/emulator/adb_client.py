@@ -0,0 +1,378 @@
+# Copyright 2018 The Android Open Source Project. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A client for the adb server's smart socket protocol.
+
+Talks to a running adb server (ANDROID_ADB_SERVER_PORT) directly, instead of
+forking the adb binary for every shell command, push or connect. A request is
+its length in 4 hex digits followed by the request, the server answers OKAY or
+FAIL followed by a hex length prefixed message:
+
+  host:connect:<address>     connect the server to a device over tcp.
+  host:transport:<serial>    route the rest of the connection to the device,
+                             then one of:
+    shell,v2,raw:<command>   a command with exit status and separate stderr.
+    shell:<command>          older adbd, stdout and stderr merged.
+    sync:                    file transfers (SEND, RECV) until QUIT.
+
+The server serves one service per connection, so a shell command takes a new
+(local tcp) connection. Sync connections serve any number of transfers and are
+pooled per device.
+
+The client cannot start the adb server, callers fall back to the adb binary
+when it raises AdbUnavailableError.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import os
+import socket
+import stat
+import struct
+import threading
+
+_OKAY = b'OKAY'
+_FAIL = b'FAIL'
+
+# shell protocol v2 packet ids.
+_SHELL_STDOUT = 1
+_SHELL_STDERR = 2
+_SHELL_EXIT = 3
+_SHELL_CLOSE_STDIN = 4
+
+_SYNC_DATA_MAX = 64 << 10
+_READ_SIZE = 64 << 10
+
+
+class AdbError(Exception):
+  """The adb server failed a request, or the connection to it broke.
+
+  Attributes:
+    sent: whether the request had reached the device, and so may have run.
+  """
+
+  def __init__(self, message, sent=False):
+    super(AdbError, self).__init__(message)
+    self.sent = sent
+
+
+class AdbUnavailableError(AdbError):
+  """The adb server is not running."""
+
+
+def _Bytes(s):
+  if isinstance(s, bytes):
+    return s
+  return s.encode('utf-8')
+
+
+def _Text(b):
+  if isinstance(b, str):
+    return b
+  return b.decode('utf-8', 'replace')
+
+
+class AdbClient(object):
+  """Runs adb requests over sockets to the adb server.
+
+  Attributes:
+    owner_pid: the process the client's pooled connections belong to.
+  """
+
+  def __init__(self, port, host='127.0.0.1', timeout_seconds=30,
+               max_idle_per_device=2):
+    self.owner_pid = os.getpid()
+    self._address = (host, int(port))
+    self._timeout_seconds = timeout_seconds
+    self._max_idle_per_device = max_idle_per_device
+    self._lock = threading.Lock()
+    self._idle_sync = collections.defaultdict(list)
+    self._features = {}
+    self._counters = dict.fromkeys(['connections', 'reused'], 0)
+
+  def Counters(self):
+    """Returns how many connections were opened and how many were reused."""
+    with self._lock:
+      return dict(self._counters)
+
+  def Version(self):
+    """Returns the adb server's protocol version."""
+    return int(self._HostRequest('host:version'), 16)
+
+  def Connect(self, address):
+    """Connects the adb server to address (host:port), returns its message."""
+    return self._HostRequest('host:connect:%s' % address)
+
+  def Features(self, serial):
+    """Returns the features shared by the adb server and the device."""
+    with self._lock:
+      features = self._features.get(serial)
+    if features is None:
+      features = frozenset(
+          self._HostRequest('host-serial:%s:features' % serial).split(','))
+      with self._lock:
+        self._features[serial] = features
+    return features
+
+  def Shell(self, serial, command, timeout_seconds=None):
+    """Runs command on the device, with stdin closed.
+
+    Args:
+      serial: the device serial.
+      command: the shell command line.
+      timeout_seconds: [optional] how long to wait for output, defaults to
+        the client's timeout.
+
+    Returns:
+      (exit status, stdout, stderr). Without the shell_v2 feature stderr is
+      merged into stdout and the exit status is always 0.
+
+    Raises:
+      AdbError: if the command failed to run or to complete.
+    """
+    shell_v2 = 'shell_v2' in self.Features(serial)
+    sock = self._Transport(serial, timeout_seconds)
+    try:
+      if shell_v2:
+        self._Request(sock, 'shell,v2,raw:%s' % command)
+        sock.sendall(struct.pack('<BI', _SHELL_CLOSE_STDIN, 0))
+        return self._ReadShellPackets(sock)
+      self._Request(sock, 'shell:%s' % command)
+      return 0, self._ReadToEnd(sock), b''
+    except socket.error as e:
+      raise AdbError('shell %r: %s' % (command, e), sent=True)
+    finally:
+      sock.close()
+
+  def Push(self, serial, local_path, device_path, mode=None):
+    """Copies local_path to device_path on the device.
+
+    Args:
+      serial: the device serial.
+      local_path: the file to copy.
+      device_path: the absolute path of the copy on the device.
+      mode: [optional] permission bits of the copy, defaults to those of
+        local_path.
+
+    Raises:
+      AdbError: if the copy failed.
+    """
+    st = os.stat(local_path)
+    if mode is None:
+      mode = stat.S_IMODE(st.st_mode)
+    header = _Bytes('%s,%d' % (device_path, stat.S_IFREG | mode))
+
+    def _Send(sock):
+      _SyncRequest(sock, b'SEND', header)
+      with open(local_path, 'rb') as f:
+        while True:
+          chunk = f.read(_SYNC_DATA_MAX)
+          if not chunk:
+            break
+          _SyncRequest(sock, b'DATA', chunk)
+      sock.sendall(b'DONE' + struct.pack('<I', int(st.st_mtime)))
+      response, length = _ReadSyncHeader(sock)
+      if response == _FAIL:
+        raise AdbError('push %s: %s' % (device_path,
+                                        _Text(_ReadExactly(sock, length))))
+      if response != _OKAY:
+        raise AdbError('push %s: unexpected %r' % (device_path, response))
+
+    self._Sync(serial, _Send)
+
+  def Pull(self, serial, device_path, local_path):
+    """Copies device_path on the device to local_path.
+
+    Raises:
+      AdbError: if the copy failed.
+    """
+
+    def _Receive(sock):
+      _SyncRequest(sock, b'RECV', _Bytes(device_path))
+      tmp_path = '%s.%d.tmp' % (local_path, os.getpid())
+      try:
+        with open(tmp_path, 'wb') as f:
+          while True:
+            response, length = _ReadSyncHeader(sock)
+            if response == b'DONE':
+              break
+            data = _ReadExactly(sock, length)
+            if response == _FAIL:
+              raise AdbError('pull %s: %s' % (device_path, _Text(data)))
+            if response != b'DATA':
+              raise AdbError('pull %s: unexpected %r' % (device_path,
+                                                         response))
+            f.write(data)
+        os.rename(tmp_path, local_path)
+      finally:
+        if os.path.exists(tmp_path):
+          os.unlink(tmp_path)
+
+    self._Sync(serial, _Receive)
+
+  def Close(self):
+    """Closes the pooled connections."""
+    with self._lock:
+      idle = [s for socks in self._idle_sync.values() for s in socks]
+      self._idle_sync.clear()
+    for sock in idle:
+      _Quit(sock)
+
+  def _Sync(self, serial, transfer):
+    """Runs transfer(sock) on a sync connection to the device.
+
+    A pooled connection may have gone stale (e.g. adbd restarted), the
+    transfer is then retried once on a new one.
+    """
+    with self._lock:
+      idle = self._idle_sync[serial]
+      sock = idle.pop() if idle else None
+      if sock:
+        self._counters['reused'] += 1
+    if sock:
+      try:
+        transfer(sock)
+      except (AdbError, socket.error):
+        sock.close()
+        sock = None
+    if not sock:
+      sock = self._Transport(serial)
+      try:
+        self._Request(sock, 'sync:')
+        transfer(sock)
+      except socket.error as e:
+        sock.close()
+        raise AdbError('sync with %s: %s' % (serial, e), sent=True)
+      except AdbError:
+        sock.close()
+        raise
+    with self._lock:
+      idle = self._idle_sync[serial]
+      if len(idle) < self._max_idle_per_device:
+        idle.append(sock)
+        return
+    _Quit(sock)
+
+  def _Open(self, timeout_seconds=None):
+    try:
+      sock = socket.create_connection(
+          self._address, timeout_seconds or self._timeout_seconds)
+    except socket.error as e:
+      raise AdbUnavailableError('cannot connect to adb server at %s:%d: %s' %
+                                (self._address + (e,)))
+    with self._lock:
+      self._counters['connections'] += 1
+    return sock
+
+  def _HostRequest(self, request):
+    """Sends a host request and returns its (length prefixed) reply."""
+    sock = self._Open()
+    try:
+      self._Request(sock, request)
+      return _Text(_ReadExactly(sock, int(_ReadExactly(sock, 4), 16)))
+    except socket.error as e:
+      raise AdbError('%s: %s' % (request, e))
+    finally:
+      sock.close()
+
+  def _Transport(self, serial, timeout_seconds=None):
+    """Returns a connection routed to the device."""
+    sock = self._Open(timeout_seconds)
+    try:
+      self._Request(sock, 'host:transport:%s' % serial)
+    except socket.error as e:
+      sock.close()
+      raise AdbError('transport to %s: %s' % (serial, e))
+    except AdbError:
+      sock.close()
+      raise
+    return sock
+
+  def _Request(self, sock, request):
+    """Sends request and raises AdbError if the server fails it."""
+    request = _Bytes(request)
+    sock.sendall(_Bytes('%04x' % len(request)) + request)
+    status = _ReadExactly(sock, 4)
+    if status == _OKAY:
+      return
+    if status == _FAIL:
+      message = _ReadExactly(sock, int(_ReadExactly(sock, 4), 16))
+      raise AdbError('%s: %s' % (_Text(request), _Text(message)))
+    raise AdbError('%s: unexpected status %r' % (_Text(request), status))
+
+  def _ReadToEnd(self, sock):
+    chunks = []
+    while True:
+      chunk = sock.recv(_READ_SIZE)
+      if not chunk:
+        return b''.join(chunks)
+      chunks.append(chunk)
+
+  def _ReadShellPackets(self, sock):
+    out = []
+    err = []
+    while True:
+      packet_id, length = struct.unpack('<BI', _ReadExactly(sock, 5))
+      data = _ReadExactly(sock, length)
+      if packet_id == _SHELL_STDOUT:
+        out.append(data)
+      elif packet_id == _SHELL_STDERR:
+        err.append(data)
+      elif packet_id == _SHELL_EXIT:
+        return ord(data[:1]), b''.join(out), b''.join(err)
+
+
+def _ReadExactly(sock, length):
+  data = b''
+  while len(data) < length:
+    chunk = sock.recv(length - len(data))
+    if not chunk:
+      raise socket.error('connection closed by the adb server')
+    data += chunk
+  return data
+
+
+def _SyncRequest(sock, request_id, data):
+  sock.sendall(request_id + struct.pack('<I', len(data)) + data)
+
+
+def _ReadSyncHeader(sock):
+  header = _ReadExactly(sock, 8)
+  return header[:4], struct.unpack('<I', header[4:])[0]
+
+
+def _Quit(sock):
+  try:
+    _SyncRequest(sock, b'QUIT', b'')
+  except socket.error:
+    pass
+  sock.close()
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def GetAdbClient(port):
+  """Returns the process wide AdbClient for the adb server at port."""
+  with _clients_lock:
+    client = _clients.get(port)
+    # pooled connections are not shared with forked children.
+    if client is None or client.owner_pid != os.getpid():
+      client = AdbClient(port)
+      _clients[port] = client
+    return client
@@ -0,0 +1,284 @@
+# Copyright 2018 The Android Open Source Project. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for tools.android.emulator.adb_client.
+
+A stand-in adb server runs shell commands with the host's sh and keeps the
+device's files under a temporary directory.
+"""
+
+import os
+import shutil
+import socket
+import struct
+import subprocess
+import tempfile
+import threading
+
+from google.apputils import basetest as googletest
+from tools.android.emulator import adb_client
+
+SERIAL = 'localhost:5555'
+
+
+def _ReadExactly(conn, length):
+  data = b''
+  while len(data) < length:
+    chunk = conn.recv(length - len(data))
+    if not chunk:
+      raise EOFError()
+    data += chunk
+  return data
+
+
+def _Okay(conn, reply=None):
+  conn.sendall(b'OKAY')
+  if reply is not None:
+    conn.sendall(('%04x%s' % (len(reply), reply)).encode('ascii'))
+
+
+def _Fail(conn, message):
+  conn.sendall(('FAIL%04x%s' % (len(message), message)).encode('ascii'))
+
+
+class FakeAdbServer(object):
+  """Serves the host, shell and sync requests of an adb server."""
+
+  def __init__(self, root, features='shell_v2,cmd'):
+    self.root = root
+    self.features = features
+    # like adbd restarting, sync connections end after a transfer.
+    self.drop_sync = False
+    self.requests = []
+    self._listener = socket.socket()
+    self._listener.bind(('127.0.0.1', 0))
+    self._listener.listen(8)
+    self.port = self._listener.getsockname()[1]
+    self._accept_thread = threading.Thread(target=self._Accept)
+    self._accept_thread.daemon = True
+    self._accept_thread.start()
+
+  def Close(self):
+    """Stops accepting connections, the port is refused once it returns."""
+    try:
+      # wakes up the accept() close alone may leave blocked.
+      self._listener.shutdown(socket.SHUT_RDWR)
+    except (socket.error, OSError):
+      pass  # closed already.
+    self._listener.close()
+    self._accept_thread.join()
+
+  def _Accept(self):
+    while True:
+      try:
+        conn, _ = self._listener.accept()
+      except (socket.error, OSError):
+        return
+      thread = threading.Thread(target=self._Serve, args=(conn,))
+      thread.daemon = True
+      thread.start()
+
+  def _ReadRequest(self, conn):
+    request = _ReadExactly(conn, int(_ReadExactly(conn, 4), 16))
+    request = request.decode('utf-8')
+    self.requests.append(request)
+    return request
+
+  def _Serve(self, conn):
+    try:
+      request = self._ReadRequest(conn)
+      if request == 'host:version':
+        _Okay(conn, '0029')
+      elif request.startswith('host:connect:'):
+        _Okay(conn, 'connected to %s' % request[len('host:connect:'):])
+      elif request == 'host-serial:%s:features' % SERIAL:
+        _Okay(conn, self.features)
+      elif request == 'host:transport:%s' % SERIAL:
+        _Okay(conn)
+        self._ServeDevice(conn, self._ReadRequest(conn))
+      else:
+        _Fail(conn, 'device \'%s\' not found' % request.split(':')[-1])
+    except EOFError:
+      pass
+    finally:
+      conn.close()
+
+  def _ServeDevice(self, conn, request):
+    if request.startswith('shell,v2,raw:') and 'shell_v2' in self.features:
+      _Okay(conn)
+      # the close stdin packet.
+      _ReadExactly(conn, 5)
+      proc = subprocess.Popen(['/bin/sh', '-c', request.split(':', 1)[1]],
+                              stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                              stderr=subprocess.PIPE)
+      out, err = proc.communicate()
+      for packet_id, data in ((1, out), (2, err),
+                              (3, struct.pack('B', proc.returncode))):
+        conn.sendall(struct.pack('<BI', packet_id, len(data)) + data)
+    elif request.startswith('shell:'):
+      _Okay(conn)
+      proc = subprocess.Popen(['/bin/sh', '-c', request.split(':', 1)[1]],
+                              stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                              stderr=subprocess.STDOUT)
+      conn.sendall(proc.communicate()[0])
+    elif request == 'sync:':
+      _Okay(conn)
+      self._ServeSync(conn)
+    else:
+      _Fail(conn, 'closed')
+
+  def _ServeSync(self, conn):
+    while True:
+      header = _ReadExactly(conn, 8)
+      request, length = header[:4], struct.unpack('<I', header[4:])[0]
+      data = _ReadExactly(conn, length)
+      self.requests.append(request.decode('ascii'))
+      if request == b'QUIT':
+        return
+      if request == b'SEND':
+        path, mode = data.decode('utf-8').rsplit(',', 1)
+        chunks = []
+        while True:
+          header = _ReadExactly(conn, 8)
+          if header[:4] == b'DONE':
+            break
+          chunks.append(_ReadExactly(conn, struct.unpack('<I', header[4:])[0]))
+        if not os.path.isdir(os.path.dirname(self.root + path)):
+          message = b'secure_mkdirs failed'
+          conn.sendall(b'FAIL' + struct.pack('<I', len(message)) + message)
+          return
+        with open(self.root + path, 'wb') as f:
+          f.write(b''.join(chunks))
+        os.chmod(self.root + path, int(mode) & 0o7777)
+        conn.sendall(b'OKAY' + struct.pack('<I', 0))
+        if self.drop_sync:
+          return
+      elif request == b'RECV':
+        path = self.root + data.decode('utf-8')
+        if not os.path.exists(path):
+          message = b'No such file or directory'
+          conn.sendall(b'FAIL' + struct.pack('<I', len(message)) + message)
+          return
+        with open(path, 'rb') as f:
+          content = f.read()
+        for i in range(0, len(content), 1000):
+          chunk = content[i:i + 1000]
+          conn.sendall(b'DATA' + struct.pack('<I', len(chunk)) + chunk)
+        conn.sendall(b'DONE' + struct.pack('<I', 0))
+
+
+class AdbClientTest(googletest.TestCase):
+
+  def setUp(self):
+    super(AdbClientTest, self).setUp()
+    self.tmp_dir = tempfile.mkdtemp()
+    self.root = os.path.join(self.tmp_dir, 'device')
+    os.makedirs(os.path.join(self.root, 'data', 'local', 'tmp'))
+    self.server = FakeAdbServer(self.root)
+    self.client = adb_client.AdbClient(self.server.port, timeout_seconds=10)
+
+  def tearDown(self):
+    super(AdbClientTest, self).tearDown()
+    self.client.Close()
+    self.server.Close()
+    shutil.rmtree(self.tmp_dir)
+
+  def testHostRequests(self):
+    self.assertEquals(41, self.client.Version())
+    self.assertEquals('connected to localhost:5556',
+                      self.client.Connect('localhost:5556'))
+    self.assertEquals(frozenset(['shell_v2', 'cmd']),
+                      self.client.Features(SERIAL))
+
+  def testShell(self):
+    self.assertEquals((0, b'hello\n', b''),
+                      self.client.Shell(SERIAL, 'echo hello'))
+    self.assertEquals((3, b'out', b'err\n'),
+                      self.client.Shell(SERIAL, 'printf out; echo err >&2; '
+                                        'exit 3'))
+    # the features are asked once per device.
+    self.assertEquals(1, self.server.requests.count(
+        'host-serial:%s:features' % SERIAL))
+
+  def testShell_withoutShellV2(self):
+    self.server.features = 'cmd'
+    self.assertEquals((0, b'out\nerr\n', b''),
+                      self.client.Shell(SERIAL, 'echo out; echo err >&2; '
+                                        'exit 3'))
+    self.assertIn('shell:echo out; echo err >&2; exit 3', self.server.requests)
+
+  def testUnknownDevice(self):
+    try:
+      self.client.Shell('localhost:1', 'true')
+      self.fail('expected AdbError')
+    except adb_client.AdbError as e:
+      self.assertFalse(e.sent)
+      self.assertIn('not found', str(e))
+
+  def testServerNotRunning(self):
+    self.server.Close()
+    self.assertRaises(adb_client.AdbUnavailableError,
+                      adb_client.AdbClient(self.server.port).Version)
+
+  def testPushAndPull(self):
+    local = os.path.join(self.tmp_dir, 'local')
+    content = os.urandom(200 << 10)
+    with open(local, 'wb') as f:
+      f.write(content)
+    os.chmod(local, 0o750)
+    self.client.Push(SERIAL, local, '/data/local/tmp/pushed')
+    pushed = os.path.join(self.root, 'data', 'local', 'tmp', 'pushed')
+    with open(pushed, 'rb') as f:
+      self.assertEquals(content, f.read())
+    self.assertEquals(0o750, os.stat(pushed).st_mode & 0o777)
+
+    pulled = os.path.join(self.tmp_dir, 'pulled')
+    self.client.Pull(SERIAL, '/data/local/tmp/pushed', pulled)
+    with open(pulled, 'rb') as f:
+      self.assertEquals(content, f.read())
+
+    # both transfers used one sync connection.
+    self.assertEquals(1, self.server.requests.count('sync:'))
+    self.assertEquals(1, self.client.Counters()['reused'])
+
+  def testSyncFailures(self):
+    local = os.path.join(self.tmp_dir, 'local')
+    with open(local, 'wb') as f:
+      f.write(b'x')
+    self.assertRaises(adb_client.AdbError, self.client.Push, SERIAL, local,
+                      '/no/such/dir/file')
+    pulled = os.path.join(self.tmp_dir, 'pulled')
+    self.assertRaises(adb_client.AdbError, self.client.Pull, SERIAL,
+                      '/data/missing', pulled)
+    self.assertFalse(os.path.exists(pulled))
+    self.assertEquals(['device', 'local'], sorted(os.listdir(self.tmp_dir)))
+    # the failed connections were not pooled.
+    self.client.Push(SERIAL, local, '/data/local/tmp/x')
+    self.assertEquals(3, self.server.requests.count('sync:'))
+
+  def testStalePooledConnection(self):
+    self.server.drop_sync = True
+    local = os.path.join(self.tmp_dir, 'local')
+    for content in (b'first', b'second'):
+      with open(local, 'wb') as f:
+        f.write(content)
+      self.client.Push(SERIAL, local, '/data/local/tmp/x')
+      with open(os.path.join(self.root, 'data/local/tmp/x'), 'rb') as f:
+        self.assertEquals(content, f.read())
+    self.assertEquals(2, self.server.requests.count('sync:'))
+    self.assertEquals(1, self.client.Counters()['reused'])
+
+
+if __name__ == '__main__':
+  googletest.main()
@@ -0,0 +1,289 @@
+# Copyright 2018 The Android Open Source Project. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A long lived adb shell which runs one command after another.
+
+Rather than starting `adb shell <command>` per command (a fork and exec on the
+host and a new connection to adbd), commands are written to the stdin of one
+`adb shell`. Each command runs in its own `sh -c`, with its stderr in a file
+on the device, and is followed by unique sentinels:
+
+  <stdout>\\n<sentinel> <exit status>\\n<stderr>\\n<sentinel>_END\\n
+
+The sentinels are written as two quoted halves, so an echo of the input (a
+pty) never looks like one. Start() checks that the channel is clean (no echo,
+no CR LF translation, a writable stderr file) and raises ShellSessionError if
+not, callers then fall back to one-shot `adb shell <command>`. They do the
+same when Run() raises a ShellSessionError for a command that was not sent
+(or could not run), e.g. because adbd restarted.
+
+RunBatch() writes the lines of several commands at once, so a batch costs a
+single round trip to the device rather than one per command.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import errno
+import os
+import random
+import select
+import subprocess
+import threading
+import time
+
+from tools.android.emulator import process_backend
+
+_SENTINEL_PREFIX = '__ADBSH_'
+_READ_SIZE = 64 << 10
+_NOT_RUN = b'not_run'
+_SKIPPED = b'skipped'
+_SKIP_VAR = '__adbsh_skip'
+
+
+class ShellSessionError(Exception):
+  """The session is unusable.
+
+  Attributes:
+    sent: whether the command had been sent, and so may have run.
+    output: the output received before the session broke.
+    results: for RunBatch, the results of the commands which completed before
+      the one which failed. Those after it did not run.
+  """
+
+  def __init__(self, message, sent=False, output=b'', results=None):
+    super(ShellSessionError, self).__init__(message)
+    self.sent = sent
+    self.output = output
+    self.results = results or []
+
+
+def _Quote(command):
+  return "'" + command.replace("'", "'\\''") + "'"
+
+
+class ShellSession(object):
+  """An `adb shell` kept open to run commands.
+
+  Run() is not reentrant, lock serializes the callers which share a session.
+  """
+
+  def __init__(self, adb, serial, env=None,
+               tmp_dir='/data/local/tmp', start_timeout_seconds=10):
+    self.lock = threading.Lock()
+    self.owner_pid = os.getpid()
+    self._args = [adb, '-s', serial, 'shell']
+    self._env = env
+    self._start_timeout_seconds = start_timeout_seconds
+    self._token = '%s_%08x' % (os.getpid(), random.getrandbits(32))
+    self._stderr_file = '%s/.adbsh_%s' % (tmp_dir, self._token)
+    self._sequence = 0
+    self._proc = None
+    self._buffer = b''
+    self.commands = 0
+
+  @property
+  def alive(self):
+    return self._proc is not None and self._proc.poll() is None
+
+  def Start(self):
+    """Starts adb shell and checks the channel is usable.
+
+    Raises:
+      ShellSessionError: if the shell cannot be used for framed commands.
+    """
+    try:
+      self._proc = process_backend.Popen(
+          self._args, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+          stderr=subprocess.STDOUT, env=self._env, close_fds=True)
+    except OSError as e:
+      raise ShellSessionError('cannot start %s: %s' % (self._args, e))
+    try:
+      returncode, out, err = self.Run('true', self._start_timeout_seconds)
+    except ShellSessionError:
+      self.Close()
+      raise
+    if returncode or out or err:
+      self.Close()
+      raise ShellSessionError('unclean channel: exit %s out %r err %r' % (
+          returncode, out, err))
+
+  def Run(self, command, timeout_seconds=None):
+    """Runs command (a shell command line) on the device.
+
+    Args:
+      command: the command line, run by sh -c with stdin from /dev/null.
+      timeout_seconds: [optional] how long to wait for the command.
+
+    Returns:
+      (exit status, stdout, stderr) of the command.
+
+    Raises:
+      ShellSessionError: if the session broke or timed out, it is closed.
+    """
+    return self.RunBatch([command], timeout_seconds=timeout_seconds)[0]
+
+  def RunBatch(self, commands, fail_fast=False, timeout_seconds=None):
+    """Runs commands one after another, sent to the device in one write.
+
+    Args:
+      commands: the command lines, each run by sh -c with stdin from
+        /dev/null.
+      fail_fast: if set, the commands after the first one to fail are skipped.
+      timeout_seconds: [optional] how long to wait for all the commands.
+
+    Returns:
+      A list with (exit status, stdout, stderr) of each command, or None for
+      those skipped.
+
+    Raises:
+      ShellSessionError: if the session broke or timed out, it is closed. Its
+        results holds those of the commands which completed before.
+    """
+    if not self.alive:
+      raise ShellSessionError('session is not running')
+    sentinels = []
+    lines = ['%s=0\n' % _SKIP_VAR]
+    for command in commands:
+      self._sequence += 1
+      sentinel = '%s%s_%d' % (_SENTINEL_PREFIX, self._token, self._sequence)
+      sentinels.append(sentinel)
+      lines.append(self._Frame(command, sentinel, fail_fast))
+    data = ''.join(lines)
+    if not isinstance(data, bytes):
+      data = data.encode('utf-8')
+    try:
+      self._proc.stdin.write(data)
+      self._proc.stdin.flush()
+    except (IOError, OSError) as e:
+      self.Close()
+      raise ShellSessionError('cannot send command: %s' % e)
+    self.commands += len(commands)
+
+    deadline = None
+    if timeout_seconds is not None:
+      deadline = time.time() + timeout_seconds
+    results = []
+    for sentinel in sentinels:
+      status_marker = ('\n%s ' % sentinel).encode('ascii')
+      end_marker = ('\n%s_END\n' % sentinel).encode('ascii')
+      try:
+        out, status = self._ReadUntil(status_marker, deadline)
+        err, _ = self._ReadUntil(end_marker, deadline)
+      except ShellSessionError as e:
+        e.results = results
+        raise
+      if status == _SKIPPED:
+        results.append(None)
+        continue
+      if status == _NOT_RUN:
+        self.Close()
+        raise ShellSessionError('cannot write %s' % self._stderr_file,
+                                results=results)
+      try:
+        results.append((int(status), out, err))
+      except ValueError:
+        self.Close()
+        raise ShellSessionError('bad exit status %r' % status, sent=True,
+                                output=out, results=results)
+    return results
+
+  def _Frame(self, command, sentinel, fail_fast):
+    """Returns the line which runs command and frames its output."""
+    # "a""b" is echoed as written, but prints as ab.
+    split = '"%s""%s"' % (sentinel[:len(_SENTINEL_PREFIX)],
+                          sentinel[len(_SENTINEL_PREFIX):])
+    # The command only runs if its stderr file can be written (/data may be
+    # read only or unmounted), its status is then not_run and the rest of the
+    # batch is skipped. The check uses `true`, a failed redirection of the
+    # special builtin `:` would end sh.
+    on_failure = ''
+    if fail_fast:
+      on_failure = '[ "$r" = 0 ] || %s=1; ' % _SKIP_VAR
+    return ('if [ "$%s" = 1 ]; then r=skipped; '
+            'elif { true >%s; } 2>/dev/null; then '
+            'sh -c %s </dev/null 2>%s; r=$?; else r=not_run; %s=1; fi; %s'
+            'echo; echo %s" $r"; cat %s 2>/dev/null; rm -f %s; '
+            'echo; echo %s"_END"\n' % (
+                _SKIP_VAR, self._stderr_file, _Quote(command),
+                self._stderr_file, _SKIP_VAR, on_failure, split,
+                self._stderr_file, self._stderr_file, split))
+
+  def _ReadUntil(self, marker, deadline):
+    """Reads up to marker, and the rest of its line if it has no newline.
+
+    Anything read beyond stays in the buffer for the next call.
+
+    Args:
+      marker: the bytes to wait for.
+      deadline: [optional] the time.time() to give up at.
+
+    Returns:
+      (the bytes before marker, the rest of the marker's line).
+
+    Raises:
+      ShellSessionError: on EOF or timeout.
+    """
+    fd = self._proc.stdout.fileno()
+    while True:
+      index = self._buffer.find(marker)
+      if index >= 0:
+        before = self._buffer[:index]
+        after = self._buffer[index + len(marker):]
+        if marker.endswith(b'\n'):
+          self._buffer = after
+          return before, b''
+        if b'\n' in after:
+          rest_of_line, self._buffer = after.split(b'\n', 1)
+          return before, rest_of_line
+      timeout = None
+      if deadline is not None:
+        timeout = deadline - time.time()
+        if timeout <= 0:
+          output = self._buffer
+          self.Close()
+          raise ShellSessionError('timed out', sent=True, output=output)
+      try:
+        readable, _, _ = select.select([fd], [], [], timeout)
+      except (IOError, OSError, select.error) as e:
+        if e.args[0] == errno.EINTR:
+          continue
+        raise
+      if not readable:
+        continue
+      chunk = os.read(fd, _READ_SIZE)
+      if not chunk:
+        output = self._buffer
+        self.Close()
+        raise ShellSessionError('adb shell exited', sent=True, output=output)
+      self._buffer += chunk
+
+  def Close(self):
+    """Ends the shell, the next Run raises ShellSessionError."""
+    proc, self._proc = self._proc, None
+    self._buffer = b''
+    if not proc:
+      return
+    for f in (proc.stdin, proc.stdout):
+      try:
+        f.close()
+      except (IOError, OSError):
+        pass
+    if proc.poll() is None:
+      try:
+        proc.kill()
+      except OSError:
+        pass
+    proc.wait()
@@ -0,0 +1,172 @@
+# Copyright 2018 The Android Open Source Project. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for tools.android.emulator.adb_shell_session.
+
+A fake adb runs a host shell in place of the device's.
+"""
+
+import os
+import shutil
+import stat
+import tempfile
+
+from google.apputils import basetest as googletest
+from tools.android.emulator import adb_shell_session
+
+
+class ShellSessionTest(googletest.TestCase):
+
+  def setUp(self):
+    super(ShellSessionTest, self).setUp()
+    self.tmp_dir = tempfile.mkdtemp()
+    self.adb = self._FakeAdb('shift 3\nexec /bin/sh "$@"\n')
+
+  def tearDown(self):
+    super(ShellSessionTest, self).tearDown()
+    shutil.rmtree(self.tmp_dir)
+
+  def _FakeAdb(self, script):
+    path = os.path.join(self.tmp_dir, 'adb_%d' % len(os.listdir(self.tmp_dir)))
+    with open(path, 'w') as f:
+      f.write('#!/bin/sh\n' + script)
+    os.chmod(path, stat.S_IRWXU)
+    return path
+
+  def _Session(self, adb=None):
+    session = adb_shell_session.ShellSession(adb or self.adb, 'localhost:1234',
+                                             tmp_dir=self.tmp_dir)
+    session.Start()
+    self.addCleanup(session.Close)
+    return session
+
+  def testRun(self):
+    session = self._Session()
+    self.assertEquals((0, b'hello\n', b''), session.Run('echo hello'))
+    self.assertEquals((3, b'out', b'err\n'),
+                      session.Run("printf out; echo err >&2; exit 3"))
+    self.assertEquals((0, b"it's\n", b''), session.Run("echo \"it's\""))
+    self.assertEquals((0, b'', b''), session.Run('true'))
+    self.assertEquals(5, session.commands)
+    # stderr files are cleaned up.
+    self.assertEquals(['adb_0'], os.listdir(self.tmp_dir))
+
+  def testLargeOutput(self):
+    session = self._Session()
+    returncode, out, _ = session.Run('seq 1 100000')
+    self.assertEquals(0, returncode)
+    self.assertTrue(out.endswith(b'\n99999\n100000\n'))
+
+  def testSyntaxErrorKeepsSession(self):
+    session = self._Session()
+    returncode, _, err = session.Run('echo (')
+    self.assertNotEqual(0, returncode)
+    self.assertTrue(err)
+    self.assertEquals((0, b'ok\n', b''), session.Run('echo ok'))
+
+  def testShellDiesDuringCommand(self):
+    session = self._Session()
+    try:
+      session.Run('echo partial; kill -9 $PPID')
+      self.fail('expected ShellSessionError')
+    except adb_shell_session.ShellSessionError as e:
+      self.assertTrue(e.sent)
+      self.assertEquals(b'partial\n', e.output)
+    self.assertFalse(session.alive)
+    try:
+      session.Run('true')
+      self.fail('expected ShellSessionError')
+    except adb_shell_session.ShellSessionError as e:
+      self.assertFalse(e.sent)
+
+  def testTimeout(self):
+    session = self._Session()
+    self.assertRaises(adb_shell_session.ShellSessionError, session.Run,
+                      'sleep 5', 0.2)
+    self.assertFalse(session.alive)
+
+  def testUnusableChannels(self):
+    for script in ['exec /bin/echo "$@"\n',
+                   # echoes its input, like a pty.
+                   'exec tee /dev/stderr | /bin/sh\n',
+                   'exit 1\n']:
+      self.assertRaises(adb_shell_session.ShellSessionError, self._Session,
+                        self._FakeAdb(script))
+
+  def testRunBatch(self):
+    session = self._Session()
+    self.assertEquals(
+        [(0, b'a\n', b''), (1, b'', b'b\n'), (0, b'c\n', b'')],
+        session.RunBatch(['echo a', 'echo b >&2; false', 'echo c']))
+    self.assertEquals([], session.RunBatch([]))
+    self.assertEquals((0, b'd\n', b''), session.Run('echo d'))
+    self.assertEquals(5, session.commands)
+
+  def testRunBatch_failFast(self):
+    session = self._Session()
+    ran = os.path.join(self.tmp_dir, 'ran')
+    self.assertEquals(
+        [(0, b'a\n', b''), (2, b'', b''), None],
+        session.RunBatch(['echo a', 'exit 2', 'touch %s' % ran],
+                         fail_fast=True))
+    self.assertFalse(os.path.exists(ran))
+    # the next batch starts afresh.
+    self.assertEquals([(0, b'e\n', b'')],
+                      session.RunBatch(['echo e'], fail_fast=True))
+
+  def testRunBatch_unwritableTmpDirMidway(self):
+    stderr_dir = os.path.join(self.tmp_dir, 'data')
+    os.mkdir(stderr_dir)
+    session = adb_shell_session.ShellSession(self.adb, 'localhost:1234',
+                                             tmp_dir=stderr_dir)
+    session.Start()
+    ran = os.path.join(self.tmp_dir, 'ran')
+    try:
+      session.RunBatch(['echo a', 'rm -rf %s' % stderr_dir, 'echo b',
+                        'mkdir %s; touch %s' % (stderr_dir, ran)])
+      self.fail('expected ShellSessionError')
+    except adb_shell_session.ShellSessionError as e:
+      self.assertFalse(e.sent)
+      self.assertEquals([(0, b'a\n', b''), (0, b'', b'')], e.results)
+    self.assertFalse(session.alive)
+    self.assertFalse(os.path.exists(ran))
+
+  def testRunBatch_shellDies(self):
+    session = self._Session()
+    try:
+      session.RunBatch(['echo a', 'echo partial; kill -9 $PPID', 'echo c'])
+      self.fail('expected ShellSessionError')
+    except adb_shell_session.ShellSessionError as e:
+      self.assertTrue(e.sent)
+      self.assertEquals(b'partial\n', e.output)
+      self.assertEquals([(0, b'a\n', b'')], e.results)
+
+  def testUnwritableTmpDir(self):
+    stderr_dir = os.path.join(self.tmp_dir, 'data')
+    os.mkdir(stderr_dir)
+    session = adb_shell_session.ShellSession(self.adb, 'localhost:1234',
+                                             tmp_dir=stderr_dir)
+    session.Start()
+    # like /data being unmounted.
+    os.rmdir(stderr_dir)
+    try:
+      session.Run('touch %s/ran' % self.tmp_dir)
+      self.fail('expected ShellSessionError')
+    except adb_shell_session.ShellSessionError as e:
+      self.assertFalse(e.sent)
+    self.assertFalse(os.path.exists(os.path.join(self.tmp_dir, 'ran')))
+
+
+if __name__ == '__main__':
+  googletest.main()
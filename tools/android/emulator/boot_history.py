@@ -0,0 +1,258 @@
+# Copyright 2018 The Android Open Source Project. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""How long the boot steps took before, and polling paced by it.
+
+StepHistory is a small json file of the durations of every boot step (by its
+stopwatch tag), per boot kind: system image, api level, boot mode and host
+class. Only the most recent samples of each step are kept:
+
+  {"version": 1,
+   "boots": {"<boot kind>": {"SYS_SERVER_CHECK": [2.1, 1.9, ...], ...}}}
+
+AdaptivePoller replaces the fixed sleep between the attempts of a step. With
+enough samples it sleeps through the part of the step which has never been
+fast enough, polls densely from just before the fastest tenth of past steps up
+to the slowest tenth, and backs off after that:
+
+  |-- one long sleep --|-- dense polls --|-- base, 2*base, ... 4*base --|
+  0              p10 - base             p90
+
+Without history every sleep is the base interval, as before. Stats() compares
+the polls made with a fixed interval poll of the same steps.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import contextlib
+import fcntl
+import json
+import multiprocessing
+import os
+import platform
+import tempfile
+import threading
+import time
+
+from absl import logging
+
+_VERSION = 1
+
+
+def BootKind(system_image, api_level, boot_mode, with_kvm):
+  """Returns the history key of a boot.
+
+  Args:
+    system_image: names the system image, e.g. its directory.
+    api_level: the image's api level.
+    boot_mode: e.g. 'cold' or 'snapshot'.
+    with_kvm: whether the emulator is accelerated.
+  """
+  host_class = '%s-%dcpu-%s' % (platform.machine(),
+                                multiprocessing.cpu_count(),
+                                'kvm' if with_kvm else 'tcg')
+  return '%s/api%s/%s/%s' % (system_image, api_level, boot_mode, host_class)
+
+
+def _Percentile(samples, fraction):
+  ordered = sorted(samples)
+  return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class StepHistory(object):
+  """The durations of past boot steps, loaded from and merged into path."""
+
+  def __init__(self, path, max_samples=20):
+    self._path = path
+    self._max_samples = max_samples
+    self._lock = threading.Lock()
+    self._boots = self._Read()
+    self._new = {}
+
+  def _Read(self):
+    try:
+      with open(self._path) as f:
+        data = json.load(f)
+    except (IOError, OSError, ValueError):
+      return {}
+    if not isinstance(data, dict) or data.get('version') != _VERSION:
+      return {}
+    return data.get('boots') or {}
+
+  def Samples(self, boot_kind, step):
+    """Returns the recorded durations of step, oldest first."""
+    with self._lock:
+      return (list(self._boots.get(boot_kind, {}).get(step, ())) +
+              list(self._new.get(boot_kind, {}).get(step, ())))
+
+  def Record(self, boot_kind, step, seconds):
+    """Adds a duration, kept in memory until Save."""
+    with self._lock:
+      self._new.setdefault(boot_kind, {}).setdefault(step, []).append(
+          round(seconds, 3))
+
+  @contextlib.contextmanager
+  def _Locked(self):
+    fd = os.open(self._path + '.lock', os.O_WRONLY | os.O_CREAT, 0o644)
+    try:
+      fcntl.flock(fd, fcntl.LOCK_EX)
+      yield
+    finally:
+      os.close(fd)
+
+  def Save(self):
+    """Merges the recorded durations into the file, returns whether it could.
+
+    Other boots may have saved in the meantime, so the file is read again under
+    a lock and replaced atomically.
+    """
+    with self._lock:
+      new, self._new = self._new, {}
+    if not new:
+      return True
+    try:
+      directory = os.path.dirname(self._path)
+      if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+      with self._Locked():
+        boots = self._Read()
+        for boot_kind, steps in new.items():
+          for step, samples in steps.items():
+            kept = boots.setdefault(boot_kind, {}).setdefault(step, [])
+            kept.extend(samples)
+            del kept[:-self._max_samples]
+        fd, tmp_path = tempfile.mkstemp(dir=directory or '.',
+                                        prefix='.boot_history')
+        with os.fdopen(fd, 'w') as f:
+          json.dump({'version': _VERSION, 'boots': boots}, f, sort_keys=True)
+        os.rename(tmp_path, self._path)
+    except (IOError, OSError) as e:
+      logging.warning('Cannot save the boot history to %s: %s', self._path, e)
+      return False
+    with self._lock:
+      self._boots = boots
+    return True
+
+
+class _Step(object):
+
+  def __init__(self, start_time):
+    self.start_time = start_time
+    self.polls = 0
+    self.late_polls = 0
+    self.last_sleep = None
+
+
+class AdaptivePoller(object):
+  """Paces the attempts of boot steps by their history."""
+
+  def __init__(self, history, boot_kind, base_interval, min_samples=3,
+               max_sleep_seconds=10, clock=time.time):
+    """Constructor.
+
+    Args:
+      history: a StepHistory.
+      boot_kind: the history key of this boot, see BootKind.
+      base_interval: the fixed interval this replaces.
+      min_samples: how many durations a step needs before its polls are
+        paced, before that they are base_interval apart.
+      max_sleep_seconds: the longest sleep, so that a dead emulator is still
+        noticed soon.
+      clock: the time source.
+    """
+    self._history = history
+    self._boot_kind = boot_kind
+    self._base_interval = base_interval
+    self._min_samples = min_samples
+    self._max_sleep_seconds = max_sleep_seconds
+    self._clock = clock
+    self._lock = threading.Lock()
+    self._steps = {}
+    self._stats = {}
+
+  def Attempt(self, step):
+    """Notes an attempt of step, the first one starts its clock."""
+    with self._lock:
+      if step not in self._steps:
+        self._steps[step] = _Step(self._clock())
+      self._steps[step].polls += 1
+
+  def NextSleep(self, step):
+    """Returns how long to sleep after a failed attempt of step."""
+    samples = self._history.Samples(self._boot_kind, step)
+    with self._lock:
+      state = self._steps.get(step) or _Step(self._clock())
+      base = self._base_interval
+      sleep = base
+      if len(samples) >= self._min_samples:
+        elapsed = self._clock() - state.start_time
+        dense_from = _Percentile(samples, 0.1) - base
+        dense_until = _Percentile(samples, 0.9)
+        if elapsed + base < dense_from:
+          sleep = min(dense_from - elapsed, self._max_sleep_seconds)
+        elif elapsed < dense_until:
+          # no denser, the boot loop counts attempts against its limits.
+          sleep = base / 2
+        else:
+          sleep = min(base * 2 ** state.late_polls, base * 4)
+          state.late_polls += 1
+      state.last_sleep = sleep
+      return sleep
+
+  def Done(self, step):
+    """Records how long step took, returns the duration."""
+    with self._lock:
+      state = self._steps.pop(step, None)
+    if not state:
+      return None
+    duration = self._clock() - state.start_time
+    self._history.Record(self._boot_kind, step, duration)
+    fixed_polls = int(duration / self._base_interval) + 1
+    last_sleep = self._base_interval
+    if state.last_sleep is not None:
+      last_sleep = state.last_sleep
+    with self._lock:
+      self._stats[step] = {
+          'seconds': duration,
+          'polls': state.polls,
+          'fixed_polls': fixed_polls,
+          # the step became ready during the last sleep, which bounds how late
+          # it was noticed.
+          'latency_gained_seconds': self._base_interval - last_sleep,
+      }
+    return duration
+
+  def Stats(self):
+    """Returns the per step stats and their totals.
+
+    polls_saved is the fixed interval polls minus the polls made and
+    latency_gained_seconds how much shorter the sleeps were in which steps
+    became ready, negative when they were longer.
+    """
+    with self._lock:
+      steps = dict((step, dict(stats)) for step, stats in self._stats.items())
+    totals = {
+        'polls': sum(s['polls'] for s in steps.values()),
+        'fixed_polls': sum(s['fixed_polls'] for s in steps.values()),
+        'latency_gained_seconds': sum(s['latency_gained_seconds']
+                                      for s in steps.values()),
+    }
+    totals['polls_saved'] = totals['fixed_polls'] - totals['polls']
+    totals['steps'] = steps
+    return totals
+
+  def Save(self):
+    return self._history.Save()
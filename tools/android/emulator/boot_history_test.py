@@ -0,0 +1,127 @@
+# Copyright 2018 The Android Open Source Project. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for tools.android.emulator.boot_history."""
+
+import json
+import os
+import shutil
+import tempfile
+
+from google.apputils import basetest as googletest
+from tools.android.emulator import boot_history
+
+_KIND = 'x86_26/api26/cold/x86_64-8cpu-kvm'
+
+
+class BootHistoryTest(googletest.TestCase):
+
+  def setUp(self):
+    super(BootHistoryTest, self).setUp()
+    self.tmp_dir = tempfile.mkdtemp()
+    self.path = os.path.join(self.tmp_dir, 'cache', 'boot_history.json')
+    self.now = [1000.0]
+
+  def tearDown(self):
+    super(BootHistoryTest, self).tearDown()
+    shutil.rmtree(self.tmp_dir)
+
+  def _Poller(self, history=None):
+    return boot_history.AdaptivePoller(
+        history or boot_history.StepHistory(self.path), _KIND,
+        base_interval=1.0, clock=lambda: self.now[0])
+
+  def _RunStep(self, poller, step, ready_after):
+    """Polls step until ready_after seconds passed, returns the sleeps."""
+    start = self.now[0]
+    sleeps = []
+    while True:
+      poller.Attempt(step)
+      if self.now[0] - start >= ready_after:
+        poller.Done(step)
+        return sleeps
+      sleeps.append(poller.NextSleep(step))
+      self.now[0] += sleeps[-1]
+
+  def testBootKind(self):
+    kind = boot_history.BootKind('x86_26', 26, 'snapshot', True)
+    self.assertTrue(kind.startswith('x86_26/api26/snapshot/'))
+    self.assertTrue(kind.endswith('-kvm'))
+
+  def testFixedIntervalWithoutHistory(self):
+    poller = self._Poller()
+    self.assertEquals([1.0] * 5, self._RunStep(poller, 'SYS_SERVER_CHECK', 5))
+    stats = poller.Stats()
+    self.assertEquals(6, stats['polls'])
+    self.assertEquals(0, stats['polls_saved'])
+    self.assertEquals(0, stats['latency_gained_seconds'])
+
+  def testHistorySavedAndMerged(self):
+    for seconds in (10, 11):
+      poller = self._Poller()
+      self._RunStep(poller, 'SYS_SERVER_CHECK', seconds)
+      self.assertTrue(poller.Save())
+    history = boot_history.StepHistory(self.path, max_samples=3)
+    self.assertEquals([10, 11], history.Samples(_KIND, 'SYS_SERVER_CHECK'))
+    history.Record(_KIND, 'SYS_SERVER_CHECK', 12)
+    history.Record(_KIND, 'SYS_SERVER_CHECK', 13)
+    history.Record(_KIND, 'PM_CHECK', 2)
+    self.assertEquals([10, 11, 12, 13],
+                      history.Samples(_KIND, 'SYS_SERVER_CHECK'))
+    self.assertTrue(history.Save())
+    with open(self.path) as f:
+      saved = json.load(f)
+    self.assertEquals(1, saved['version'])
+    self.assertEquals({'SYS_SERVER_CHECK': [11, 12, 13], 'PM_CHECK': [2]},
+                      saved['boots'][_KIND])
+    self.assertEquals([], boot_history.StepHistory(self.path).Samples(
+        'other', 'PM_CHECK'))
+
+  def testUnreadableHistory(self):
+    os.makedirs(os.path.dirname(self.path))
+    with open(self.path, 'w') as f:
+      f.write('{not json')
+    self.assertEquals([], boot_history.StepHistory(self.path).Samples(
+        _KIND, 'PM_CHECK'))
+    history = boot_history.StepHistory(os.path.join(self.path, 'in_a_file'))
+    history.Record(_KIND, 'PM_CHECK', 1)
+    self.assertFalse(history.Save())
+
+  def testPacedByHistory(self):
+    history = boot_history.StepHistory(self.path)
+    for seconds in (20, 21, 22, 24):
+      history.Record(_KIND, 'CHECK_BOOT_PROP', seconds)
+    poller = self._Poller(history)
+    # sleeps until 1s before the fastest boot, then polls densely.
+    sleeps = self._RunStep(poller, 'CHECK_BOOT_PROP', 20.2)
+    self.assertEquals([10, 9, 0.5, 0.5, 0.5], sleeps)
+    stats = poller.Stats()
+    self.assertEquals(6, stats['polls'])
+    self.assertEquals(21, stats['fixed_polls'])
+    self.assertEquals(15, stats['polls_saved'])
+    self.assertEquals(0.5, stats['latency_gained_seconds'])
+    self.assertEquals(20.5, stats['steps']['CHECK_BOOT_PROP']['seconds'])
+
+  def testBacksOffWhenLate(self):
+    history = boot_history.StepHistory(self.path)
+    for seconds in (2, 2, 2):
+      history.Record(_KIND, 'PM_CHECK', seconds)
+    poller = self._Poller(history)
+    sleeps = self._RunStep(poller, 'PM_CHECK', 12)
+    self.assertEquals([0.5, 0.5, 0.5, 0.5, 1, 2, 4, 4], sleeps)
+    self.assertEquals(-3, poller.Stats()['latency_gained_seconds'])
+
+
+if __name__ == '__main__':
+  googletest.main()
@@ -0,0 +1,160 @@
+# Copyright 2018 The Android Open Source Project. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Where the time of a launch went, as timers and as a trace.
+
+TracingStopWatch is a StopWatch which also keeps a Span for every stretch a
+timer ran, on the thread which started it. Together with the Spans of the
+readiness steps (StepSpans) they make a Chrome trace (ChromeTrace), which
+chrome://tracing and Perfetto show as one lane per thread.
+
+AddPerfData puts the totals into EmulatorMetaDataPb.perf_data, TimerPb
+accumulated_time being milliseconds:
+
+  activity 'launch'       a TimerPb per stopwatch timer.
+  activity 'boot_steps'   a TimerPb per readiness step, number_of_starts being
+                          its attempts.
+  activity 'prelaunch_critical_path'
+                          a TimerPb per task of the critical path of the work
+                          before the emulator was spawned, in path order.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import json
+import os
+import threading
+import time
+
+from google.apputils import stopwatch
+
+from tools.android.emulator import readiness_graph
+
+LAUNCH_ACTIVITY = 'launch'
+BOOT_STEPS_ACTIVITY = 'boot_steps'
+CRITICAL_PATH_ACTIVITY = 'prelaunch_critical_path'
+
+Span = collections.namedtuple('Span', ['name', 'category', 'start', 'end',
+                                       'thread', 'args'])
+
+
+class TracingStopWatch(stopwatch.StopWatch):
+  """A StopWatch which records a Span whenever a timer stops.
+
+  A timer paused by another one (stop_others) ends its span and starts a new
+  one once it resumes.
+  """
+
+  def __init__(self):
+    super(TracingStopWatch, self).__init__()
+    self.spans = []
+    self._open = {}
+
+  def start(self, timer='total', stop_others=True):
+    super(TracingStopWatch, self).start(timer, stop_others)
+    self._open[timer] = (self.timers[timer],
+                         threading.current_thread().name)
+
+  def stop(self, timer='total'):
+    opened = self._open.pop(timer, None)
+    end = time.time()
+    super(TracingStopWatch, self).stop(timer)
+    if opened:
+      start, thread = opened
+      self.spans.append(Span(timer, 'timer', start, end, thread, {}))
+
+  def Spans(self):
+    """Returns the spans, the ones of running timers up to now."""
+    now = time.time()
+    return list(self.spans) + [
+        Span(timer, 'timer', start, now, thread, {'running': True})
+        for timer, (start, thread) in self._open.items()]
+
+
+def StepSpans(timeline):
+  """Returns a Span per readiness_graph.StepTiming."""
+  now = time.time()
+  return [Span(timing.name, 'boot_step', timing.start, timing.end or now,
+               readiness_graph.THREAD_NAME_FORMAT % timing.name,
+               {'attempts': timing.attempts, 'outcome': timing.outcome})
+          for timing in timeline]
+
+
+def AddPerfData(metadata_pb, timer, timeline=(), critical_path=()):
+  """Adds the totals of timer and timeline to metadata_pb.perf_data.
+
+  Args:
+    metadata_pb: an EmulatorMetaDataPb.
+    timer: a stopwatch.StopWatch.
+    timeline: readiness_graph.StepTiming tuples.
+    critical_path: task_graph.TaskTiming tuples.
+  """
+  now = time.time()
+  launch = metadata_pb.perf_data.add(activity_name=LAUNCH_ACTIVITY)
+  for name in sorted(set(timer.accum) | set(timer.timers)):
+    launch.timing.add(
+        name=name, number_of_starts=timer.counters.get(name, 0),
+        accumulated_time=int(round(timer.timervalue(name, now=now) * 1000)))
+  if timeline:
+    steps = metadata_pb.perf_data.add(activity_name=BOOT_STEPS_ACTIVITY)
+    for timing in timeline:
+      steps.timing.add(
+          name=timing.name, number_of_starts=timing.attempts,
+          accumulated_time=int(round(((timing.end or now) - timing.start) *
+                                     1000)))
+  if critical_path:
+    path = metadata_pb.perf_data.add(activity_name=CRITICAL_PATH_ACTIVITY)
+    for timing in critical_path:
+      path.timing.add(
+          name=timing.name, number_of_starts=1,
+          accumulated_time=int(round((timing.end - timing.start) * 1000)))
+
+
+def ChromeTrace(spans, pid=None):
+  """Returns spans as a Chrome trace event json object.
+
+  Args:
+    spans: Spans, of any threads.
+    pid: the process id shown, defaults to ours.
+  """
+  pid = os.getpid() if pid is None else pid
+  origin = min([span.start for span in spans] or [0])
+  thread_ids = {}
+  events = []
+  for span in sorted(spans, key=lambda span: span.start):
+    if span.thread not in thread_ids:
+      thread_ids[span.thread] = len(thread_ids) + 1
+      events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid,
+                     'tid': thread_ids[span.thread],
+                     'args': {'name': span.thread}})
+    events.append({
+        'name': span.name,
+        'cat': span.category,
+        'ph': 'X',
+        'ts': int((span.start - origin) * 1e6),
+        'dur': int((span.end - span.start) * 1e6),
+        'pid': pid,
+        'tid': thread_ids[span.thread],
+        'args': dict(span.args),
+    })
+  return {'traceEvents': events, 'displayTimeUnit': 'ms',
+          'otherData': {'start_time': origin}}
+
+
+def WriteChromeTrace(f, spans):
+  """Writes spans to the file object f, see ChromeTrace."""
+  json.dump(ChromeTrace(spans), f, sort_keys=True)
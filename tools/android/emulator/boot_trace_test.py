@@ -0,0 +1,118 @@
+# Copyright 2018 The Android Open Source Project. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for tools.android.emulator.boot_trace."""
+
+import json
+import StringIO
+import threading
+
+from google.apputils import basetest as googletest
+from tools.android.emulator import boot_trace
+from tools.android.emulator import emulator_meta_data_pb2
+from tools.android.emulator import readiness_graph
+from tools.android.emulator import task_graph
+
+
+class BootTraceTest(googletest.TestCase):
+
+  def testSpans(self):
+    timer = boot_trace.TracingStopWatch()
+    timer.start('STAGE_DATA')
+    timer.start('SDCARD_CREATE')
+    timer.stop('SDCARD_CREATE')
+    timer.stop('STAGE_DATA')
+
+    def Check():
+      timer.start('PM_CHECK', stop_others=False)
+      timer.stop('PM_CHECK')
+    thread = threading.Thread(target=Check, name='readiness-pm')
+    thread.start()
+    thread.join()
+    timer.start('SPAWN_EMULATOR')
+
+    spans = timer.Spans()
+    self.assertEquals(['STAGE_DATA', 'SDCARD_CREATE', 'STAGE_DATA', 'PM_CHECK',
+                       'SPAWN_EMULATOR'], [s.name for s in spans])
+    # STAGE_DATA was paused while the sdcard was created.
+    self.assertLessEqual(spans[0].end, spans[1].start)
+    self.assertLessEqual(spans[1].end, spans[2].start)
+    self.assertEquals('readiness-pm', spans[3].thread)
+    self.assertEquals({'running': True}, spans[4].args)
+    self.assertEquals(2, timer.counters['STAGE_DATA'])
+
+  def testPerfData(self):
+    timer = boot_trace.TracingStopWatch()
+    timer.start('STAGE_DATA')
+    timer.stop('STAGE_DATA')
+    timer.accum['STAGE_DATA'] = 1.5
+    timeline = [readiness_graph.StepTiming('adb_listening', 10.0, 12.25, 3,
+                                           readiness_graph.PASSED)]
+    metadata = emulator_meta_data_pb2.EmulatorMetaDataPb()
+    boot_trace.AddPerfData(metadata, timer, timeline)
+    self.assertEquals([boot_trace.LAUNCH_ACTIVITY,
+                       boot_trace.BOOT_STEPS_ACTIVITY],
+                      [p.activity_name for p in metadata.perf_data])
+    stage = metadata.perf_data[0].timing[0]
+    self.assertEquals(('STAGE_DATA', 1, 1500),
+                      (stage.name, stage.number_of_starts,
+                       stage.accumulated_time))
+    step = metadata.perf_data[1].timing[0]
+    self.assertEquals(('adb_listening', 3, 2250),
+                      (step.name, step.number_of_starts,
+                       step.accumulated_time))
+
+  def testPerfData_criticalPath(self):
+    path = [task_graph.TaskTiming('EXTRACT_SYSTEM_IMAGE', 1.0, 3.5, 0,
+                                  task_graph.DONE),
+            task_graph.TaskTiming('MODIFY_SYSTEM_IMAGE', 3.5, 4.0, 1,
+                                  task_graph.DONE)]
+    metadata = emulator_meta_data_pb2.EmulatorMetaDataPb()
+    boot_trace.AddPerfData(metadata, boot_trace.TracingStopWatch(),
+                           critical_path=path)
+    self.assertEquals([boot_trace.LAUNCH_ACTIVITY,
+                       boot_trace.CRITICAL_PATH_ACTIVITY],
+                      [p.activity_name for p in metadata.perf_data])
+    self.assertEquals([('EXTRACT_SYSTEM_IMAGE', 2500),
+                       ('MODIFY_SYSTEM_IMAGE', 500)],
+                      [(t.name, t.accumulated_time)
+                       for t in metadata.perf_data[1].timing])
+
+  def testChromeTrace(self):
+    spans = [
+        boot_trace.Span('SPAWN_EMULATOR', 'timer', 100.0, 130.0, 'MainThread',
+                        {}),
+        boot_trace.Span('SYS_SERVER_CHECK', 'timer', 110.5, 110.75,
+                        'readiness-system_server', {}),
+    ] + boot_trace.StepSpans([readiness_graph.StepTiming(
+        'system_server', 110.0, 112.0, 2, readiness_graph.PASSED)])
+    out = StringIO.StringIO()
+    boot_trace.WriteChromeTrace(out, spans)
+    trace = json.loads(out.getvalue())
+    events = [e for e in trace['traceEvents'] if e['ph'] == 'X']
+    self.assertEquals(['SPAWN_EMULATOR', 'system_server', 'SYS_SERVER_CHECK'],
+                      [e['name'] for e in events])
+    self.assertEquals((0, 30000000), (events[0]['ts'], events[0]['dur']))
+    self.assertEquals((10500000, 250000), (events[2]['ts'], events[2]['dur']))
+    self.assertEquals({'attempts': 2, 'outcome': 'passed'}, events[1]['args'])
+    # the step and its checks share a lane.
+    self.assertEquals(events[1]['tid'], events[2]['tid'])
+    self.assertNotEquals(events[0]['tid'], events[1]['tid'])
+    names = dict((e['tid'], e['args']['name']) for e in trace['traceEvents']
+                 if e['ph'] == 'M')
+    self.assertEquals('readiness-system_server', names[events[1]['tid']])
+
+
+if __name__ == '__main__':
+  googletest.main()
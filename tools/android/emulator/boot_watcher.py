@@ -0,0 +1,194 @@
+# Copyright 2018 The Android Open Source Project. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Watches a booting device from the device, over one adb shell.
+
+Rather than the host polling ps, pm, mount and getprop over adb every second,
+a small shell loop runs on the device. It checks each milestone locally every
+fraction of a second and prints one line as each is reached:
+
+  __BOOTWATCH system_server      system_server is running.
+  __BOOTWATCH package_manager    the package service is registered.
+  __BOOTWATCH storage            external storage is mounted.
+  __BOOTWATCH boot_completed     sys.boot_completed or dev.bootcomplete is set.
+  __BOOTWATCH launcher           a home screen process is running.
+
+The loop ends once every milestone was seen or after max_seconds. The host
+waits on the milestones with WaitFor, which returns as soon as the line
+arrives. The loop needs mksh (API 21+); callers keep polling from the host
+when the watcher is not alive.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import subprocess
+import threading
+import time
+
+from absl import logging
+
+from tools.android.emulator import process_backend
+
+SYSTEM_SERVER = 'system_server'
+PACKAGE_MANAGER = 'package_manager'
+STORAGE = 'storage'
+BOOT_COMPLETED = 'boot_completed'
+LAUNCHER = 'launcher'
+MILESTONES = (SYSTEM_SERVER, PACKAGE_MANAGER, STORAGE, BOOT_COMPLETED,
+              LAUNCHER)
+
+_PREFIX = '__BOOTWATCH '
+
+# Each check is `if <variable unset> && <test>; then <variable>=1; echo ...`.
+# The storage paths are the environment of the device's shell.
+_CHECKS = (
+    (SYSTEM_SERVER, 'case "$(%(ps)s)" in *system_server*) true;; '
+     '*) false;; esac'),
+    # cheaper than pm path, which starts a vm each time.
+    (PACKAGE_MANAGER, 'case "$(service check package)" in *": found"*) '
+     'true;; *) false;; esac'),
+    (STORAGE, 'o="$(mount)"; f=1; for d in $EMULATED_STORAGE_SOURCE '
+     '$EXTERNAL_STORAGE $ANDROID_STORAGE; do case "$o" in *"$d"*) f=0;; '
+     'esac; done; [ $f = 0 ]'),
+    (BOOT_COMPLETED, '[ -n "$(getprop sys.boot_completed)$(getprop '
+     'dev.bootcomplete)" ]'),
+    (LAUNCHER, 'case "$(%(ps)s)" in %(launchers)s) true;; *) false;; esac'),
+)
+
+
+def WatcherScript(ps_command, launcher_packages, interval_seconds=0.5,
+                  max_seconds=600):
+  """Returns the device side loop, a single line for sh -c.
+
+  Args:
+    ps_command: the command line which lists every process.
+    launcher_packages: home screen process names (or parts of them).
+    interval_seconds: the pause between checks.
+    max_seconds: when the loop gives up.
+  """
+  checks = []
+  for i, (milestone, test) in enumerate(_CHECKS):
+    test %= {'ps': ps_command,
+             'launchers': '|'.join('*%s*' % p for p in launcher_packages)}
+    checks.append('if [ -z "$m%d" ] && { %s; }; then m%d=1; n=$((n+1)); '
+                  'echo "%s%s"; fi' % (i, test, i, _PREFIX, milestone))
+  # toolbox sleep only takes whole seconds.
+  pause = 'sleep %s 2>/dev/null || sleep 1' % interval_seconds
+  return ('n=0; e=$(($(date +%%s)+%d)); '
+          'while [ $n -lt %d ] && [ $(date +%%s) -lt $e ]; do %s; %s; done' % (
+              max_seconds, len(checks), '; '.join(checks), pause))
+
+
+class BootWatcher(object):
+  """Runs the watcher loop over `adb shell` and collects its milestones."""
+
+  def __init__(self, adb_args, script, env=None, clock=time.time):
+    """Constructor.
+
+    Args:
+      adb_args: the adb command up to and including 'shell'.
+      script: the loop, see WatcherScript.
+      env: [optional] adb's environment.
+      clock: the time source of the transition times.
+    """
+    self._args = list(adb_args) + [script]
+    self._env = env
+    self._clock = clock
+    self._proc = None
+    self._reader = None
+    self._condition = threading.Condition()
+    self._seen = {}
+    self._start_time = None
+
+  def Start(self):
+    """Starts the loop on the device, returns False if adb cannot start."""
+    self._start_time = self._clock()
+    try:
+      with open(os.devnull) as dev_null:
+        self._proc = process_backend.Popen(
+            self._args, stdin=dev_null, stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT, env=self._env, close_fds=True)
+    except OSError as e:
+      logging.warning('Cannot start the boot watcher: %s', e)
+      return False
+    self._reader = threading.Thread(target=self._Read, name='BootWatcher')
+    self._reader.daemon = True
+    self._reader.start()
+    return True
+
+  @property
+  def alive(self):
+    """Whether the loop may still report milestones."""
+    return self._reader is not None and self._reader.is_alive()
+
+  def Watching(self, milestone):
+    """Whether WaitFor(milestone) waits on the device, rather than failing."""
+    with self._condition:
+      return self.alive and milestone not in self._seen
+
+  def Seen(self, milestone):
+    with self._condition:
+      return milestone in self._seen
+
+  def WaitFor(self, milestone, timeout_seconds):
+    """Waits up to timeout_seconds for milestone, returns whether it came."""
+    deadline = time.time() + timeout_seconds
+    with self._condition:
+      while milestone not in self._seen and self.alive:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+          break
+        self._condition.wait(remaining)
+      return milestone in self._seen
+
+  def Transitions(self):
+    """Returns (milestone, seconds after Start) in the order they came."""
+    with self._condition:
+      return sorted(((m, t - self._start_time) for m, t in self._seen.items()),
+                    key=lambda transition: transition[1])
+
+  def Close(self):
+    """Stops the loop, if it still runs."""
+    proc, self._proc = self._proc, None
+    if proc and proc.poll() is None:
+      try:
+        proc.kill()
+      except OSError:
+        pass
+    if proc:
+      proc.wait()
+    if self._reader:
+      self._reader.join(5)
+
+  def _Read(self):
+    proc = self._proc
+    for line in iter(proc.stdout.readline, b''):
+      line = line.decode('utf-8', 'replace').strip()
+      if not line.startswith(_PREFIX):
+        if line:
+          logging.info('Boot watcher: %s', line)
+        continue
+      milestone = line[len(_PREFIX):]
+      with self._condition:
+        if milestone not in self._seen:
+          self._seen[milestone] = self._clock()
+          logging.info('Boot watcher: %s after %.1fs', milestone,
+                       self._seen[milestone] - self._start_time)
+        self._condition.notify_all()
+    proc.stdout.close()
+    with self._condition:
+      self._condition.notify_all()
@@ -0,0 +1,138 @@
+# Copyright 2018 The Android Open Source Project. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for tools.android.emulator.boot_watcher.
+
+A fake adb runs the watcher loop in a host shell, whose ps, service, mount and
+getprop print the files of a fake device directory.
+"""
+
+import os
+import shutil
+import stat
+import tempfile
+
+from google.apputils import basetest as googletest
+from tools.android.emulator import boot_watcher
+
+_DEVICE_COMMANDS = {
+    'ps': 'cat "$DEVICE/ps" 2>/dev/null\n',
+    'service': 'if [ -e "$DEVICE/$2" ]; then echo "Service $2: found"; '
+               'else echo "Service $2: not found"; fi\n',
+    'mount': 'cat "$DEVICE/mounts" 2>/dev/null\n',
+    'getprop': 'cat "$DEVICE/$1" 2>/dev/null\n',
+}
+
+
+class BootWatcherTest(googletest.TestCase):
+
+  def setUp(self):
+    super(BootWatcherTest, self).setUp()
+    self.tmp_dir = tempfile.mkdtemp()
+    self.device_dir = os.path.join(self.tmp_dir, 'device')
+    bin_dir = os.path.join(self.tmp_dir, 'bin')
+    os.mkdir(self.device_dir)
+    os.mkdir(bin_dir)
+    for name, script in _DEVICE_COMMANDS.items():
+      self._Executable(os.path.join(bin_dir, name), script)
+    self.adb = os.path.join(self.tmp_dir, 'adb')
+    self._Executable(self.adb, 'shift 3\nexec /bin/sh -c "$1"\n')
+    self.env = dict(os.environ, DEVICE=self.device_dir,
+                    PATH=bin_dir + os.pathsep + os.environ['PATH'],
+                    EXTERNAL_STORAGE='/storage/emulated/legacy')
+
+  def tearDown(self):
+    super(BootWatcherTest, self).tearDown()
+    shutil.rmtree(self.tmp_dir)
+
+  def _Executable(self, path, script):
+    with open(path, 'w') as f:
+      f.write('#!/bin/sh\n' + script)
+    os.chmod(path, stat.S_IRWXU)
+
+  def _Device(self, name, content=''):
+    with open(os.path.join(self.device_dir, name), 'a') as f:
+      f.write(content)
+
+  def _Watcher(self, max_seconds=60):
+    script = boot_watcher.WatcherScript(
+        'ps', ['com.android.launcher', 'com.android.tv'],
+        interval_seconds=0.05, max_seconds=max_seconds)
+    watcher = boot_watcher.BootWatcher([self.adb, '-s', 'emulator-1',
+                                        'shell'], script, env=self.env)
+    self.assertTrue(watcher.Start())
+    self.addCleanup(watcher.Close)
+    return watcher
+
+  def testMilestonesInOrder(self):
+    watcher = self._Watcher()
+    self.assertFalse(watcher.WaitFor(boot_watcher.SYSTEM_SERVER, 0.3))
+    self.assertTrue(watcher.Watching(boot_watcher.SYSTEM_SERVER))
+
+    self._Device('ps', 'USER PID PPID NAME\nsystem 500 1 system_server\n')
+    self.assertTrue(watcher.WaitFor(boot_watcher.SYSTEM_SERVER, 10))
+    self.assertFalse(watcher.Watching(boot_watcher.SYSTEM_SERVER))
+    self._Device('package')
+    self.assertTrue(watcher.WaitFor(boot_watcher.PACKAGE_MANAGER, 10))
+    self._Device('mounts', '/dev/fuse /storage/emulated/legacy fuse rw 0 0\n')
+    self.assertTrue(watcher.WaitFor(boot_watcher.STORAGE, 10))
+    self._Device('sys.boot_completed', '1\n')
+    self.assertTrue(watcher.WaitFor(boot_watcher.BOOT_COMPLETED, 10))
+    self.assertFalse(watcher.Seen(boot_watcher.LAUNCHER))
+    self._Device('ps', 'u0_a20 800 1 com.android.tv.launcher\n')
+    self.assertTrue(watcher.WaitFor(boot_watcher.LAUNCHER, 10))
+
+    transitions = watcher.Transitions()
+    self.assertEquals(list(boot_watcher.MILESTONES),
+                      [m for m, _ in transitions])
+    self.assertEquals(sorted(t for _, t in transitions),
+                      [t for _, t in transitions])
+    # every milestone seen, the loop ends by itself.
+    watcher._reader.join(10)
+    self.assertFalse(watcher.alive)
+
+  def testMilestonesAtOnce(self):
+    self._Device('ps', 'system 500 1 system_server\n'
+                       'u0_a20 800 1 com.android.launcher3\n')
+    self._Device('package')
+    self._Device('mounts', '/data/media on /storage/emulated/legacy '
+                           'type sdcardfs (rw)\n')
+    self._Device('dev.bootcomplete', '1\n')
+    watcher = self._Watcher()
+    self.assertTrue(watcher.WaitFor(boot_watcher.LAUNCHER, 10))
+    self.assertEquals(set(boot_watcher.MILESTONES),
+                      set(m for m, _ in watcher.Transitions()))
+
+  def testGivesUp(self):
+    watcher = self._Watcher(max_seconds=0)
+    self.assertFalse(watcher.WaitFor(boot_watcher.SYSTEM_SERVER, 10))
+    self.assertFalse(watcher.alive)
+    self.assertFalse(watcher.Watching(boot_watcher.SYSTEM_SERVER))
+
+  def testClose(self):
+    watcher = self._Watcher()
+    watcher.Close()
+    self.assertFalse(watcher.alive)
+    self.assertFalse(watcher.WaitFor(boot_watcher.SYSTEM_SERVER, 10))
+
+  def testAdbMissing(self):
+    watcher = boot_watcher.BootWatcher(
+        [os.path.join(self.tmp_dir, 'no_adb'), 'shell'], 'true')
+    self.assertFalse(watcher.Start())
+    self.assertFalse(watcher.alive)
+    self.assertFalse(watcher.Watching(boot_watcher.SYSTEM_SERVER))
+
+
+if __name__ == '__main__':
+  googletest.main()
@@ -20,18 +20,48 @@
 
 
 
+import collections
+import errno
+import fcntl
 import os
+import random
+import select
 import signal
 import subprocess
 import threading
+import time
 
 from absl import flags
 from absl import logging
 
+from tools.android.emulator import log_store
+from tools.android.emulator import process_backend
+from tools.android.emulator import timer_scheduler
+
 FLAGS = flags.FLAGS
 flags.DEFINE_string('subprocess_log_dir',
                     os.environ.get('TEST_UNDECLARED_OUTPUTS_DIR'),
                     'The directory to log commands to.')
+flags.DEFINE_boolean('subprocess_log_store', True,
+                     'If true, commands are logged to an indexed, size capped '
+                     'log store in subprocess_log_dir/subprocess_logs rather '
+                     'than to a file per command.')
+flags.DEFINE_integer('subprocess_log_segment_bytes', 8 << 20,
+                     'Size at which log store segments are rotated.')
+flags.DEFINE_integer('subprocess_log_budget_bytes', 256 << 20,
+                     'The oldest log store segments are deleted once the '
+                     'store grows past this size.')
+flags.DEFINE_boolean('subprocess_tee_in_process', True,
+                     'If true, the output of spawned commands is copied to '
+                     'the command log by a shared in-process pump thread '
+                     'rather than by two forked tee processes per command.')
+flags.DEFINE_integer('subprocess_capture_window_bytes', 64 << 10,
+                     'The size of the head and of the tail of a command\'s '
+                     'output kept in memory by bounded captures.')
+flags.DEFINE_boolean('subprocess_bounded_capture', False,
+                     'If true, communicate() on every spawned command keeps '
+                     'only the head and tail windows of its output in memory, '
+                     'the full output is still in the command log.')
 
 
 def _GetLogCommand(logfile, is_stderr=False):
@@ -50,6 +80,320 @@ def _GetLogCommand(logfile, is_stderr=False):
   return ['/usr/bin/tee', '-a', logfile]
 
 
+def _UsesExternalTee(logfile):
+  """Whether output to logfile has to be written by a tee subprocess."""
+  if not FLAGS.subprocess_tee_in_process:
+    return True
+  # CNS writes need to go thru fileutil.
+  return logfile.startswith('/cns/') or logfile.startswith('/namespace/')
+
+
+def _SetCloseOnExec(fd):
+  flags_value = fcntl.fcntl(fd, fcntl.F_GETFD)
+  fcntl.fcntl(fd, fcntl.F_SETFD, flags_value | fcntl.FD_CLOEXEC)
+
+
+def _SetNonBlocking(fd):
+  flags_value = fcntl.fcntl(fd, fcntl.F_GETFL)
+  fcntl.fcntl(fd, fcntl.F_SETFL, flags_value | os.O_NONBLOCK)
+
+
+class _SharedLogFile(object):
+  """An append only logfile shared by the streams of a single task."""
+
+  def __init__(self, path, users):
+    self.path = path
+    self._fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    _SetCloseOnExec(self._fd)
+    self._users = users
+    self._lock = threading.Lock()
+
+  def Write(self, data):
+    view = memoryview(data)
+    while view:
+      try:
+        written = os.write(self._fd, view)
+      except OSError as e:
+        if e.errno == errno.EINTR:
+          continue
+        logging.warning('Cannot write to log %s: %s', self.path, e)
+        return
+      view = view[written:]
+
+  def Release(self):
+    with self._lock:
+      self._users -= 1
+      if not self._users:
+        os.close(self._fd)
+
+
+class _TeeStream(object):
+  """Copies one output pipe of a task to its logfile and to the caller.
+
+  Stands in for a tee subprocess: it supports the wait() / poll() calls
+  WaitProcesses makes on tee tasks, and exposes the pipe the caller reads from
+  (if the caller asked for one) as reader. done_fd turns readable once the
+  stream is done, WaitProcesses polls it along with the pidfds of processes.
+
+  All reads and writes happen on the _OutputPump thread.
+  """
+
+  # Stop reading from the task when this much output is waiting for the
+  # caller. This is the same backpressure a tee process applies.
+  _MAX_BUFFERED = 1 << 20
+  _READ_SIZE = 64 << 10
+
+  def __init__(self, source, log, destination):
+    self.reader = None
+    self.returncode = None
+    self.logged_bytes = 0
+    self._log = log
+    self._source_file = source
+    self.source_fd = source.fileno()
+    _SetNonBlocking(self.source_fd)
+    self.sink_fd = None
+    self._owns_pipe = False
+    if destination == subprocess.PIPE:
+      read_fd, write_fd = os.pipe()
+      _SetCloseOnExec(read_fd)
+      _SetCloseOnExec(write_fd)
+      _SetNonBlocking(write_fd)
+      self.reader = os.fdopen(read_fd, 'rb')
+      self.sink_fd = write_fd
+      self._owns_pipe = True
+    elif destination is not None:
+      if not isinstance(destination, int):
+        destination = destination.fileno()
+      # Writes to a callers file are blocking, we must not flip O_NONBLOCK on
+      # a file description shared with the caller.
+      self.sink_fd = os.dup(destination)
+      _SetCloseOnExec(self.sink_fd)
+    self._pending = bytearray()
+    self._source_eof = False
+    self._done = threading.Event()
+    read_fd, self._done_write_fd = os.pipe()
+    _SetCloseOnExec(read_fd)
+    _SetCloseOnExec(self._done_write_fd)
+    # closed with the stream object once nobody can wait on it anymore.
+    self._done_reader = os.fdopen(read_fd, 'rb', 0)
+    self.done_fd = read_fd
+
+  def OnReadable(self, pump):
+    """Reads available output from the task."""
+    try:
+      data = os.read(self.source_fd, self._READ_SIZE)
+    except OSError as e:
+      if e.errno in (errno.EAGAIN, errno.EINTR):
+        return
+      data = b''
+    if not data:
+      self._source_eof = True
+      pump.Unregister(self.source_fd)
+      self._source_file.close()
+      if not self._pending:
+        self._Finish(pump)
+      return
+    self._log.Write(data)
+    self.logged_bytes += len(data)
+    if self.sink_fd is None:
+      return
+    if not self._owns_pipe:
+      self._WriteAll(pump, data)
+      return
+    was_empty = not self._pending
+    self._pending.extend(data)
+    if was_empty:
+      self.OnWritable(pump)
+    elif len(self._pending) > self._MAX_BUFFERED:
+      pump.Modify(self.source_fd, 0)
+
+  def OnWritable(self, pump):
+    """Forwards buffered output to the caller's pipe."""
+    try:
+      written = os.write(self.sink_fd, self._pending)
+    except OSError as e:
+      if e.errno in (errno.EAGAIN, errno.EINTR):
+        written = 0
+      else:
+        # The caller is not listening anymore (EPIPE) - keep logging.
+        logging.debug('Dropping output for closed pipe: %s', e)
+        self._CloseSink(pump)
+        self._pending = bytearray()
+        written = 0
+    del self._pending[:written]
+    if self._pending:
+      pump.Watch(self.sink_fd, self, select.POLLOUT)
+      if len(self._pending) > self._MAX_BUFFERED:
+        pump.Modify(self.source_fd, 0)
+      return
+    if self.sink_fd is not None:
+      pump.Unregister(self.sink_fd)
+    if self._source_eof:
+      self._Finish(pump)
+    else:
+      pump.Modify(self.source_fd, select.POLLIN)
+
+  def _WriteAll(self, pump, data):
+    view = memoryview(data)
+    while view:
+      try:
+        written = os.write(self.sink_fd, view)
+      except OSError as e:
+        if e.errno == errno.EINTR:
+          continue
+        logging.debug('Dropping output for closed file: %s', e)
+        self._CloseSink(pump)
+        return
+      view = view[written:]
+
+  def _CloseSink(self, pump):
+    if self.sink_fd is not None:
+      pump.Unregister(self.sink_fd)
+      os.close(self.sink_fd)
+      self.sink_fd = None
+
+  def _Finish(self, pump):
+    try:
+      self._CloseSink(pump)
+      self._log.Release()
+    finally:
+      self.returncode = 0
+      self._done.set()
+      if self._done_write_fd is not None:
+        # the end of file wakes up anyone polling done_fd.
+        os.close(self._done_write_fd)
+        self._done_write_fd = None
+
+  def Abort(self, pump):
+    """Closes the stream after one of its handlers failed."""
+    if not self._source_eof:
+      self._source_eof = True
+      pump.Unregister(self.source_fd)
+      self._source_file.close()
+    self._pending = bytearray()
+    if not self._done.is_set():
+      self._Finish(pump)
+
+  def poll(self):
+    return self.returncode
+
+  def wait(self):
+    # Event.wait without a timeout can not be interrupted in python 2.
+    while not self._done.wait(60):
+      pass
+    return self.returncode
+
+
+class _OutputPump(object):
+  """Moves the output of all spawned tasks from a single daemon thread.
+
+  Replaces one pair of tee processes per command with poll()-driven copying.
+  The registration of streams happens on the pump thread itself, other
+  threads hand over new streams and wake it thru a self-pipe.
+  """
+
+  def __init__(self):
+    self._pid = os.getpid()
+    self._lock = threading.Lock()
+    self._new_streams = []
+    self._handlers = {}
+    self._poller = select.poll()
+    self._wake_read, self._wake_write = os.pipe()
+    for fd in (self._wake_read, self._wake_write):
+      _SetCloseOnExec(fd)
+      _SetNonBlocking(fd)
+    self._poller.register(self._wake_read, select.POLLIN)
+    self._thread = threading.Thread(target=self._Loop, name='output_pump')
+    self._thread.daemon = True
+    self._thread.start()
+
+  def IsValid(self):
+    # Threads do not survive a fork, a child needs a pump of its own.
+    return self._pid == os.getpid()
+
+  def Add(self, stream):
+    with self._lock:
+      self._new_streams.append(stream)
+    try:
+      os.write(self._wake_write, b'x')
+    except OSError as e:
+      if e.errno != errno.EAGAIN:  # already woken up.
+        raise
+
+  def Watch(self, fd, stream, events):
+    if fd in self._handlers:
+      self._poller.modify(fd, events)
+    else:
+      self._poller.register(fd, events)
+    self._handlers[fd] = stream
+
+  def Modify(self, fd, events):
+    if fd in self._handlers:
+      self._poller.modify(fd, events)
+
+  def Unregister(self, fd):
+    if self._handlers.pop(fd, None) is not None:
+      self._poller.unregister(fd)
+
+  def _Loop(self):
+    while True:
+      try:
+        events = self._poller.poll()
+      except (IOError, OSError, select.error) as e:
+        if e.args[0] == errno.EINTR:
+          continue
+        raise
+      for fd, event in events:
+        if fd == self._wake_read:
+          self._AcceptNewStreams()
+          continue
+        stream = self._handlers.get(fd)
+        if stream is None:
+          continue
+        try:
+          if fd == stream.source_fd:
+            stream.OnReadable(self)
+          elif event & (select.POLLERR | select.POLLHUP):
+            stream.OnWritable(self)
+          elif event & select.POLLOUT:
+            stream.OnWritable(self)
+        except Exception:  # pylint: disable=broad-except
+          # one broken stream must not stop the output of all other tasks.
+          logging.exception('Closing output stream %d.', stream.source_fd)
+          self._AbortStream(stream)
+
+  def _AbortStream(self, stream):
+    try:
+      stream.Abort(self)
+    except Exception:  # pylint: disable=broad-except
+      logging.exception('Cannot close output stream %d.', stream.source_fd)
+
+  def _AcceptNewStreams(self):
+    try:
+      while os.read(self._wake_read, 4096):
+        pass
+    except OSError as e:
+      if e.errno != errno.EAGAIN:
+        raise
+    with self._lock:
+      streams = self._new_streams
+      self._new_streams = []
+    for stream in streams:
+      self.Watch(stream.source_fd, stream, select.POLLIN)
+
+
+_output_pump = None
+_output_pump_lock = threading.Lock()
+
+
+def _GetOutputPump():
+  global _output_pump
+  with _output_pump_lock:
+    if _output_pump is None or not _output_pump.IsValid():
+      _output_pump = _OutputPump()
+    return _output_pump
+
+
 def _ResetSigPipeHandling():
   # http://bugs.python.org/issue1652
   signal.signal(signal.SIGPIPE, signal.SIG_DFL)
@@ -95,31 +439,123 @@ def CommandLogFile(args, exec_dir, extra_env):
 CommandLogFile.count = 0
 
 
-def EnsureFileCached(path):
-  """Makes sure a file is cached on the local machine.
+def BeginLogRecord(args, exec_dir, extra_env):
+  """Starts logging a command to the log store.
 
-  Files on objfs / bazel-out cache can be accessed like standard
-  files by regular unix tools. However reading from them can cause long
-  blocks. Some programs (emulator, adb, etc) do not behave well in this case.
+  Args:
+    args: the args used to launch the subprocess
+    exec_dir: the directory the process launches from.
+    extra_env: the environment used to launch the process.
 
-  To circumvent this, we can write the first byte of the file to /dev/null.
+  Returns:
+    A log_store.LogRecord or None if the log store is not used.
+  """
+  if not FLAGS.subprocess_log_store:
+    return None
+  subprocess_log_dir = extra_env.get('subprocess_log_dir',
+                                     FLAGS.subprocess_log_dir)
+  # the store is written by the output pump, and can't live on CNS.
+  if not subprocess_log_dir or _UsesExternalTee(subprocess_log_dir):
+    return None
+  try:
+    store = log_store.GetLogStore(
+        os.path.join(subprocess_log_dir, 'subprocess_logs'),
+        segment_bytes=FLAGS.subprocess_log_segment_bytes,
+        budget_bytes=FLAGS.subprocess_log_budget_bytes)
+    return store.Begin(args, exec_dir, extra_env)
+  except (IOError, OSError) as e:
+    logging.warning('Cannot use log store in %s: %s', subprocess_log_dir, e)
+    return None
+
+
+class BoundedCapture(object):
+  """Keeps the first and last window bytes of a stream of chunks.
+
+  The bytes in between are counted and dropped, so capturing the output of a
+  chatty command costs at most 2 * window bytes of memory.
+  """
+
+  def __init__(self, window=None):
+    if window is None:
+      window = FLAGS.subprocess_capture_window_bytes
+    self.window = window
+    self.total = 0
+    self._head = []
+    self._head_size = 0
+    self._tail = collections.deque()
+    self._tail_size = 0
+
+  @property
+  def omitted(self):
+    """The number of bytes dropped between the head and the tail."""
+    return self.total - self._head_size - self._tail_size
+
+  def Append(self, chunk):
+    self.total += len(chunk)
+    if self._head_size < self.window:
+      head = chunk[:self.window - self._head_size]
+      self._head.append(head)
+      self._head_size += len(head)
+      chunk = chunk[len(head):]
+    if not chunk:
+      return
+    if len(chunk) >= self.window:
+      self._tail.clear()
+      chunk = chunk[-self.window:]
+      self._tail_size = 0
+    self._tail.append(chunk)
+    self._tail_size += len(chunk)
+    while self._tail_size - len(self._tail[0]) >= self.window:
+      self._tail_size -= len(self._tail.popleft())
+    excess = self._tail_size - self.window
+    if excess > 0:
+      # dropped bytes count as omitted, the tail stays at most window.
+      self._tail[0] = self._tail[0][excess:]
+      self._tail_size -= excess
+
+  def Value(self):
+    """Returns the head and tail, marking where bytes were omitted."""
+    head = b''.join(self._head)
+    tail = b''.join(self._tail)
+    if not self.omitted:
+      return head + tail
+    return head + (b'\n[... %d bytes omitted ...]\n' % self.omitted) + tail
+
+
+def BoundedCommunicate(task, task_in=None, window=None):
+  """Like communicate() but keeps only head/tail windows of the outputs.
 
   Args:
-    path: path to the file
-  Raises:
-    AssertionError: if the path doesn't exist.
+    task: a process with stdout and stderr pipes.
+    task_in: optional input to write to the task's stdin.
+    window: the size of the head and tail kept of each output, defaults to
+      subprocess_capture_window_bytes.
+
+  Returns:
+    A pair of BoundedCapture for stdout and stderr, once the task exited.
   """
-  assert os.path.exists(path), 'Path doesn\'t exist: %s' % path
-  with open('/dev/null', mode='w') as dev_null:
-    logging.debug('Ensuring we have cache hit (first attempt might take some '
-                  'time) for file: %s', path)
-    subprocess.check_call(['/usr/bin/head', '-c1', path],
-                          stdout=dev_null,
-                          stderr=dev_null)
+  captures = (BoundedCapture(window), BoundedCapture(window))
+  readers = []
+  for pipe, capture in zip((task.stdout, task.stderr), captures):
+    if pipe:
+      readers.append((pipe, capture.Append))
+  process_backend.PumpPipes(task.stdin, task_in, readers)
+  task.wait()
+  return captures
+
+
+def _ReadWindow(pipe, window=None):
+  """Drains a pipe, returning the head and tail windows of its content."""
+  capture = BoundedCapture(window)
+  while True:
+    chunk = pipe.read(_TeeStream._READ_SIZE)
+    if not chunk:
+      return capture.Value()
+    capture.Append(chunk)
 
 
 def Spawn(args, proc_input=None, proc_output=None, exec_dir=None,
-          exec_env=None, logfile=None, **kwargs):
+          exec_env=None, logfile=None, capture_window=None, **kwargs):
   """Execs a subprocess using Popen.
 
   Task output will be logged to file.
@@ -133,7 +569,11 @@ def Spawn(args, proc_input=None, proc_output=None, exec_dir=None,
     exec_dir: the directory the subprocess will run from.
     exec_env: the environment the subprocess will use.
     logfile: an optional filename to log stdout/stderr.
-    **kwargs: passed to subprocess.Popen as is.
+    capture_window: [optional] if set, communicate() keeps only this many
+      bytes of the head and of the tail of stdout/stderr in memory, see
+      BoundedCapture. Defaults to subprocess_capture_window_bytes if
+      subprocess_bounded_capture is set, and to unbounded otherwise.
+    **kwargs: passed to process_backend.Popen as is.
 
   Returns:
     An object supporting Popen.wait(), Popen.stdout and Popen.stdin
@@ -144,7 +584,10 @@ def Spawn(args, proc_input=None, proc_output=None, exec_dir=None,
   if not exec_env:
     exec_env = dict(os.environ)
 
+  log_record = None
   if not logfile:
+    log_record = BeginLogRecord(args, exec_dir, exec_env)
+  if not logfile and not log_record:
     logfile = CommandLogFile(args, exec_dir, exec_env)
   if not logfile:
     logfile = '/dev/null'
@@ -158,7 +601,7 @@ def Spawn(args, proc_input=None, proc_output=None, exec_dir=None,
   if proc_output == True:  # could be a file or True or None
     proc_output = subprocess.PIPE
     proc_err = subprocess.PIPE
-  elif not proc_output:
+  elif not proc_output and not log_record:
     # caller not doing anything with outputs, dont pass them on.
     # just write output straight to log.
     logged_to_file = True
@@ -170,13 +613,35 @@ def Spawn(args, proc_input=None, proc_output=None, exec_dir=None,
                 ' '.join(args), proc_input, proc_output, exec_dir)
   task = None
 
-  if not logged_to_file:
+  if log_record or (not logged_to_file and not _UsesExternalTee(logfile)):
+    # launch the task and let the output pump write the stdout/stderr to the
+    # log and pass it along to the caller's pipes or files.
+    task = process_backend.Popen(args, stdout=subprocess.PIPE,
+                                 stdin=proc_input, env=exec_env, cwd=exec_dir,
+                                 stderr=subprocess.PIPE, close_fds=True,
+                                 **kwargs)
+    if log_record:
+      log_record.task = task
+      task.log_record = log = log_record
+    else:
+      log = _SharedLogFile(logfile, 2)
+    out_stream = _TeeStream(task.stdout, log, proc_output)
+    err_stream = _TeeStream(task.stderr, log, proc_err)
+    pump = _GetOutputPump()
+    pump.Add(out_stream)
+    pump.Add(err_stream)
+
+    task.stdout = out_stream.reader
+    task.stderr = err_stream.reader
+    task.tee_stdout_task = out_stream
+    task.tee_stderr_task = err_stream
+  elif not logged_to_file:
     # launch the task and tee tasks to write the stdout/stderr to file and then
     # pass it along to the caller's pipes or files.
-    task = subprocess.Popen(args, stdout=subprocess.PIPE, stdin=proc_input,
-                            env=exec_env, cwd=exec_dir, stderr=subprocess.PIPE,
-                            close_fds=True,
-                            **kwargs)
+    task = process_backend.Popen(args, stdout=subprocess.PIPE,
+                                 stdin=proc_input, env=exec_env, cwd=exec_dir,
+                                 stderr=subprocess.PIPE, close_fds=True,
+                                 **kwargs)
     log_out_task = subprocess.Popen(_GetLogCommand(logfile),
                                     stdin=task.stdout, stdout=proc_output,
                                     stderr=open('/dev/null'),
@@ -192,14 +657,16 @@ def Spawn(args, proc_input=None, proc_output=None, exec_dir=None,
     task.tee_stderr_task = log_err_task
   else:
     # proc_output and proc_error are already pointing to the logfiles.
-    task = subprocess.Popen(args, stdout=proc_output, stdin=proc_input,
-                            env=exec_env, cwd=exec_dir, stderr=proc_err,
-                            close_fds=True)
+    task = process_backend.Popen(args, stdout=proc_output, stdin=proc_input,
+                                 env=exec_env, cwd=exec_dir, stderr=proc_err,
+                                 close_fds=True)
     task.logfile_handle = logfile_handle
 
   task.logged_stdout = ''
   task.logged_stderr = ''
   task.spawn_env = exec_env
+  if capture_window is None and FLAGS.subprocess_bounded_capture:
+    capture_window = FLAGS.subprocess_capture_window_bytes
 
   def LoggingCommunicate(task_in=None):
     """Used to capture the results of a call to communicate.
@@ -209,7 +676,14 @@ def Spawn(args, proc_input=None, proc_output=None, exec_dir=None,
     Returns:
       A pair of (stdout, stderr) from the process.
     """
-    task.logged_stdout, task.logged_stderr = task.RawCommunicate(input=task_in)
+    if capture_window is None:
+      task.logged_stdout, task.logged_stderr = task.RawCommunicate(
+          input=task_in)
+    else:
+      task.stdout_capture, task.stderr_capture = BoundedCommunicate(
+          task, task_in, capture_window)
+      task.logged_stdout = task.stdout_capture.Value()
+      task.logged_stderr = task.stderr_capture.Value()
     return (task.logged_stdout, task.logged_stderr)
 
   task.RawCommunicate = task.communicate
@@ -219,38 +693,248 @@ def Spawn(args, proc_input=None, proc_output=None, exec_dir=None,
 
 
 def _DefaultTimeoutFunction(task):
-  if task.poll() is None:
-    # still running!
-    task.kill()
+  # SIGTERM, then SIGKILL if the task is still running after a grace period.
+  timer_scheduler.GetTimerScheduler().Terminate(task)
+
+
+AttemptRecord = collections.namedtuple(
+    'AttemptRecord',
+    ['number', 'delay', 'timeout', 'start', 'duration', 'error'])
+
+
+class RetryPolicy(object):
+  """Decides how often, how fast and for how long an operation is retried.
+
+  Iterating over a policy yields one _Attempt per try. Between tries the
+  policy sleeps with exponential backoff and jitter. When a deadline is set
+  no attempt is started which cannot get at least min_attempt_seconds before
+  it, and each attempt's timeout is capped by the time remaining.
+
+  for attempt in policy:
+    try:
+      DoSomething(timeout=attempt.timeout)
+      attempt.Succeeded()
+      break
+    except SomeError as e:
+      attempt.Failed(e)
+
+  After iterating, records holds an AttemptRecord per attempt made and
+  deadline_exceeded tells whether attempts stopped because of the deadline.
+  """
+
+  def __init__(self, max_attempts=1, initial_delay_seconds=0,
+               max_delay_seconds=None, backoff_factor=2.0, jitter=0.0,
+               attempt_timeout_seconds=None, min_attempt_seconds=0,
+               deadline=None, clock=time.time, sleep_fn=time.sleep,
+               random_fn=random.random):
+    """Creates a retry policy.
+
+    Args:
+      max_attempts: total number of attempts, None for unlimited (requires a
+        deadline).
+      initial_delay_seconds: sleep between the first and second attempt.
+      max_delay_seconds: upper bound of the sleep between attempts.
+      backoff_factor: multiplier applied to the delay after each attempt.
+      jitter: fraction [0, 1] of each delay that is randomly shaved off, so
+        concurrent retriers do not move in lockstep.
+      attempt_timeout_seconds: timeout of a single attempt.
+      min_attempt_seconds: an attempt is only started if at least this much
+        time is left before the deadline.
+      deadline: absolute time (as returned by clock) after which no attempt
+        is started.
+      clock: returns the current time.
+      sleep_fn: sleeps the given number of seconds.
+      random_fn: returns a float in [0, 1).
+    """
+    assert max_attempts is not None or deadline is not None, (
+        'unbounded retries need a deadline')
+    assert 0 <= jitter <= 1, 'jitter must be within [0, 1]'
+    self.max_attempts = max_attempts
+    self.initial_delay_seconds = initial_delay_seconds
+    self.max_delay_seconds = max_delay_seconds
+    self.backoff_factor = backoff_factor
+    self.jitter = jitter
+    self.attempt_timeout_seconds = attempt_timeout_seconds
+    self.min_attempt_seconds = min_attempt_seconds
+    self.deadline = deadline
+    self._clock = clock
+    self._sleep_fn = sleep_fn
+    self._random_fn = random_fn
+    self.records = []
+    self.deadline_exceeded = False
+
+  def Remaining(self):
+    """Seconds left until the deadline, None if there is no deadline."""
+    if self.deadline is None:
+      return None
+    return self.deadline - self._clock()
+
+  def AttemptTimeout(self):
+    """The timeout for an attempt started now, None for no timeout."""
+    remaining = self.Remaining()
+    if remaining is None:
+      return self.attempt_timeout_seconds
+    if self.attempt_timeout_seconds is None:
+      return max(remaining, 0)
+    return max(min(self.attempt_timeout_seconds, remaining), 0)
+
+  def Delay(self, attempt_number):
+    """The sleep before the given (1 based) attempt, before jitter."""
+    if attempt_number <= 1:
+      return 0
+    delay = self.initial_delay_seconds * (
+        self.backoff_factor ** (attempt_number - 2))
+    if self.max_delay_seconds is not None:
+      delay = min(delay, self.max_delay_seconds)
+    return delay
+
+  def _CanFit(self, delay):
+    remaining = self.Remaining()
+    if remaining is None:
+      return True
+    return remaining - delay > self.min_attempt_seconds
+
+  def Reset(self):
+    """Forgets previous attempts, called when iteration starts."""
+    self.records = []
+    self.deadline_exceeded = False
+
+  def NextDelay(self, attempt_number):
+    """Returns the (jittered) sleep before an attempt, None to give up.
+
+    Args:
+      attempt_number: the 1 based number of the attempt about to start.
+    """
+    if self.max_attempts is not None and attempt_number > self.max_attempts:
+      return None
+    delay = self.Delay(attempt_number) * (1 - self.jitter * self._random_fn())
+    if not self._CanFit(delay):
+      logging.warning('Not starting attempt #%s: %.2fs left before the '
+                      'deadline.', attempt_number, self.Remaining())
+      self.deadline_exceeded = True
+      return None
+    return delay
+
+  def StartAttempt(self, attempt_number, delay):
+    """Returns the _Attempt starting now, after sleeping delay seconds."""
+    return _Attempt(self, attempt_number, delay, self.AttemptTimeout())
+
+  def __iter__(self):
+    self.Reset()
+    number = 0
+    while True:
+      number += 1
+      delay = self.NextDelay(number)
+      if delay is None:
+        return
+      if delay > 0:
+        self._sleep_fn(delay)
+      attempt = self.StartAttempt(number, delay)
+      yield attempt
+      attempt.Finish()
+      if attempt.succeeded:
+        return
+
+  def TotalTime(self):
+    """Seconds spent in attempts and in the sleeps between them."""
+    return sum(r.delay + r.duration for r in self.records)
+
+
+class _Attempt(object):
+  """A single try handed out by RetryPolicy."""
+
+  def __init__(self, policy, number, delay, timeout):
+    self._policy = policy
+    self.number = number
+    self.delay = delay
+    self.timeout = timeout
+    self.succeeded = False
+    self._start = policy._clock()  # pylint: disable=protected-access
+    self._finished = False
+
+  def Succeeded(self):
+    self.succeeded = True
+    self.Finish()
+
+  def Failed(self, error=None):
+    self.Finish(error)
+
+  def Finish(self, error=None):
+    if self._finished:
+      return
+    self._finished = True
+    now = self._policy._clock()  # pylint: disable=protected-access
+    self._policy.records.append(AttemptRecord(
+        number=self.number, delay=self.delay, timeout=self.timeout,
+        start=self._start, duration=now - self._start, error=error))
 
 
 def SpawnAndWaitWithRetry(args, retries=1, timeout_seconds=None,
                           timeout_fn=_DefaultTimeoutFunction, retry_fn=None,
-                          on_success=None, on_error=None, **kwds):
-  attempts = 0
-  while True:
-    logging.debug('Attempt #%s to %s', attempts, args)
+                          on_success=None, on_error=None, retry_policy=None,
+                          **kwds):
+  """Spawns args and waits for it, retrying on failure.
+
+  Args:
+    args: the command to run.
+    retries: number of retries after the first attempt. Ignored if a
+      retry_policy is given.
+    timeout_seconds: timeout of each attempt. Ignored if a retry_policy is
+      given.
+    timeout_fn: called with the task once an attempt times out.
+    retry_fn: called with the failed task before it is retried.
+    on_success: see WaitProcess.
+    on_error: see WaitProcess.
+    retry_policy: [optional] a RetryPolicy deciding on backoff, per attempt
+      timeouts and the overall deadline.
+    **kwds: passed on to Spawn.
+
+  Returns:
+    the successful task, with borg_out and borg_err holding its output.
+
+  Raises:
+    SpawnError: if the last attempt failed or no attempt fit the deadline.
+  """
+  if retry_policy is None:
+    retry_policy = RetryPolicy(max_attempts=retries + 1,
+                               attempt_timeout_seconds=timeout_seconds)
+  error = None
+  failed_task = None
+  for attempt in retry_policy:
+    logging.debug('Attempt #%s to %s', attempt.number - 1, args)
+    if failed_task and retry_fn:
+      retry_fn(failed_task)
     timer = None
+    task = None
     try:
       task = Spawn(args, **kwds)
-      if timeout_seconds:
-        timer = threading.Timer(timeout_seconds, timeout_fn, [task])
-        timer.daemon = True
-        timer.start()
+      if getattr(task, 'accounting', None):
+        task.accounting.retries = attempt.number - 1
+      if attempt.timeout:
+        timer = timer_scheduler.GetTimerScheduler().TerminateAfter(
+            task, attempt.timeout, on_timeout=timeout_fn)
       task.borg_out, task.borg_err = task.communicate()
       WaitProcess(args, task, on_success=on_success, on_error=on_error)
       if timer:
-        timer.cancel()
+        timer.Cancel()
+      attempt.Succeeded()
       return task
-    except SpawnError as b:
+    except SpawnError as e:
       if timer:
-        timer.cancel()
-      attempts += 1
-      if attempts > retries:
-        logging.error('Command %s failed %s times. Giving up.', args, attempts)
-        raise b
-      if retry_fn:
-        retry_fn(task)
+        timer.Cancel()
+      attempt.Failed(e)
+      error = e
+      failed_task = task
+
+  if retry_policy.deadline_exceeded:
+    logging.error('Command %s failed %s times and ran out of time. Giving up.',
+                  args, len(retry_policy.records))
+  else:
+    logging.error('Command %s failed %s times. Giving up.', args,
+                  len(retry_policy.records))
+  if error is None:
+    error = SpawnError('Command %s not attempted: deadline exceeded.' % args)
+  raise error
 
 
 def WaitProcess(context, task, on_error=None, on_success=None):
@@ -276,12 +960,18 @@ def WaitProcess(context, task, on_error=None, on_success=None):
     return (successes[0], None)
 
 
-def WaitProcesses(context_and_tasks, on_error=None, on_success=None):
+def WaitProcesses(context_and_tasks, on_error=None, on_success=None,
+                  timeout_seconds=None):
   """Waits for a group of processes to complete.
 
+  All tasks (and the tee helpers of tasks created by Spawn) are waited for at
+  once. Handlers are invoked in the order the tasks complete, so a fast
+  failure is reported without first waiting for slower tasks listed ahead of
+  it.
+
   Args:
     context_and_tasks: A sequence of pairs of context and a task object. Each
-      task will have wait() called and based on return code the success/error
+      task will be waited for and based on return code the success/error
       handler will be called with context, task.
     on_error: An error handler when task returns a non zero return code.
       Handler should accept context, task. The default handler logs the
@@ -290,9 +980,14 @@ def WaitProcesses(context_and_tasks, on_error=None, on_success=None):
     on_success: A success handler function f(context, task). On every
       successful wait() the handler is invoked and the return is returned
       back to the caller. The default handler is a no-op.
+    timeout_seconds: [optional] an overall deadline for all tasks to
+      complete. Tasks still running at the deadline are left running.
 
   Returns:
-    A pair of sequences of success and failure results.
+    A pair of sequences of success and failure results, in completion order.
+
+  Raises:
+    SpawnTimeoutError: if timeout_seconds elapse before all tasks complete.
   """
 
   if not on_error:
@@ -300,28 +995,225 @@ def WaitProcesses(context_and_tasks, on_error=None, on_success=None):
   if not on_success:
     on_success = DefaultOnSuccess
 
+  deadline = None
+  if timeout_seconds is not None:
+    deadline = time.time() + timeout_seconds
+
   success_results = []
   error_results = []
-  for context, task in context_and_tasks:
-    wait_result = task.wait()
-    if hasattr(task, 'tee_stdout_task'):
-      task.tee_stdout_task.wait()
-    if hasattr(task, 'tee_stderr_task'):
-      task.tee_stderr_task.wait()
-    if hasattr(task, 'logfile_handle'):
-      task.logfile_handle.flush()
-      task.logfile_handle.close()
-
-    if wait_result:
-      # note task.wait() returns 0 on success, non-zero on error.
-      error_result = on_error(context, task)
-      error_results.append(error_result)
-    else:
-      success_result = on_success(context, task)
-      success_results.append(success_result)
+  waiter = _CompletionWaiter(context_and_tasks)
+  try:
+    for context, task, wait_result in waiter.Completed(deadline):
+      if hasattr(task, 'logfile_handle'):
+        task.logfile_handle.flush()
+        task.logfile_handle.close()
+      if hasattr(task, 'log_record'):
+        task.log_record.Finish(task.returncode)
+      if getattr(task, 'accounting', None):
+        task.accounting.log_bytes = sum(
+            getattr(getattr(task, tee, None), 'logged_bytes', 0)
+            for tee in ('tee_stdout_task', 'tee_stderr_task'))
+
+      if wait_result:
+        # note task.wait() returns 0 on success, non-zero on error.
+        error_result = on_error(context, task)
+        error_results.append(error_result)
+      else:
+        success_result = on_success(context, task)
+        success_results.append(success_result)
+  finally:
+    waiter.Close()
+
+  if waiter.pending_contexts:
+    raise SpawnTimeoutError(
+        'Tasks did not complete in %ss: %s' % (timeout_seconds,
+                                               waiter.pending_contexts),
+        success_results, error_results, waiter.pending_contexts)
   return (success_results, error_results)
 
 
+def _OpenPidFd(pid):
+  """Returns a pollable fd for the process or None if not supported."""
+  pidfd_open = getattr(os, 'pidfd_open', None)
+  if pidfd_open is None:
+    return None
+  try:
+    fd = pidfd_open(pid)
+  except OSError:
+    # ENOSYS on kernels before 5.3, ESRCH if the pid was already reaped.
+    return None
+  _SetCloseOnExec(fd)
+  return fd
+
+
+class _WaitThread(object):
+  """Calls wait() of a task which can not be polled on a thread of its own.
+
+  Stands in for the task and its tee helpers in _CompletionWaiter. Like a
+  _TeeStream its returncode is 0 once they are all done, and done_fd turns
+  readable then. wait_result holds what the task's wait() returned.
+  """
+
+  def __init__(self, parts):
+    self.returncode = None
+    self.wait_result = None
+    self._error = None
+    read_fd, self._done_write_fd = os.pipe()
+    _SetCloseOnExec(read_fd)
+    _SetCloseOnExec(self._done_write_fd)
+    self._done_reader = os.fdopen(read_fd, 'rb', 0)
+    self.done_fd = read_fd
+    thread = threading.Thread(target=self._Wait, args=(parts,),
+                              name='wait_task')
+    thread.daemon = True
+    thread.start()
+
+  def _Wait(self, parts):
+    try:
+      self.wait_result = parts[0].wait()
+      for tee in parts[1:]:
+        tee.wait()
+    except Exception as e:  # pylint: disable=broad-except
+      # raised again by poll() on the thread waiting for the tasks.
+      self._error = e
+    finally:
+      self.returncode = 0
+      os.close(self._done_write_fd)
+
+  def poll(self):
+    if self.returncode is not None and self._error is not None:
+      raise self._error  # pylint: disable=raising-bad-type
+    return self.returncode
+
+  def Close(self):
+    self._done_reader.close()
+
+
+class _PendingTask(object):
+  """A task and its tee helpers, waited for as a unit."""
+
+  def __init__(self, context, task):
+    self.context = context
+    self.task = task
+    self.parts = [task]
+    for tee_attr in ('tee_stdout_task', 'tee_stderr_task'):
+      if hasattr(task, tee_attr):
+        self.parts.append(getattr(task, tee_attr))
+    self._wait_thread = None
+    if not all(callable(getattr(part, 'poll', None)) for part in self.parts):
+      # Objects only supporting wait() are waited for by a thread.
+      self._wait_thread = _WaitThread(self.parts)
+      self.parts = [self._wait_thread]
+    self.pidfds = {}
+    self.fds = {}
+    for part in self.parts:
+      pid = getattr(part, 'pid', None)
+      if isinstance(pid, int):
+        fd = _OpenPidFd(pid)
+        if fd is not None:
+          self.pidfds[fd] = part
+          self.fds[fd] = part
+      elif getattr(part, 'done_fd', None) is not None:
+        self.fds[part.done_fd] = part
+
+  def AllPartsWaitable(self):
+    """Whether every part has an fd which turns readable once it is done."""
+    return len(self.fds) == len(self.parts)
+
+  def Poll(self):
+    """Reaps finished parts, returns True once the task and tees are done."""
+    done = True
+    for part in self.parts:
+      if part.poll() is None:
+        done = False
+    return done
+
+  def Result(self):
+    if self._wait_thread is not None:
+      return self._wait_thread.wait_result
+    return self.task.returncode
+
+  def Close(self):
+    for fd in self.pidfds:
+      os.close(fd)
+    self.pidfds = {}
+    self.fds = {}
+    if self._wait_thread is not None:
+      self._wait_thread.Close()
+
+
+class _CompletionWaiter(object):
+  """Waits on many processes at once, yielding them as they complete.
+
+  Uses pidfds where the kernel and python support them, and the done_fd of
+  in-process tees and of tasks waited for by a _WaitThread. Otherwise falls
+  back to polling waitpid with an increasing interval.
+  """
+
+  _MIN_POLL_INTERVAL = 0.005
+  _MAX_POLL_INTERVAL = 0.1
+
+  def __init__(self, context_and_tasks):
+    self._pending = [_PendingTask(context, task)
+                     for context, task in context_and_tasks]
+
+  @property
+  def pending_contexts(self):
+    return [p.context for p in self._pending]
+
+  def Completed(self, deadline=None):
+    """Yields (context, task, returncode) in completion order."""
+    interval = self._MIN_POLL_INTERVAL
+    while self._pending:
+      still_pending = []
+      finished = []
+      for pending in self._pending:
+        if pending.Poll():
+          finished.append(pending)
+        else:
+          still_pending.append(pending)
+      self._pending = still_pending
+      for pending in finished:
+        pending.Close()
+        yield pending.context, pending.task, pending.Result()
+
+      if not self._pending:
+        return
+      remaining = None
+      if deadline is not None:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+          return
+      if all(p.AllPartsWaitable() for p in self._pending):
+        self._WaitForFds(remaining)
+      else:
+        if remaining is not None:
+          interval = min(interval, remaining)
+        time.sleep(interval)
+        interval = min(interval * 2, self._MAX_POLL_INTERVAL)
+
+  def _WaitForFds(self, remaining):
+    poller = select.poll()
+    for pending in self._pending:
+      for fd, part in pending.fds.items():
+        # An exited pid or finished tee stays readable, only wait on running
+        # parts.
+        if part.returncode is None:
+          poller.register(fd, select.POLLIN)
+    timeout_ms = None
+    if remaining is not None:
+      timeout_ms = max(1, int(remaining * 1000))
+    try:
+      poller.poll(timeout_ms)
+    except (IOError, OSError, select.error) as e:
+      if e.args[0] != errno.EINTR:
+        raise
+
+  def Close(self):
+    for pending in self._pending:
+      pending.Close()
+
+
 def DefaultOnError(context, task):
   """Default error handling for failed processes.
 
@@ -346,17 +1238,19 @@ def DefaultOnError(context, task):
   extra_details = ''
   if hasattr(task, 'logfile_handle'):
     extra_details += 'logfile: ' + task.logfile_handle.name
+  elif hasattr(task, 'log_record'):
+    extra_details += 'log: ' + task.log_record.name
   output = []
 
   if task.logged_stdout:
     output.append(task.logged_stdout)
   elif task.stdout and not task.stdout.closed:
-    output += task.stdout.readlines()
+    output.append(_ReadWindow(task.stdout))
 
   if task.logged_stderr:
     output.append(task.logged_stderr)
   elif task.stderr and not task.stderr.closed:
-    output += task.stderr.readlines()
+    output.append(_ReadWindow(task.stderr))
 
   if output:
     logging.error('Task failed: output: %s', '\n'.join(output))
@@ -382,3 +1276,14 @@ def DefaultOnSuccess(unused_context, unused_task):
 
 class SpawnError(Exception):
   pass
+
+
+class SpawnTimeoutError(SpawnError):
+  """Raised when tasks outlive the deadline given to WaitProcesses."""
+
+  def __init__(self, message, success_results, error_results,
+               pending_contexts):
+    super(SpawnTimeoutError, self).__init__(message)
+    self.success_results = success_results
+    self.error_results = error_results
+    self.pending_contexts = pending_contexts
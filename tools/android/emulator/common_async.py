@@ -0,0 +1,363 @@
+# Copyright 2018 The Android Open Source Project. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""asyncio counterparts of the subprocess utilities in common.
+
+Processes are logged to the same log store or CommandLogFile logs and fail
+with the same SpawnErrors as their blocking counterparts, but many of them can be driven
+from a single event loop instead of one blocked thread per subprocess.
+
+Python 3 only.
+"""
+
+import asyncio
+import os
+import subprocess
+
+from absl import logging
+
+from tools.android.emulator import common
+
+_READ_SIZE = 64 << 10
+
+
+class AsyncTask(object):
+  """A spawned process whose output is logged by the event loop.
+
+  Mirrors the attributes of tasks returned by common.Spawn which handlers
+  rely on: args, returncode, logged_stdout, logged_stderr and spawn_env.
+  Output is decoded to str.
+  """
+
+  def __init__(self, args, process, logfile, proc_output, exec_env,
+               log_record=None):
+    self.args = args
+    self.process = process
+    self.pid = process.pid
+    self.logfile = log_record.name if log_record else logfile
+    self.log_record = log_record
+    self.spawn_env = exec_env
+    self.logged_stdout = ''
+    self.logged_stderr = ''
+    # No pipes are handed out, output is available through communicate().
+    self.stdout = None
+    self.stderr = None
+    self.borg_out = None
+    self.borg_err = None
+    self._pumps = []
+    self._log = None
+    self._stdout_chunks = []
+    self._stderr_chunks = []
+    if log_record:
+      log_record.task = self
+    elif process.stdout is not None:
+      self._log = open(logfile, 'ab')
+    if process.stdout is not None:
+      self._pumps.append(asyncio.ensure_future(self._Pump(
+          process.stdout, proc_output, self._stdout_chunks)))
+      self._pumps.append(asyncio.ensure_future(self._Pump(
+          process.stderr, proc_output, self._stderr_chunks)))
+
+  @property
+  def returncode(self):
+    return self.process.returncode
+
+  def poll(self):
+    return self.process.returncode
+
+  def kill(self):
+    if self.process.returncode is None:
+      self.process.kill()
+
+  def terminate(self):
+    if self.process.returncode is None:
+      self.process.terminate()
+
+  async def _Pump(self, stream, proc_output, chunks):
+    """Copies a process stream to the log and to the caller."""
+    try:
+      while True:
+        data = await stream.read(_READ_SIZE)
+        if not data:
+          return
+        if self.log_record:
+          self.log_record.Write(data)
+        else:
+          self._log.write(data)
+          self._log.flush()
+        if proc_output is True:
+          chunks.append(data)
+        elif isinstance(proc_output, int):
+          os.write(proc_output, data)
+        elif proc_output:
+          proc_output.write(data)
+    finally:
+      if self.log_record:
+        self.log_record.Release()
+
+  async def wait(self):
+    """Waits for the process and its logging, returning the exit code."""
+    returncode = await self.process.wait()
+    if self._pumps:
+      try:
+        await asyncio.gather(*self._pumps)
+      finally:
+        self._pumps = []
+        if self._log:
+          self._log.close()
+    if self.log_record:
+      self.log_record.Finish(returncode)
+    return returncode
+
+  async def communicate(self, task_in=None):
+    """Feeds task_in to the process and waits for it.
+
+    Args:
+      task_in: optional input to write to stdin.
+    Returns:
+      A pair of (stdout, stderr) from the process.
+    """
+    if task_in is not None:
+      if isinstance(task_in, str):
+        task_in = task_in.encode('utf-8')
+      self.process.stdin.write(task_in)
+      await self.process.stdin.drain()
+    if self.process.stdin is not None:
+      self.process.stdin.close()
+    await self.wait()
+    self.logged_stdout = _Decode(self._stdout_chunks)
+    self.logged_stderr = _Decode(self._stderr_chunks)
+    return (self.logged_stdout, self.logged_stderr)
+
+
+def _Decode(chunks):
+  return b''.join(chunks).decode('utf-8', 'replace')
+
+
+async def AsyncSpawn(args, proc_input=None, proc_output=None, exec_dir=None,
+                     exec_env=None, logfile=None, **kwargs):
+  """Execs a subprocess on the running event loop.
+
+  Task output will be logged to file.
+
+  Args:
+    args: A list of arguments to execute
+    proc_input: takes true or a file descriptor. If true the stdin is a
+      writable pipe fed by communicate(). If file descriptor the file is
+      piped into stdin
+    proc_output: true to capture stdout/stderr for communicate(), a file
+      descriptor or binary file object to copy them to.
+    exec_dir: the directory the subprocess will run from.
+    exec_env: the environment the subprocess will use.
+    logfile: an optional filename to log stdout/stderr.
+    **kwargs: passed to asyncio.create_subprocess_exec as is.
+
+  Returns:
+    An AsyncTask.
+  """
+  if not exec_dir:
+    exec_dir = os.getcwd()
+  if not exec_env:
+    exec_env = dict(os.environ)
+
+  log_record = None
+  if not logfile:
+    log_record = common.BeginLogRecord(args, exec_dir, exec_env)
+  if not logfile and not log_record:
+    logfile = common.CommandLogFile(args, exec_dir, exec_env)
+  if not logfile:
+    logfile = '/dev/null'
+
+  if proc_input is True:
+    proc_input = subprocess.PIPE
+
+  logging.debug('Launching %s. input: %s, output: %s, execdir: %s',
+                ' '.join(args), proc_input, proc_output, exec_dir)
+  if proc_output or log_record:
+    # the output is pumped to the log (and the caller) by the event loop.
+    process = await asyncio.create_subprocess_exec(
+        *args, stdin=proc_input, stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE, env=exec_env, cwd=exec_dir, close_fds=True,
+        **kwargs)
+  else:
+    # caller not doing anything with outputs, write them straight to log.
+    with open(logfile, 'ab') as logfile_handle:
+      process = await asyncio.create_subprocess_exec(
+          *args, stdin=proc_input, stdout=logfile_handle,
+          stderr=logfile_handle, env=exec_env, cwd=exec_dir, close_fds=True,
+          **kwargs)
+  return AsyncTask(args, process, logfile, proc_output, exec_env,
+                   log_record=log_record)
+
+
+def DefaultOnError(context, task):
+  """Raises the SpawnError common.DefaultOnError raises for the task."""
+  output = [o for o in (task.logged_stdout, task.logged_stderr) if o]
+  if output:
+    logging.error('Task failed: output: %s', '\n'.join(output))
+  raise common.SpawnError('Task failed. Context: %s, retcode: %s logfile: %s'
+                          % (context, task.returncode, task.logfile))
+
+
+async def AsyncWaitProcess(context, task, on_error=None, on_success=None):
+  """The single process case of AsyncWaitProcesses.
+
+  Args:
+    context: The context object given to on_success or on_error handlers.
+    task: An AsyncTask.
+    on_error: see common.WaitProcess.
+    on_success: see common.WaitProcess.
+
+  Returns:
+    A pair (success, failure) with the result of running the handler function.
+  """
+  successes, failures = await AsyncWaitProcesses(
+      [(context, task)], on_error=on_error, on_success=on_success)
+  if failures:
+    return (None, failures[0])
+  else:
+    return (successes[0], None)
+
+
+async def AsyncWaitProcesses(context_and_tasks, on_error=None,
+                             on_success=None, timeout_seconds=None):
+  """Waits for a group of AsyncTasks, calling handlers as each completes.
+
+  Args:
+    context_and_tasks: A sequence of pairs of context and an AsyncTask.
+    on_error: see common.WaitProcesses. The default raises SpawnError.
+    on_success: see common.WaitProcesses.
+    timeout_seconds: [optional] an overall deadline for all tasks to
+      complete. Tasks still running at the deadline are left running.
+
+  Returns:
+    A pair of sequences of success and failure results, in completion order.
+
+  Raises:
+    SpawnTimeoutError: if timeout_seconds elapse before all tasks complete.
+  """
+  if not on_error:
+    on_error = DefaultOnError
+  if not on_success:
+    on_success = common.DefaultOnSuccess
+
+  loop = asyncio.get_event_loop()
+  deadline = None
+  if timeout_seconds is not None:
+    deadline = loop.time() + timeout_seconds
+
+  waiters = {}
+  for context, task in context_and_tasks:
+    waiters[asyncio.ensure_future(task.wait())] = (context, task)
+
+  success_results = []
+  error_results = []
+  try:
+    while waiters:
+      timeout = None
+      if deadline is not None:
+        timeout = max(deadline - loop.time(), 0)
+      done, _ = await asyncio.wait(list(waiters), timeout=timeout,
+                                   return_when=asyncio.FIRST_COMPLETED)
+      if not done:
+        pending_contexts = [c for c, _ in waiters.values()]
+        raise common.SpawnTimeoutError(
+            'Tasks did not complete in %ss: %s' % (timeout_seconds,
+                                                   pending_contexts),
+            success_results, error_results, pending_contexts)
+      # keep the order of context_and_tasks among tasks done together.
+      for waiter in [w for w in waiters if w in done]:
+        context, task = waiters.pop(waiter)
+        if waiter.result():
+          error_results.append(on_error(context, task))
+        else:
+          success_results.append(on_success(context, task))
+  finally:
+    for waiter in waiters:
+      waiter.cancel()
+  return (success_results, error_results)
+
+
+def _DefaultTimeoutFunction(task):
+  task.kill()
+
+
+async def AsyncSpawnAndWaitWithRetry(args, retries=1, timeout_seconds=None,
+                                     timeout_fn=_DefaultTimeoutFunction,
+                                     retry_fn=None, on_success=None,
+                                     on_error=None, retry_policy=None,
+                                     task_in=None, **kwds):
+  """The asyncio counterpart of common.SpawnAndWaitWithRetry.
+
+  Args:
+    args: the command to run.
+    retries: number of retries after the first attempt. Ignored if a
+      retry_policy is given.
+    timeout_seconds: timeout of each attempt. Ignored if a retry_policy is
+      given.
+    timeout_fn: called with the task once an attempt times out.
+    retry_fn: called with the failed task before it is retried.
+    on_success: see common.WaitProcess.
+    on_error: see common.WaitProcess.
+    retry_policy: [optional] a common.RetryPolicy. Its sleeps are awaited.
+    task_in: optional input given to each attempt.
+    **kwds: passed on to AsyncSpawn.
+
+  Returns:
+    the successful AsyncTask, with borg_out and borg_err holding its output.
+
+  Raises:
+    SpawnError: if the last attempt failed or no attempt fit the deadline.
+  """
+  if retry_policy is None:
+    retry_policy = common.RetryPolicy(max_attempts=retries + 1,
+                                      attempt_timeout_seconds=timeout_seconds)
+  retry_policy.Reset()
+  error = None
+  failed_task = None
+  number = 0
+  while True:
+    number += 1
+    delay = retry_policy.NextDelay(number)
+    if delay is None:
+      break
+    if delay > 0:
+      await asyncio.sleep(delay)
+    attempt = retry_policy.StartAttempt(number, delay)
+    logging.debug('Attempt #%s to %s', number - 1, args)
+    if failed_task and retry_fn:
+      retry_fn(failed_task)
+    task = None
+    try:
+      task = await AsyncSpawn(args, **kwds)
+      communicate = asyncio.ensure_future(task.communicate(task_in))
+      done, _ = await asyncio.wait([communicate], timeout=attempt.timeout)
+      if not done:
+        timeout_fn(task)
+      task.borg_out, task.borg_err = await communicate
+      await AsyncWaitProcess(args, task, on_success=on_success,
+                             on_error=on_error)
+      attempt.Succeeded()
+      return task
+    except common.SpawnError as e:
+      attempt.Failed(e)
+      error = e
+      failed_task = task
+
+  logging.error('Command %s failed %s times. Giving up.', args,
+                len(retry_policy.records))
+  if error is None:
+    error = common.SpawnError(
+        'Command %s not attempted: deadline exceeded.' % args)
+  raise error
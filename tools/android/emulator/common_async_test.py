@@ -0,0 +1,147 @@
+# Copyright 2018 The Android Open Source Project. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for tools.android.emulator.common_async, using real processes."""
+
+import asyncio
+import os
+import tempfile
+import time
+
+from absl.testing import absltest
+from tools.android.emulator import common
+from tools.android.emulator import common_async
+from tools.android.emulator import log_store
+
+
+def _Run(coroutine):
+  return asyncio.get_event_loop().run_until_complete(coroutine)
+
+
+class CommonAsyncTest(absltest.TestCase):
+
+  def setUp(self):
+    super(CommonAsyncTest, self).setUp()
+    self.logfile = tempfile.NamedTemporaryFile(delete=False).name
+
+  def tearDown(self):
+    super(CommonAsyncTest, self).tearDown()
+    os.remove(self.logfile)
+
+  def testSpawn_communicateIsLogged(self):
+    async def Body():
+      task = await common_async.AsyncSpawn(
+          ['/bin/sh', '-c', 'cat; echo err >&2'], proc_input=True,
+          proc_output=True, logfile=self.logfile)
+      return task, await task.communicate('hello\n')
+
+    task, (out, err) = _Run(Body())
+    self.assertEqual('hello\n', out)
+    self.assertEqual('err\n', err)
+    self.assertEqual(out, task.logged_stdout)
+    self.assertEqual(0, task.returncode)
+    with open(self.logfile) as f:
+      self.assertEqual(set(['hello\n', 'err\n']), set(f.readlines()))
+
+  def testSpawn_outputToLogOnly(self):
+    async def Body():
+      task = await common_async.AsyncSpawn(['/bin/echo', 'logged'],
+                                           logfile=self.logfile)
+      return await task.wait()
+
+    self.assertEqual(0, _Run(Body()))
+    with open(self.logfile) as f:
+      self.assertEqual('logged\n', f.read())
+
+  def testSpawn_logStore(self):
+    log_dir = tempfile.mkdtemp()
+    env = dict(os.environ, subprocess_log_dir=log_dir)
+
+    async def Body():
+      task = await common_async.AsyncSpawn(
+          ['/bin/sh', '-c', 'echo out; echo err >&2; exit 2'], exec_env=env)
+      return await task.wait()
+
+    self.assertEqual(2, _Run(Body()))
+    self.assertEqual([], [f for f in os.listdir(log_dir)
+                          if f.endswith('.txt')])
+    store = log_store.LogStore(os.path.join(log_dir, 'subprocess_logs'))
+    command, = store.Commands()
+    self.assertEqual(2, command['exit_code'])
+    self.assertEqual(set([b'out\n', b'err\n']),
+                     set(store.ReadOutput(command['id']).splitlines(True)))
+
+  def testWaitProcesses_completionOrderAndErrors(self):
+    async def Body():
+      slow = await common_async.AsyncSpawn(['/bin/sleep', '1'],
+                                           logfile=self.logfile)
+      fast = await common_async.AsyncSpawn(['/bin/false'],
+                                           logfile=self.logfile)
+      return await common_async.AsyncWaitProcesses(
+          [('slow', slow), ('fast', fast)],
+          on_error=lambda context, task: (context, slow.returncode),
+          on_success=lambda context, task: context)
+
+    self.assertEqual((['slow'], [('fast', None)]), _Run(Body()))
+
+  def testWaitProcess_defaultRaisesSpawnError(self):
+    async def Body():
+      task = await common_async.AsyncSpawn(['/bin/false'],
+                                           logfile=self.logfile)
+      await common_async.AsyncWaitProcess('ctx', task)
+
+    self.assertRaises(common.SpawnError, _Run, Body())
+
+  def testWaitProcesses_deadline(self):
+    async def Body():
+      task = await common_async.AsyncSpawn(['/bin/sleep', '10'],
+                                           logfile=self.logfile)
+      try:
+        await common_async.AsyncWaitProcesses([('sleepy', task)],
+                                              timeout_seconds=0.2)
+      finally:
+        task.kill()
+        await task.wait()
+
+    with self.assertRaises(common.SpawnTimeoutError) as cm:
+      _Run(Body())
+    self.assertEqual(['sleepy'], cm.exception.pending_contexts)
+
+  def testRetry_timeoutThenGiveUp(self):
+    retried = []
+    start = time.time()
+    with self.assertRaises(common.SpawnError):
+      _Run(common_async.AsyncSpawnAndWaitWithRetry(
+          ['/bin/sleep', '10'], retries=2, timeout_seconds=0.2,
+          retry_fn=retried.append, logfile=self.logfile))
+    self.assertEqual(2, len(retried))
+    self.assertLess(time.time() - start, 5)
+
+  def testRetry_concurrentCommandsShareLoop(self):
+    async def Body():
+      return await asyncio.gather(*[
+          common_async.AsyncSpawnAndWaitWithRetry(
+              ['/bin/sh', '-c', 'sleep 0.5; echo %d' % i], proc_output=True,
+              logfile=self.logfile)
+          for i in range(10)])
+
+    start = time.time()
+    tasks = _Run(Body())
+    self.assertEqual(['%d\n' % i for i in range(10)],
+                     [t.borg_out for t in tasks])
+    self.assertLess(time.time() - start, 4)
+
+
+if __name__ == '__main__':
+  absltest.main()
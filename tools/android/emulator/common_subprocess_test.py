@@ -16,10 +16,14 @@
 
 
 
-import threading
+import os
+import tempfile
+import time
 
 from google.apputils import basetest as googletest
 from tools.android.emulator import common
+from tools.android.emulator import log_store
+from tools.android.emulator import timer_scheduler
 
 
 def _CheckExecution(fn):
@@ -30,36 +34,48 @@ def _CheckExecution(fn):
   return _WrappedExecution
 
 
+class _MonitoredScheduler(timer_scheduler.TimerScheduler):
+  """Keeps the command timeouts scheduled, with their checked functions."""
+
+  def __init__(self):
+    super(_MonitoredScheduler, self).__init__()
+    self.timers = []
+
+  def TerminateAfter(self, task, timeout_seconds, on_timeout=None,
+                     grace_seconds=None):
+    checked_function = on_timeout and _CheckExecution(on_timeout)
+    timer = super(_MonitoredScheduler, self).TerminateAfter(
+        task, timeout_seconds, on_timeout=checked_function,
+        grace_seconds=grace_seconds)
+    timer._checked_function = checked_function
+    self.timers.append(timer)
+    return timer
+
+
+class _WaitOnly(object):
+  """A task which can only be waited for."""
+
+  def __init__(self, task):
+    self._task = task
+
+  def wait(self):
+    return self._task.wait()
+
+
 class CommonSubprocessTest(googletest.TestCase):
   def setUp(self):
     super(CommonSubprocessTest, self).setUp()
     self.custom_timeout_called = False
-    self.timers = []
-    self.timer_factory = threading.Timer
-    threading.Timer = self._MonitorTimerCreation()
+    self.scheduler = _MonitoredScheduler()
+    self.timers = self.scheduler.timers
+    self.scheduler_factory = timer_scheduler.GetTimerScheduler
+    timer_scheduler.GetTimerScheduler = lambda: self.scheduler
 
   def tearDown(self):
     super(CommonSubprocessTest, self).tearDown()
-    threading.Timer = self.timer_factory
+    timer_scheduler.GetTimerScheduler = self.scheduler_factory
     self.timers = None
 
-  def _MonitorTimerCreation(self):
-    def TimerFactory(interval, function, *args, **kwargs):
-      checked_function = _CheckExecution(function)
-      timer = self.timer_factory(interval, checked_function, *args, **kwargs)
-      timer._ActualCancel = timer.cancel
-      timer._was_cancel_called = False  # cancel should always be called
-      timer._checked_function = checked_function
-
-      def _LogCancel():
-        timer._was_cancel_called = True
-        return timer._ActualCancel()
-
-      timer.cancel = _LogCancel
-      self.timers.append(timer)
-      return timer
-    return TimerFactory
-
   def testTimeout(self):
     try:
       common.SpawnAndWaitWithRetry(
@@ -71,6 +87,22 @@ class CommonSubprocessTest(googletest.TestCase):
     except common.SpawnError as unused_expected:
       pass
     self._AssertTimersExecuted()
+    counters = self.scheduler.Counters()
+    self.assertEquals(3, counters['timeouts'])
+    self.assertEquals(3, counters['terminated'])
+    self.assertEquals(0, counters['killed'])
+
+  def testTimeout_escalatesToKill(self):
+    task = common.Spawn(
+        ['/bin/sh', '-c', 'trap "" TERM; while :; do sleep 0.1; done'],
+        proc_output=True)
+    timer = self.scheduler.TerminateAfter(task, 0.5, grace_seconds=0.5)
+    task.communicate()
+    timer.Cancel()
+    self.assertEquals(-9, task.wait())
+    counters = self.scheduler.Counters()
+    self.assertEquals(1, counters['terminated'])
+    self.assertEquals(1, counters['killed'])
 
   def testTimeout_successful(self):
     try:
@@ -111,15 +143,196 @@ class CommonSubprocessTest(googletest.TestCase):
       self.assertTrue(self.custom_timeout_called, 'Custom callback not called.')
     self._AssertTimersExecuted()
 
+  def testInProcessTee_pipes(self):
+    logfile = tempfile.NamedTemporaryFile(delete=False).name
+    task = common.Spawn(['/bin/sh', '-c', 'echo out; echo err >&2'],
+                        proc_output=True, logfile=logfile)
+    out, err = task.communicate()
+    common.WaitProcess('tee', task)
+    self.assertEquals('out\n', out)
+    self.assertEquals('err\n', err)
+    self.assertEquals(out, task.logged_stdout)
+    with open(logfile) as f:
+      self.assertEquals(set(['out\n', 'err\n']), set(f.readlines()))
+
+  def testInProcessTee_largeOutput(self):
+    logfile = tempfile.NamedTemporaryFile(delete=False).name
+    task = common.Spawn(['/usr/bin/head', '-c', str(3 << 20), '/dev/zero'],
+                        proc_output=True, logfile=logfile)
+    out, _ = task.communicate()
+    common.WaitProcess('tee', task)
+    self.assertEquals(3 << 20, len(out))
+    self.assertEquals(3 << 20, os.path.getsize(logfile))
+
+  def testBoundedCapture(self):
+    logfile = tempfile.NamedTemporaryFile(delete=False).name
+    task = common.Spawn(['/bin/sh', '-c', 'seq 1 200000; echo err >&2'],
+                        proc_output=True, logfile=logfile, capture_window=100)
+    out, err = task.communicate()
+    common.WaitProcess('bounded', task)
+    self.assertTrue(out.startswith(b'1\n2\n3\n'), out)
+    self.assertTrue(out.endswith(b'199999\n200000\n'), out)
+    self.assertLess(len(out), 300)
+    self.assertEquals(b'err\n', err)
+    self.assertEquals(out, task.logged_stdout)
+    self.assertEquals(task.stdout_capture.total - 200,
+                      task.stdout_capture.omitted)
+    # the log still has the full output.
+    self.assertEquals(task.stdout_capture.total + 4,
+                      os.path.getsize(logfile))
+
+  def testInProcessTee_toFile(self):
+    logfile = tempfile.NamedTemporaryFile(delete=False).name
+    with tempfile.NamedTemporaryFile() as output:
+      task = common.Spawn(['/bin/echo', 'hello'], proc_output=output,
+                          logfile=logfile)
+      common.WaitProcess('tee', task)
+      self.assertIsNone(task.stdout)
+      output.seek(0)
+      self.assertEquals('hello\n', output.read())
+    with open(logfile) as f:
+      self.assertEquals('hello\n', f.read())
+
+  def testWaitProcesses_completionOrder(self):
+    slow = common.Spawn(['/bin/sleep', '2'])
+    fast = common.Spawn(['/bin/sh', '-c', 'exit 3'])
+    completed = []
+
+    def OnSuccess(context, task):
+      completed.append((context, slow.poll()))
+      return context
+
+    def OnError(context, task):
+      completed.append((context, slow.poll()))
+      return task.returncode
+
+    success, errors = common.WaitProcesses([('slow', slow), ('fast', fast)],
+                                           on_error=OnError,
+                                           on_success=OnSuccess)
+    self.assertEquals(['slow'], success)
+    self.assertEquals([3], errors)
+    # the failure is reported while the slow task is still running.
+    self.assertEquals([('fast', None), ('slow', 0)], completed)
+
+  def testWaitProcesses_deadline(self):
+    slow = common.Spawn(['/bin/sleep', '10'])
+    fast = common.Spawn(['/bin/true'])
+    try:
+      common.WaitProcesses([('slow', slow), ('fast', fast)],
+                           timeout_seconds=0.5)
+      self.fail('Should have timed out.')
+    except common.SpawnTimeoutError as e:
+      self.assertEquals(['slow'], e.pending_contexts)
+      self.assertEquals([None], e.success_results)
+      self.assertIsNone(slow.poll())
+    finally:
+      slow.kill()
+      slow.wait()
+
+  def testWaitProcesses_inProcessTee(self):
+    logfile = tempfile.NamedTemporaryFile(delete=False).name
+    task = common.Spawn(['/bin/echo', 'hello'], proc_output=True,
+                        logfile=logfile)
+    common.WaitProcesses([('tee', task)], timeout_seconds=10)
+    self.assertEquals(0, task.returncode)
+    with open(logfile) as f:
+      self.assertEquals('hello\n', f.read())
+
+  def testWaitProcesses_inProcessTeeWaitsOnFds(self):
+    slow = common.Spawn(['/bin/sh', '-c', 'sleep 1; echo slow'],
+                        proc_output=True)
+    fast = common.Spawn(['/bin/sh', '-c', 'echo fast; exit 3'],
+                        proc_output=True)
+    completed = []
+    sleeps = []
+    sleep = time.sleep
+
+    def RecordingSleep(seconds):
+      sleeps.append(seconds)
+      sleep(seconds)
+
+    def OnDone(context, task):
+      completed.append((context, task.returncode))
+
+    time.sleep = RecordingSleep
+    try:
+      common.WaitProcesses([('slow', slow), ('fast', fast)], on_error=OnDone,
+                           on_success=OnDone, timeout_seconds=10)
+    finally:
+      time.sleep = sleep
+    self.assertEquals([('fast', 3), ('slow', 0)], completed)
+    if hasattr(os, 'pidfd_open'):
+      # the tees are waited for with the pidfds instead of polled.
+      self.assertEquals([], sleeps)
+
+  def testWaitProcesses_waitOnlyTasksInCompletionOrder(self):
+    slow = _WaitOnly(common.Spawn(['/bin/sleep', '1']))
+    fast = common.Spawn(['/bin/sh', '-c', 'exit 3'])
+    completed = []
+
+    def OnDone(context, unused_task):
+      completed.append(context)
+
+    common.WaitProcesses([('slow', slow), ('fast', fast)], on_error=OnDone,
+                         on_success=OnDone, timeout_seconds=10)
+    self.assertEquals(['fast', 'slow'], completed)
+
+  def testLogStore(self):
+    log_dir = tempfile.mkdtemp()
+    env = dict(os.environ, subprocess_log_dir=log_dir)
+    task = common.Spawn(['/bin/sh', '-c', 'echo out; exit 2'],
+                        proc_output=True, exec_env=env)
+    out, _ = task.communicate()
+    self.assertRaises(common.SpawnError, common.WaitProcess, 'store', task)
+    self.assertEquals('out\n', out)
+    self.assertEquals([], [f for f in os.listdir(log_dir)
+                           if f.endswith('.txt')])
+    store = log_store.LogStore(os.path.join(log_dir, 'subprocess_logs'))
+    command, = store.Commands()
+    self.assertEquals(['/bin/sh', '-c', 'echo out; exit 2'], command['argv'])
+    self.assertEquals(2, command['exit_code'])
+    self.assertEquals(b'out\n', store.ReadOutput(command['id']))
+
+  def testLogStore_brokenLogKeepsPumping(self):
+    log_dir = tempfile.mkdtemp()
+    env = dict(os.environ, subprocess_log_dir=log_dir)
+    store = log_store.GetLogStore(os.path.join(log_dir, 'subprocess_logs'))
+
+    def BrokenAppend(unused_command_id, unused_data):
+      raise ValueError('broken log')
+
+    store.Append = BrokenAppend
+    broken = common.Spawn(['/bin/echo', 'lost'], exec_env=env)
+    common.WaitProcesses([('broken', broken)], timeout_seconds=10)
+    # the output of other tasks still flows.
+    task = common.Spawn(['/bin/echo', 'hello'], proc_output=True)
+    out, _ = task.communicate()
+    common.WaitProcesses([('tee', task)], timeout_seconds=10)
+    self.assertEquals(b'hello\n', out)
+
+  def testAccounting(self):
+    logfile = tempfile.NamedTemporaryFile(delete=False).name
+    attempts = tempfile.NamedTemporaryFile(delete=False).name
+    # fails on the first attempt only.
+    task = common.SpawnAndWaitWithRetry(
+        ['/bin/sh', '-c', 'echo out; echo x >> %s; '
+         'test $(wc -l < %s) -gt 1' % (attempts, attempts)],
+        retries=1, proc_output=True, logfile=logfile)
+    record = task.accounting
+    self.assertEquals(0, record.exit_status)
+    self.assertEquals(1, record.retries)
+    self.assertEquals(4, record.log_bytes)
+    self.assertIsNotNone(record.user_seconds)
+
   def _AssertTimersExecuted(self):
     for timer in self.timers:
       self.assertTrue(timer._checked_function.called, 'function never called.')
-      self.assertTrue(timer._was_cancel_called, 'even executed timers should '
+      self.assertTrue(timer.cancelled, 'even executed timers should '
                       'be cancelled.')
 
   def _AssertTimersNotExecuted(self):
     for timer in self.timers:
-      self.assertTrue(timer._was_cancel_called, 'cancel not attempted')
+      self.assertTrue(timer.cancelled, 'cancel not attempted')
       self.assertFalse(timer._checked_function.called, 'the timer function was'
                        'executed')
 
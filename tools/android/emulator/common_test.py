@@ -21,15 +21,30 @@ import subprocess
 
 
 
+from absl import flags
 import mox
 import six
 
 from google.apputils import basetest as googletest
 from tools.android.emulator import common
+from tools.android.emulator import process_backend
+
+FLAGS = flags.FLAGS
 
 
 class CommonTest(mox.MoxTestBase):
 
+  def setUp(self):
+    super(CommonTest, self).setUp()
+    self._tee_in_process = FLAGS.subprocess_tee_in_process
+    self._log_store = FLAGS.subprocess_log_store
+    FLAGS.subprocess_log_store = False
+
+  def tearDown(self):
+    super(CommonTest, self).tearDown()
+    FLAGS.subprocess_tee_in_process = self._tee_in_process
+    FLAGS.subprocess_log_store = self._log_store
+
   def testDefaultOnError(self):
     waiter = Waitable(1)
     waiter.stdout = None
@@ -121,8 +136,8 @@ class CommonTest(mox.MoxTestBase):
     file_handle = 1
     open(logfile_name, 'a').AndReturn(file_handle)
 
-    self.mox.StubOutWithMock(subprocess, 'Popen')
-    subprocess.Popen(
+    self.mox.StubOutWithMock(process_backend, 'Popen')
+    process_backend.Popen(
         args,
         stdout=file_handle,
         stderr=file_handle,
@@ -137,6 +152,7 @@ class CommonTest(mox.MoxTestBase):
     self.assertEquals(task.logfile_handle, file_handle)
 
   def testSpawn_RedirectStdinStdout(self):
+    FLAGS.subprocess_tee_in_process = False
     base_args = ['/some/process', '-a']
     args = base_args
     exec_dir = '/foo'
@@ -146,13 +162,14 @@ class CommonTest(mox.MoxTestBase):
     self.mox.StubOutWithMock(common, 'CommandLogFile')
     common.CommandLogFile(args, exec_dir, exec_env).AndReturn(logfile_name)
 
+    self.mox.StubOutWithMock(process_backend, 'Popen')
     self.mox.StubOutWithMock(subprocess, 'Popen')
     main_task = Waitable(stdout_text='foo', stderr_text='bar',
                          stdin=True)
     tee_out_task = Waitable(stdout_text='foo')
     tee_err_task = Waitable(stdout_text='bar')
 
-    subprocess.Popen(
+    process_backend.Popen(
         args,
         stdout=subprocess.PIPE,
         stdin=subprocess.PIPE,
@@ -184,6 +201,104 @@ class CommonTest(mox.MoxTestBase):
     self.assertEquals(real_task, main_task)
     self.assertTrue(real_task.stdin)
 
+  def testRetryPolicy_backoff(self):
+    clock = FakeClock()
+    policy = common.RetryPolicy(max_attempts=4, initial_delay_seconds=1,
+                                max_delay_seconds=3, clock=clock.Time,
+                                sleep_fn=clock.Sleep)
+    numbers = []
+    for attempt in policy:
+      numbers.append(attempt.number)
+      clock.Sleep(0.5)
+      attempt.Failed('nope')
+    self.assertEquals([1, 2, 3, 4], numbers)
+    self.assertEquals([1, 2, 3], clock.sleeps[1::2])
+    self.assertEquals([0, 1, 2, 3], [r.delay for r in policy.records])
+    self.assertEquals([0.5] * 4, [r.duration for r in policy.records])
+    self.assertEquals(['nope'] * 4, [r.error for r in policy.records])
+    self.assertFalse(policy.deadline_exceeded)
+
+  def testRetryPolicy_stopsOnSuccess(self):
+    clock = FakeClock()
+    policy = common.RetryPolicy(max_attempts=5, clock=clock.Time,
+                                sleep_fn=clock.Sleep)
+    for attempt in policy:
+      if attempt.number == 2:
+        attempt.Succeeded()
+      else:
+        attempt.Failed()
+    self.assertEquals(2, len(policy.records))
+
+  def testRetryPolicy_jitter(self):
+    clock = FakeClock()
+    policy = common.RetryPolicy(max_attempts=2, initial_delay_seconds=10,
+                                jitter=0.5, clock=clock.Time,
+                                sleep_fn=clock.Sleep, random_fn=lambda: 0.5)
+    for attempt in policy:
+      attempt.Failed()
+    self.assertEquals([7.5], clock.sleeps)
+
+  def testRetryPolicy_deadline(self):
+    clock = FakeClock()
+    policy = common.RetryPolicy(max_attempts=10, initial_delay_seconds=2,
+                                backoff_factor=1, attempt_timeout_seconds=5,
+                                min_attempt_seconds=1, deadline=10,
+                                clock=clock.Time, sleep_fn=clock.Sleep)
+    timeouts = []
+    for attempt in policy:
+      timeouts.append(attempt.timeout)
+      clock.Sleep(2)
+      attempt.Failed()
+    # the attempt at t=8 is cut to the deadline, none fits in after t=10.
+    self.assertEquals([5, 5, 2], timeouts)
+    self.assertEquals([0, 4, 8], [r.start for r in policy.records])
+    self.assertTrue(policy.deadline_exceeded)
+
+  def testSpawnAndWaitWithRetry_deadlinePassed(self):
+    self.mox.StubOutWithMock(common, 'Spawn')
+    self.mox.ReplayAll()
+    policy = common.RetryPolicy(max_attempts=3, deadline=0)
+    self.assertRaises(common.SpawnError, common.SpawnAndWaitWithRetry,
+                      ['/bin/true'], retry_policy=policy)
+
+  def testBoundedCapture_small(self):
+    capture = common.BoundedCapture(4)
+    capture.Append(b'abc')
+    capture.Append(b'defg')
+    self.assertEquals(b'abcdefg', capture.Value())
+    self.assertEquals(0, capture.omitted)
+
+  def testBoundedCapture_keepsHeadAndTail(self):
+    capture = common.BoundedCapture(4)
+    for chunk in [b'ab', b'cdef', b'g' * 100, b'hi', b'jk']:
+      capture.Append(chunk)
+    self.assertEquals(110, capture.total)
+    self.assertEquals(102, capture.omitted)
+    self.assertEquals(b'abcd\n[... 102 bytes omitted ...]\nhijk',
+                      capture.Value())
+
+  def testBoundedCapture_tailSplitsAChunk(self):
+    capture = common.BoundedCapture(4)
+    for chunk in [b'wxyz', b'abc', b'de']:
+      capture.Append(chunk)
+    self.assertEquals(1, capture.omitted)
+    self.assertEquals(b'wxyz\n[... 1 bytes omitted ...]\nbcde',
+                      capture.Value())
+
+
+class FakeClock(object):
+
+  def __init__(self):
+    self.now = 0
+    self.sleeps = []
+
+  def Time(self):
+    return self.now
+
+  def Sleep(self, seconds):
+    self.sleeps.append(seconds)
+    self.now += seconds
+
 
 class Waitable(object):
   """Stub of a Popen object.
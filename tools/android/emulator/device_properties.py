@@ -0,0 +1,155 @@
+# Copyright 2018 The Android Open Source Project. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A short lived cache of the device's system properties.
+
+The boot checks read properties over and over, often several in the same poll
+iteration. DeviceProperties keeps the parsed output of one `getprop` for a few
+seconds, and refreshes single keys with `getprop <key>` once it is stale:
+
+  props = DeviceProperties(device.ExecOnDevice)
+  props.Snapshot()                       # every property, one full getprop.
+  props.Get('sys.boot_completed')        # from the snapshot, or getprop key.
+
+Commands which change properties or services (setprop, start, stop,
+am restart) are passed to NoteCommand, which drops the cache.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import re
+import threading
+import time
+
+# setprop, start and stop, or am restart at the start of a (sub)command.
+_INVALIDATING_COMMAND_RE = re.compile(
+    r'(?:^|[;&|(]\s*)(?:setprop|start|stop|am\s+restart)\b')
+
+
+def ParseGetprop(output):
+  """Returns the properties in the output of getprop, in a dict."""
+  props = {}
+  # output looks roughly like:
+  # [someprop]: [its value]\n
+  # [otherprop]: [val 2]\n
+  # [init.svc.vold]: [running]\n
+  # [anotherprop]: [val 3]\n
+  for prop_line in output.splitlines():
+    if not prop_line:
+      continue
+    prop_parts = prop_line.split(']:', 1)
+    if len(prop_parts) != 2:
+      continue
+    k = prop_parts[0][1:].strip()
+    v = prop_parts[1].strip()[1:-1]
+    props[k] = v
+  return props
+
+
+class DeviceProperties(object):
+  """Caches the device's properties for ttl_seconds.
+
+  Counters() tells how many full and single key getprops were run and how many
+  reads the cache served.
+  """
+
+  def __init__(self, exec_on_device, ttl_seconds=2.0, clock=time.time):
+    """Constructor.
+
+    Args:
+      exec_on_device: runs a command (a list of args) on the device and returns
+        its stdout.
+      ttl_seconds: how long properties are served from the cache.
+      clock: the time source.
+    """
+    self._exec_on_device = exec_on_device
+    self._ttl_seconds = ttl_seconds
+    self._clock = clock
+    self._lock = threading.Lock()
+    self._snapshot = None
+    self._snapshot_time = None
+    # key -> (value, time), refreshed without a full getprop.
+    self._keys = {}
+    self._counters = dict.fromkeys(['full', 'keys', 'hits', 'invalidations'],
+                                   0)
+
+  def Snapshot(self):
+    """Returns all the properties, in a dict the caller may change."""
+    with self._lock:
+      if self._Fresh(self._snapshot_time):
+        self._counters['hits'] += 1
+        return dict(self._snapshot)
+    props = ParseGetprop(self._exec_on_device(['getprop']))
+    with self._lock:
+      self._counters['full'] += 1
+      self._snapshot = props
+      self._snapshot_time = self._clock()
+      self._keys.clear()
+      return dict(props)
+
+  def Get(self, key, default=''):
+    """Returns the value of key, default if it is not set."""
+    return self.GetMany([key], default)[key]
+
+  def GetMany(self, keys, default=''):
+    """Returns a dict with the values of keys, default for those not set.
+
+    The keys which are not cached are read with a single command.
+    """
+    values = {}
+    with self._lock:
+      for key in keys:
+        if self._Fresh(self._snapshot_time):
+          values[key] = self._snapshot.get(key, default)
+        elif key in self._keys and self._Fresh(self._keys[key][1]):
+          values[key] = self._keys[key][0] or default
+      self._counters['hits'] += len(values)
+    missing = [key for key in keys if key not in values]
+    if missing:
+      # getprop prints one line per key, empty if the key is not set.
+      output = self._exec_on_device(
+          [' ; '.join('getprop %s' % key for key in missing)])
+      lines = output.splitlines()
+      now = self._clock()
+      with self._lock:
+        self._counters['keys'] += len(missing)
+        for i, key in enumerate(missing):
+          value = lines[i].strip() if i < len(lines) else ''
+          self._keys[key] = (value, now)
+          values[key] = value or default
+    return values
+
+  def Invalidate(self):
+    """Drops the cached properties."""
+    with self._lock:
+      self._counters['invalidations'] += 1
+      self._snapshot = None
+      self._snapshot_time = None
+      self._keys.clear()
+
+  def NoteCommand(self, commandline):
+    """Drops the cache if commandline may change properties."""
+    if _INVALIDATING_COMMAND_RE.search(commandline):
+      self.Invalidate()
+
+  def Counters(self):
+    """Returns a copy of the counters."""
+    with self._lock:
+      return dict(self._counters)
+
+  def _Fresh(self, fetch_time):
+    return (fetch_time is not None and
+            0 <= self._clock() - fetch_time < self._ttl_seconds)
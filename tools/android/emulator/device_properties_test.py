@@ -0,0 +1,99 @@
+# Copyright 2018 The Android Open Source Project. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for tools.android.emulator.device_properties."""
+
+from google.apputils import basetest as googletest
+from tools.android.emulator import device_properties
+
+GETPROP = """[dev.bootcomplete]: [1]
+[init.svc.vold]: [running]
+[ro.build.version.sdk]: [23]
+[persist.sys.emulate_fbe]: []
+garbage
+"""
+
+
+class FakeDevice(object):
+
+  def __init__(self):
+    self.props = {'dev.bootcomplete': '1', 'init.svc.vold': 'running'}
+    self.commands = []
+
+  def ExecOnDevice(self, args):
+    command = ' '.join(args)
+    self.commands.append(command)
+    if command == 'getprop':
+      return ''.join('[%s]: [%s]\n' % kv for kv in self.props.items())
+    return ''.join('%s\n' % self.props.get(c.split()[1], '')
+                   for c in command.split(' ; '))
+
+
+class DevicePropertiesTest(googletest.TestCase):
+
+  def setUp(self):
+    super(DevicePropertiesTest, self).setUp()
+    self.now = [100.0]
+    self.device = FakeDevice()
+    self.props = device_properties.DeviceProperties(
+        self.device.ExecOnDevice, ttl_seconds=2, clock=lambda: self.now[0])
+
+  def testParseGetprop(self):
+    self.assertEquals({'dev.bootcomplete': '1',
+                       'init.svc.vold': 'running',
+                       'ro.build.version.sdk': '23',
+                       'persist.sys.emulate_fbe': ''},
+                      device_properties.ParseGetprop(GETPROP))
+
+  def testSnapshotIsCached(self):
+    self.assertEquals('running', self.props.Snapshot()['init.svc.vold'])
+    self.device.props['init.svc.vold'] = 'stopped'
+    self.now[0] += 1
+    self.assertEquals('running', self.props.Snapshot()['init.svc.vold'])
+    self.assertEquals('1', self.props.Get('dev.bootcomplete'))
+    self.assertEquals(['getprop'], self.device.commands)
+    self.now[0] += 1
+    self.assertEquals('stopped', self.props.Snapshot()['init.svc.vold'])
+    self.assertEquals(2, self.props.Counters()['full'])
+
+  def testStaleKeysAreReadSingly(self):
+    self.assertEquals({'dev.bootcomplete': '1', 'sys.boot_completed': ''},
+                      self.props.GetMany(['dev.bootcomplete',
+                                          'sys.boot_completed']))
+    self.assertEquals(
+        ['getprop dev.bootcomplete ; getprop sys.boot_completed'],
+        self.device.commands)
+    self.assertEquals('x', self.props.Get('sys.boot_completed', 'x'))
+    self.assertEquals(1, len(self.device.commands))
+    self.now[0] += 5
+    self.device.props['sys.boot_completed'] = '1'
+    self.assertEquals('1', self.props.Get('sys.boot_completed'))
+    self.assertEquals('getprop sys.boot_completed', self.device.commands[-1])
+    self.assertEquals(0, self.props.Counters()['full'])
+
+  def testCommandsInvalidate(self):
+    self.props.Snapshot()
+    for command in ['setprop a b', 'stop', 'start fingerprintd',
+                    'am restart', 'mkdir x && stop adbd']:
+      self.props.NoteCommand(command)
+      self.props.Snapshot()
+    self.assertEquals(6, self.props.Counters()['full'])
+    for command in ['am start -a X', 'pm disable x', 'getprop', 'rm /stop']:
+      self.props.NoteCommand(command)
+      self.props.Snapshot()
+    self.assertEquals(6, self.props.Counters()['full'])
+
+
+if __name__ == '__main__':
+  googletest.main()
@@ -19,10 +19,12 @@
 
 import collections
 import contextlib
+import errno
 import json
 import logging
 import os
 import re
+import select
 import shutil
 import signal
 import socket
@@ -54,9 +56,23 @@ import portpicker
 from tools.android.emulator import resources
 from google.apputils import stopwatch
 
+from tools.android.emulator import adb_client
+from tools.android.emulator import adb_shell_session
+from tools.android.emulator import boot_history
+from tools.android.emulator import boot_trace
+from tools.android.emulator import boot_watcher
 from tools.android.emulator import common
+from tools.android.emulator import device_properties
 from tools.android.emulator import emulator_meta_data_pb2
+from tools.android.emulator import image_cache
+from tools.android.emulator import mount_table
+from tools.android.emulator import process_backend
+from tools.android.emulator import process_table
+from tools.android.emulator import readiness_graph
 from tools.android.emulator import reporting
+from tools.android.emulator import staging_copy
+from tools.android.emulator import targz_index
+from tools.android.emulator import task_graph
 
 from tools.android.emulator import xserver
 
@@ -76,6 +92,43 @@ flags.DEFINE_bool('dex2oat_on_cloud_enabled', False,
                   'Was Dex2oat run in cloud.')
 flags.DEFINE_bool('enable_test_harness', True, 'Whether device should run in '
                   'test_harness mode: ro.test_harness=1')
+flags.DEFINE_bool('adb_shell_session', True, 'Run ExecOnDevice commands in a '
+                  'long lived adb shell rather than an adb process each. '
+                  'Falls back to one adb shell per command if the session '
+                  'cannot be used.')
+flags.DEFINE_bool('adb_native_client', True, 'Talk to the adb server over '
+                  'its socket protocol for shell commands, pushes and connect '
+                  'rather than forking adb, when the device is reached '
+                  'through the adb server.')
+flags.DEFINE_bool('boot_watcher', True, 'Watch the boot milestones from a '
+                  'loop on the device which reports each as it is reached, '
+                  'rather than polling every one from the host.')
+flags.DEFINE_string('boot_history_file', os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+    'android_emulator', 'boot_history.json'), 'Where the durations of past '
+                    'boot steps are kept, per system image and host, to pace '
+                    'the boot polls by. Empty polls at a fixed interval.')
+flags.DEFINE_string('image_cache_dir', os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+    'android_emulator', 'image_cache'), 'Where the images extracted, made and '
+                    'resized while staging are kept for the next launches of '
+                    'the host, by the hash of their inputs. Empty stages '
+                    'without a cache.')
+flags.DEFINE_integer('image_cache_max_mb', 16384, 'The disk space the image '
+                     'cache may take, the least recently used images are '
+                     'removed beyond it.')
+flags.DEFINE_string('tar_index_dir', os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+    'android_emulator', 'tar_index'), 'Where the indexes of the .tar.gz '
+                    'images are kept, which let an image be inflated from '
+                    'the checkpoint before it rather than the start of the '
+                    'archive. Empty extracts with tar.')
+flags.DEFINE_integer('prelaunch_workers', 4, 'How many of the staging and '
+                     'other tasks before the emulator is spawned run at a '
+                     'time.')
+flags.DEFINE_bool('export_boot_trace', True, 'Write the launch timers and boot '
+                  'steps as a Chrome trace (chrome://tracing) to '
+                  'TEST_UNDECLARED_OUTPUTS_DIR, if it is set.')
 
 LoadInfo = collections.namedtuple('LoadInfo', 'timestamp up_time idle_time')
 
@@ -134,6 +187,7 @@ SD_CARD_UUID_OFFSET = 0x43
 
 # The maximum time that near-zero before we give up on an install
 INSTALL_IDLE_TIMEOUT_SECONDS = 120
+_INSTALL_IDLE_CHECK_SECONDS = 8
 
 
 def _InstallFailureType(output):
@@ -182,8 +236,8 @@ _OPEN_TARBALL = 'OPEN_TARBALL'
 _EXTRACT_TARBALL = 'EXTRACT_TARBALL'
 _BOOT_COMPLETE_PRESENT = 'CHECK_BOOT_PROP'
 _BOOT_COMPLETE_FAIL_SLEEP = 'CHECK_BOOT_PROP_FAIL_SLEEP'
-_LAUNCHER_STARTED = 'CHECK_BOOT_PROP'
-_LAUNCHER_STARTED_FAIL_SLEEP = 'CHECK_BOOT_PROP_FAIL_SLEEP'
+_LAUNCHER_STARTED = 'CHECK_LAUNCHER'
+_LAUNCHER_STARTED_FAIL_SLEEP = 'CHECK_LAUNCHER_FAIL_SLEEP'
 _PIPE_TRAVERSAL_CHECK = 'PIPE_TRAVERSAL_CHECK'
 _PIPE_TRAVERSAL_CHECK_FAIL_SLEEP = 'PIPE_TRAVERSAL_CHECK_FAIL_SLEEP'
 _SNAPSHOT_COPY = 'SNAPSHOT_COPY'
@@ -198,6 +252,7 @@ _KILL_EMULATOR = 'KILL_EMULATOR'
 _SPAWN_EMULATOR = 'SPAWN_EMULATOR'
 _ADB_CONNECT = 'ADB_CONNECT'
 _ADB_CONNECT_FAIL_SLEEP = 'ADB_CONNECT_FAIL_SLEEP'
+_ENABLE_LOGCAT = 'ENABLE_LOGCAT'
 _SYS_SERVER_CHECK = 'SYS_SERVER_CHECK'
 _SYS_SERVER_CHECK_FAIL_SLEEP = 'SYS_SERVER_CHECK_FAIL_SLEEP'
 _PM_CHECK = 'PM_CHECK'
@@ -213,6 +268,32 @@ EMULATOR_PID = 'emulator_process.pid'
 
 _ANR_RE = re.compile(r'\w\/(am_(?:crash|anr|proc_died)).*\[(\w.*)\]')
 _DEV_NULL = open('/dev/null')
+# Logcat dumps are only logged, so keep the start and the most recent entries.
+_LOGCAT_DUMP_WINDOW = 256 << 10
+# After an adb shell session could not be opened, commands are run one-shot
+# for this long before opening one is tried again.
+_SHELL_SESSION_RETRY_SECONDS = 5
+# The exit status of adb when it, rather than the device command, failed.
+_ADB_ERROR_EXIT = 255
+# Likewise, after the adb server could not be reached, adb is forked.
+_ADB_CLIENT_RETRY_SECONDS = 5
+# Near the boot deadline, a console connect still gets at least this long.
+_CONSOLE_MIN_CONNECT_SECONDS = 1
+# How long getprop, mount and ps results are reused, about one boot poll
+# iteration.
+_PROPERTIES_TTL_SECONDS = 2
+# Processes whose presence means the home screen is up.
+_LAUNCHER_PACKAGES = (
+    'com.android.launcher',
+    'com.google.android.wearable',
+    'com.google.glass.nowtown',
+    'com.google.android.googlequicksearchbox',
+    'com.google.android.tv',
+    'com.android.tv',
+    'com.android.iotlauncher',
+    'com.android.car',
+    'com.google.android.car',
+)
 
 _DENSITY_TVDPI = 213
 
@@ -379,10 +460,31 @@ class EmulatedDevice(object):
     # to print log.
     self._start_time = time.time()
     self._time_out_time = self._start_time + 580
+    # Deadline inherited by retry policies, only set while booting.
+    self._retry_deadline = None
     self._use_real_adb = False
+    self._shell_session = None
+    # boot checks run concurrently, only one of them opens the session.
+    self._shell_session_lock = threading.Lock()
+    self._shell_session_retry_time = 0
+    self._adb_client_retry_time = 0
+    self._properties = device_properties.DeviceProperties(
+        lambda args: self.ExecOnDevice(args),
+        ttl_seconds=_PROPERTIES_TTL_SECONDS)
+    self._mounts = mount_table.MountTable(
+        lambda args: self.ExecOnDevice(args),
+        ttl_seconds=_PROPERTIES_TTL_SECONDS)
+    self._processes = process_table.ProcessTableCache(
+        lambda args: self.ExecOnDevice(args), ps_command=self._PsCommand,
+        ttl_seconds=_PROPERTIES_TTL_SECONDS)
     self._reporter = reporter or reporting.NoOpReporter()
     self._direct_boot = False
     self._mini_boot = mini_boot
+    self._boot_watcher = None
+    self._boot_timeline = []
+    self._prelaunch_critical_path = []
+    self._services_dir = None
+    self._bios_dir = None
     self._sim_access_rules_file = sim_access_rules_file
     self._source_properties = source_properties
     self._phone_number = phone_number
@@ -501,28 +603,92 @@ class EmulatedDevice(object):
       f.seek(SD_CARD_UUID_OFFSET)
       f.write(struct.pack('i', uuid_value))
 
-  def _SparseCp(self, src, dst):
-    """Copies a file and respects its sparseness.
+  def _StagingCopy(self, src, dst):
+    """Copies a file, sharing its blocks or keeping its holes.
 
     Symbolic links are dereferenced.
 
     Args:
       src: the source file
       dst: the destination file
+
+    Returns:
+      the staging_copy.CopyResult.
     """
-    subprocess.check_call(
-        ['cp', '--sparse=always', '--dereference', src, dst])
+    return staging_copy.Copy(src, dst)
 
   def _ExtractTarEntry(self, archive, entry, working_dir):
     """Extracts a single entry from a compressed tar archive."""
-    subprocess.check_call([
+    # staging tasks run side by side, tar must not hold their pipes open.
+    process_backend.CheckCall([
         'tar', '-xzSf', archive, '--no-same-owner',
-        '-C', working_dir, '--no-anchored', entry])
+        '-C', working_dir, '--no-anchored', entry], close_fds=True)
+
+  def _ExtractTarEntryTo(self, archive, entry, dst):
+    """Extracts a single entry from a compressed tar archive to dst."""
+    if FLAGS.tar_index_dir and targz_index.Available():
+      try:
+        indexed = targz_index.ExtractMember(archive, entry, dst,
+                                            FLAGS.tar_index_dir)
+        logging.info('Extracted %s from %s, %s.', entry, archive,
+                     'by its index' if indexed else 'indexing it')
+        return
+      except (targz_index.Error, KeyError, IOError, OSError) as e:
+        logging.warning('Cannot extract %s from %s with an index, using '
+                        'tar: %s', entry, archive, e)
+    working_dir = tempfile.mkdtemp(dir=os.path.dirname(dst))
+    try:
+      self._ExtractTarEntry(archive, entry, working_dir)
+      shutil.move(os.path.join(working_dir, entry), dst)
+    finally:
+      shutil.rmtree(working_dir, ignore_errors=True)
+
+  def _ImageCache(self):
+    """Returns the host's image_cache.ImageCache, None without one."""
+    if not FLAGS.image_cache_dir:
+      return None
+    try:
+      return image_cache.ImageCache(FLAGS.image_cache_dir,
+                                    FLAGS.image_cache_max_mb << 20)
+    except (IOError, OSError) as e:
+      logging.warning('Cannot use the image cache %s: %s',
+                      FLAGS.image_cache_dir, e)
+      return None
+
+  def _StageImage(self, cache, dst, inputs, transform, produce_fn,
+                  writable=False):
+    """Makes dst with produce_fn, or takes it from the cache.
+
+    Args:
+      cache: [optional] the ImageCache.
+      dst: the staged file.
+      inputs: the files produce_fn reads.
+      transform: names what produce_fn makes of them, with its parameters.
+      produce_fn: writes the image to the path it is called with.
+      writable: whether the emulator writes to dst rather than to an overlay.
+    """
+    if cache:
+      try:
+        cache.Stage(dst, inputs, transform, produce_fn, writable)
+        return
+      except (IOError, OSError) as e:
+        logging.warning('Staging %s without the image cache: %s', dst, e)
+    produce_fn(dst)
+
+  def _ResizeUserdata(self, data_size, dst):
+    """Writes the userdata image, grown to data_size MB, to dst.
 
-  def _StageDataFiles(self,
+    The image is copied, not moved: if the image cache fails after this ran,
+    _StageImage runs it again for dst itself.
+    """
+    if dst != self._UserdataQemuFile():
+      self._StagingCopy(self._UserdataQemuFile(), dst)
+    process_backend.CheckCall(['/sbin/resize2fs', '-f', dst,
+                               '%dM' % data_size], close_fds=True)
+
+  def _StageDataTasks(self,
                       system_image_dir,
                       userdata_tarball,
-                      timer,
                       enable_guest_gl,
                       snapshot_file,
                       system_image_path=None,
@@ -533,11 +699,19 @@ class EmulatedDevice(object):
                       build_prop_path=None,
                       modified_ramdisk_path=None,
                       data_files=None):
-    """Stages files for the emulator launch."""
+    """Returns the task_graph.Tasks staging the files for the emulator launch.
+
+    What every task needs is staged right away.
+    """
 
     self._images_dir = os.path.abspath(self._TempDir('images'))
     os.makedirs(self._InitImagesDir())
     os.makedirs(self._SessionImagesDir())
+    cache = self._ImageCache()
+    # qemu2 writes to qcow2 overlays, its images may share the cache's inode.
+    images_writable = (self._metadata_pb.emulator_type !=
+                       emulator_meta_data_pb2.EmulatorMetaDataPb.QEMU2)
+    tasks = []
 
     # Copy build.prop into the session dir where the emulator will find it.
     # TODO(b/67322170): Generally we want build.prop in the session dir where
@@ -556,6 +730,7 @@ class EmulatedDevice(object):
 
     init_sys = os.path.abspath(system_image_path)
     assert os.path.exists(init_sys), '%s: no system.img' % system_image_path
+    system_deps = []
     if system_image_path.endswith('.img'):
       os.symlink(init_sys, self._InitSystemFile())
       if (self._metadata_pb.emulator_type ==
@@ -565,41 +740,49 @@ class EmulatedDevice(object):
         # ObjFS to avoid a copy.
         os.symlink(init_sys, self._SystemFile())
       else:
-        logging.info('Copying system image to %s', self._SystemFile())
-        timer.start('COPY_SYSTEM_IMAGE')
-        self._SparseCp(self._InitSystemFile(), self._SystemFile())
-        timer.stop('COPY_SYSTEM_IMAGE')
-        os.chmod(self._SystemFile(), stat.S_IRWXU)
+        def CopySystemImage():
+          logging.info('Copying system image to %s', self._SystemFile())
+          self._StagingCopy(self._InitSystemFile(), self._SystemFile())
+          os.chmod(self._SystemFile(), stat.S_IRWXU)
+        tasks.append(task_graph.Task('COPY_SYSTEM_IMAGE', CopySystemImage))
+        system_deps = ['COPY_SYSTEM_IMAGE']
     else:
       assert system_image_path.endswith('.img.tar.gz'), 'Not known format'
-      logging.info('Extracting system image from tar.gz')
-      timer.start('EXTRACT_SYSTEM_IMAGE')
-      self._ExtractTarEntry(
-          init_sys, 'system.img', os.path.dirname(self._SystemFile()))
-      shutil.move(os.path.join(os.path.dirname(self._SystemFile()),
-                               'system.img'),
-                  self._SystemFile())
-      timer.stop('EXTRACT_SYSTEM_IMAGE')
-      os.chmod(self._SystemFile(), stat.S_IRWXU)
-
-    timer.start('MODIFY_SYSTEM_IMAGE')
-    self._ModifySystemImage(enable_guest_gl)
-    timer.stop('MODIFY_SYSTEM_IMAGE')
+
+      def ExtractSystemImage():
+        logging.info('Extracting system image from tar.gz')
+        self._StageImage(
+            cache, self._SystemFile(), [init_sys], 'tar:system.img',
+            lambda dst: self._ExtractTarEntryTo(init_sys, 'system.img', dst),
+            images_writable or self._ShouldModifySystemImage(enable_guest_gl))
+        os.chmod(self._SystemFile(), stat.S_IRWXU)
+      tasks.append(task_graph.Task('EXTRACT_SYSTEM_IMAGE', ExtractSystemImage))
+      system_deps = ['EXTRACT_SYSTEM_IMAGE']
+
+    tasks.append(task_graph.Task(
+        'MODIFY_SYSTEM_IMAGE',
+        lambda: self._ModifySystemImage(enable_guest_gl), deps=system_deps))
 
     # Folders created are data/misc/*
     # Folders created are data/nativetest/**/* and so on.
     # If we don't place the files in the right location, we end up
     # getting weird exceptions in logcat since emulator requires those files
     # to be present.
+    userdata_deps = []
     if data_files:
-      for each_file in data_files:
-        fn = each_file.split('data/')[1]
-        dn = os.path.join(self._SessionImagesDir(), 'data', os.path.dirname(fn))
-        # Create if this dir does not exist.
-        if not os.path.exists(dn):
-          os.makedirs(dn)
-        bn = os.path.basename(fn)
-        shutil.copy(each_file, os.path.join(dn, bn))
+      def StageDataFiles():
+        for each_file in data_files:
+          fn = each_file.split('data/')[1]
+          dn = os.path.join(self._SessionImagesDir(), 'data',
+                            os.path.dirname(fn))
+          # Create if this dir does not exist.
+          if not os.path.exists(dn):
+            os.makedirs(dn)
+          bn = os.path.basename(fn)
+          self._StagingCopy(each_file, os.path.join(dn, bn))
+      tasks.append(task_graph.Task('STAGE_DATA_FILES', StageDataFiles))
+      # the userdata tarball is extracted over them.
+      userdata_deps = ['STAGE_DATA_FILES']
 
     # Pipe service won't work for user build and api level 23+, since
     # pipe_traversal doesn't have a right seclinux policy. In this case, just
@@ -607,6 +790,8 @@ class EmulatedDevice(object):
     self._use_real_adb = (
         self._IsUserBuild(build_prop_path) and self.GetApiVersion() >= 23)
 
+    # the images below are staged unless the userdata tarball has them.
+    image_deps = []
     if userdata_tarball:
       # userdata tarball should contain:
       #   self._UserdataQemuFile()
@@ -619,113 +804,161 @@ class EmulatedDevice(object):
       #   self._KernelFile()  # handled above
       #   self._SystemFile()  # handled above
       #   self._InitSystemFile() # handled above
-      tar_opts = '-xzSf'
-      if (self._metadata_pb.emulator_type ==
-          emulator_meta_data_pb2.EmulatorMetaDataPb.QEMU2):
-        # qemu2's userdata.dat is not gzipped because it is a diff of the
-        # initial userdata partition and thus quite small already. It also
-        # doesn't compress as well as a raw image does.
-        tar_opts = '-xSf'
-      subprocess.check_call(['tar', tar_opts, userdata_tarball, '-C',
-                             self._images_dir])
-      data_size = FLAGS.data_partition_size
-      if (self.GetApiVersion() >= 19 and data_size and
-          data_size > os.path.getsize(self._UserdataQemuFile()) >> 20):
-        logging.info('Resize data partition to %dM', data_size)
-        subprocess.check_call(['/sbin/resize2fs', '-f',
-                               self._UserdataQemuFile(), '%dM' % data_size])
-
-      # Symlink the snapshot file to the actual location.
-      if (snapshot_file and self._metadata_pb.emulator_architecture == 'x86' and
-          os.path.exists(snapshot_file)):
-        os.symlink(snapshot_file, self._SnapshotRamBinFile())
+      def ExtractUserdataTarball():
+        tar_opts = '-xzSf'
+        if (self._metadata_pb.emulator_type ==
+            emulator_meta_data_pb2.EmulatorMetaDataPb.QEMU2):
+          # qemu2's userdata.dat is not gzipped because it is a diff of the
+          # initial userdata partition and thus quite small already. It also
+          # doesn't compress as well as a raw image does.
+          tar_opts = '-xSf'
+        process_backend.CheckCall(['tar', tar_opts, userdata_tarball, '-C',
+                                   self._images_dir], close_fds=True)
+        data_size = FLAGS.data_partition_size
+        if (self.GetApiVersion() >= 19 and data_size and
+            data_size > os.path.getsize(self._UserdataQemuFile()) >> 20):
+          logging.info('Resize data partition to %dM', data_size)
+          self._StageImage(
+              cache, self._UserdataQemuFile(), [userdata_tarball],
+              'resize2fs:%s:%dM' % (
+                  os.path.basename(self._UserdataQemuFile()), data_size),
+              lambda dst: self._ResizeUserdata(data_size, dst),
+              images_writable)
+
+        # Symlink the snapshot file to the actual location.
+        if (snapshot_file and
+            self._metadata_pb.emulator_architecture == 'x86' and
+            os.path.exists(snapshot_file)):
+          os.symlink(snapshot_file, self._SnapshotRamBinFile())
+      tasks.append(task_graph.Task('EXTRACT_USERDATA_TARBALL',
+                                   ExtractUserdataTarball,
+                                   deps=userdata_deps))
+      image_deps = ['EXTRACT_USERDATA_TARBALL']
     else:
       #   self._RamdiskFile() - we modify this abit
       #   self._SnapshotFile() - always exists
-      self._InitializeRamdisk(system_image_dir, modified_ramdisk_path)
-      self._SparseCp(self.android_platform.empty_snapshot_fs,
-                     self._SnapshotFile())
-
-    if vendor_img_path and not os.path.exists(self._VendorFile()):
+      tasks.append(task_graph.Task(
+          'REPACK_RAMDISK',
+          lambda: self._InitializeRamdisk(system_image_dir,
+                                          modified_ramdisk_path)))
+      tasks.append(task_graph.Task(
+          'COPY_SNAPSHOT_FS',
+          lambda: self._StagingCopy(self.android_platform.empty_snapshot_fs,
+                                    self._SnapshotFile())))
+
+    def StageVendorImage():
+      if os.path.exists(self._VendorFile()):
+        return
       init_data = vendor_img_path
       assert os.path.exists(init_data), '%s: no vendor.img' % vendor_img_path
       if init_data.endswith('.img.tar.gz'):
-        self._ExtractTarEntry(
-            init_data, 'vendor.img', os.path.dirname(self._VendorFile()))
-        shutil.move(os.path.join(os.path.dirname(self._VendorFile()),
-                                 'vendor.img'),
-                    self._VendorFile())
+        self._StageImage(
+            cache, self._VendorFile(), [init_data], 'tar:vendor.img',
+            lambda dst: self._ExtractTarEntryTo(init_data, 'vendor.img', dst),
+            images_writable)
       elif init_data.endswith('.img'):
-        self._SparseCp(init_data, self._VendorFile())
+        self._StagingCopy(init_data, self._VendorFile())
       else:
         raise Exception('Unknown vendor image type %s', vendor_img_path)
       os.chmod(self._VendorFile(), stat.S_IRWXU)
+    if vendor_img_path:
+      tasks.append(task_graph.Task('STAGE_VENDOR_IMAGE', StageVendorImage,
+                                   deps=image_deps))
 
-    if encryptionkey_img_path and not os.path.exists(
-        self._EncryptionKeyImageFile()):
-
+    def StageEncryptionKey():
+      if os.path.exists(self._EncryptionKeyImageFile()):
+        return
       init_data = encryptionkey_img_path
       assert os.path.exists(init_data), (
           '%s: no encryptionkey.img' % encryptionkey_img_path)
       assert init_data.endswith('.img'), 'Not known format'
-      shutil.copy(init_data, self._EncryptionKeyImageFile())
+      self._StagingCopy(init_data, self._EncryptionKeyImageFile())
       os.chmod(self._EncryptionKeyImageFile(), stat.S_IRWXU)
+    if encryptionkey_img_path:
+      tasks.append(task_graph.Task('STAGE_ENCRYPTION_KEY', StageEncryptionKey,
+                                   deps=image_deps))
 
-    if advanced_features_ini and not os.path.exists(
-        self._AdvancedFeaturesFile()):
+    def StageAdvancedFeatures():
+      if os.path.exists(self._AdvancedFeaturesFile()):
+        return
       assert os.path.exists(advanced_features_ini), (
           'Advanced Features file %s does not exist' % advanced_features_ini)
       shutil.copy(advanced_features_ini, self._AdvancedFeaturesFile())
       os.chmod(self._AdvancedFeaturesFile(), stat.S_IRWXU)
+    if advanced_features_ini:
+      tasks.append(task_graph.Task('STAGE_ADVANCED_FEATURES',
+                                   StageAdvancedFeatures, deps=image_deps))
 
-    if data_image_path and not os.path.exists(self._UserdataQemuFile()):
+    def StageUserdataImage():
+      if os.path.exists(self._UserdataQemuFile()):
+        return
       init_data = data_image_path
       assert os.path.exists(init_data), '%s: no userdata.img' % data_image_path
       if init_data.endswith('.img'):
-        self._SparseCp(init_data, self._UserdataQemuFile())
+        self._StagingCopy(init_data, self._UserdataQemuFile())
       else:
         assert init_data.endswith('.img.tar.gz'), 'Not known format'
-        self._ExtractTarEntry(
-            init_data,
-            'userdata.img',
-            os.path.dirname(self._UserdataQemuFile()))
-        shutil.move(os.path.join(os.path.dirname(self._UserdataQemuFile()),
-                                 'userdata.img'),
-                    self._UserdataQemuFile())
-
-    if not os.path.exists(self._CacheFile()):
+        self._StageImage(
+            cache, self._UserdataQemuFile(), [init_data], 'tar:userdata.img',
+            lambda dst: self._ExtractTarEntryTo(init_data, 'userdata.img',
+                                                dst),
+            images_writable)
+    if data_image_path:
+      tasks.append(task_graph.Task('STAGE_USERDATA_IMAGE', StageUserdataImage,
+                                   deps=image_deps))
+
+    def StageCacheImage():
+      if os.path.exists(self._CacheFile()):
+        return
       init_cache = resources.GetResourceFilename(
           'android_test_support/'
           'tools/android/emulator/support/cache.img.tar.gz')
-      self._ExtractTarEntry(init_cache, 'cache.img',
-                            os.path.dirname(self._CacheFile()))
-
-    if not os.path.exists(self._SdcardFile()):
-      sdcard_size_mb = self._metadata_pb.sdcard_size_mb
-      if sdcard_size_mb == 256:
-        sd_name = 'default_sdcard.256.img'
-        self._ExtractTarEntry(
-            resources.GetResourceFilename(
-                'android_test_support/'
-                'tools/android/emulator/support/%s.tar.gz' % sd_name),
-            sd_name, os.path.dirname(self._SdcardFile()))
-        shutil.move(os.path.join(os.path.dirname(self._SdcardFile()),
-                                 sd_name),
-                    self._SdcardFile())
-        logging.info('Using default sd card.')
-      else:
-        logging.info('Making sdcard on the fly due to a nonstandard size')
-        sdcard_args = [
-            self.android_platform.mksdcard,
-            '%sM' % sdcard_size_mb,
-            self._SdcardFile()]
-        timer.start(_SDCARD_CREATE)
-        common.SpawnAndWaitWithRetry(sdcard_args)
-        # 1AEF-1A1E is hard coded in AdbController.java
-        self._SetUUID(self._SdcardFile(), 0x1AEF1A1E)
-        timer.stop(_SDCARD_CREATE)
+      self._StageImage(
+          cache, self._CacheFile(), [init_cache], 'tar:cache.img',
+          lambda dst: self._ExtractTarEntryTo(init_cache, 'cache.img', dst),
+          images_writable)
+    tasks.append(task_graph.Task('STAGE_CACHE_IMAGE', StageCacheImage,
+                                 deps=image_deps))
 
+    sdcard_size_mb = self._metadata_pb.sdcard_size_mb
 
+    def StageDefaultSdcard():
+      if os.path.exists(self._SdcardFile()):
+        return
+      sd_name = 'default_sdcard.256.img'
+      sd_archive = resources.GetResourceFilename(
+          'android_test_support/'
+          'tools/android/emulator/support/%s.tar.gz' % sd_name)
+      self._StageImage(
+          cache, self._SdcardFile(), [sd_archive], 'tar:%s' % sd_name,
+          lambda dst: self._ExtractTarEntryTo(sd_archive, sd_name, dst),
+          images_writable)
+      logging.info('Using default sd card.')
+
+    def CreateSdcard():
+      if os.path.exists(self._SdcardFile()):
+        return
+      logging.info('Making sdcard on the fly due to a nonstandard size')
+
+      def MakeSdcard(dst):
+        common.SpawnAndWaitWithRetry([self.android_platform.mksdcard,
+                                      '%sM' % sdcard_size_mb, dst])
+        # 1AEF-1A1E is hard coded in AdbController.java
+        self._SetUUID(dst, 0x1AEF1A1E)
+      self._StageImage(
+          cache, self._SdcardFile(), [self.android_platform.mksdcard],
+          'mksdcard:%sM:1AEF1A1E' % sdcard_size_mb, MakeSdcard,
+          images_writable)
+    if sdcard_size_mb == 256:
+      tasks.append(task_graph.Task('STAGE_DEFAULT_SDCARD', StageDefaultSdcard,
+                                   deps=image_deps))
+    else:
+      tasks.append(task_graph.Task(_SDCARD_CREATE, CreateSdcard,
+                                   deps=image_deps))
+    return tasks
+
+  def _FinishStaging(self):
+    """Makes the staged images writable, once all are there."""
     os.chmod(self._SdcardFile(), stat.S_IRWXU)
     if os.path.exists(self._UserdataQemuFile()):
       os.chmod(self._UserdataQemuFile(), stat.S_IRWXU)
@@ -825,7 +1058,8 @@ class EmulatedDevice(object):
 
       # the default size is ~256 megs, which fills up fast on iterative
       # development.
-      if 'ext4' in subprocess.check_output(['file', self._UserdataQemuFile()]):
+      if 'ext4' in process_backend.CheckOutput(
+          ['file', self._UserdataQemuFile()]):
         # getting this size right is pretty crucial - if it doesnt match
         # the underlying file the guest os will get confused.
         config_ini.write('disk.dataPartition.size=%s\n' %
@@ -836,7 +1070,7 @@ class EmulatedDevice(object):
       # system partition must be less than 2GB (there's a constraint check in
       # qemu). Also we must set the commandline flag too - which sets both
       # userdata and system sizes, so everything is set to 2047 for sanity.
-      if 'ext4' in subprocess.check_output(['file', self._SystemFile()]):
+      if 'ext4' in process_backend.CheckOutput(['file', self._SystemFile()]):
         # getting this size right is pretty crucial - if it doesnt match
         # the underlying file the guest os will get confused.
         config_ini.write('disk.systemPartition.size=%s\n' %
@@ -855,7 +1089,7 @@ class EmulatedDevice(object):
       config_ini.write('disk.cachePartition=1\n')
       config_ini.write('disk.cachePartition.path=cache.img\n')
       cache_size = '66m'
-      if 'ext4' in subprocess.check_output(['file', self._CacheFile()]):
+      if 'ext4' in process_backend.CheckOutput(['file', self._CacheFile()]):
         cache_size = os.path.getsize(self._CacheFile())
 
       # getting this size right is pretty crucial - if it doesnt match
@@ -1246,18 +1480,30 @@ class EmulatedDevice(object):
         open_gl_driver=open_gl_driver,
         env=os.environ)
 
-    timer = stopwatch.StopWatch()
+    # timings of an earlier launch must not be exported with this one.
+    del self._metadata_pb.perf_data[:]
+    timer = boot_trace.TracingStopWatch()
     timer.start(_STAGE_DATA)
 
     images_dict = json.loads(self._metadata_pb.system_image_path)
     if modified_ramdisk_path:
       images_dict['modified_ramdisk_path'] = modified_ramdisk_path
 
-    self._StageDataFiles(self._metadata_pb.system_image_dir,
-                         userdata_tarball, timer,
-                         open_gl_driver == GUEST_OPEN_GL,
-                         snapshot_file,
-                         **images_dict)
+    tasks = self._StageDataTasks(self._metadata_pb.system_image_dir,
+                                 userdata_tarball,
+                                 open_gl_driver == GUEST_OPEN_GL,
+                                 snapshot_file,
+                                 **images_dict)
+    graph = task_graph.TaskGraph(tasks + self._PrelaunchTasks(), timer,
+                                 workers=FLAGS.prelaunch_workers)
+    try:
+      graph.Run()
+    finally:
+      self._prelaunch_critical_path = graph.CriticalPath()
+      logging.info('Prelaunch critical path: %s', ' -> '.join(
+          '%s %.3fs' % (t.name, t.end - t.start)
+          for t in self._prelaunch_critical_path))
+    self._FinishStaging()
     timer.stop(_STAGE_DATA)
 
     timer.start(_START_PROCESS)
@@ -1292,10 +1538,10 @@ class EmulatedDevice(object):
     exploded_temp = os.path.join(ramdisk_dir, 'tmp')
     os.makedirs(exploded_temp)
 
-    gunzip_proc = subprocess.Popen(
+    gunzip_proc = process_backend.Popen(
         ['gunzip', '-f', '-c', base_ramdisk],
         stdout=subprocess.PIPE)
-    extract_cpio_proc = subprocess.Popen(
+    extract_cpio_proc = process_backend.Popen(
         ['cpio', '--extract'],
         cwd=exploded_temp,
         stdin=gunzip_proc.stdout,
@@ -1488,16 +1734,16 @@ class EmulatedDevice(object):
           adbd_bytes = resource_adbd.read()
           ramdisk_adbd.write(adbd_bytes)
           ramdisk_adbd.flush()
-    find_proc = subprocess.Popen(
+    find_proc = process_backend.Popen(
         ['find', '.', '-mindepth', '1', '-printf', '%P\n'],
         cwd=exploded_temp,
         stdout=subprocess.PIPE)
-    create_cpio_proc = subprocess.Popen(
+    create_cpio_proc = process_backend.Popen(
         ['cpio', '--create', '--format', 'newc', '--owner', '0:0'],
         cwd=exploded_temp,
         stdin=find_proc.stdout,
         stdout=subprocess.PIPE)
-    gzip_proc = subprocess.Popen(
+    gzip_proc = process_backend.Popen(
         ['gzip', '-c'],
         stdin=create_cpio_proc.stdout,
         stdout=open(self._RamdiskFile(), 'w+'))
@@ -1534,7 +1780,8 @@ class EmulatedDevice(object):
     if not self._display or self._display.open_gl_driver != HOST_OPEN_GL:
       lib_paths.append(gles_mesa)
     else:
-      out = subprocess.check_output(['ldd', self.android_platform.emulator_x86])
+      out = process_backend.CheckOutput(
+          ['ldd', self.android_platform.emulator_x86])
       for line in out.splitlines():
         # line looks like:
         #   libGL.so.1 => /usr/lib/nvidia-367/libGL.so.1 (0x00007fbcd1c4b000)
@@ -1574,9 +1821,27 @@ class EmulatedDevice(object):
     return {k: str(v) for k, v in target_env.items() if v is not None}
 
   def _AddTimerResults(self, timer):
-    # pylint: disable=unnecessary-pass
-    pass
-    # pylint: enable=unnecessary-pass
+    """Adds the launch timers and boot steps to the metadata's perf_data.
+
+    Args:
+      timer: the boot_trace.TracingStopWatch of the launch. Its spans, the
+        prelaunch tasks among them, and the boot steps are written as a
+        Chrome trace too, see --export_boot_trace.
+    """
+    boot_trace.AddPerfData(self._metadata_pb, timer, self._boot_timeline,
+                           self._prelaunch_critical_path)
+    outputs_dir = os.environ.get('TEST_UNDECLARED_OUTPUTS_DIR')
+    if not FLAGS.export_boot_trace or not outputs_dir:
+      return
+    spans = timer.Spans() + boot_trace.StepSpans(self._boot_timeline)
+    try:
+      with tempfile.NamedTemporaryFile(
+          prefix='emulator_boot_trace_', suffix='.json', dir=outputs_dir,
+          mode='w', delete=False) as f:
+        boot_trace.WriteChromeTrace(f, spans)
+      logging.info('Boot trace written to %s', f.name)
+    except (IOError, OSError) as e:
+      logging.warning('Cannot write the boot trace: %s', e)
 
   def _EscapeInitToken(self, token):
     """Escape a token in init.rc so that it will be parsed as a single token.
@@ -1724,7 +1989,7 @@ class EmulatedDevice(object):
       if self._metadata_pb.qemu_arg:
         self._emulator_start_args.extend(self._metadata_pb.qemu_arg)
         self._emulator_start_args.extend(
-            ['-L', self.android_platform.MakeBiosDir(self._TempDir('bios'))])
+            ['-L', self._bios_dir])
 
       if self._qemu_gdb_port:
         self._emulator_start_args.extend(['-gdb',
@@ -1756,12 +2021,21 @@ class EmulatedDevice(object):
         self._emulator_start_args.extend(['-append', ' '.join(kernel_args)])
 
   # pylint: disable=too-many-statements
-  def _StartEmulator(self, timer,
-                     net_type, new_process_group, window_scale,
-                     with_audio, with_boot_anim,
-                     loading_from_snapshot=False):
-    """Start emulator or user mode android."""
-
+  def _PrelaunchTasks(self):
+    """Returns the task_graph.Tasks preparing the launch besides staging."""
+    tasks = [
+        task_graph.Task('PICK_PORTS', self._PickPorts),
+        task_graph.Task('STAGE_SERVICE_BINARIES',
+                        self._StageServiceBinaries),
+    ]
+    if self._metadata_pb.qemu_arg:
+      def MakeBiosDir():
+        self._bios_dir = self.android_platform.MakeBiosDir(
+            self._TempDir('bios'))
+      tasks.append(task_graph.Task('MAKE_BIOS_DIR', MakeBiosDir))
+    return tasks
+
+  def _PickPorts(self):
     if not self.emulator_adb_port:
       self.emulator_adb_port = portpicker.PickUnusedPort()
     if not self.emulator_telnet_port:
@@ -1769,31 +2043,10 @@ class EmulatedDevice(object):
     if not self.device_serial:
       self.device_serial = 'localhost:%s' % self.emulator_adb_port
 
-    emulator_binary = os.path.abspath(
-        self.android_platform.GetEmulator(
-            self._metadata_pb.emulator_architecture,
-            self._metadata_pb.emulator_type))
-
-    services_dir = self._TempDir('emu_services')
-    exec_dir = self._SessionImagesDir()
-    self._emulator_env = self._MakeEmulatorEnv(os.environ, with_audio)
-
-    if (self._metadata_pb.emulator_type in
-        [emulator_meta_data_pb2.EmulatorMetaDataPb.QEMU,
-         emulator_meta_data_pb2.EmulatorMetaDataPb.QEMU2]):
-      self._PrepareQemuArgs(emulator_binary, net_type, window_scale,
-                            with_audio, with_boot_anim)
-    else:
-      raise Exception('Not known emulator type %d' %
-                      self._metadata_pb.emulator_type)
-
-    logging.info('Executing: %s', self._emulator_start_args)
-    timer.start(_SPAWN_EMULATOR)
-
-    self._emulator_exec_dir = exec_dir
-    self._sockets_dir = os.path.join(exec_dir, 'sockets')
-    os.makedirs(self._sockets_dir)
-
+  def _StageServiceBinaries(self):
+    """Copies the forwarders the watchdog runs next to the emulator."""
+    self._services_dir = self._TempDir('emu_services')
+    services_dir = self._services_dir
     if self._use_waterfall:
       if not self._forward_bin:
         with contextlib.closing(
@@ -1820,6 +2073,40 @@ class EmulatedDevice(object):
           shutil.copyfileobj(piper, o)
           os.chmod(os.path.join(services_dir, 'pipe_traversal'), stat.S_IRWXU)
 
+  def _StartEmulator(self, timer,
+                     net_type, new_process_group, window_scale,
+                     with_audio, with_boot_anim,
+                     loading_from_snapshot=False):
+    """Start emulator or user mode android.
+
+    The ports, service binaries and bios are prepared by _PrelaunchTasks.
+    """
+
+    emulator_binary = os.path.abspath(
+        self.android_platform.GetEmulator(
+            self._metadata_pb.emulator_architecture,
+            self._metadata_pb.emulator_type))
+
+    services_dir = self._services_dir
+    exec_dir = self._SessionImagesDir()
+    self._emulator_env = self._MakeEmulatorEnv(os.environ, with_audio)
+
+    if (self._metadata_pb.emulator_type in
+        [emulator_meta_data_pb2.EmulatorMetaDataPb.QEMU,
+         emulator_meta_data_pb2.EmulatorMetaDataPb.QEMU2]):
+      self._PrepareQemuArgs(emulator_binary, net_type, window_scale,
+                            with_audio, with_boot_anim)
+    else:
+      raise Exception('Not known emulator type %d' %
+                      self._metadata_pb.emulator_type)
+
+    logging.info('Executing: %s', self._emulator_start_args)
+    timer.start(_SPAWN_EMULATOR)
+
+    self._emulator_exec_dir = exec_dir
+    self._sockets_dir = os.path.join(exec_dir, 'sockets')
+    os.makedirs(self._sockets_dir)
+
     self._child_will_delete_tmp = self.delete_temp_on_exit
     logging.info('Launching emulator in: %s', exec_dir)
 
@@ -1843,38 +2130,41 @@ class EmulatedDevice(object):
     api_version = self.GetApiVersion()
 
 
-    self.ExecOnDevice(['setprop', 'qemu.host.socket.dir',
-                       str(self._sockets_dir)])
-    self.ExecOnDevice(['setprop', 'qemu.host.hostname', socket.gethostname()])
+    setup_commands = [
+        ['setprop', 'qemu.host.socket.dir', str(self._sockets_dir)],
+        ['setprop', 'qemu.host.hostname', socket.gethostname()]]
 
     # TODO: remove once waterfall is default and scuba is fixed
     # permanently
     waterfall_on = '1' if self._use_waterfall else '0'
-    self.ExecOnDevice(['setprop', 'mdevx.waterfall', waterfall_on])
+    setup_commands.append(['setprop', 'mdevx.waterfall', waterfall_on])
     if not loading_from_snapshot:
       # set screen off timeout to 30 minutes.
-      self._SetDeviceSetting(self.GetApiVersion(), 'system',
-                             'screen_off_timeout', '1800000')
+      setup_commands.append(self._DeviceSettingCommand(
+          self.GetApiVersion(), 'system', 'screen_off_timeout', '1800000'))
       # disable lockscreen, this works on most api levels.
       if not self._direct_boot:
-        self._SetDeviceSetting(self.GetApiVersion(), 'secure',
-                               'lockscreen.disabled', '1')
+        setup_commands.append(self._DeviceSettingCommand(
+            self.GetApiVersion(), 'secure', 'lockscreen.disabled', '1'))
       # disable software keyboard when hardware keyboard is there.
-      self._SetDeviceSetting(self.GetApiVersion(), 'secure',
-                             'show_ime_with_hard_keyboard', '0')
+      setup_commands.append(self._DeviceSettingCommand(
+          self.GetApiVersion(), 'secure', 'show_ime_with_hard_keyboard', '0'))
 
     if FLAGS.long_press_timeout:
       if self.GetApiVersion() == 10:
         logging.warn('long_press_timeout doesn\'t work on api 10.')
       else:
-        self._SetDeviceSetting(self.GetApiVersion(), 'secure',
-                               'long_press_timeout',
-                               str(FLAGS.long_press_timeout))
+        setup_commands.append(self._DeviceSettingCommand(
+            self.GetApiVersion(), 'secure', 'long_press_timeout',
+            str(FLAGS.long_press_timeout)))
+    self.ExecBatchOnDevice(setup_commands)
+    if FLAGS.long_press_timeout:
       # fix possible stuck keyguardscrim window.
       self._DismissStuckKeyguardScrim()
       # ensure that processes that hang can write to /data/anr/traces.txt
       self.ExecOnDevice(['mkdir -p /data/anr && chmod -R 777 /data/anr'])
-      logging.info(self.ExecOnDevice(['getprop']))
+      logging.info('\n'.join('[%s]: [%s]' % prop for prop in
+                             sorted(self._properties.Snapshot().items())))
   # pylint: enable=too-many-statements
 
   def _ForkWatchdog(self, new_process_group, emu_args, emu_env, emu_wd,
@@ -2239,8 +2529,19 @@ class EmulatedDevice(object):
         cwd=self._sockets_dir,
         close_fds=True)
 
-  def ExecOnDevice(self, args, stdin=_DEV_NULL):
-    """Execute commands on device with adb."""
+  def ExecOnDevice(self, args, stdin=_DEV_NULL, output_window=None):
+    """Execute commands on device with adb.
+
+    Args:
+      args: the shell command to run on the device.
+      stdin: the stdin of adb.
+      output_window: [optional] if set, only this many bytes of the head and
+        of the tail of the output are kept, for commands such as a logcat
+        dump whose output is only logged.
+
+    Returns:
+      The stdout of the command.
+    """
 
     assert self._IsPipeTraversalRunning()
     assert self._CanConnect(), 'missing details to connect to adb.'
@@ -2254,26 +2555,228 @@ class EmulatedDevice(object):
     args = [self.android_platform.adb,
             '-s', self.device_serial,
             'shell', emu_commandline]
-    logging.info('Executing on emulator: %s', args)
-    start_time = time.time()
-    proc = subprocess.Popen(args, stdin=stdin, env=self._AdbEnv(),
-                            stdout=subprocess.PIPE,
-                            stderr=subprocess.PIPE)
-    out, err = proc.communicate()
+    result = None
+    if stdin is _DEV_NULL and output_window is None:
+      result = (self._ExecInShellSession(emu_commandline) or
+                self._ExecWithAdbClient(emu_commandline))
+    if result:
+      returncode, out, err = result
+    else:
+      logging.info('Executing on emulator: %s', args)
+      proc = process_backend.Popen(args, stdin=stdin, env=self._AdbEnv(),
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE)
+      if output_window is None:
+        out, err = proc.communicate()
+      else:
+        out, err = [c.Value() for c in common.BoundedCommunicate(
+            proc, window=output_window)]
+      returncode = proc.returncode
+    self._NoteCommand(emu_commandline)
     if err:
       logging.warn('Something is wrong: %s', err)
-    if proc.returncode:
-      self._ShowEmulatorLog()
-      self._reporter.ReportFailure('tools.android.emulator.adb.ErrorExit', {
-          'command': args,
-          'return': proc.returncode,
-          'out': out,
-          'error': err,
-      })
-      self._TransientDeath(
-          'Adb command failed, stdout:%s error:%s' % (out, err))
+    if returncode:
+      self._AdbFailed(args, returncode, out, err)
     return out
 
+  def _AdbFailed(self, command, returncode, out, err):
+    """Reports a failed adb command, the emulator is presumed dead."""
+    self._ShowEmulatorLog()
+    self._reporter.ReportFailure('tools.android.emulator.adb.ErrorExit', {
+        'command': command,
+        'return': returncode,
+        'out': out,
+        'error': err,
+    })
+    self._TransientDeath(
+        'Adb command failed, stdout:%s error:%s' % (out, err))
+
+  def ExecBatchOnDevice(self, commands, fail_fast=False):
+    """Execute several commands on device, in one round trip if possible.
+
+    The commands are sent together through the adb shell session, or run one
+    after another with adb if there is none. Unlike ExecOnDevice, a command
+    which exits non zero does not end the emulator, its status is returned;
+    adb failing does end it, as in ExecOnDevice.
+
+    Args:
+      commands: a list of shell commands (each a list of args, as taken by
+        ExecOnDevice).
+      fail_fast: if set, the commands after the first one to fail are not run.
+
+    Returns:
+      A list with (exit status, stdout, stderr) of each command, or None for
+      those not run.
+    """
+    assert self._IsPipeTraversalRunning()
+    assert self._CanConnect(), 'missing details to connect to adb.'
+    commandlines = [' '.join(args) for args in commands]
+    logging.info('Executing batch on emulator: %s', commandlines)
+    results = []
+    session = self._AcquireShellSession()
+    if session:
+      try:
+        results = session.RunBatch(commandlines, fail_fast=fail_fast)
+      except adb_shell_session.ShellSessionError as e:
+        logging.warning('adb shell session failed: %s', e)
+        results = e.results
+        if e.sent:
+          # The command may have run, report it like a failed adb shell.
+          self._AdbFailed(commandlines[len(results)], _ADB_ERROR_EXIT,
+                          e.output, str(e))
+      finally:
+        session.lock.release()
+
+    for commandline in commandlines[len(results):]:
+      if fail_fast and [r for r in results if r is None or r[0]]:
+        results.append(None)
+        continue
+      result = self._ExecWithAdbClient(commandline)
+      if not result:
+        args = [self.android_platform.adb, '-s', self.device_serial,
+                'shell', commandline]
+        logging.info('Executing on emulator: %s', args)
+        proc = process_backend.Popen(args, stdin=_DEV_NULL,
+                                     env=self._AdbEnv(),
+                                     stdout=subprocess.PIPE,
+                                     stderr=subprocess.PIPE)
+        out, err = proc.communicate()
+        result = (proc.returncode, out, err)
+      if result[0] == _ADB_ERROR_EXIT:
+        # adb itself failed, as in ExecOnDevice the emulator is presumed dead.
+        self._AdbFailed(commandline, result[0], result[1], result[2])
+      results.append(result)
+
+    for commandline, result in zip(commandlines, results):
+      if result:
+        self._NoteCommand(commandline)
+      if result and (result[0] or result[2]):
+        logging.warn('%s: exit %s, stderr: %s', commandline, result[0],
+                     result[2])
+    return results
+
+  def _NoteCommand(self, commandline):
+    """Drops the device state cached for commands which may change it."""
+    self._properties.NoteCommand(commandline)
+    self._mounts.NoteCommand(commandline)
+    self._processes.NoteCommand(commandline)
+
+  def _AcquireShellSession(self):
+    """Returns the device's adb shell session, locked for the caller.
+
+    Returns:
+      The session, whose lock the caller has to release, or None if commands
+      have to be run with a one-shot adb shell.
+    """
+    if not FLAGS.adb_shell_session:
+      return None
+    with self._shell_session_lock:
+      session = self._shell_session
+      if session and session.owner_pid != os.getpid():
+        # forked, the session belongs to our parent.
+        return None
+      if not session or not session.alive:
+        if time.time() < self._shell_session_retry_time:
+          return None
+        session = adb_shell_session.ShellSession(
+            self.android_platform.adb, self.device_serial, env=self._AdbEnv())
+        try:
+          session.Start()
+        except adb_shell_session.ShellSessionError as e:
+          logging.info('No adb shell session, running commands one-shot: %s',
+                       e)
+          self._shell_session_retry_time = (time.time() +
+                                            _SHELL_SESSION_RETRY_SECONDS)
+          return None
+        self._shell_session = session
+    if not session.lock.acquire(False):
+      # in use by another thread.
+      return None
+    return session
+
+  def _ExecInShellSession(self, commandline):
+    """Runs commandline in the device's adb shell session.
+
+    Args:
+      commandline: the shell command line.
+
+    Returns:
+      (exit status, stdout, stderr), or None if the command has to be run
+      with a one-shot adb shell. Like the one-shot adb shell, which exits 0
+      whatever the command does, the status is 0 unless the session broke.
+    """
+    session = self._AcquireShellSession()
+    if not session:
+      return None
+    try:
+      logging.info('Executing in adb shell session: %s', commandline)
+      returncode, out, err = session.Run(commandline)
+      if returncode:
+        logging.info('%s: exit %d', commandline, returncode)
+      return 0, out, err
+    except adb_shell_session.ShellSessionError as e:
+      logging.warning('adb shell session failed: %s', e)
+      if not e.sent:
+        return None
+      # The command may have run, report it like a failed adb shell.
+      return _ADB_ERROR_EXIT, e.output, str(e)
+    finally:
+      session.lock.release()
+
+  def _NativeAdbClient(self):
+    """Returns an AdbClient for the adb server, or None to fork adb instead.
+
+    Commands only go through the adb server if the pipe services are not
+    used (adb.turbo would fall back to the real adb then too).
+    """
+    if (not FLAGS.adb_native_client or not self._use_real_adb or
+        not self.adb_server_port or
+        time.time() < self._adb_client_retry_time):
+      return None
+    return adb_client.GetAdbClient(self.adb_server_port)
+
+  def _AdbClientFailed(self, error):
+    logging.warning('adb client failed: %s', error)
+    if isinstance(error, adb_client.AdbUnavailableError):
+      self._adb_client_retry_time = time.time() + _ADB_CLIENT_RETRY_SECONDS
+
+  def _ExecWithAdbClient(self, commandline):
+    """Runs commandline on the device through the adb server's socket.
+
+    Args:
+      commandline: the shell command line.
+
+    Returns:
+      (exit status, stdout, stderr), or None if the command has to be run
+      with a one-shot adb shell.
+    """
+    client = self._NativeAdbClient()
+    if not client:
+      return None
+    try:
+      logging.info('Executing through the adb server: %s', commandline)
+      return client.Shell(self.device_serial, commandline)
+    except adb_client.AdbError as e:
+      self._AdbClientFailed(e)
+      if not e.sent:
+        return None
+      # The command may have run, report it like a failed adb shell.
+      return _ADB_ERROR_EXIT, '', str(e)
+
+  def _CloseShellSession(self, disable=False):
+    """Closes the adb shell session, the next command opens a new one.
+
+    Args:
+      disable: if set, commands are run one-shot from now on, e.g. while /data
+        (which holds the session's stderr files) is unmounted.
+    """
+    if disable:
+      self._shell_session_retry_time = float('inf')
+    session, self._shell_session = self._shell_session, None
+    if session and session.owner_pid == os.getpid():
+      with session.lock:
+        session.Close()
+
   def _KillProcess(self, pid):
     if pid and pid.isdigit():
       try:
@@ -2327,6 +2830,18 @@ class EmulatedDevice(object):
   def _PollEmulatorStatus(self, timer=None, loading_from_snapshot=False):
     """Blocks until the emulator is fully launched.
 
+    Retries made while polling share the boot time out.
+
+    Args:
+      timer: stopwatch to measure how long each check takes
+      loading_from_snapshot: Is the emulator loaded from a snapshot
+    """
+    with self._BootDeadline():
+      self._PollUntilLaunched(timer, loading_from_snapshot)
+
+  def _PollUntilLaunched(self, timer, loading_from_snapshot):
+    """Blocks until the emulator is fully launched.
+
     Args:
       timer: stopwatch to measure how long each check takes
       loading_from_snapshot: Is the emulator loaded from a snapshot
@@ -2335,214 +2850,276 @@ class EmulatedDevice(object):
       Exception: if the emulator dies or doesn't become lively in a reasonable
       timeframe.
     """
-    if not timer:
-      timer = stopwatch.StopWatch()
+    poller = self._BootPoller(loading_from_snapshot)
+    try:
+      self._PollBootSteps(timer, loading_from_snapshot, poller)
+    finally:
+      self._StopBootWatcher()
+    if poller:
+      stats = poller.Stats()
+      logging.info('Boot polls: %d, %d saved over a fixed interval, '
+                   '%.2fs less ready latency. Steps: %s', stats['polls'],
+                   stats['polls_saved'], stats['latency_gained_seconds'],
+                   stats['steps'])
+      poller.Save()
+
+  def _BootPoller(self, loading_from_snapshot):
+    """Returns the AdaptivePoller of this boot, None without a history."""
+    if not FLAGS.boot_history_file:
+      return None
+    boot_kind = boot_history.BootKind(
+        os.path.basename(self._metadata_pb.system_image_dir.rstrip('/')),
+        self.GetApiVersion(),
+        'snapshot' if loading_from_snapshot else 'cold',
+        self._metadata_pb.with_kvm)
+    return boot_history.AdaptivePoller(
+        boot_history.StepHistory(FLAGS.boot_history_file), boot_kind,
+        self._connect_poll_interval)
+
+  def _StartBootWatcher(self):
+    """Starts reporting the boot milestones from the device, if it can."""
+    if (not FLAGS.boot_watcher or self._mini_boot or
+        self.GetApiVersion() < 21):
+      return
+    script = boot_watcher.WatcherScript(' '.join(self._PsCommand()),
+                                        _LAUNCHER_PACKAGES)
+    watcher = boot_watcher.BootWatcher(
+        [self.android_platform.adb, '-s', self.device_serial, 'shell'],
+        script, env=self._AdbEnv())
+    if watcher.Start():
+      self._boot_watcher = watcher
+
+  def _StopBootWatcher(self):
+    watcher, self._boot_watcher = self._boot_watcher, None
+    if watcher:
+      watcher.Close()
+      logging.info('Boot milestones: %s', ', '.join(
+          '%s %.1fs' % t for t in watcher.Transitions()))
+
+  def _WatchedStep(self, milestone, check_fn, timeout_seconds):
+    """Returns a step which waits for milestone from the device first.
+
+    The host check only runs once the boot watcher reported milestone, or
+    straight away when there is no watcher or it stopped.
+    """
+    def _Step():
+      watcher = self._boot_watcher
+      if (watcher and watcher.Watching(milestone) and
+          not watcher.WaitFor(milestone, timeout_seconds)):
+        return False
+      return check_fn()
+    return _Step
 
-    fully_booted = False
-    system_server_running = False
-    pm_running = False
-    adb_listening = False
-    adb_connected = False
-    sd_card_mounted = False
-    external_storage = None
-    boot_complete_present = False
-    launcher_started = False
-    dpi_ok = False
-    pipe_traversal_ready = False
-    waterfall_listening = False
-    logcat_enabled = False
+  def _SleepAfterStep(self, milestone):
+    """Whether a failed step for milestone still has to sleep.
 
-    interval = self._connect_poll_interval
-    max_attempts = self._connect_max_attempts
+    A step waiting on the boot watcher has spent its interval waiting already.
+    """
+    return not (self._boot_watcher and self._boot_watcher.Watching(milestone))
+
+  def _PollBootSteps(self, timer, loading_from_snapshot, poller=None):
+    """Runs the boot checks, see _PollUntilLaunched and _BootSteps."""
+    if not timer:
+      timer = stopwatch.StopWatch()
 
-    attempter = Attempter(timer, interval)
+    external_storage = []
+    graph = readiness_graph.ReadinessGraph(
+        self._BootSteps(loading_from_snapshot, external_storage), timer,
+        sleep_interval=self._connect_poll_interval, poller=poller)
+    if not self._mini_boot:
+      graph.AddMonitor(self._DetectFSErrors, after='logcat')
+      graph.AddMonitor(self._KillCrashedProcesses, after='system_server')
 
-    while not fully_booted:
-      if (attempter.total_attempts > max_attempts or
-          time.time() > self._time_out_time):
-        self._reporter.ReportFailure(
-            'tools.android.emulator.boot.DeviceNotReady', {
-                'attempts': attempter.total_attempts,
-                'start_time': self._start_time,
-                'time_out_time': self._time_out_time,
-                'system_server_running': system_server_running,
-                'pm_running': pm_running,
-                'adb_listening': adb_listening,
-                'adb_connected': adb_connected,
-                'sd_card_mounted': sd_card_mounted,
-                'external_storage': external_storage,
-                'boot_complete_present': boot_complete_present,
-                'launcher_started': launcher_started,
-                'dpi_ok': dpi_ok,
-            })
+    try:
+      graph.Run(deadline=self._time_out_time,
+                max_attempts=self._connect_max_attempts,
+                watchdog=self._EnsureEmuRunning)
+    except readiness_graph.StepFailedError as e:
+      self._TransientDeath(str(e))
+    except readiness_graph.DeadlineExceededError as e:
+      logging.error('%s', e)
+      self._reporter.ReportFailure(
+          'tools.android.emulator.boot.DeviceNotReady', {
+              'attempts': graph.Attempts(),
+              'start_time': self._start_time,
+              'time_out_time': self._time_out_time,
+              'system_server_running': graph.Passed('system_server'),
+              'pm_running': graph.Passed('package_manager'),
+              'adb_listening': graph.Passed('adb_listening'),
+              'adb_connected': graph.Passed('adb_connected'),
+              'sd_card_mounted': graph.Passed('external_storage'),
+              'external_storage': external_storage,
+              'boot_complete_present': graph.Passed('boot_completed'),
+              'launcher_started': graph.Passed('launcher'),
+              'dpi_ok': graph.Passed('dpi'),
+          })
 
-        self._ShowEmulatorLog()
-        if adb_listening:
-          log = self.ExecOnDevice(['logcat', '-v', 'threadtime', '-d'])
-          logging.info('Android logcat below ' + '=' * 50 + '\n%s', log)
-          logging.info('Android logcat end ' + '=' * 50)
-        self._reporter.ReportFailure(
-            'tools.android.emulator.adb.AdbNotListening',
-            {'attempts': attempter.total_attempts})
-        raise Exception('Haven\'t been able to connect to device after %s'
-                        ' attempts.' % attempter.total_attempts)
-
-      logging.info('system: %s pm: %s adb: %s sdcard: %s '
-                   'boot_complete: %s launcher: %s pipes: %s '
-                   'current step attempts: %s total attempts: %s',
-                   system_server_running,
-                   pm_running,
-                   adb_listening,
-                   sd_card_mounted,
-                   boot_complete_present,
-                   launcher_started,
-                   pipe_traversal_ready,
-                   attempter.step_attempts,
-                   attempter.total_attempts)
-      self._EnsureEmuRunning()
-
-      if not adb_listening:
-        adb_listening = attempter.AttemptStep(self._AdbListeningStep,
-                                              'Checking if adb is listening.',
-                                              _ADB_LISTENING_CHECK,
-                                              _ADB_LISTENING_CHECK_FAIL_SLEEP)
-        if not adb_listening:
-          continue
+      self._ShowEmulatorLog()
+      if graph.Passed('adb_listening'):
+        log = self.ExecOnDevice(['logcat', '-v', 'threadtime', '-d'],
+                                output_window=_LOGCAT_DUMP_WINDOW)
+        logging.info('Android logcat below ' + '=' * 50 + '\n%s', log)
+        logging.info('Android logcat end ' + '=' * 50)
+      self._reporter.ReportFailure(
+          'tools.android.emulator.adb.AdbNotListening',
+          {'attempts': graph.Attempts()})
+      raise Exception('Haven\'t been able to connect to device after %s'
+                      ' attempts.' % graph.Attempts())
+    finally:
+      self._boot_timeline = graph.Timeline()
+      logging.info('Boot steps: %s', ', '.join(
+          '%s %s after %.1fs in %d attempts' % (
+              t.name, t.outcome, (t.end or time.time()) - t.start, t.attempts)
+          for t in self._boot_timeline))
+
+    # If we are running in dex2oat mode, stop the device once
+    # pipe_traversal is ready.
+    if self._mini_boot:
+      self.ExecOnDevice(['stop'])
+      self._WaitUntilDataPartitionMounted()
+      return
 
-      if not adb_connected and self._use_real_adb:
-        if not self.ConnectDevice():
-          raise Exception('Unable to connect to adbd')
-        wait_args = [self.android_platform.real_adb, '-s',
-                     'localhost:%s' % self.emulator_adb_port, 'wait-for-device']
-        common.SpawnAndWaitWithRetry(wait_args, retries=2, timeout_seconds=30,
-                                     exec_env=self._AdbEnv())
-        adb_connected = True
-
-      if not pipe_traversal_ready:
-        pipe_traversal_ready = attempter.AttemptStep(
-            self._PipeTraversalRestoreStep,
-            'Checking Pipe Traversal.',
-            _PIPE_TRAVERSAL_CHECK,
-            _PIPE_TRAVERSAL_CHECK_FAIL_SLEEP)
-        if not pipe_traversal_ready:
-          continue
+    self._running = True
+    self._KillCrashedProcesses()
 
-      if not waterfall_listening and self._use_waterfall:
-        waterfall_listening = attempter.AttemptStep(
-            self._WaterfallListeningStep, 'Checking if waterfall is listening.',
-            _WATERFALL_LISTENING_CHECK, _WATERFALL_LISTENING_CHECK_FAIL_SLEEP)
-        if not waterfall_listening:
-          continue
+  def _BootSteps(self, loading_from_snapshot, external_storage):
+    """Returns the readiness_graph.Steps of a boot.
 
-      if not logcat_enabled:
-        self.EnableLogcat()
-        logcat_enabled = True
+    Args:
+      loading_from_snapshot: Is the emulator loaded from a snapshot
+      external_storage: a list, which gets the external storage paths.
 
-        emu_type = self._metadata_pb.emulator_type
-        self._reporter.ReportDeviceProperties(emu_type, self._Props())
+    Returns:
+      The Steps. Once the device has a shell, system_server is waited for,
+      then the package manager, external storage and the boot property at the
+      same time, then the DPI and the launcher.
+    """
+    interval = self._connect_poll_interval
+    max_attempts = self._connect_max_attempts
 
-      # If we are running in dex2oat mode, stop the device once
-      # pipe_traversal is ready.
-      if self._mini_boot:
-        self.ExecOnDevice(['stop'])
-        self._WaitUntilDataPartitionMounted()
-        return
+    def _Connect():
+      if not self.ConnectDevice():
+        raise Exception('Unable to connect to adbd')
+      wait_args = [self.android_platform.real_adb, '-s',
+                   'localhost:%s' % self.emulator_adb_port, 'wait-for-device']
+      common.SpawnAndWaitWithRetry(wait_args, retries=2, timeout_seconds=30,
+                                   exec_env=self._AdbEnv())
+      return True
 
-      self._DetectFSErrors()
+    def _EnableLogcat():
+      self.EnableLogcat()
+      emu_type = self._metadata_pb.emulator_type
+      self._reporter.ReportDeviceProperties(emu_type, self._Props())
+      self._StartBootWatcher()
+      return True
 
-      if not system_server_running:
-        system_server_running = attempter.AttemptStep(
-            self._CheckSystemServerProcess,
-            'Checking System Server',
-            _SYS_SERVER_CHECK,
-            _SYS_SERVER_CHECK_FAIL_SLEEP)
-        if not system_server_running:
-          continue
+    def _ExternalStorageReady():
+      if not external_storage:
+        external_storage.extend(' '.join(self._GetEnvironmentVars(
+            ['EMULATED_STORAGE_SOURCE', 'EXTERNAL_STORAGE',
+             'ANDROID_STORAGE'])).split())
+      return bool(external_storage) and self._CheckMount(external_storage)
 
-      self._KillCrashedProcesses()
+    def _ExternalStoragePolicy(failures):
+      if float(failures) / max_attempts * 100 > 20:
+        return 'SDCard mount issues. This is a transient KI.'
 
-      if not pm_running:
-        pm_running = attempter.AttemptStep(self._CheckPackageManagerRunning,
-                                           'Checking package manager',
-                                           _PM_CHECK,
-                                           _PM_CHECK_FAIL_SLEEP)
-        if not pm_running:
-          continue
+    def _NoteDirectBoot():
+      if not self._direct_boot:
+        self._direct_boot = '1' in self._properties.Get(DIRECT_BOOT_PROP)
 
-      if not sd_card_mounted:
-        if not external_storage:
-          external_storage = ('%s %s %s' % (
-              self._GetEnvironmentVar('EMULATED_STORAGE_SOURCE'),
-              self._GetEnvironmentVar('EXTERNAL_STORAGE'),
-              self._GetEnvironmentVar('ANDROID_STORAGE'))).split()
-
-        def _ExternalStorageReady():
-          return external_storage and self._CheckMount(external_storage)
-        sd_card_mounted = attempter.AttemptStep(_ExternalStorageReady,
-                                                'Checking external storage',
-                                                _SD_CARD_MOUNT_CHECK,
-                                                _SD_CARD_MOUNT_CHECK_FAIL_SLEEP)
-        if not sd_card_mounted:
-          perc_steps_spent = float(
-              attempter.step_attempts) / max_attempts
-          perc_steps_spent *= 100
-          if perc_steps_spent > 20:
-            self._TransientDeath('SDCard mount issues. This is a transient KI.')
-          continue
+    def _BeforeDpi(failures):
+      if not failures and not self.IsInstalled(_BOOTSTRAP_PKG):
+        self.InstallApk(
+            resources.GetResourceFilename(_BOOTSTRAP_PATH),
+            grant_runtime_permissions=True)
+      if not self._direct_boot:
+        self._UnlockScreen()
 
-      if not boot_complete_present:
-        boot_complete_present = attempter.AttemptStep(
-            self._CheckBootComplete,
-            'Checking for boot complete',
-            _BOOT_COMPLETE_PRESENT,
-            _BOOT_COMPLETE_FAIL_SLEEP)
-        if not boot_complete_present:
-          continue
-        if not self._direct_boot:
-          self._direct_boot = ('1' in
-                               self.ExecOnDevice(['getprop', DIRECT_BOOT_PROP]))
-
-      if not loading_from_snapshot:
-        if not dpi_ok:
-          if not attempter.step_attempts:
-            if not self.IsInstalled(_BOOTSTRAP_PKG):
-              self.InstallApk(
-                  resources.GetResourceFilename(_BOOTSTRAP_PATH),
-                  grant_runtime_permissions=True)
-
-          if not self._direct_boot:
-            self._UnlockScreen()
-          dpi_ok = attempter.AttemptStep(self._CheckDpi,
-                                         'Checking DPI',
-                                         _CHECK_DPI,
-                                         _CHECK_DPI_FAIL_SLEEP)
-          if not dpi_ok:
-            if attempter.step_attempts > 4:
-              self._TransientDeath('Haven\'t been able to read  '
-                                   'correct DPI values in '
-                                   ' %s attempts.' % attempter.step_attempts)
-            continue
-
-
-      if not self._direct_boot and not launcher_started:
-        if attempter.step_attempts > 0:
-          self._UnlockScreen()
-
-        if attempter.step_attempts > 2 and not self._kicked_launcher:
-          # sometimes the handoff to start the launcher fails. doing
-          # am start -a android.intent.action.MAIN \
-          # -c android.intent.category.HOME can't hurt.
-          self._KickLauncher()
-        launcher_started = attempter.AttemptStep(self._CheckLauncherStarted,
-                                                 'Checking launcher app.',
-                                                 _LAUNCHER_STARTED,
-                                                 _LAUNCHER_STARTED_FAIL_SLEEP)
-        if not launcher_started:
-          continue
-      fully_booted = True
+    def _DpiPolicy(failures):
+      if failures > 4:
+        return ('Haven\'t been able to read  correct DPI values in  %s '
+                'attempts.' % failures)
 
-    self._running = True
-    self._KillCrashedProcesses()
+    def _BeforeLauncher(failures):
+      if failures > 0:
+        self._UnlockScreen()
+      if failures > 2 and not self._kicked_launcher:
+        # sometimes the handoff to start the launcher fails. doing
+        # am start -a android.intent.action.MAIN \
+        # -c android.intent.category.HOME can't hurt.
+        self._KickLauncher()
+
+    def _Watched(name, milestone, check_fn, **kwargs):
+      return readiness_graph.Step(
+          name, self._WatchedStep(milestone, check_fn, interval),
+          sleep_after_failure=lambda: self._SleepAfterStep(milestone),
+          **kwargs)
+
+    steps = [readiness_graph.Step(
+        'adb_listening', self._AdbListeningStep,
+        check_tag=_ADB_LISTENING_CHECK,
+        sleep_tag=_ADB_LISTENING_CHECK_FAIL_SLEEP,
+        details='Checking if adb is listening.')]
+    if self._use_real_adb:
+      steps.append(readiness_graph.Step(
+          'adb_connected', _Connect, deps=[steps[-1].name],
+          check_tag=_ADB_CONNECT, sleep_tag=_ADB_CONNECT_FAIL_SLEEP,
+          details='Connecting adb.'))
+    steps.append(readiness_graph.Step(
+        'pipe_traversal', self._PipeTraversalRestoreStep,
+        deps=[steps[-1].name], check_tag=_PIPE_TRAVERSAL_CHECK,
+        sleep_tag=_PIPE_TRAVERSAL_CHECK_FAIL_SLEEP,
+        details='Checking Pipe Traversal.'))
+    if self._use_waterfall:
+      steps.append(readiness_graph.Step(
+          'waterfall', self._WaterfallListeningStep, deps=[steps[-1].name],
+          check_tag=_WATERFALL_LISTENING_CHECK,
+          sleep_tag=_WATERFALL_LISTENING_CHECK_FAIL_SLEEP,
+          details='Checking if waterfall is listening.'))
+    steps.append(readiness_graph.Step(
+        'logcat', _EnableLogcat, deps=[steps[-1].name],
+        check_tag=_ENABLE_LOGCAT, details='Enabling logcat.'))
+    if self._mini_boot:
+      return steps
+
+    steps += [
+        _Watched('system_server', boot_watcher.SYSTEM_SERVER,
+                 self._CheckSystemServerProcess, deps=['logcat'],
+                 check_tag=_SYS_SERVER_CHECK,
+                 sleep_tag=_SYS_SERVER_CHECK_FAIL_SLEEP,
+                 details='Checking System Server'),
+        _Watched('package_manager', boot_watcher.PACKAGE_MANAGER,
+                 self._CheckPackageManagerRunning, deps=['system_server'],
+                 check_tag=_PM_CHECK, sleep_tag=_PM_CHECK_FAIL_SLEEP,
+                 details='Checking package manager'),
+        _Watched('external_storage', boot_watcher.STORAGE,
+                 _ExternalStorageReady, deps=['system_server'],
+                 check_tag=_SD_CARD_MOUNT_CHECK,
+                 sleep_tag=_SD_CARD_MOUNT_CHECK_FAIL_SLEEP,
+                 failure_policy=_ExternalStoragePolicy,
+                 details='Checking external storage'),
+        _Watched('boot_completed', boot_watcher.BOOT_COMPLETED,
+                 self._CheckBootComplete, deps=['system_server'],
+                 check_tag=_BOOT_COMPLETE_PRESENT,
+                 sleep_tag=_BOOT_COMPLETE_FAIL_SLEEP, on_pass=_NoteDirectBoot,
+                 details='Checking for boot complete'),
+    ]
+    launcher_deps = ['package_manager', 'external_storage', 'boot_completed']
+    if not loading_from_snapshot:
+      steps.append(readiness_graph.Step(
+          'dpi', self._CheckDpi, deps=['package_manager', 'boot_completed'],
+          check_tag=_CHECK_DPI, sleep_tag=_CHECK_DPI_FAIL_SLEEP,
+          before_attempt=_BeforeDpi, failure_policy=_DpiPolicy,
+          details='Checking DPI'))
+      launcher_deps.append('dpi')
+    steps.append(_Watched(
+        'launcher', boot_watcher.LAUNCHER, self._CheckLauncherStarted,
+        deps=launcher_deps, check_tag=_LAUNCHER_STARTED,
+        sleep_tag=_LAUNCHER_STARTED_FAIL_SLEEP,
+        enabled=lambda: not self._direct_boot,
+        before_attempt=_BeforeLauncher, details='Checking launcher app.'))
+    return steps
   # pylint: enable=too-many-statements
 
   # Newer MR1 images have a async encryption operation that remounts the data
@@ -2554,8 +3131,7 @@ class EmulatedDevice(object):
     if not self._mini_boot and self.GetApiVersion() != 25:
       return
     for _ in range(10):
-      output = self.ExecOnDevice(['mount'])
-      if '/data type ext4' in output:
+      if self._mounts.FsType('/data') == 'ext4':
         return
       time.sleep(1)
 
@@ -2609,38 +3185,41 @@ class EmulatedDevice(object):
 
     return [str(x) for x in crashed_or_anr_procs if x not in dead_procs]
 
-  def _GetEnvironmentVar(self, varname):
-    """Return the value of a environment variable.
+  def _GetEnvironmentVars(self, varnames):
+    """Return the values of environment variables.
 
     Args:
-      varname: name of the environment variable.
+      varnames: names of the environment variables.
 
     Returns:
-      Value of the environment variable or None if the variable is not defined.
+      Values of the environment variables, empty for those not defined.
     """
-    return self.ExecOnDevice(['printenv', varname]).strip()
+    results = self.ExecBatchOnDevice([['printenv', varname]
+                                      for varname in varnames])
+    return [out.strip() for _, out, _ in results]
 
   def _CheckBootComplete(self):
-    output = self.ExecOnDevice(['getprop'])
-    completed = 'dev.bootcomplete' in output
-    if not completed:
-      completed = 'sys.boot_completed' in output
-    return completed
+    props = self._properties.GetMany(['dev.bootcomplete',
+                                      'sys.boot_completed'])
+    return any(props.values())
 
   def _CheckMount(self, mount_points):
-    output = self.ExecOnDevice(['mount'])
     mounted = [mount_point for mount_point in mount_points
-               if mount_point in output]
+               if self._mounts.IsMounted(mount_point)]
     if not mounted:
-      logging.info('%s not mounted - mount info: %s', mount_points, output)
+      logging.info('%s not mounted - mount info: %s', mount_points,
+                   self._mounts.Output())
     logging.info('mounted: %s', mounted)
     return mounted
 
   def _Remount(self, mount_point, permission):
+    self.ExecOnDevice(self._RemountCommand(mount_point, permission))
+
+  def _RemountCommand(self, mount_point, permission):
     mount_cmd = ['mount', '-o', '%s,remount' % permission, mount_point]
     if self.GetApiVersion() <= 10:
       mount_cmd.append(mount_point)
-    self.ExecOnDevice(mount_cmd)
+    return mount_cmd
 
   def _DetermineArchitecture(self, source_properties):
     if SYSTEM_ABI_KEY in source_properties:
@@ -2748,7 +3327,7 @@ class EmulatedDevice(object):
 
     if self.GetApiVersion() < 21:
       logging.info('checking event buffer for launcher...')
-      command_line = [
+      output = self.ExecOnDevice([
           'logcat',
           '-d',
           '-b',
@@ -2757,29 +3336,20 @@ class EmulatedDevice(object):
           'activity_launch_time:*',  # eclair to JB
           'am_activity_launch_time:*',  # JB-MR-1 +
           'am_on_resume_called:*',  # API 23 +
-      ]
+      ])
+      launcher_started = bool([p for p in _LAUNCHER_PACKAGES if p in output])
     else:
       logging.info('checking process list for launcher...')
-      command_line = ['ps']
-
-    output = self.ExecOnDevice(command_line)
-    launcher_started = ('com.android.launcher' in output or
-                        'com.google.android.wearable' in output or
-                        'com.google.glass.nowtown' in output or
-                        'com.google.android.googlequicksearchbox' in output or
-                        'com.google.android.tv' in output or
-                        'com.android.tv' in output or
-                        'com.android.iotlauncher' in output or
-                        'com.android.car' in output or
-                        'com.google.android.car' in output)
+      launcher_started = bool(
+          self._processes.Get().NameContains(_LAUNCHER_PACKAGES))
     logging.info('launcher running? %s', launcher_started)
     return launcher_started
 
   def _AdbListeningStep(self):
     port = int(self.emulator_adb_port)
     if FLAGS.skip_connect_device:
-      lsof_out = subprocess.check_output('lsof -ni:%d || true' % port,
-                                         shell=True)
+      lsof_out = process_backend.CheckOutput('lsof -ni:%d || true' % port,
+                                             shell=True)
       return bool(lsof_out)
     try:
       s = socket.create_connection(('localhost', port))
@@ -2815,10 +3385,19 @@ class EmulatedDevice(object):
 
     self._kicked_launcher = True
 
-  def _CheckSystemServerProcess(self):
-    output = self.ExecOnDevice(['ps'])
+  def _PsCommand(self):
+    # toybox ps (O+) only lists the processes of the session without -A.
+    if self._metadata_pb:
+      api_level = self.GetApiVersion()
+    else:
+      # ping and kill know the device by its ports only.
+      api_level = int(self._properties.Get('ro.build.version.sdk') or 0)
+    if api_level >= 26:
+      return ['ps', '-A']
+    return ['ps']
 
-    system_server_running = 'system_server' in output
+  def _CheckSystemServerProcess(self):
+    system_server_running = self._processes.Get().IsRunning('system_server')
     logging.info('system_server running? %s', system_server_running)
     return system_server_running
 
@@ -2852,7 +3431,6 @@ class EmulatedDevice(object):
                     'connect',
                     'localhost:%s' % self.emulator_adb_port]
     logging.info('Connecting adb server to device: %s', connect_args)
-    connect_task = None
     if not self.adb_server_port:
       self.adb_server_port = portpicker.PickUnusedPort()
     elif self.adb_server_port < 0 or self.adb_server_port > 65535:
@@ -2860,24 +3438,42 @@ class EmulatedDevice(object):
                    self.adb_server_port)
       return
 
-    try:
-      logging.info('Starting: %s', connect_args)
-      connect_task = common.SpawnAndWaitWithRetry(
-          connect_args,
-          proc_output=True,
-          exec_env=self._AdbEnv(),
-          timeout_seconds=ADB_SHORT_TIMEOUT_SECONDS,
-          retries=5)
-      logging.info('Done: %s', connect_args)
-    except common.SpawnError:
-      return False
-
-    connect_stdout = connect_task.borg_out
-    logging.info('Status: %s ', connect_stdout)
     odd_successful_connection = 'localhost:%s:%s' % (self.emulator_adb_port,
                                                      self.emulator_adb_port)
-    return ('connected' in connect_stdout or
-            odd_successful_connection in connect_stdout)
+
+    def _Connected(connect_stdout):
+      return ('connected' in connect_stdout or
+              odd_successful_connection in connect_stdout)
+
+    connect_stdout = ''
+    if FLAGS.adb_native_client:
+      # adb connect also starts the adb server and retries, the client is only
+      # used once the server runs and connects at the first attempt.
+      try:
+        connect_stdout = adb_client.GetAdbClient(self.adb_server_port).Connect(
+            'localhost:%s' % self.emulator_adb_port)
+      except adb_client.AdbError as e:
+        logging.info('Connecting with adb, not through the server: %s', e)
+
+    if not _Connected(connect_stdout):
+      try:
+        logging.info('Starting: %s', connect_args)
+        connect_task = common.SpawnAndWaitWithRetry(
+            connect_args,
+            proc_output=True,
+            exec_env=self._AdbEnv(),
+            retry_policy=self._RetryPolicy(
+                max_attempts=6,
+                initial_delay_seconds=0.25,
+                max_delay_seconds=2,
+                attempt_timeout_seconds=ADB_SHORT_TIMEOUT_SECONDS))
+        logging.info('Done: %s', connect_args)
+      except common.SpawnError:
+        return False
+      connect_stdout = connect_task.borg_out
+
+    logging.info('Status: %s ', connect_stdout)
+    return _Connected(connect_stdout)
 
   def _AdbEnv(self):
     """Prepare environment for running adb."""
@@ -2900,6 +3496,10 @@ class EmulatedDevice(object):
 
   def _SetDeviceSetting(self, api_level, table, name, value):
     """Set device settings."""
+    self.ExecOnDevice(self._DeviceSettingCommand(api_level, table, name, value))
+
+  def _DeviceSettingCommand(self, api_level, table, name, value):
+    """Returns the command which sets a device setting."""
 
     if api_level < 16:
       sql_cmd = (
@@ -2912,26 +3512,25 @@ class EmulatedDevice(object):
           '--bind value:s:%s' % (table, name, value)]
     else:
       cmd = ['settings put %s %s %s' % (table, name, value)]
-    self.ExecOnDevice(cmd)
+    return cmd
 
   def _GetDeviceSetting(self, table, name):
     sql_cmd = '"SELECT value FROM %s WHERE name=\'%s\';"' % (table, name)
     return self.ExecOnDevice(['sqlite3', _DB_PATH, sql_cmd])
 
-  def _DisableSideloading(self):
+  def _DisableSideloadingCommands(self):
     api = self.GetApiVersion()
     if api in [17, 19]:
       db_table = 'global'
     else:
       db_table = 'secure'
 
-    self._SetDeviceSetting(api, db_table, 'install_non_market_apps', 0)
-    self.ExecOnDevice(['pm', 'disable com.android.providers.settings'])
-
-  def _RemoveSettingsControl(self):
-    """Remove SettingsControl App from system."""
-    self._Remount(self._GetSystemMountPoint(), 'rw')
+    return [self._DeviceSettingCommand(api, db_table,
+                                       'install_non_market_apps', 0),
+            ['pm', 'disable com.android.providers.settings']]
 
+  def _RemoveSettingsControlCommands(self):
+    """Returns the commands which remove SettingsControl App from system."""
     if self.GetApiVersion() < 19:
       app_dir = '/system/app'
       odex_dir = app_dir
@@ -2945,9 +3544,11 @@ class EmulatedDevice(object):
         arch = 'arm'
       odex_dir = os.path.join(app_dir, 'oat/%s' % arch)
 
-    self.ExecOnDevice(['rm', os.path.join(app_dir, 'Settings.apk')])
-    self.ExecOnDevice(['rm', os.path.join(odex_dir, 'Settings.odex')])
-    self._Remount(self._GetSystemMountPoint(), 'ro')
+    return [self._RemountCommand(self._GetSystemMountPoint(), 'rw'),
+            ['rm', '-f', os.path.join(app_dir, 'Settings.apk')],
+            # deodexed images have none.
+            ['rm', '-f', os.path.join(odex_dir, 'Settings.odex')],
+            self._RemountCommand(self._GetSystemMountPoint(), 'ro')]
 
   def _GetSystemMountPoint(self):
     """Get the mount point of the filesystem which includes /system.
@@ -2963,19 +3564,31 @@ class EmulatedDevice(object):
     else:
       return '/system'
 
-  def _RemoveAdbd(self):
-    self._Remount('/', 'rw')
-    self.ExecOnDevice(['rm', '/sbin/adbd'])
-    self.ExecOnDevice(['stop', 'adbd'])
-    self._Remount('/', 'ro')
+  def _RemoveAdbdCommands(self):
+    return [self._RemountCommand('/', 'rw'),
+            ['rm', '-f', '/sbin/adbd'],
+            ['stop', 'adbd'],
+            self._RemountCommand('/', 'ro')]
 
   def Lockdown(self, lockdown_level):
+    commands = []
     if lockdown_level == 'no_settings_control':
-      self._DisableSideloading()
-      self._RemoveSettingsControl()
+      commands.extend(self._DisableSideloadingCommands())
+      commands.extend(self._RemoveSettingsControlCommands())
 
     if lockdown_level == 'no_settings_control' or lockdown_level == 'no_adb':
-      self._RemoveAdbd()
+      commands.extend(self._RemoveAdbdCommands())
+    if not commands:
+      return
+    # every step is attempted, so adbd is stopped and / read only even if
+    # removing a file failed.
+    results = self.ExecBatchOnDevice(commands)
+    failed = ['%s: exit %d %s' % (' '.join(args), result[0],
+                                  result[2] or result[1])
+              for args, result in zip(commands, results)
+              if result and result[0]]
+    if failed:
+      self._TransientDeath('Lockdown failed: %s' % '; '.join(failed))
 
   def _QueryServices(self):
     """Returns a dictionary of all the init services and their states.
@@ -2994,23 +3607,7 @@ class EmulatedDevice(object):
 
   def _Props(self):
     """Returns the device properties in a map."""
-    props = {}
-    props_out = self.ExecOnDevice(['getprop'])
-    # output looks roughly like:
-    # [someprop]: [its value]\n
-    # [otherprop]: [val 2]\n
-    # [init.svc.vold]: [running]\n
-    # [anotherprop]: [val 3]\n
-    for prop_line in props_out.splitlines():
-      if not prop_line:
-        continue
-      prop_parts = prop_line.split(']:', 1)
-      if len(prop_parts) != 2:
-        continue
-      k = prop_parts[0][1:].strip()
-      v = prop_parts[1].strip()[1:-1]
-      props[k] = v
-    return props
+    return self._properties.Snapshot()
 
   def _DetectFSErrors(self):
     """Detects the rare situation that /data or /cache have become corrupt.
@@ -3022,10 +3619,7 @@ class EmulatedDevice(object):
     Raises:
       TransientEmulatorFailure: if corruption is detected.
     """
-    fs_opts = [point.split()[3] for point
-               in self.ExecOnDevice(['mount']).splitlines()
-               if '/cache' in point or '/data' in point]
-    if [opt for opt in fs_opts if 'ro' in opt.split(',')]:
+    if self._mounts.IsReadOnly('/data') or self._mounts.IsReadOnly('/cache'):
       self._TransientDeath('RW file system has been remounted RO!')
 
   def _CleanUmount(self, mount_point):
@@ -3043,28 +3637,32 @@ class EmulatedDevice(object):
     Returns:
       True if the path was dismounted and if all fsck checks succeed.
     """
-    self.ExecOnDevice(['sync', '&&', 'sync'])
-    self._Remount(mount_point, 'ro')
+    # Each change of the mounts is followed by a mount in the same batch.
+    results = self.ExecBatchOnDevice([
+        ['sync', '&&', 'sync'],
+        self._RemountCommand(mount_point, 'ro'),
+        ['mount']])
+    self._mounts.Update(results[-1][1])
 
     # If the mount_point is not present, don't bother trying to umount.
-    if mount_point not in self.ExecOnDevice(['mount']):
+    info = self._mounts.Find(mount_point)
+    if not info:
       return True
 
-    info = [point for point in self.ExecOnDevice(['mount']).splitlines()
-            if mount_point in point.split()]
     umount_attempts = 0
     umounted = False
     while umount_attempts < 5 and not umounted:
       umount_attempts += 1
-      self.ExecOnDevice(['umount', mount_point])
-      umounted = mount_point not in self.ExecOnDevice(['mount'])
+      results = self.ExecBatchOnDevice([['umount', mount_point], ['mount']])
+      self._mounts.Update(results[-1][1])
+      umounted = not self._mounts.Find(mount_point)
       if not umounted:
         time.sleep(self._connect_poll_interval)
 
     if not umounted:
       err = self.ExecOnDevice(['umount', mount_point])
       logging.warn('%s could not be umounted: %s', mount_point, err)
-      logging.warn('Mounts:\n%s', self.ExecOnDevice(['mount']))
+      logging.warn('Mounts:\n%s', self._mounts.Output())
       for f in self.ExecOnDevice(['lsof']).splitlines():
         if mount_point in f:
           logging.warn('Open file: %s', f)
@@ -3073,69 +3671,38 @@ class EmulatedDevice(object):
     if self.GetApiVersion() < 21:
       return umounted
 
-    clean = False
-    if info:
-      info = info[0]
-      if 'ext4' in info:
-        dev = info.split()[0]
-        fsck_out = self.ExecOnDevice(['e2fsck', '-v', '-f', '-p', dev])
-        if 'UNEXPECTED INCONSISTENCY' in fsck_out:
-          logging.error('%s: FS Corruption! %s', mount_point, fsck_out)
-        else:
-          clean = True
-      else:
-        clean = True
-    else:
-      logging.warn('%s: Could not retrieve mount info - cannot fsck.',
-                   mount_point)
+    clean = True
+    if info.fstype == 'ext4':
+      fsck_out = self.ExecOnDevice(['e2fsck', '-v', '-f', '-p', info.device])
+      if 'UNEXPECTED INCONSISTENCY' in fsck_out:
+        logging.error('%s: FS Corruption! %s', mount_point, fsck_out)
+        clean = False
 
     return clean and umounted
 
   def _CheckLeftProcess(self):
     """Check left process on device, also killing known dead process body."""
 
-    ps_out = self.ExecOnDevice(['ps'])
-    lines = ps_out.split('\n')
-    raw_key = lines[0].strip().split()
-    # The output of ps is buggy on Android device.
-    # The columns of header is inconsistent with
-    # following lines. Just use the first 4 columns
-    # and the last column.
-    key = raw_key[:4] + raw_key[-1:]
-    processes = []
-    for l in lines[1:]:
-      line = l.strip()
-      if not line:
-        continue
-      raw_value = line.split()
-      value = raw_value[:4] + raw_value[-1:]
-      proc = dict(zip(key, value))
-      # Ignore kernel process
-      vsize = proc.get('VSIZE') or proc.get('VSZ')
-      if vsize == '0':
-        continue
-      # Ignore init
-      if proc['PID'] == '1':
-        continue
-      if os.path.basename(proc['NAME']) == 'pipe_traversal':
-        pipe_traversal_pid = proc['PID']
-        continue
-      if proc['NAME'] == 'ps':
-        continue
-      processes.append(proc)
-
+    self._processes.Invalidate()
+    processes = self._processes.Get()
+    pipe_traversal_pids = set(
+        p.pid for p in processes.Named('pipe_traversal'))
     suspicious = False
-    for proc in processes:
+    for proc in processes.Records():
+      # Ignore kernel processes, init, pipe_traversal and ps.
+      if (not proc.vsize or proc.pid == 1 or proc.pid in pipe_traversal_pids or
+          proc.name == 'ps'):
+        continue
       # Kill crashed "pm install" body. Its parent
       # process should be pipe_traversal.
-      if (proc['PPID'] == pipe_traversal_pid and
-          proc['NAME'] == 'app_process'):
-        self.ExecOnDevice(['kill', '-9', proc['PID']])
+      if (proc.ppid in pipe_traversal_pids and
+          proc.name == 'app_process'):
+        self.ExecOnDevice(['kill', '-9', str(proc.pid)])
         continue
       suspicious = True
 
     if suspicious:
-      logging.warning('Some process is still running: %s\n', ps_out)
+      logging.warning('Some process is still running: %s\n', processes.output)
 
   def KillEmulator(self, politely=False, kill_over_telnet=True):
     """Stops the emulator.
@@ -3167,6 +3734,8 @@ class EmulatedDevice(object):
         self.ExecOnDevice(['stop', svc])
 
       self._CheckLeftProcess()
+      # The shell session writes to /data, unmount without it.
+      self._CloseShellSession(disable=True)
       # Umount /data/media first. Otherwise umount of /data will fail.
       clean_death = self._CleanUmount('/data/media') and clean_death
       if self.GetApiVersion() >= 28:
@@ -3186,11 +3755,16 @@ class EmulatedDevice(object):
     else:
       self._StopAllProcesses()
       self._running = False
+    self._CloseShellSession()
 
     if politely and not clean_death:
       self._TransientDeath('Could not cleanly shutdown emulator', False)
 
   def _TransientDeath(self, msg, needs_kill=True):
+    if readiness_graph.InStep():
+      # Other boot steps still use the emulator and its files, the thread
+      # running the graph tears down once they stopped.
+      raise readiness_graph.StepFailedError(msg)
     self._reporter.ReportFailure('tools.android.emulator.TransientDeath',
                                  {'message': msg})
     if needs_kill:
@@ -3251,7 +3825,7 @@ class EmulatedDevice(object):
     for r, _, f in os.walk(os.path.join(self._SessionImagesDir(), 'snapshots')):
       for each_file in f:
         if each_file == 'ram.bin' and ram_binary_location:
-          shutil.copy(os.path.join(r, each_file), ram_binary_location)
+          self._StagingCopy(os.path.join(r, each_file), ram_binary_location)
           snapshot_file_found = True
           continue
         image_files.append(os.path.join(r, each_file))
@@ -3276,7 +3850,7 @@ class EmulatedDevice(object):
     # Wait for 10 seconds before giving up.
     for _ in range(10):
       try:
-        output = subprocess.check_output(lsof_command)
+        output = process_backend.CheckOutput(lsof_command)
         logging.info('lsof output :%s', output)
       except subprocess.CalledProcessError as err:
         # If no processes are writing to it, then we are done and it will throw
@@ -3300,7 +3874,7 @@ class EmulatedDevice(object):
       # format will not compress very well. (roughly 2x vs RAW images which
       # compress 4x or better).
       # so running thru gzip is slow and doesn't save much space.
-      subprocess.check_call([
+      process_backend.CheckCall([
           'tar',
           '-cSpf',
           location,
@@ -3309,11 +3883,11 @@ class EmulatedDevice(object):
       logging.info('Tar/gz pipeline completes.')
     else:
       with open(location, 'w') as dat_file:
-        tar_proc = subprocess.Popen(
+        tar_proc = process_backend.Popen(
             ['tar', '-cSp', '-C', self._images_dir] + image_files,
             stdout=subprocess.PIPE)
         # consider replacing with zippy?
-        gz_proc = subprocess.Popen(
+        gz_proc = process_backend.Popen(
             ['gzip'],
             stdin=tar_proc.stdout,
             stdout=dat_file)
@@ -3342,28 +3916,53 @@ class EmulatedDevice(object):
   def _ConnectToEmulatorConsole(self):
     """Connect to Emulator console."""
     assert self._CanConnect(), 'missing details to connect to emulator.'
-    attempts = 0
-    while attempts < 5:
+    policy = self._RetryPolicy(
+        max_attempts=5, initial_delay_seconds=0.5, max_delay_seconds=4,
+        attempt_timeout_seconds=60,
+        min_attempt_seconds=_CONSOLE_MIN_CONNECT_SECONDS)
+    for attempt in policy:
+      timeout = max(attempt.timeout, _CONSOLE_MIN_CONNECT_SECONDS)
       try:
-        sock = telnetlib.Telnet('localhost', self.emulator_telnet_port, 60)
+        sock = telnetlib.Telnet('localhost', self.emulator_telnet_port,
+                                timeout)
         self._TryAuth(sock)
+        attempt.Succeeded()
         return sock
 
+      except socket.timeout as e:
+        logging.info('Emulator console did not answer in %ss.', timeout)
+        attempt.Failed(e)
       except socket.error as e:
         if e.errno == 111:
           # not bound yet!
           logging.info('Emulator console port not bound yet.')
-          time.sleep(2)
-          attempts += 1
+          attempt.Failed(e)
         else:
           raise e
+    attempts = len(policy.records)
     self._reporter.ReportFailure('tools.android.emulator.console.CannotConnect',
-                                 {'attempts': attempts})
+                                 {'attempts': attempts,
+                                  'deadline_exceeded': policy.deadline_exceeded})
     # Since we failed connecting to the console, let's kill all processes and
     # retry.
     self._TransientDeath(
         'Tried %s times to connect to emu console.' % attempts)
 
+  def _RetryPolicy(self, **kwargs):
+    """Returns a common.RetryPolicy bound by the boot deadline if booting."""
+    kwargs.setdefault('jitter', 0.2)
+    return common.RetryPolicy(deadline=self._retry_deadline, **kwargs)
+
+  @contextlib.contextmanager
+  def _BootDeadline(self):
+    """Makes retry policies created within fit the boot time out."""
+    previous = self._retry_deadline
+    self._retry_deadline = self._time_out_time
+    try:
+      yield
+    finally:
+      self._retry_deadline = previous
+
   def _SnapshotPresent(self):
     """Returns the avd config property snapshot.present."""
     for prop in self._metadata_pb.avd_config_property:
@@ -3459,7 +4058,7 @@ class EmulatedDevice(object):
     if not self._ShouldModifySystemImage(enable_guest_gl):
       return
 
-    if 'ext4' in subprocess.check_output(['file', self._SystemFile()]):
+    if 'ext4' in process_backend.CheckOutput(['file', self._SystemFile()]):
       debugfs_cmd = self._GetDebugfsCmd(enable_guest_gl)
       if debugfs_cmd:
         logging.info('Running debugfs commands: %s', debugfs_cmd)
@@ -3468,12 +4067,12 @@ class EmulatedDevice(object):
   def _ExecDebugfsCmd(self, image_file, cmd_list):
     """Execute debugfs commands from cmd_list on disk image file."""
     assert not self._emu_process_pid, 'Emulator is running!'
-    assert 'ext4' in subprocess.check_output(['file', image_file]), (
+    assert 'ext4' in process_backend.CheckOutput(['file', image_file]), (
         'Not ext4 image')
     assert os.path.exists('/sbin/debugfs'), 'No debugfs tool find'
     os.chmod(image_file, stat.S_IRWXU)
-    proc = subprocess.Popen(['/sbin/debugfs', '-w', '-f', '-', image_file],
-                            stdin=subprocess.PIPE)
+    proc = process_backend.Popen(
+        ['/sbin/debugfs', '-w', '-f', '-', image_file], stdin=subprocess.PIPE)
     proc.communicate('\n'.join(cmd_list) + '\n')
     proc.wait()
 
@@ -3501,12 +4100,22 @@ class EmulatedDevice(object):
     if device_path.startswith('/system'):
       self._Remount(self._GetSystemMountPoint(), 'rw')
     logging.info('pushing: %s to %s', file_path, device_path)
-    subprocess.check_call([
-        self.android_platform.adb,
-        '-s', self.device_serial,
-        'push',
-        file_path,
-        device_path], env=self._AdbEnv())
+    pushed = False
+    client = self._NativeAdbClient()
+    if client:
+      try:
+        client.Push(self.device_serial, file_path, device_path)
+        pushed = True
+      except adb_client.AdbError as e:
+        # a push can be repeated, whether or not it started.
+        self._AdbClientFailed(e)
+    if not pushed:
+      process_backend.CheckCall([
+          self.android_platform.adb,
+          '-s', self.device_serial,
+          'push',
+          file_path,
+          device_path], env=self._AdbEnv())
     if device_path.startswith('/system'):
       self._Remount(self._GetSystemMountPoint(), 'ro')
 
@@ -3548,7 +4157,6 @@ class EmulatedDevice(object):
   def InstallApk(self, apk_path, max_tries=5, grant_runtime_permissions=False):
     """Installs the given apk onto the device."""
     assert os.path.exists(apk_path), 'apk doesnt exist at: %s' % apk_path
-    attempts = 0
     install_args = [self.android_platform.adb,
                     '-s',
                     self.device_serial,
@@ -3579,9 +4187,15 @@ class EmulatedDevice(object):
       # optimization will add an additional time penalty
       install_timeout_secs = 120
 
-
-
-    while True:
+    policy = self._RetryPolicy(max_attempts=max_tries,
+                               initial_delay_seconds=1,
+                               max_delay_seconds=8,
+                               attempt_timeout_seconds=install_timeout_secs)
+    install_output = ''
+    for attempt in policy:
+      if attempt.number > 1:
+        logging.info('%s: attempting install again due to: %s',
+                     apk_path, install_output)
       logging.info('installing: %s', apk_path)
       install_output = ''
       try:
@@ -3591,7 +4205,7 @@ class EmulatedDevice(object):
         else:
           install_task = common.SpawnAndWaitWithRetry(
               install_args,
-              timeout_seconds=install_timeout_secs,
+              timeout_seconds=attempt.timeout,
               exec_env=self._AdbEnv(),
               proc_output=True)
           exit_status = install_task.returncode
@@ -3599,6 +4213,7 @@ class EmulatedDevice(object):
 
         if exit_status == 0 and 'Success' in install_output:
           logging.info('install done: %s', apk_path)
+          attempt.Succeeded()
           return
         if self._IsPermanentInstallError(install_output):
           logging.warning('install failed: %s %s', apk_path, install_output)
@@ -3613,7 +4228,8 @@ class EmulatedDevice(object):
         else:
           logging.info('Install failed: %s', install_output)
           logging.info('logcat: %s', self.ExecOnDevice(
-              ['logcat -v threadtime -b all -d']))
+              ['logcat -v threadtime -b all -d'],
+              output_window=_LOGCAT_DUMP_WINDOW))
       except common.SpawnError:
         self._reporter.ReportFailure(
             'tools.android.emulator.TimeoutInstallError', {
@@ -3621,20 +4237,20 @@ class EmulatedDevice(object):
                 'apk_basename': os.path.basename(apk_path),
             })
         install_output = 'timeout failure'
-      attempts += 1
-      if attempts >= max_tries:
-        self._reporter.ReportFailure(
-            'tools.android.emulator.install.ExceededMaxFailures', {
-                'apk': apk_path,
-                'apk_basename': os.path.basename(apk_path),
-                'attempts': attempts,
-                'install_output': install_output,
-                'install_failure_type': _InstallFailureType(install_output),
-            })
-      assert attempts < max_tries
-      logging.info('%s: attempting install again due to: %s',
-                   apk_path, install_output)
-      time.sleep(1)
+      attempt.Failed(install_output)
+
+    attempts = len(policy.records)
+    self._reporter.ReportFailure(
+        'tools.android.emulator.install.ExceededMaxFailures', {
+            'apk': apk_path,
+            'apk_basename': os.path.basename(apk_path),
+            'attempts': attempts,
+            'deadline_exceeded': policy.deadline_exceeded,
+            'install_output': install_output,
+            'install_failure_type': _InstallFailureType(install_output),
+        })
+    raise AssertionError('install of %s failed after %s attempts: %s' % (
+        apk_path, attempts, install_output))
 
   def _Dex2OatCheckingInstall(self, install_args):
     """Installs an apk on an ART device.
@@ -3648,49 +4264,54 @@ class EmulatedDevice(object):
     Returns:
       (exit_status, stdout)
     """
-    install_proc = subprocess.Popen(
+    install_proc = process_backend.Popen(
         install_args,
         stdout=subprocess.PIPE,
         stderr=subprocess.STDOUT,
         env=self._AdbEnv(),
         close_fds=True)
-    stdout = []
-    def _StdoutReader(fd, buf):
-      buf.append(fd.read())
-
-    stdout_thread = threading.Thread(
-        target=_StdoutReader,
-        args=(install_proc.stdout, stdout))
-    stdout_thread.setDaemon(True)
-    stdout_thread.start()
-
-    poll_checks = 0
     idle = IdleStatus(device=self)
-
-    while install_proc.poll() is None:
-      time.sleep(.5)
-      poll_checks += 1
-      if (poll_checks % 16) != 0:
+    # the output is read here, the idle check runs whenever it was quiet for
+    # _INSTALL_IDLE_CHECK_SECONDS.
+    fd = install_proc.stdout.fileno()
+    stdout = []
+    next_check = time.time() + _INSTALL_IDLE_CHECK_SECONDS
+    while True:
+      try:
+        readable, _, _ = select.select(
+            [fd], [], [], max(0, next_check - time.time()))
+      except (IOError, OSError, select.error) as e:
+        if e.args[0] == errno.EINTR:
+          continue
+        raise
+      if readable:
+        data = os.read(fd, 64 << 10)
+        if not data:
+          break
+        stdout.append(data)
         continue
       load = idle.RecentMaxLoad(INSTALL_IDLE_TIMEOUT_SECONDS)
+      next_check = time.time() + _INSTALL_IDLE_CHECK_SECONDS
       if load > 0.1:
         logging.info('system load is %f, still busy', load)
-      else:
-        logging.info('system load is %f for more than %d seconds',
-                     load, INSTALL_IDLE_TIMEOUT_SECONDS)
-        # system is idle now, give it one last shot to tell us the
-        # install has completed.
-        install_proc.kill()
-        install_proc.wait()
-        stdout_thread.join()
-        logging.warning('System idle after ~%ss, system hung?',
-                        INSTALL_IDLE_TIMEOUT_SECONDS)
-        return (-1, stdout[0])
-
-    return_code = install_proc.poll()
+        continue
+      logging.info('system load is %f for more than %d seconds',
+                   load, INSTALL_IDLE_TIMEOUT_SECONDS)
+      # system is idle now, give it one last shot to tell us the
+      # install has completed.
+      install_proc.kill()
+      install_proc.wait()
+      stdout.append(install_proc.stdout.read())
+      install_proc.stdout.close()
+      logging.warning('System idle after ~%ss, system hung?',
+                      INSTALL_IDLE_TIMEOUT_SECONDS)
+      return (-1, b''.join(stdout))
+    install_proc.stdout.close()
+    install_proc.wait()
+    stdout = b''.join(stdout)
+    return_code = install_proc.returncode
     logging.info('install [%s]: return code: %s', install_args, return_code)
-    stdout_thread.join()
-    return return_code, stdout[0]
+    return return_code, stdout
 
   def SyncTime(self):
     """Sync time of the emulator with host time."""
@@ -3782,6 +4403,11 @@ class EmulatedDevice(object):
 
     if self.GetApiVersion() >= 23:
       self.ExecOnDevice(['start fingerprintd'])
+    # adbd may restart with the rest of user space.
+    self._CloseShellSession()
+    self._properties.Invalidate()
+    self._mounts.Invalidate()
+    self._processes.Invalidate()
 
   def _CheckDpi(self):
     """Checks if DPI is set correctly."""
@@ -3911,42 +4537,6 @@ class EmulatedDevice(object):
                       (wait_result >> 8, wait_result & 0xF))
 
 
-class Attempter(object):
-  """Tracks progress of launching the emulator."""
-
-  def __init__(self, timer, sleep_interval):
-    self._stopwatch = timer
-    self.sleep_interval = sleep_interval
-    self.total_attempts = 0
-    self.step_attempts = 0
-
-  def AttemptStep(self, step_fn, details, check_tag, sleep_tag):
-    """Attempts to execute a particular step in launching the emulator.
-
-    Args:
-      step_fn: The function which performs the step - must return success.
-      details: a message to log out before performing the step
-      check_tag: the tag to pass to stopwatch to charge the exec time against
-      sleep_tag: the tag to pass to stopwatch to charge sleeping time against
-
-    Returns:
-      The result of step_fn(). If result is truthy step_attempts is 0'd out
-    """
-    self.total_attempts += 1
-    self.step_attempts += 1
-    logging.info(details)
-    self._stopwatch.start(check_tag)
-    step_completes = step_fn()
-    self._stopwatch.stop(check_tag)
-    if not step_completes:
-      self._stopwatch.start(sleep_tag)
-      time.sleep(self.sleep_interval)
-      self._stopwatch.stop(sleep_tag)
-    else:
-      self.step_attempts = 0
-    return step_completes
-
-
 class TransientEmulatorFailure(Exception):
   """Indicates the emulator could not be started or shutdown.
 
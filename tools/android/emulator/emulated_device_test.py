@@ -18,18 +18,25 @@
 
 
 import collections
+import errno
 import os
+import shutil
+import socket
 import tempfile
+import threading
+import time
 
 
 import mox
 
 from tools.android.emulator import resources
 from google.apputils import basetest as googletest
+from tools.android.emulator import adb_shell_session
 from tools.android.emulator import common
 from tools.android.emulator import emulated_device
 from tools.android.emulator import emulator_meta_data_pb2
 from tools.android.emulator import fake_android_platform_util
+from tools.android.emulator import readiness_graph
 
 
 root_dir = os.path.abspath(os.path.join(resources.GetRunfilesDir(),
@@ -68,6 +75,26 @@ I/am_crash(  951): [2712,0,com.a.dev,896,ja.la.Il,When they come ,Bad.java,147]
 _CONSOLE_TOKEN_DEVICE_PATH = '/data/console_token'
 
 
+class FakeShellSession(object):
+  """Answers Run and RunBatch with canned results, or raises error."""
+
+  def __init__(self, results=(), error=None):
+    self.lock = threading.Lock()
+    self.lock.acquire()
+    self.ran = []
+    self._results = list(results)
+    self._error = error
+
+  def Run(self, command):
+    return self.RunBatch([command])[0]
+
+  def RunBatch(self, commands, fail_fast=False):
+    self.ran.extend(commands)
+    if self._error:
+      raise self._error
+    return self._results[:len(commands)]
+
+
 class EmulatedDeviceTest(mox.MoxTestBase):
 
   def setUp(self):
@@ -108,6 +135,179 @@ class EmulatedDeviceTest(mox.MoxTestBase):
     self.assertEquals('-s localhost:1234 shell echo hello\n',
                       mock_device.ExecOnDevice(['echo', 'hello']))
 
+  def _SessionDevice(self, session):
+    test_plat = emulated_device.AndroidPlatform()
+    test_plat.adb = '/bin/echo'
+    test_plat.real_adb = '/bin/echo'
+    device = emulated_device.EmulatedDevice(
+        android_platform=test_plat,
+        emulator_adb_port=1234,
+        emulator_telnet_port=4567,
+        device_serial='localhost:1234')
+    device._metadata_pb = emulator_meta_data_pb2.EmulatorMetaDataPb()
+    self.mox.StubOutWithMock(device, '_AcquireShellSession')
+    device._AcquireShellSession().AndReturn(session)
+    return device
+
+  def testExecOnEmulator_sessionCommandFails(self):
+    session = FakeShellSession([(1, '', '')])
+    device = self._SessionDevice(session)
+    # the emulator is not presumed dead, nothing is recorded for these.
+    self.mox.StubOutWithMock(device, '_AdbFailed')
+    self.mox.StubOutWithMock(device, '_TransientDeath')
+    self.mox.ReplayAll()
+
+    self.assertEquals('', device.ExecOnDevice(['pm', 'path', 'android']))
+    self.assertEquals(['pm path android'], session.ran)
+
+  def testExecOnEmulator_sessionBreaks(self):
+    session = FakeShellSession(error=adb_shell_session.ShellSessionError(
+        'adb exited', sent=True))
+    device = self._SessionDevice(session)
+    self.mox.StubOutWithMock(device, '_AdbFailed')
+    device._AdbFailed(mox.IgnoreArg(), 255, b'', 'adb exited')
+    self.mox.ReplayAll()
+
+    device.ExecOnDevice(['pm', 'path', 'android'])
+
+  def testLockdown_failedCommandRaisesAfterTheBatch(self):
+    session = FakeShellSession([
+        (0, '', ''), (1, '', 'rm: /sbin/adbd: Read-only file system'),
+        (0, '', ''), (0, '', '')])
+    device = self._SessionDevice(session)
+    device._metadata_pb.api_name = '28'
+    self.mox.StubOutWithMock(device, '_TransientDeath')
+    device._TransientDeath(mox.Regex('rm -f /sbin/adbd: exit 1')).AndRaise(
+        emulated_device.TransientEmulatorFailure('lockdown'))
+    self.mox.ReplayAll()
+
+    self.assertRaises(emulated_device.TransientEmulatorFailure,
+                      device.Lockdown, 'no_adb')
+    # adbd is stopped and / remounted read only all the same.
+    self.assertEquals(4, len(session.ran))
+
+  def testExecBatchOnDevice_adbFails(self):
+    device = self._SessionDevice(None)
+    device._ExecWithAdbClient = lambda _: (255, '', 'error: device offline')
+    self.mox.StubOutWithMock(device, '_AdbFailed')
+    device._AdbFailed('setprop a b', 255, '', 'error: device offline').AndRaise(
+        emulated_device.TransientEmulatorFailure('device offline'))
+    self.mox.ReplayAll()
+
+    self.assertRaises(emulated_device.TransientEmulatorFailure,
+                      device.ExecBatchOnDevice,
+                      [['setprop', 'a', 'b'], ['setprop', 'c', 'd']])
+
+  def testStageImage_resizeAgainAfterTheCacheFailed(self):
+    images = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, images)
+    userdata = os.path.join(images, 'userdata-qemu.img')
+    with open(userdata, 'w') as f:
+      f.write('data')
+    device = emulated_device.EmulatedDevice()
+    device._UserdataQemuFile = lambda: userdata
+    resized = []
+
+    def CheckCall(args, **unused_kwargs):
+      with open(args[2]) as f:
+        resized.append(f.read())
+    self.stubs.Set(emulated_device.process_backend, 'CheckCall', CheckCall)
+
+    class FullCache(object):
+
+      def Stage(self, dst, unused_inputs, unused_transform, produce_fn,
+                unused_writable):
+        work_dir = tempfile.mkdtemp(dir=images)
+        try:
+          produce_fn(os.path.join(work_dir, os.path.basename(dst)))
+        finally:
+          shutil.rmtree(work_dir)
+        raise OSError(errno.ENOSPC, 'No space left on device')
+
+    self.mox.ReplayAll()
+    device._StageImage(FullCache(), userdata, [], 'resize2fs:64M',
+                       lambda dst: device._ResizeUserdata(64, dst))
+    self.assertEquals(['data', 'data'], resized)
+
+  def testConnectToEmulatorConsole_retriesTimeoutsNearTheDeadline(self):
+    timeouts = []
+    console = object()
+
+    def Telnet(unused_host, unused_port, timeout):
+      timeouts.append(timeout)
+      if len(timeouts) == 1:
+        raise socket.timeout('timed out')
+      return console
+    self.stubs.Set(emulated_device.telnetlib, 'Telnet', Telnet)
+    device = emulated_device.EmulatedDevice(emulator_telnet_port=4567)
+    device._CanConnect = lambda: True
+    device._TryAuth = lambda unused_sock: None
+    # close to the deadline, each attempt still gets a second.
+    device._retry_deadline = time.time() + 2
+    self.mox.ReplayAll()
+
+    self.assertIs(console, device._ConnectToEmulatorConsole())
+    self.assertEquals(2, len(timeouts))
+    self.assertGreaterEqual(min(timeouts), 1)
+
+  def testTransientDeath_tearDownAfterTheStepsStopped(self):
+    device = emulated_device.EmulatedDevice()
+    self.mox.StubOutWithMock(device, 'KillEmulator')
+    self.mox.StubOutWithMock(device, 'CleanUp')
+    device.KillEmulator(politely=False, kill_over_telnet=False)
+    device.CleanUp()
+    self.mox.ReplayAll()
+
+    def Check():
+      device._TransientDeath('Adb command failed')
+
+    graph = readiness_graph.ReadinessGraph(
+        [readiness_graph.Step('adb', Check)], sleep_interval=0.01)
+    with self.assertRaises(readiness_graph.StepFailedError) as e:
+      graph.Run()
+    self.assertRaises(emulated_device.TransientEmulatorFailure,
+                      device._TransientDeath, str(e.exception))
+
+  def _IdleStatus(self, load, checked_on):
+
+    class FakeIdleStatus(object):
+
+      def __init__(self, device):
+        pass
+
+      def RecentMaxLoad(self, unused_seconds):
+        checked_on.append(threading.current_thread())
+        return load
+
+    self.stubs.Set(emulated_device, 'IdleStatus', FakeIdleStatus)
+    self.stubs.Set(emulated_device, '_INSTALL_IDLE_CHECK_SECONDS', 0.05)
+
+  def testDex2OatCheckingInstall_idleCheckOnTheCallingThread(self):
+    checked_on = []
+    self._IdleStatus(1.0, checked_on)
+    device = emulated_device.EmulatedDevice()
+    device._AdbEnv = lambda: None
+    self.mox.ReplayAll()
+
+    self.assertEquals(
+        (0, b'Success\n'),
+        device._Dex2OatCheckingInstall(
+            ['/bin/sh', '-c', 'sleep 0.5; echo Success']))
+    self.assertTrue(checked_on)
+    self.assertEquals(set([threading.current_thread()]), set(checked_on))
+
+  def testDex2OatCheckingInstall_idleDeviceKillsTheInstall(self):
+    self._IdleStatus(0.0, [])
+    device = emulated_device.EmulatedDevice()
+    device._AdbEnv = lambda: None
+    self.mox.ReplayAll()
+
+    self.assertEquals(
+        (-1, b'Performing Streamed Install\n'),
+        device._Dex2OatCheckingInstall(
+            ['/bin/sh', '-c', 'echo Performing Streamed Install; '
+             'exec sleep 30']))
+
   def testEmulatorPing_noConnect(self):
     mock_device = emulated_device.EmulatedDevice(
         android_platform=fake_android_platform_util.BuildAndroidPlatform())
@@ -550,12 +750,8 @@ class EmulatedDeviceTest(mox.MoxTestBase):
     device = emulated_device.EmulatedDevice()
     device._metadata_pb = emulator_meta_data_pb2.EmulatorMetaDataPb(
         api_name=api_level)
-    called_with = []
-
-    def StubTestAdbCall(args):
-      called_with.extend(args)
-    device.ExecOnDevice = StubTestAdbCall
-    device._DisableSideloading()
+    called_with = [arg for args in device._DisableSideloadingCommands()
+                   for arg in args]
     self.assertSideLoading(api_level, table_name, called_with)
 
   def assertSideLoading(self, api_level, table_name, called_with,):
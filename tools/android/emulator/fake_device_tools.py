@@ -0,0 +1,618 @@
+# Copyright 2018 The Android Open Source Project. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Scripted stand-ins for the emulator, adb, mksdcard and the device's tools.
+
+launcher_benchmark points the launcher at these instead of a real emulator,
+so that it times the launcher rather than a guest boot. WriteTools installs
+them into a directory, as small scripts which call Main with a json config:
+
+  {"state_dir": ...,                where the running fake devices keep state.
+   "tools_dir": ...,                the PATH of the device's shell.
+   "adb_latency_seconds": 0.02,     added to every adb command.
+   "shell_latency_seconds": 0.005,  added to every device tool.
+   "install_seconds": 0.2,          an adb install.
+   "api_level": 28,
+   "boot": {"adbd": 0.5, "system_server": 2, ...}}
+
+boot tells how many seconds after the emulator started each of BOOT_STAGES is
+reached. The emulator opens its console and adb ports (-ports), creates the
+-unix-pipe sockets and the disk overlays qemu would and records its start in
+state_dir/<adb port>. adb finds the device by the port of its serial and runs
+shell commands with sh, the device tools (ps, getprop, mount, pm, service,
+am, ...) first on its PATH. These answer from the time since the emulator
+started, so the device boots as configured. Only the stand-ins' own files are
+touched: /data/local/tmp of the device is a directory of state_dir.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import os
+import select
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+EMULATOR = 'emulator'
+ADB = 'adb'
+MKSDCARD = 'mksdcard'
+DEVICE_TOOL = 'device_tool'
+
+ADBD = 'adbd'
+SYSTEM_SERVER = 'system_server'
+PACKAGE_MANAGER = 'package_manager'
+STORAGE = 'storage'
+BOOT_COMPLETED = 'boot_completed'
+LAUNCHER = 'launcher'
+# in the order a device reaches them.
+BOOT_STAGES = (ADBD, SYSTEM_SERVER, PACKAGE_MANAGER, STORAGE, BOOT_COMPLETED,
+               LAUNCHER)
+
+DEFAULT_CONFIG = {
+    'adb_latency_seconds': 0.02,
+    'shell_latency_seconds': 0.005,
+    'install_seconds': 0.2,
+    'api_level': 28,
+    'boot': {ADBD: 0.5, SYSTEM_SERVER: 2.0, PACKAGE_MANAGER: 3.0,
+             STORAGE: 3.0, BOOT_COMPLETED: 4.0, LAUNCHER: 5.0},
+}
+
+# The commands the device's shell finds on its PATH.
+DEVICE_TOOLS = ('am', 'cat', 'chmod', 'cmd', 'content', 'date', 'dumpsys',
+                'e2fsck', 'getprop', 'input', 'kill', 'log', 'logcat', 'lsof',
+                'mkdir', 'mount', 'pm', 'printenv', 'ps', 'rm', 'service',
+                'settings', 'setprop', 'sleep', 'sqlite3', 'start', 'stop',
+                'svc', 'sync', 'umount', 'wm')
+
+_DEVICE_TMP = '/data/local/tmp'
+_LAUNCHER_PACKAGE = 'com.android.launcher3'
+_BOOTSTRAP_PACKAGE = 'com.google.android.apps.common.testing.services.bootstrap'
+_PACKAGE_NAMES = {'bootstrap.apk': _BOOTSTRAP_PACKAGE}
+# The overlays qemu2 creates next to the images it is given.
+_OVERLAY_FLAGS = ('-data', '-cache', '-sdcard', '-system', '-vendor',
+                  '-encryption-key')
+_SCRIPT = """#!%(python)s
+import sys
+sys.path.insert(0, %(root)r)
+from tools.android.emulator import fake_device_tools
+sys.exit(fake_device_tools.Main(%(config)r))
+"""
+
+
+def WriteTools(directory, state_dir, config=None):
+  """Installs the stand-ins into directory.
+
+  Args:
+    directory: gets the emulator, adb and mksdcard scripts, and a device
+      subdirectory with the device's tools.
+    state_dir: where the fake devices keep their state.
+    config: [optional] overrides of DEFAULT_CONFIG.
+
+  Returns:
+    A dict with the path of EMULATOR, ADB and MKSDCARD.
+  """
+  merged = dict(DEFAULT_CONFIG)
+  merged.update(config or {})
+  merged['boot'] = dict(DEFAULT_CONFIG['boot'], **(config or {}).get('boot',
+                                                                     {}))
+  tools_dir = os.path.join(directory, 'device')
+  merged['state_dir'] = state_dir
+  merged['tools_dir'] = tools_dir
+  for d in (directory, tools_dir, state_dir):
+    if not os.path.isdir(d):
+      os.makedirs(d)
+  config_path = os.path.join(directory, 'fake_device_tools.json')
+  with open(config_path, 'w') as f:
+    json.dump(merged, f, indent=1, sort_keys=True)
+
+  root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(
+      os.path.abspath(__file__)))))
+  script = _SCRIPT % {'python': sys.executable, 'root': root,
+                      'config': config_path}
+  paths = {}
+  for name in (EMULATOR, ADB, MKSDCARD, DEVICE_TOOL):
+    paths[name] = os.path.join(directory, name)
+    with open(paths[name], 'w') as f:
+      f.write(script)
+    os.chmod(paths[name], 0o755)
+  for tool in DEVICE_TOOLS:
+    os.symlink(paths[DEVICE_TOOL], os.path.join(tools_dir, tool))
+  # framed shell session commands run in their own sh.
+  os.symlink('/bin/sh', os.path.join(tools_dir, 'sh'))
+  del paths[DEVICE_TOOL]
+  return paths
+
+
+def KillDevices(state_dir):
+  """Terminates the fake emulators still running, returns their number."""
+  killed = 0
+  for port in os.listdir(state_dir):
+    try:
+      with open(os.path.join(state_dir, port, 'started.json')) as f:
+        os.kill(json.load(f)['pid'], signal.SIGTERM)
+      killed += 1
+    except (IOError, OSError, ValueError):
+      pass
+  return killed
+
+
+def Main(config_path):
+  """Runs the stand-in named by argv[0], returns its exit status."""
+  with open(config_path) as f:
+    config = json.load(f)
+  name = os.path.basename(sys.argv[0])
+  args = sys.argv[1:]
+  if name == EMULATOR:
+    return _Emulator(config, args).Run()
+  if name == ADB:
+    return _Adb(config, args)
+  if name == MKSDCARD:
+    return _Mksdcard(args)
+  time.sleep(config['shell_latency_seconds'])
+  return _DeviceTool(config, _Device(config, os.environ['FAKE_DEVICE_DIR']),
+                     name, args)
+
+
+def _Write(text):
+  out = getattr(sys.stdout, 'buffer', sys.stdout)
+  if not isinstance(text, bytes):
+    text = text.encode('utf-8')
+  out.write(text)
+  out.flush()
+
+
+def _Mksdcard(args):
+  """mksdcard [-l label] <size> <file>, as a sparse file."""
+  size, path = args[-2:]
+  multiplier = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+  count = int(size.rstrip('KMGkmg'))
+  with open(path, 'wb') as f:
+    f.truncate(count * multiplier.get(size[-1].upper(), 1))
+  return 0
+
+
+class _Device(object):
+  """The state of a fake device, a directory of state_dir."""
+
+  def __init__(self, config, path):
+    self.config = config
+    self.path = path
+    self.root = os.path.join(path, 'root')
+
+  @classmethod
+  def ForSerial(cls, config, serial):
+    return cls(config, os.path.join(config['state_dir'],
+                                    serial.rsplit(':', 1)[-1]))
+
+  def _Read(self, name, default):
+    try:
+      with open(os.path.join(self.path, name)) as f:
+        return json.load(f)
+    except (IOError, OSError, ValueError):
+      return default
+
+  def _Update(self, name, update_fn, default):
+    value = update_fn(self._Read(name, default))
+    tmp = os.path.join(self.path, '.%s.%d' % (name, os.getpid()))
+    with open(tmp, 'w') as f:
+      json.dump(value, f)
+    os.rename(tmp, os.path.join(self.path, name))
+
+  def Start(self, pid):
+    for d in (self.path, os.path.join(self.root, _DEVICE_TMP.lstrip('/'))):
+      if not os.path.isdir(d):
+        os.makedirs(d)
+    for name in os.listdir(self.path):
+      if name.endswith('.json'):
+        os.remove(os.path.join(self.path, name))
+    self._Update('started.json',
+                 lambda _: {'time': time.time(), 'pid': pid}, None)
+
+  def Stop(self):
+    try:
+      os.remove(os.path.join(self.path, 'started.json'))
+    except OSError:
+      pass
+
+  @property
+  def alive(self):
+    started = self._Read('started.json', None)
+    if not started:
+      return False
+    try:
+      os.kill(started['pid'], 0)
+    except OSError:
+      return False
+    return True
+
+  def Uptime(self):
+    started = self._Read('started.json', None)
+    return time.time() - started['time'] if started else 0
+
+  def Reached(self, stage):
+    """Whether the device booted up to stage."""
+    if stage != ADBD and self._Read('android_stopped.json', False):
+      return False
+    return self.Uptime() >= self.config['boot'][stage]
+
+  def Props(self):
+    props = {
+        'ro.build.version.sdk': str(self.config['api_level']),
+        'ro.product.cpu.abi': 'x86',
+        'ro.kernel.qemu': '1',
+        'init.svc.adbd': 'running',
+        'init.svc.pipe_traverse': 'running',
+        'init.svc.zygote': ('running' if self.Reached(SYSTEM_SERVER)
+                            else 'stopped'),
+    }
+    if self.Reached(BOOT_COMPLETED):
+      props['sys.boot_completed'] = '1'
+      props['dev.bootcomplete'] = '1'
+    props.update(self._Read('props.json', {}))
+    return props
+
+  def SetProp(self, name, value):
+    def Set(props):
+      props[name] = value
+      return props
+    self._Update('props.json', Set, {})
+
+  def SetAndroidStopped(self, stopped):
+    self._Update('android_stopped.json', lambda _: stopped, False)
+
+  def Packages(self):
+    packages = self._Read('packages.json', [])
+    if self.Reached(PACKAGE_MANAGER):
+      packages = ['android', _LAUNCHER_PACKAGE] + packages
+    return packages
+
+  def Install(self, apk):
+    name = os.path.basename(apk)
+    package = _PACKAGE_NAMES.get(name, os.path.splitext(name)[0])
+    self._Update('packages.json', lambda p: sorted(set(p + [package])), [])
+
+  def Mounts(self):
+    """Returns (device, mount point, fstype, options) of the mounts."""
+    mounts = [('rootfs', '/', 'rootfs', 'ro'),
+              ('/dev/block/vda', '/system', 'ext4', 'ro'),
+              ('/dev/block/vdb', '/cache', 'ext4', 'rw'),
+              ('/dev/block/vdc', '/data', 'ext4', 'rw')]
+    if self.Reached(STORAGE):
+      mounts += [('/data/media', '/mnt/runtime/default/emulated', 'sdcardfs',
+                  'rw'),
+                 ('/data/media', '/storage/emulated', 'sdcardfs', 'rw')]
+    changed = self._Read('mounts.json', {})
+    return [(dev, point, fstype, changed.get(point, options))
+            for dev, point, fstype, options in mounts
+            if changed.get(point) != 'umounted']
+
+  def ChangeMount(self, mount_point, state):
+    def Change(changed):
+      changed[mount_point] = state
+      return changed
+    self._Update('mounts.json', Change, {})
+
+  def Remap(self, command):
+    """Points command's /data/local/tmp to the device's own directory."""
+    tmp = os.path.join(self.root, _DEVICE_TMP.lstrip('/'))
+    if isinstance(command, bytes):
+      return command.replace(_DEVICE_TMP.encode('utf-8'), tmp.encode('utf-8'))
+    return command.replace(_DEVICE_TMP, tmp)
+
+
+class _Emulator(object):
+  """emulator -ports <console>,<adb> [-unix-pipe <path>]... [...]."""
+
+  def __init__(self, config, args):
+    self._config = config
+    self._args = args
+    self._option = {}
+    self._pipes = []
+    for flag, value in zip(args, args[1:]):
+      if flag == '-unix-pipe':
+        self._pipes.append(value)
+      elif flag.startswith('-'):
+        self._option[flag] = value
+    self._console_port, self._adb_port = [
+        int(p) for p in self._option['-ports'].split(',')]
+    self._device = _Device.ForSerial(config, str(self._adb_port))
+    self._killed = threading.Event()
+
+  def _Listen(self, port):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('127.0.0.1', port))
+    sock.listen(5)
+    return sock
+
+  def _CreateFiles(self):
+    for flag in _OVERLAY_FLAGS:
+      if flag in self._option:
+        open(self._option[flag] + '.qcow2', 'a').close()
+    for name in ('version_num.cache', 'snapshots.img'):
+      open(name, 'a').close()
+    sockets = []
+    for path in self._pipes:
+      # the host services of pipe_traversal may have created it already.
+      if os.path.exists(path):
+        continue
+      if not os.path.isdir(os.path.dirname(path) or '.'):
+        os.makedirs(os.path.dirname(path))
+      sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+      sock.bind(path)
+      sock.listen(1)
+      sockets.append(sock)
+    return sockets
+
+  def _Console(self, conn):
+    """Serves one console connection until it closes or asks to kill."""
+    try:
+      conn.sendall(b'Android Console: type \'help\' for a list of commands'
+                   b'\r\nOK\r\n')
+      data = b''
+      while not self._killed.is_set():
+        chunk = conn.recv(4096)
+        if not chunk:
+          return
+        data += chunk
+        while b'\n' in data:
+          line, data = data.split(b'\n', 1)
+          if line.strip() == b'kill':
+            conn.sendall(b'OK: killing emulator, bye bye\r\n')
+            self._killed.set()
+            return
+          conn.sendall(b'OK\r\n')
+    except socket.error:
+      pass
+    finally:
+      conn.close()
+
+  def Run(self):
+    print('emulator: %s' % ' '.join(self._args))
+    sys.stdout.flush()
+    self._device.Start(os.getpid())
+    signal.signal(signal.SIGTERM, lambda *unused: sys.exit(0))
+    try:
+      unix_sockets = self._CreateFiles()
+      console = self._Listen(self._console_port)
+      adb = None
+      while not self._killed.is_set():
+        if adb is None and self._device.Reached(ADBD):
+          adb = self._Listen(self._adb_port)
+        listening = [s for s in (console, adb) if s]
+        readable, _, _ = select.select(listening + unix_sockets, [], [], 0.1)
+        for sock in readable:
+          conn, _ = sock.accept()
+          if sock is console:
+            # the launcher may hold a console open, serve the others too.
+            thread = threading.Thread(target=self._Console, args=(conn,))
+            thread.daemon = True
+            thread.start()
+          else:
+            conn.close()
+      return 0
+    finally:
+      self._device.Stop()
+
+
+def _Adb(config, args):
+  """adb [-s serial] [-P port] <command> [args]."""
+  time.sleep(config['adb_latency_seconds'])
+  serial = os.environ.get('ANDROID_SERIAL')
+  while args and args[0] in ('-s', '-P', '-H'):
+    if args[0] == '-s':
+      serial = args[1]
+    args = args[2:]
+  command, args = (args[0], args[1:]) if args else ('help', [])
+
+  if command == 'devices':
+    lines = ['List of devices attached']
+    for port in sorted(os.listdir(config['state_dir'])):
+      if _Device(config, os.path.join(config['state_dir'], port)).alive:
+        lines.append('localhost:%s\tdevice' % port)
+    _Write('\n'.join(lines) + '\n\n')
+    return 0
+  if command == 'connect':
+    serial = args[0]
+  if not serial:
+    _Write('error: no devices/emulators found\n')
+    return 1
+  device = _Device.ForSerial(config, serial)
+  if command == 'wait-for-device':
+    while not device.alive:
+      time.sleep(0.1)
+    return 0
+  if not device.alive:
+    _Write('error: device \'%s\' not found\n' % serial)
+    return 1
+  if command == 'connect':
+    _Write('connected to %s\n' % serial)
+  elif command == 'get-state':
+    _Write('device\n')
+  elif command == 'install':
+    time.sleep(config['install_seconds'])
+    device.Install(args[-1])
+    _Write('Performing Streamed Install\nSuccess\n')
+  elif command == 'shell':
+    return _Shell(device, ' '.join(args))
+  elif command == 'logcat':
+    _WaitForDeath(device)
+  return 0
+
+
+def _WaitForDeath(device):
+  while device.alive:
+    time.sleep(0.2)
+
+
+def _Shell(device, command):
+  """Runs command, or the commands on stdin, in the device's shell.
+
+  Like adb.turbo the exit status is 0 unless the device went away.
+  """
+  env = {
+      'PATH': device.config['tools_dir'],
+      'FAKE_DEVICE_DIR': device.path,
+      'EXTERNAL_STORAGE': '/sdcard',
+      'ANDROID_STORAGE': '/storage',
+      'ANDROID_DATA': '/data',
+  }
+  args = ['/bin/sh']
+  if command:
+    args += ['-c', device.Remap(command)]
+  proc = subprocess.Popen(args, env=env, cwd=device.root,
+                          stdin=subprocess.PIPE if not command else None,
+                          preexec_fn=os.setsid)
+
+  def Stop(*unused_args):
+    try:
+      os.killpg(proc.pid, signal.SIGKILL)
+    except OSError:
+      pass
+  signal.signal(signal.SIGTERM, lambda *args: (Stop(), sys.exit(143)))
+
+  def Watch():
+    # a shell ends with its device, as it would with adbd.
+    while proc.poll() is None:
+      if not device.alive:
+        Stop()
+        return
+      time.sleep(0.2)
+  watch = threading.Thread(target=Watch)
+  watch.daemon = True
+  watch.start()
+
+  if not command:
+    stdin = getattr(sys.stdin, 'buffer', sys.stdin)
+    try:
+      for line in iter(stdin.readline, b''):
+        proc.stdin.write(device.Remap(line))
+        proc.stdin.flush()
+      proc.stdin.close()
+    except (IOError, OSError):
+      pass
+  proc.wait()
+  return 0 if device.alive else 255
+
+
+def _DeviceTool(config, device, name, args):
+  """Runs the device tool name, returns its exit status."""
+  if name == 'ps':
+    processes = ['init', 'ueventd', 'adbd', 'pipe_traversal']
+    if device.Reached(SYSTEM_SERVER):
+      processes += ['zygote', 'system_server', 'surfaceflinger']
+    if device.Reached(LAUNCHER):
+      processes.append(_LAUNCHER_PACKAGE)
+    lines = ['USER           PID  PPID     VSZ    RSS WCHAN            '
+             'ADDR S NAME']
+    for pid, process in enumerate(processes, 1):
+      lines.append('root %13d %5d %7d %6d 0                   0 S %s' % (
+          pid, 0 if pid == 1 else 1, 10000 + pid, 2000, process))
+    _Write('\n'.join(lines) + '\n')
+  elif name == 'getprop':
+    props = device.Props()
+    if args:
+      _Write(props.get(args[0], '') + '\n')
+    else:
+      _Write(''.join('[%s]: [%s]\n' % item for item in sorted(props.items())))
+  elif name == 'setprop':
+    device.SetProp(args[0], args[1] if len(args) > 1 else '')
+  elif name == 'mount':
+    if not args:
+      _Write(''.join('%s on %s type %s (%s)\n' % m for m in device.Mounts()))
+    elif args[0] == '-o':
+      device.ChangeMount(args[-1], args[1].split(',')[0])
+  elif name == 'umount':
+    device.ChangeMount(args[-1], 'umounted')
+  elif name == 'service':
+    if args[:1] == ['check']:
+      found = args[1] != 'package' or device.Reached(PACKAGE_MANAGER)
+      _Write('Service %s: %sfound\n' % (args[1], '' if found else 'not '))
+  elif name == 'pm':
+    return _Pm(device, args)
+  elif name == 'am':
+    _Am(device, args)
+  elif name in ('start', 'stop') and not args:
+    device.SetAndroidStopped(name == 'stop')
+  elif name == 'printenv':
+    _Write(''.join(os.environ.get(a, '') + '\n' for a in args))
+  elif name == 'date':
+    _Write('%d\n' % time.time() if args == ['+%s'] else time.ctime() + '\n')
+  elif name == 'sleep':
+    time.sleep(float(args[0].rstrip('s')))
+  elif name == 'cat':
+    return _Cat(device, args)
+  elif name == 'rm':
+    for path in args:
+      if path.startswith(device.root):
+        try:
+          os.remove(path)
+        except OSError:
+          pass
+  elif name == 'logcat':
+    if '-d' not in args:
+      _WaitForDeath(device)
+  elif name == 'e2fsck':
+    _Write('%s: clean\n' % args[-1])
+  return 0
+
+
+def _Pm(device, args):
+  if not device.Reached(PACKAGE_MANAGER):
+    _Write('Error: Could not access the Package Manager.  Is the system '
+           'running?\n')
+    return 1
+  if args[:2] == ['path', 'android']:
+    _Write('package:/system/framework/framework-res.apk\n')
+  elif args[:2] == ['list', 'packages']:
+    _Write(''.join('package:%s\n' % p for p in device.Packages()
+                   if not args[2:] or args[2] in p))
+  return 0
+
+
+def _Am(device, args):
+  if args[:1] == ['instrument']:
+    if _BOOTSTRAP_PACKAGE in device.Packages():
+      _Write('INSTRUMENTATION_RESULT: dpi=ok\nINSTRUMENTATION_CODE: -1\n')
+    else:
+      _Write('INSTRUMENTATION_STATUS: Error=Unable to find instrumentation '
+             'info\nINSTRUMENTATION_FAILED\n')
+  elif args[:1] == ['broadcast']:
+    _Write('Broadcasting: Intent { act=%s }\nBroadcast completed: '
+           'result=0\n' % args[args.index('-a') + 1])
+  elif args[:1] == ['start']:
+    _Write('Starting: Intent { act=android.intent.action.MAIN }\n')
+
+
+def _Cat(device, args):
+  status = 0
+  for path in args:
+    if path == '/proc/uptime':
+      uptime = device.Uptime()
+      # an idle device, all cpu time was spent idle.
+      _Write('%.2f %.2f\n' % (uptime, uptime))
+      continue
+    try:
+      with open(path, 'rb') as f:
+        _Write(f.read())
+    except (IOError, OSError):
+      sys.stderr.write('cat: %s: No such file or directory\n' % path)
+      status = 1
+  return status
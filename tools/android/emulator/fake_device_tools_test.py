@@ -0,0 +1,136 @@
+# Copyright 2018 The Android Open Source Project. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for tools.android.emulator.fake_device_tools."""
+
+import os
+import shutil
+import socket
+import subprocess
+import telnetlib
+import tempfile
+import time
+
+from google.apputils import basetest as googletest
+from tools.android.emulator import fake_device_tools
+
+
+def _FreePort():
+  sock = socket.socket()
+  sock.bind(('127.0.0.1', 0))
+  port = sock.getsockname()[1]
+  sock.close()
+  return port
+
+
+class FakeDeviceToolsTest(googletest.TestCase):
+
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.state_dir = os.path.join(self.dir, 'devices')
+    self.tools = fake_device_tools.WriteTools(
+        os.path.join(self.dir, 'tools'), self.state_dir, {
+            'adb_latency_seconds': 0,
+            'shell_latency_seconds': 0,
+            'install_seconds': 0,
+            'boot': {'adbd': 0, 'system_server': 0.5,
+                     'package_manager': 0.5, 'storage': 0.5,
+                     'boot_completed': 0.5, 'launcher': 0.5},
+        })
+    self.images = os.path.join(self.dir, 'images')
+    os.makedirs(self.images)
+    self.console_port, self.adb_port = _FreePort(), _FreePort()
+    self.serial = 'localhost:%d' % self.adb_port
+    self.emulator = None
+
+  def tearDown(self):
+    fake_device_tools.KillDevices(self.state_dir)
+    if self.emulator:
+      self.emulator.wait()
+    shutil.rmtree(self.dir)
+
+  def _StartEmulator(self):
+    self.emulator = subprocess.Popen(
+        [self.tools[fake_device_tools.EMULATOR], '-ports',
+         '%d,%d' % (self.console_port, self.adb_port), '-data',
+         'userdata-qemu.img', '-unix-pipe', 'sockets/qemu.mgmt'],
+        cwd=self.images, stdout=open(os.devnull, 'w'))
+    deadline = time.time() + 30
+    while time.time() < deadline:
+      try:
+        socket.create_connection(('127.0.0.1', self.adb_port)).close()
+        return
+      except socket.error:
+        time.sleep(0.05)
+    self.fail('adb port not open')
+
+  def _Shell(self, command):
+    return subprocess.check_output(
+        [self.tools[fake_device_tools.ADB], '-s', self.serial, 'shell',
+         command], env={}).decode('utf-8')
+
+  def testBootProgression(self):
+    self._StartEmulator()
+    self.assertTrue(os.path.exists(
+        os.path.join(self.images, 'userdata-qemu.img.qcow2')))
+    self.assertTrue(os.path.exists(
+        os.path.join(self.images, 'sockets', 'qemu.mgmt')))
+    self.assertNotIn('system_server', self._Shell('ps -A'))
+    self.assertIn('not found', self._Shell('service check package'))
+    time.sleep(0.5)
+    self.assertIn('system_server', self._Shell('ps -A'))
+    self.assertEquals('1\n', self._Shell('getprop sys.boot_completed'))
+    self.assertIn(': found', self._Shell('service check package'))
+    self.assertIn(' /storage/emulated ', self._Shell('mount'))
+    self.assertEquals('/sdcard\n', self._Shell('printenv EXTERNAL_STORAGE'))
+
+  def testInstallAndStop(self):
+    self._StartEmulator()
+    time.sleep(0.5)
+    out = subprocess.check_output([self.tools[fake_device_tools.ADB], '-s',
+                                   self.serial, 'install', '-r',
+                                   '/x/bootstrap.apk']).decode('utf-8')
+    self.assertIn('Success', out)
+    self.assertIn('INSTRUMENTATION_CODE: -1',
+                  self._Shell('am instrument -w bootstrap/.DpiCheck'))
+    self._Shell('setprop persist.a 1; stop; mount -o ro,remount /data')
+    self.assertEquals('1\n', self._Shell('getprop persist.a'))
+    self.assertNotIn('system_server', self._Shell('ps -A'))
+    self.assertIn(' /data type ext4 (ro)', self._Shell('mount'))
+
+  def testShellSession(self):
+    self._StartEmulator()
+    proc = subprocess.Popen([self.tools[fake_device_tools.ADB], '-s',
+                             self.serial, 'shell'], stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE, env={})
+    out, _ = proc.communicate(b'echo hi > /data/local/tmp/f\n'
+                              b'cat /data/local/tmp/f\n')
+    self.assertEquals(b'hi\n', out)
+
+  def testConsoleKill(self):
+    self._StartEmulator()
+    held = telnetlib.Telnet('127.0.0.1', self.console_port)
+    console = telnetlib.Telnet('127.0.0.1', self.console_port)
+    console.read_until(b'OK')
+    console.write(b'kill\n')
+    self.assertIn(b'bye', console.read_all())
+    self.assertEquals(0, self.emulator.wait())
+    held.close()
+    out = subprocess.check_output([self.tools[fake_device_tools.ADB],
+                                   'devices']).decode('utf-8')
+    self.assertNotIn(self.serial, out)
+
+
+if __name__ == '__main__':
+  googletest.main()
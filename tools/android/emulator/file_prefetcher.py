@@ -0,0 +1,216 @@
+# Copyright 2018 The Android Open Source Project. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Warms the page cache for the files needed to launch an emulator.
+
+Files on objfs / bazel-out cache can be accessed like standard files, however
+the first read of them can block for a long time. Prefetching them in parallel
+before the emulator starts keeps those stalls off the boot path.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import ctypes
+import ctypes.util
+import os
+import threading
+import time
+
+from absl import flags
+from absl import logging
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_integer('prefetch_threads', 8, 'Number of threads used to warm '
+                     'the page cache for images and tools before launching.')
+flags.DEFINE_enum('prefetch_mode', 'advise', ['advise', 'read', 'touch'],
+                  'How files are warmed: advise the kernel to read them ahead '
+                  '(falls back to reading), read them fully, or only touch '
+                  'their first byte.')
+
+# Lower values are prefetched first.
+KERNEL_PRIORITY = 0
+IMAGE_PRIORITY = 1
+DEFAULT_PRIORITY = 2
+LIBRARY_PRIORITY = 3
+
+_KERNEL_NAMES = ('kernel-qemu', 'kernel-ranchu', 'kernel-ranchu-64',
+                 'ramdisk.img')
+_IMAGE_SUFFIXES = ('.img', '.img.tar.gz', '.bin')
+
+_READ_SIZE = 1 << 20
+
+# From linux/fadvise.h, used when os.posix_fadvise is not available.
+_POSIX_FADV_WILLNEED = 3
+
+PrefetchResult = collections.namedtuple(
+    'PrefetchResult',
+    ['path', 'priority', 'size', 'bytes_warmed', 'method', 'seconds'])
+
+
+def DefaultPriority(path):
+  """Kernel and ramdisk first, other images next and emulator libs last."""
+  basename = os.path.basename(path)
+  if basename in _KERNEL_NAMES:
+    return KERNEL_PRIORITY
+  if '/lib64/' in path or '/lib/' in path:
+    return LIBRARY_PRIORITY
+  if basename.endswith(_IMAGE_SUFFIXES):
+    return IMAGE_PRIORITY
+  return DEFAULT_PRIORITY
+
+
+def _LoadFadvise():
+  """Returns f(fd, offset, length) advising WILLNEED or None."""
+  posix_fadvise = getattr(os, 'posix_fadvise', None)
+  if posix_fadvise:
+    return lambda fd, offset, length: posix_fadvise(
+        fd, offset, length, os.POSIX_FADV_WILLNEED)
+  try:
+    libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6')
+    libc_fadvise = libc.posix_fadvise
+  except (OSError, AttributeError):
+    return None
+  libc_fadvise.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64,
+                           ctypes.c_int]
+
+  def _Fadvise(fd, offset, length):
+    # posix_fadvise returns the error number rather than setting errno.
+    err = libc_fadvise(fd, offset, length, _POSIX_FADV_WILLNEED)
+    if err:
+      raise OSError(err, os.strerror(err))
+  return _Fadvise
+
+
+_fadvise = _LoadFadvise()
+
+
+def _ReadFully(fd):
+  warmed = 0
+  while True:
+    data = os.read(fd, _READ_SIZE)
+    if not data:
+      return warmed
+    warmed += len(data)
+
+
+def _WarmFile(path, priority, mode):
+  """Pulls a file into the page cache, returning a PrefetchResult."""
+  start = time.time()
+  fd = os.open(path, os.O_RDONLY)
+  try:
+    size = os.fstat(fd).st_size
+    # The first read makes remote file systems fetch the file.
+    warmed = len(os.read(fd, 1))
+    method = mode
+    if mode == 'advise':
+      if _fadvise and size:
+        try:
+          _fadvise(fd, 0, size)
+          warmed = size
+        except OSError as e:
+          logging.debug('fadvise(%s) failed: %s, reading instead.', path, e)
+          method = 'read'
+      else:
+        method = 'read'
+    if method == 'read':
+      warmed += _ReadFully(fd)
+  finally:
+    os.close(fd)
+  return PrefetchResult(path=path, priority=priority, size=size,
+                        bytes_warmed=warmed, method=method,
+                        seconds=time.time() - start)
+
+
+def _Flatten(pathss):
+  """Yields the non empty paths in pathss, each a str or a list of str."""
+  for paths in pathss:
+    if not paths:
+      continue
+    if isinstance(paths, str):
+      paths = (paths,)
+    for path in paths:
+      if path and isinstance(path, str):
+        yield path
+
+
+def PrefetchFiles(pathss, priority_fn=DefaultPriority, threads=None,
+                  mode=None):
+  """Warms the page cache for a set of files in parallel.
+
+  Args:
+    pathss: A list where each element can be a str or a list of str.
+      Duplicates are prefetched once.
+    priority_fn: f(path) returning the priority of a path, lower values are
+      started first. Ties keep their order in pathss.
+    threads: the number of files warmed concurrently, defaults to
+      --prefetch_threads.
+    mode: one of --prefetch_mode's values, defaults to --prefetch_mode.
+
+  Returns:
+    A list of PrefetchResult, in the order files were started.
+
+  Raises:
+    AssertionError: if a path doesn't exist.
+  """
+  threads = threads or FLAGS.prefetch_threads
+  mode = mode or FLAGS.prefetch_mode
+
+  seen = set()
+  work = []
+  for path in _Flatten(pathss):
+    real_path = os.path.realpath(path)
+    if real_path in seen:
+      continue
+    seen.add(real_path)
+    assert os.path.exists(path), 'Path doesn\'t exist: %s' % path
+    work.append((priority_fn(path), len(work), path))
+  work.sort()
+
+  pending = collections.deque(work)
+  results = [None] * len(work)
+
+  def _Worker():
+    while True:
+      try:
+        priority, index, path = pending.popleft()
+      except IndexError:
+        return
+      try:
+        results[index] = _WarmFile(path, priority, mode)
+      except (IOError, OSError) as e:
+        logging.warning('Could not prefetch %s: %s', path, e)
+        results[index] = PrefetchResult(path=path, priority=priority, size=0,
+                                        bytes_warmed=0, method='error',
+                                        seconds=0)
+
+  workers = [threading.Thread(target=_Worker, name='prefetch-%d' % i)
+             for i in range(min(threads, len(work)))]
+  start = time.time()
+  for worker in workers:
+    worker.daemon = True
+    worker.start()
+  for worker in workers:
+    worker.join()
+
+  ordered = [results[index] for _, index, _ in work]
+  for result in ordered:
+    logging.info('Prefetched %s: %d bytes by %s in %.3fs', result.path,
+                 result.bytes_warmed, result.method, result.seconds)
+  logging.info('Prefetched %d files, %d bytes in %.3fs', len(ordered),
+               sum(r.bytes_warmed for r in ordered), time.time() - start)
+  return ordered
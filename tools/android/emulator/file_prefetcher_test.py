@@ -0,0 +1,89 @@
+# Copyright 2018 The Android Open Source Project. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for tools.android.emulator.file_prefetcher."""
+
+import os
+import shutil
+import tempfile
+
+from google.apputils import basetest as googletest
+from tools.android.emulator import file_prefetcher
+
+
+class FilePrefetcherTest(googletest.TestCase):
+
+  def setUp(self):
+    super(FilePrefetcherTest, self).setUp()
+    self.root = tempfile.mkdtemp()
+
+  def tearDown(self):
+    super(FilePrefetcherTest, self).tearDown()
+    shutil.rmtree(self.root)
+
+  def _MakeFile(self, relative_path, size):
+    path = os.path.join(self.root, relative_path)
+    if not os.path.exists(os.path.dirname(path)):
+      os.makedirs(os.path.dirname(path))
+    with open(path, 'wb') as f:
+      f.write(b'x' * size)
+    return path
+
+  def testDefaultPriority(self):
+    self.assertEquals(file_prefetcher.KERNEL_PRIORITY,
+                      file_prefetcher.DefaultPriority('/a/kernel-qemu'))
+    self.assertEquals(file_prefetcher.KERNEL_PRIORITY,
+                      file_prefetcher.DefaultPriority('/a/ramdisk.img'))
+    self.assertEquals(file_prefetcher.IMAGE_PRIORITY,
+                      file_prefetcher.DefaultPriority('/a/system.img'))
+    self.assertEquals(file_prefetcher.DEFAULT_PRIORITY,
+                      file_prefetcher.DefaultPriority('/a/adb'))
+    self.assertEquals(file_prefetcher.LIBRARY_PRIORITY,
+                      file_prefetcher.DefaultPriority('/emu/lib64/libc++.so'))
+
+  def testPrefetchFiles_priorityAndDedupe(self):
+    lib = self._MakeFile('emu/lib64/libfoo.so', 10)
+    adb = self._MakeFile('adb', 10)
+    system = self._MakeFile('system.img', 10)
+    kernel = self._MakeFile('kernel-ranchu', 10)
+    link = os.path.join(self.root, 'system_link.img')
+    os.symlink(system, link)
+
+    results = file_prefetcher.PrefetchFiles(
+        [[lib, adb], None, system, [kernel, link, None], adb],
+        threads=1, mode='read')
+    self.assertEquals([kernel, system, adb, lib], [r.path for r in results])
+
+  def testPrefetchFiles_modes(self):
+    path = self._MakeFile('system.img', 3 << 20)
+    for mode in ('advise', 'read'):
+      result, = file_prefetcher.PrefetchFiles([path], mode=mode)
+      self.assertEquals(3 << 20, result.size)
+      self.assertEquals(3 << 20, result.bytes_warmed)
+    result, = file_prefetcher.PrefetchFiles([path], mode='touch')
+    self.assertEquals(1, result.bytes_warmed)
+    self.assertEquals('touch', result.method)
+
+  def testPrefetchFiles_emptyFile(self):
+    path = self._MakeFile('empty', 0)
+    result, = file_prefetcher.PrefetchFiles([path], mode='advise')
+    self.assertEquals(0, result.bytes_warmed)
+
+  def testPrefetchFiles_missing(self):
+    self.assertRaises(AssertionError, file_prefetcher.PrefetchFiles,
+                      [os.path.join(self.root, 'missing')])
+
+
+if __name__ == '__main__':
+  googletest.main()
@@ -0,0 +1,233 @@
+# Copyright 2018 The Android Open Source Project. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A host wide cache of the images a launch derives from its inputs.
+
+Staging extracts the same system, cache and sdcard images, makes the same
+sdcards and resizes the same userdata partitions launch after launch.
+ImageCache keeps each such output under the hash of the contents of its
+inputs and of the transform that made it:
+
+  cache.Stage(dst, [archive], 'tar:cache.img', ExtractTo)
+
+runs ExtractTo(path) only the first time; afterwards dst is materialized
+from the cache, by reflink if the filesystem can, else by hard link if the
+caller does not write to dst, else by a sparse copy. The cache directory is
+
+  entries/<key>     the outputs, their mtime being the last use.
+  digests/<hash>    the content hash of an input file, by its path, size,
+                    mtime and inode, so inputs are read once.
+  tmp/              outputs being made, renamed into entries/ when done.
+
+Entries are only ever renamed into place, so concurrent launchers never see
+a partial one; two launchers missing the same key both make it and the last
+rename wins. After every miss the least recently used entries are removed
+until the cache is within its byte budget.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import errno
+import fcntl
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from absl import logging
+
+from tools.android.emulator import staging_copy
+
+_VERSION = 1
+
+REFLINK = staging_copy.REFLINK
+HARDLINK = 'hardlink'
+COPY = 'copy'
+
+
+class ImageCache(object):
+  """Outputs of image transforms, by the hash of their inputs."""
+
+  def __init__(self, root, max_bytes, clock=time.time):
+    """Constructor.
+
+    Args:
+      root: the cache directory, shared by all launchers of the host.
+      max_bytes: the disk space the entries may take.
+      clock: the time source of the last uses.
+    """
+    self._root = root
+    self._max_bytes = max_bytes
+    self._clock = clock
+    self._lock = threading.Lock()
+    self.stats = {'hits': 0, 'misses': 0, 'evicted': 0, REFLINK: 0,
+                  HARDLINK: 0, COPY: 0}
+    for d in ('entries', 'digests', 'tmp'):
+      path = os.path.join(root, d)
+      if not os.path.isdir(path):
+        try:
+          os.makedirs(path)
+        except OSError as e:
+          if e.errno != errno.EEXIST:
+            raise
+
+  def _Count(self, stat):
+    with self._lock:
+      self.stats[stat] += 1
+
+  def Digest(self, path):
+    """Returns the sha256 of the contents of path, remembered by its stat."""
+    st = os.stat(path)
+    stat_key = hashlib.sha1(('%s:%d:%d:%d:%d' % (
+        os.path.realpath(path), st.st_size, int(st.st_mtime * 1e9),
+        st.st_ino, st.st_dev)).encode('utf-8')).hexdigest()
+    memo = os.path.join(self._root, 'digests', stat_key)
+    try:
+      with open(memo) as f:
+        return f.read().strip()
+    except (IOError, OSError):
+      pass
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+      for block in iter(lambda: f.read(1 << 20), b''):
+        digest.update(block)
+    self._WriteAtomically(memo, digest.hexdigest())
+    return digest.hexdigest()
+
+  def Key(self, inputs, transform):
+    """Returns the entry name of transform applied to the input files."""
+    key = hashlib.sha256(('%d\0%s' % (_VERSION, transform)).encode('utf-8'))
+    for path in inputs:
+      key.update(b'\0' + self.Digest(path).encode('ascii'))
+    return key.hexdigest()
+
+  def _WriteAtomically(self, path, content):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.join(self._root, 'tmp'))
+    with os.fdopen(fd, 'w') as f:
+      f.write(content)
+    os.rename(tmp_path, path)
+
+  def _Entry(self, key):
+    return os.path.join(self._root, 'entries', key)
+
+  def Materialize(self, entry, dst, writable):
+    """Puts the file entry at dst, returns how."""
+    if os.path.lexists(dst):
+      os.remove(dst)
+    if staging_copy.Reflink(entry, dst):
+      return REFLINK
+    os.remove(dst)
+    if not writable:
+      try:
+        os.link(entry, dst)
+        return HARDLINK
+      except OSError as e:
+        # another filesystem, or not permitted there.
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+          raise
+    staging_copy.Copy(entry, dst)
+    return COPY
+
+  def Stage(self, dst, inputs, transform, produce_fn, writable=False):
+    """Puts the output of transform at dst, making it only on a miss.
+
+    Args:
+      dst: where the output goes.
+      inputs: the files the output is made of.
+      transform: names what produce_fn does with the inputs, including all
+        of its parameters.
+      produce_fn: called with a path to write the output to.
+      writable: whether dst is written to after, it must not share its
+        inode with the cache then.
+
+    Returns:
+      Whether it was a hit.
+    """
+    entry = self._Entry(self.Key(inputs, transform))
+    try:
+      os.utime(entry, (self._clock(), self._clock()))
+      how = self.Materialize(entry, dst, writable)
+      self._Count('hits')
+      self._Count(how)
+      logging.info('Image cache hit for %s, %s %s.', transform, how, dst)
+      return True
+    except (IOError, OSError) as e:
+      # evicted by another launcher since, is a miss.
+      if e.errno != errno.ENOENT:
+        raise
+
+    self._Count('misses')
+    work_dir = tempfile.mkdtemp(dir=os.path.join(self._root, 'tmp'))
+    try:
+      output = os.path.join(work_dir, os.path.basename(dst))
+      produce_fn(output)
+      os.utime(output, (self._clock(), self._clock()))
+      os.rename(output, entry)
+    finally:
+      shutil.rmtree(work_dir, ignore_errors=True)
+    how = self.Materialize(entry, dst, writable)
+    self._Count(how)
+    logging.info('Image cache miss for %s, made and %s %s.', transform, how,
+                 dst)
+    self.Evict(keep=entry)
+    return False
+
+  def Evict(self, keep=None):
+    """Removes the least recently used entries beyond the budget.
+
+    Args:
+      keep: [optional] an entry not to remove, e.g. the one just made.
+
+    Returns:
+      The number of entries removed.
+    """
+    lock = os.open(os.path.join(self._root, '.evict.lock'),
+                   os.O_WRONLY | os.O_CREAT, 0o644)
+    try:
+      try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+      except (IOError, OSError):
+        return 0  # another launcher is evicting.
+      entries = []
+      entries_dir = os.path.join(self._root, 'entries')
+      for name in os.listdir(entries_dir):
+        path = os.path.join(entries_dir, name)
+        try:
+          st = os.stat(path)
+        except OSError:
+          continue
+        # the blocks used, entries are mostly sparse images.
+        entries.append((st.st_mtime, st.st_blocks * 512, path))
+      total = sum(size for _, size, _ in entries)
+      removed = 0
+      for _, size, path in sorted(entries):
+        if total <= self._max_bytes:
+          break
+        if path == keep:
+          continue
+        try:
+          os.remove(path)
+        except OSError:
+          continue
+        total -= size
+        removed += 1
+      with self._lock:
+        self.stats['evicted'] += removed
+      return removed
+    finally:
+      os.close(lock)
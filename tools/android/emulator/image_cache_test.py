@@ -0,0 +1,147 @@
+# Copyright 2018 The Android Open Source Project. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for tools.android.emulator.image_cache."""
+
+import os
+import shutil
+import tempfile
+import time
+
+from google.apputils import basetest as googletest
+from tools.android.emulator import image_cache
+
+
+class FakeClock(object):
+
+  def __init__(self):
+    self.now = 1000.0
+
+  def __call__(self):
+    self.now += 1
+    return self.now
+
+
+class ImageCacheTest(googletest.TestCase):
+
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.root = os.path.join(self.dir, 'cache')
+    self.input = self._Write('input.tar.gz', b'archive')
+    self.produced = []
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def _Write(self, name, content):
+    path = os.path.join(self.dir, name)
+    with open(path, 'wb') as f:
+      f.write(content)
+    return path
+
+  def _Read(self, path):
+    with open(path, 'rb') as f:
+      return f.read()
+
+  def _Producer(self, content):
+    def Produce(dst):
+      self.produced.append(dst)
+      with open(dst, 'wb') as f:
+        f.write(content)
+    return Produce
+
+  def testMissThenHit(self):
+    cache = image_cache.ImageCache(self.root, 1 << 20)
+    dst = os.path.join(self.dir, 'a', 'system.img')
+    os.makedirs(os.path.dirname(dst))
+    self.assertFalse(cache.Stage(dst, [self.input], 'tar:system.img',
+                                 self._Producer(b'image')))
+    self.assertEquals(b'image', self._Read(dst))
+
+    other = os.path.join(self.dir, 'system.img')
+    self.assertTrue(image_cache.ImageCache(self.root, 1 << 20).Stage(
+        other, [self.input], 'tar:system.img', self._Producer(b'new')))
+    self.assertEquals(b'image', self._Read(other))
+    self.assertEquals(1, len(self.produced))
+    # produced in the cache, never at the destination.
+    self.assertTrue(self.produced[0].startswith(self.root))
+
+  def testKeyFollowsContentAndTransform(self):
+    cache = image_cache.ImageCache(self.root, 1 << 20)
+    key = cache.Key([self.input], 'resize2fs:2048M')
+    self.assertEquals(key, cache.Key([self.input], 'resize2fs:2048M'))
+    self.assertNotEquals(key, cache.Key([self.input], 'resize2fs:4096M'))
+    time.sleep(0.01)
+    self._Write('input.tar.gz', b'other archive')
+    self.assertNotEquals(key, cache.Key([self.input], 'resize2fs:2048M'))
+
+  def testWritableDoesNotShareTheEntry(self):
+    cache = image_cache.ImageCache(self.root, 1 << 20)
+    dst = os.path.join(self.dir, 'userdata.img')
+    cache.Stage(dst, [self.input], 't', self._Producer(b'data'),
+                writable=True)
+    with open(dst, 'ab') as f:
+      f.write(b' written')
+    again = os.path.join(self.dir, 'userdata2.img')
+    cache.Stage(again, [self.input], 't', self._Producer(b'x'))
+    self.assertEquals(b'data', self._Read(again))
+    entry = os.path.join(self.root, 'entries', cache.Key([self.input], 't'))
+    self.assertNotEquals(os.stat(entry).st_ino, os.stat(dst).st_ino)
+
+  def testReadOnlyIsLinked(self):
+    cache = image_cache.ImageCache(self.root, 1 << 20)
+    dst = os.path.join(self.dir, 'cache.img')
+    cache.Stage(dst, [self.input], 't', self._Producer(b'cache'))
+    linked = (cache.stats[image_cache.REFLINK] +
+              cache.stats[image_cache.HARDLINK])
+    self.assertEquals(1, linked)
+    self.assertEquals(0, cache.stats[image_cache.COPY])
+
+  def testEvictsLeastRecentlyUsed(self):
+    clock = FakeClock()
+    cache = image_cache.ImageCache(self.root, 3 * 4096, clock=clock)
+    block = b'x' * 4096
+    for name in ('a', 'b', 'c'):
+      cache.Stage(os.path.join(self.dir, name), [self.input], name,
+                  self._Producer(block))
+    # a is used again, b is the least recent now.
+    cache.Stage(os.path.join(self.dir, 'a2'), [self.input], 'a',
+                self._Producer(block))
+    cache.Stage(os.path.join(self.dir, 'd'), [self.input], 'd',
+                self._Producer(block))
+    self.assertEquals(1, cache.stats['evicted'])
+    self.assertEquals(4, len(self.produced))
+    entries = set(os.listdir(os.path.join(self.root, 'entries')))
+    self.assertNotIn(cache.Key([self.input], 'b'), entries)
+    self.assertIn(cache.Key([self.input], 'a'), entries)
+    self.assertIn(cache.Key([self.input], 'd'), entries)
+
+  def testFailedProduceLeavesNoEntry(self):
+    cache = image_cache.ImageCache(self.root, 1 << 20)
+
+    def Fail(dst):
+      with open(dst, 'wb') as f:
+        f.write(b'partial')
+      raise ValueError('tar failed')
+    self.assertRaises(ValueError, cache.Stage, os.path.join(self.dir, 'x'),
+                      [self.input], 't', Fail)
+    self.assertEquals([], os.listdir(os.path.join(self.root, 'entries')))
+    self.assertEquals([], [n for n in os.listdir(os.path.join(self.root,
+                                                              'tmp'))
+                           if os.path.isdir(os.path.join(self.root, 'tmp',
+                                                         n))])
+
+
+if __name__ == '__main__':
+  googletest.main()
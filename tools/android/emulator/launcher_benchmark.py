@@ -0,0 +1,406 @@
+# Copyright 2018 The Android Open Source Project. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmarks the launcher's own orchestration of boot, start, ping and kill.
+
+Runs unified_launcher.EntryPoint in process against the stand-ins of
+fake_device_tools, a scripted emulator and adb whose device boots on a fixed
+schedule, and a generated system image. What is left is the launcher's time:
+staging files, spawning adb commands, polling readiness and shutting down.
+Each phase reports its wall time, the host cpu of the launcher and of the
+children it reaped, and the subprocesses it started by command:
+
+  bazel run //tools/android/emulator:launcher_benchmark -- --iterations=3
+
+--baseline_file keeps the medians of a run (--update_baseline) and compares
+later runs against it, failing when a phase got slower or spawns more than
+--regression_percent more. The boot phase, like the build action, renders
+into /usr/bin/Xvfb.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import gzip
+import json
+import os
+import resource
+import shutil
+import socket
+import sys
+import tempfile
+import time
+
+from absl import app
+from absl import flags
+
+from tools.android.emulator import boot_trace
+from tools.android.emulator import emulated_device
+from tools.android.emulator import emulator_meta_data_pb2
+from tools.android.emulator import fake_device_tools
+from tools.android.emulator import process_accounting
+from tools.android.emulator import reporting
+from tools.android.emulator import unified_launcher
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_integer('iterations', 3, 'How often each phase is run.')
+flags.DEFINE_list('phases', ['boot', 'start', 'ping', 'kill'],
+                  'The launcher actions to time, in the order they run. '
+                  'start needs a booted image, without boot it is made once '
+                  'up front.')
+flags.DEFINE_float('adb_latency', 0.02, 'Seconds the fake adb takes per '
+                   'command.')
+flags.DEFINE_float('shell_latency', 0.005, 'Seconds every fake device tool '
+                   'takes.')
+flags.DEFINE_float('install_seconds', 0.2, 'Seconds a fake apk install '
+                   'takes.')
+flags.DEFINE_string('boot_progression', None, 'Comma separated stage=seconds, '
+                    'when the fake device reaches each of %s. Defaults to %s.'
+                    % (', '.join(fake_device_tools.BOOT_STAGES), ','.join(
+                        '%s=%s' % (s, fake_device_tools.DEFAULT_CONFIG['boot'][
+                            s]) for s in fake_device_tools.BOOT_STAGES)))
+flags.DEFINE_boolean('prepatched_ramdisk', False, 'Ships a patched ramdisk '
+                     'with the image, so boot does not repack it with cpio.')
+flags.DEFINE_string('work_dir', None, 'Where the image, outputs and fake '
+                    'device state go. A temporary directory by default, '
+                    'removed afterwards.')
+flags.DEFINE_string('results_file', None, 'Writes every sample as json.')
+flags.DEFINE_string('baseline_file', None, 'The medians of an earlier run to '
+                    'compare against.')
+flags.DEFINE_boolean('update_baseline', False, 'Writes the medians of this run '
+                     'to --baseline_file instead of comparing.')
+flags.DEFINE_float('regression_percent', 20, 'How much worse than the baseline '
+                   'a median may be.')
+
+# The numbers a baseline keeps of each phase.
+BASELINE_METRICS = ('wall_seconds', 'cpu_seconds', 'subprocesses')
+# Compared times below this many seconds are noise.
+_MIN_COMPARED_SECONDS = 0.05
+
+_API_LEVEL = 28
+_SKIN = '480x800'
+
+Sample = collections.namedtuple('Sample', [
+    'phase', 'iteration', 'wall_seconds', 'cpu_seconds', 'child_cpu_seconds',
+    'subprocesses', 'commands', 'timers'])
+
+
+def _FreePort():
+  sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+  try:
+    sock.bind(('127.0.0.1', 0))
+    return sock.getsockname()[1]
+  finally:
+    sock.close()
+
+
+def _WriteFile(path, content):
+  with open(path, 'wb') as f:
+    f.write(content)
+  return path
+
+
+def _SparseFile(path, size):
+  with open(path, 'wb') as f:
+    f.truncate(size)
+  return path
+
+
+def _Cpio(files):
+  """Returns a newc cpio archive of files, a dict of name to content."""
+  out = []
+  for ino, name in enumerate(sorted(files) + ['TRAILER!!!'], 1):
+    content = files.get(name, b'')
+    mode = 0o100644 if name in files else 0
+    header = '070701' + ''.join('%08x' % v for v in (
+        ino, mode, 0, 0, 1, 0, len(content), 0, 0, 0, 0, len(name) + 1, 0))
+    entry = header.encode('ascii') + name.encode('ascii') + b'\0'
+    entry += b'\0' * (-len(entry) % 4) + content
+    out.append(entry + b'\0' * (-len(entry) % 4))
+  archive = b''.join(out)
+  return archive + b'\0' * (-len(archive) % 512)
+
+
+def MakeSystemImage(directory, prepatched_ramdisk=False):
+  """Writes a minimal qemu2 system image, returns its files."""
+  os.makedirs(directory)
+  ramdisk = _Cpio({
+      'default.prop': b'ro.secure=0\n',
+      'init.rc': b'service adbd /sbin/adbd --root_seclabel=u:r:su:s0\n'
+                 b'    disabled\n    seclabel u:r:adbd:s0\n',
+  })
+  with gzip.open(os.path.join(directory, 'ramdisk.img'), 'wb') as f:
+    f.write(ramdisk)
+  files = [
+      _WriteFile(os.path.join(directory, 'kernel-ranchu'), b'\0' * 4096),
+      os.path.join(directory, 'ramdisk.img'),
+      _SparseFile(os.path.join(directory, 'system.img'), 64 << 20),
+      _SparseFile(os.path.join(directory, 'userdata.img'), 64 << 20),
+      _WriteFile(os.path.join(directory, 'build.prop'),
+                 b'ro.build.version.sdk=%d\n' % _API_LEVEL),
+  ]
+  if prepatched_ramdisk:
+    files.append(os.path.join(directory, 'modified_ramdisk_ramdisk.img'))
+    shutil.copy(files[1], files[-1])
+  return files
+
+
+class Fixture(object):
+  """The image, tools and flags the launcher runs against."""
+
+  def __init__(self, work_dir, tools_config, prepatched_ramdisk=False):
+    self.work_dir = work_dir
+    self.state_dir = os.path.join(work_dir, 'devices')
+    self.tools = fake_device_tools.WriteTools(
+        os.path.join(work_dir, 'tools'), self.state_dir, tools_config)
+    self.system_images = MakeSystemImage(
+        os.path.join(work_dir, 'system_image'), prepatched_ramdisk)
+    self.source_properties = _WriteFile(
+        os.path.join(work_dir, 'source.properties'),
+        b'androidversion.apilevel=%d\nsystemimage.abi=x86\n' % _API_LEVEL)
+    self.default_properties = _WriteFile(
+        os.path.join(work_dir, 'default.properties'),
+        b'%s=qemu2\n' % emulated_device.EMULATOR_TYPE_KEY.encode('ascii'))
+    self.empty_snapshot_fs = _SparseFile(
+        os.path.join(work_dir, 'snapshots.img'), 1 << 20)
+    self.bios = _WriteFile(os.path.join(work_dir, 'bios.bin'), b'\0' * 512)
+    self.boot_dir = os.path.join(work_dir, 'boot_output')
+    self.outputs_dir = os.path.join(work_dir, 'outputs')
+    os.makedirs(self.outputs_dir)
+    self._launches = 0
+
+  def SetFlags(self, phase, ports):
+    """Points the launcher's flags at the fixture for phase."""
+    self._launches += 1
+    FLAGS.action = phase
+    FLAGS.system_images = self.system_images
+    FLAGS.source_properties_file = self.source_properties
+    FLAGS.default_properties_file = self.default_properties
+    FLAGS.custom_emulator = self.tools[fake_device_tools.EMULATOR]
+    FLAGS.adb_turbo = self.tools[fake_device_tools.ADB]
+    FLAGS.adb = self.tools[fake_device_tools.ADB]
+    FLAGS.mksdcard = self.tools[fake_device_tools.MKSDCARD]
+    FLAGS.empty_snapshot_fs = self.empty_snapshot_fs
+    FLAGS.bios_files = [self.bios]
+    FLAGS.skin = _SKIN
+    FLAGS.density = '240'
+    FLAGS.memory = 1024
+    FLAGS.cache = '64'
+    FLAGS.vm_size = '64'
+    FLAGS.emulator_tmp_dir = os.path.join(self.work_dir,
+                                          'launch%d' % self._launches)
+    FLAGS.generate_output_dir = self.boot_dir
+    FLAGS.image_cache_dir = os.path.join(self.work_dir, 'image_cache')
+    FLAGS.tar_index_dir = os.path.join(self.work_dir, 'tar_index')
+    FLAGS.image_input_file = None
+    FLAGS.emulator_metadata_path = None
+    if phase != 'boot':
+      FLAGS.image_input_file = os.path.join(
+          self.boot_dir, unified_launcher._USERDATA_IMAGES_NAME)  # pylint: disable=protected-access
+      FLAGS.emulator_metadata_path = os.path.join(
+          self.boot_dir, unified_launcher._METADATA_FILE_NAME)  # pylint: disable=protected-access
+    FLAGS.export_launch_metadata_path = os.path.join(self.work_dir,
+                                                     'launch_metadata.pb')
+    FLAGS.adb_server_port, FLAGS.emulator_port, FLAGS.adb_port = ports
+    # start renders into a display of its own (see Display), no Xvfb.
+    FLAGS.enable_display = True
+    FLAGS.launch_in_seperate_session = True
+    FLAGS.boot_history_file = os.path.join(self.work_dir,
+                                           'boot_history.json')
+    FLAGS.process_accounting_json = None
+    os.environ['TEST_UNDECLARED_OUTPUTS_DIR'] = self.outputs_dir
+    os.environ.setdefault('DISPLAY', ':0')
+    if phase == 'boot' and os.path.isdir(self.boot_dir):
+      shutil.rmtree(self.boot_dir)
+    if phase == 'boot':
+      os.makedirs(self.boot_dir)
+
+
+def _LaunchTimers(metadata_path):
+  """Returns the launch timers the last start exported, in seconds."""
+  if not os.path.exists(metadata_path):
+    return {}
+  metadata = emulator_meta_data_pb2.EmulatorMetaDataPb()
+  with open(metadata_path, 'rb') as f:
+    metadata.ParseFromString(f.read())
+  timers = {}
+  for perf in metadata.perf_data:
+    if perf.activity_name == boot_trace.LAUNCH_ACTIVITY:
+      for timing in perf.timing:
+        timers[timing.name] = timing.accumulated_time / 1000
+  return timers
+
+
+def TimePhase(fixture, phase, iteration, ports):
+  """Runs the launcher action phase, returns its Sample."""
+  fixture.SetFlags(phase, ports)
+  registry = process_accounting.GetRegistry()
+  started = len(registry.Records())
+  if phase == 'start' and os.path.exists(FLAGS.export_launch_metadata_path):
+    os.remove(FLAGS.export_launch_metadata_path)
+  before = resource.getrusage(resource.RUSAGE_SELF)
+  before_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+  start = time.time()
+  unified_launcher.EntryPoint(reporting.NoOpReporter())
+  wall = time.time() - start
+  after = resource.getrusage(resource.RUSAGE_SELF)
+  after_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+  commands = collections.Counter(r.name for r in
+                                 registry.Records()[started:])
+  return Sample(
+      phase=phase, iteration=iteration, wall_seconds=wall,
+      cpu_seconds=(after.ru_utime - before.ru_utime +
+                   after.ru_stime - before.ru_stime),
+      child_cpu_seconds=(after_children.ru_utime - before_children.ru_utime +
+                         after_children.ru_stime - before_children.ru_stime),
+      subprocesses=sum(commands.values()), commands=dict(commands),
+      timers=(_LaunchTimers(FLAGS.export_launch_metadata_path)
+              if phase == 'start' else {}))
+
+
+def RunBenchmark(fixture, phases, iterations):
+  """Runs phases iterations times, returns the Samples."""
+  samples = []
+  if 'start' in phases and 'boot' not in phases:
+    TimePhase(fixture, 'boot', -1, (None, _FreePort(), _FreePort()))
+  for iteration in range(iterations):
+    ports = (_FreePort(), _FreePort(), _FreePort())
+    for phase in phases:
+      samples.append(TimePhase(fixture, phase, iteration, ports))
+  return samples
+
+
+def _Median(values):
+  values = sorted(values)
+  middle = len(values) // 2
+  if len(values) % 2:
+    return values[middle]
+  return (values[middle - 1] + values[middle]) / 2
+
+
+def Medians(samples):
+  """Returns {phase: {metric: median}} of the BASELINE_METRICS."""
+  medians = {}
+  for phase in set(s.phase for s in samples):
+    of_phase = [s for s in samples if s.phase == phase]
+    medians[phase] = dict(
+        (metric, _Median([getattr(s, metric) for s in of_phase]))
+        for metric in BASELINE_METRICS)
+  return medians
+
+
+def Regressions(medians, baseline, percent):
+  """Returns a message per metric worse than the baseline by over percent."""
+  regressions = []
+  for phase in sorted(medians):
+    for metric in BASELINE_METRICS:
+      old = baseline.get(phase, {}).get(metric)
+      if old is None:
+        continue
+      new = medians[phase][metric]
+      if metric.endswith('seconds') and new < _MIN_COMPARED_SECONDS:
+        continue
+      if new > old * (1 + percent / 100):
+        regressions.append('%s %s: %.3f, baseline %.3f (+%.0f%%)' % (
+            phase, metric, new, old, (new / old - 1) * 100 if old else 100))
+  return regressions
+
+
+def _PrintSamples(samples, phases):
+  print('%-8s %10s %10s %10s %10s %10s' % ('phase', 'wall s', 'p95 wall s',
+                                           'cpu s', 'child cpu s', 'spawns'))
+  for phase in phases:
+    of_phase = [s for s in samples if s.phase == phase]
+    walls = sorted(s.wall_seconds for s in of_phase)
+    print('%-8s %10.3f %10.3f %10.3f %10.3f %10.1f' % (
+        phase, _Median(walls), walls[min(len(walls) - 1,
+                                         int(len(walls) * 0.95))],
+        _Median([s.cpu_seconds for s in of_phase]),
+        _Median([s.child_cpu_seconds for s in of_phase]),
+        _Median([s.subprocesses for s in of_phase])))
+  print()
+  for phase in phases:
+    commands = collections.Counter()
+    for s in samples:
+      if s.phase == phase:
+        commands.update(s.commands)
+    print('%-8s %s' % (phase, ', '.join(
+        '%s x%.1f' % (name, count / FLAGS.iterations)
+        for name, count in commands.most_common())))
+  timers = collections.defaultdict(list)
+  for s in samples:
+    for name, seconds in s.timers.items():
+      timers[name].append(seconds)
+  if timers:
+    print('\nstart timers (median s): %s' % ', '.join(
+        '%s %.3f' % (name, seconds) for seconds, name in sorted(
+            ((_Median(v), k) for k, v in timers.items()), reverse=True)[:10]))
+
+
+def _ToolsConfig():
+  config = {
+      'adb_latency_seconds': FLAGS.adb_latency,
+      'shell_latency_seconds': FLAGS.shell_latency,
+      'install_seconds': FLAGS.install_seconds,
+      'api_level': _API_LEVEL,
+  }
+  if FLAGS.boot_progression:
+    config['boot'] = dict(
+        (stage, float(seconds)) for stage, seconds in (
+            item.split('=') for item in FLAGS.boot_progression.split(',')))
+  return config
+
+
+def main(unused_argv):
+  work_dir = FLAGS.work_dir or tempfile.mkdtemp(prefix='launcher_benchmark')
+  try:
+    fixture = Fixture(work_dir, _ToolsConfig(), FLAGS.prepatched_ramdisk)
+    try:
+      samples = RunBenchmark(fixture, FLAGS.phases, FLAGS.iterations)
+    finally:
+      # the devices a failed phase left behind.
+      fake_device_tools.KillDevices(fixture.state_dir)
+  finally:
+    if not FLAGS.work_dir:
+      shutil.rmtree(work_dir, ignore_errors=True)
+
+  _PrintSamples(samples, FLAGS.phases)
+  if FLAGS.results_file:
+    with open(FLAGS.results_file, 'w') as f:
+      json.dump([s._asdict() for s in samples], f, indent=1, sort_keys=True)
+
+  medians = Medians(samples)
+  if not FLAGS.baseline_file:
+    return
+  if FLAGS.update_baseline:
+    with open(FLAGS.baseline_file, 'w') as f:
+      json.dump(medians, f, indent=1, sort_keys=True)
+    print('\nWrote baseline %s' % FLAGS.baseline_file)
+    return
+  with open(FLAGS.baseline_file) as f:
+    baseline = json.load(f)
+  regressions = Regressions(medians, baseline, FLAGS.regression_percent)
+  if regressions:
+    print('\nRegressions against %s:' % FLAGS.baseline_file)
+    print('\n'.join(regressions))
+    sys.exit(1)
+  print('\nNo regressions against %s' % FLAGS.baseline_file)
+
+
+if __name__ == '__main__':
+  app.run(main)
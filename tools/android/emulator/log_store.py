@@ -0,0 +1,433 @@
+# Copyright 2018 The Android Open Source Project. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""An append only, size capped store for the output of subprocesses.
+
+Instead of one file per command, output is appended to numbered segments
+(segment-<N>.log). Full segments are gzip compressed and the oldest ones are
+deleted once the store exceeds its byte budget. An index.jsonl file holds one
+json object per line describing commands and where their output lives:
+
+  {"type": "env", "hash": h, "env": {...}}            each environment once
+  {"type": "start", "id": i, "argv": [...], "cwd": d, "env_hash": h,
+   "start_time": t}
+  {"type": "chunk", "id": i, "segment": n, "offset": o, "length": l}
+  {"type": "end", "id": i, "end_time": t, "exit_code": c}
+  {"type": "exit", "id": i, "exit_code": c}           if unknown at "end"
+  {"type": "drop", "segment": n}                      segment was evicted
+  {"type": "truncated", "id": i}                      replaces the chunks of
+                                                      evicted segments
+
+Several processes (the launcher and its watchdog) may write to the same
+store, writers serialize on an flock.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import contextlib
+import errno
+import fcntl
+import gzip
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import threading
+import time
+
+INDEX_NAME = 'index.jsonl'
+_LOCK_NAME = 'lock'
+_SEGMENT_RE = re.compile(r'^segment-(\d+)\.log(\.gz)?$')
+
+
+def _SegmentName(number, compressed=False):
+  return 'segment-%06d.log%s' % (number, '.gz' if compressed else '')
+
+
+def _EnvHash(env):
+  digest = hashlib.sha1()
+  for key, value in sorted(env.items()):
+    digest.update(('%s=%s\0' % (key, value)).encode('utf-8', 'replace'))
+  return digest.hexdigest()
+
+
+def _OpenAppend(path):
+  fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+  flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+  fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+  return fd
+
+
+def _WriteFully(fd, data):
+  view = memoryview(data)
+  while view:
+    try:
+      written = os.write(fd, view)
+    except OSError as e:
+      if e.errno == errno.EINTR:
+        continue
+      raise
+    view = view[written:]
+
+
+def _Unlinked(fd):
+  return os.fstat(fd).st_nlink == 0
+
+
+class LogStore(object):
+  """Writes and reads the log store in a directory."""
+
+  def __init__(self, directory, segment_bytes=8 << 20, budget_bytes=256 << 20,
+               compress=True):
+    """Opens (creating if needed) the store in directory.
+
+    Args:
+      directory: where segments and the index live.
+      segment_bytes: segments are rotated once they grow past this size.
+      budget_bytes: the oldest segments are deleted while the store (segments
+        and index) is larger than this.
+      compress: gzip rotated segments.
+    """
+    self.directory = directory
+    self.segment_bytes = segment_bytes
+    self.budget_bytes = budget_bytes
+    self.compress = compress
+    if not os.path.isdir(directory):
+      try:
+        os.makedirs(directory)
+      except OSError as e:
+        if e.errno != errno.EEXIST:
+          raise
+    self._lock = threading.Lock()
+    self._lock_fd = _OpenAppend(os.path.join(directory, _LOCK_NAME))
+    self._pid = os.getpid()
+    self._count = 0
+    self._envs_written = set()
+    self._index_fd = None
+    self._segment_fd = None
+    self._segment_number = None
+
+  def _Path(self, name):
+    return os.path.join(self.directory, name)
+
+  def _Segments(self):
+    """Returns {number: file name} of the segments on disk."""
+    segments = {}
+    for name in os.listdir(self.directory):
+      match = _SEGMENT_RE.match(name)
+      if match:
+        number = int(match.group(1))
+        # a crash between compressing and unlinking leaves both.
+        if number not in segments or not match.group(2):
+          segments[number] = name
+    return segments
+
+  @contextlib.contextmanager
+  def _Locked(self):
+    """Serializes writers within and across processes."""
+    if self._pid != os.getpid():
+      # another thread of our parent may have held the lock while forking,
+      # and flocks on the inherited file description are shared with it.
+      self._lock = threading.Lock()
+      os.close(self._lock_fd)
+      self._lock_fd = _OpenAppend(self._Path(_LOCK_NAME))
+    with self._lock:
+      fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+      try:
+        yield
+      finally:
+        fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+
+  def _EnsureOpen(self):
+    """(Re)opens the index and active segment, called with the lock held."""
+    if self._pid != os.getpid():
+      # forked, the parent keeps using the descriptors we inherited.
+      self._pid = os.getpid()
+      self._index_fd = None
+      self._segment_fd = None
+    if self._index_fd is not None and _Unlinked(self._index_fd):
+      os.close(self._index_fd)
+      self._index_fd = None
+    if self._index_fd is None:
+      self._index_fd = _OpenAppend(self._Path(INDEX_NAME))
+    if self._segment_fd is not None and _Unlinked(self._segment_fd):
+      # rotated by another writer.
+      os.close(self._segment_fd)
+      self._segment_fd = None
+    if self._segment_fd is None:
+      segments = self._Segments()
+      number = max(segments) if segments else 0
+      if number in segments and segments[number].endswith('.gz'):
+        number += 1
+      self._segment_number = number
+      self._segment_fd = _OpenAppend(self._Path(_SegmentName(number)))
+
+  def _AppendIndex(self, record):
+    _WriteFully(self._index_fd,
+                (json.dumps(record, sort_keys=True) + '\n').encode('utf-8'))
+
+  def Begin(self, argv, cwd, env):
+    """Starts logging a command, returning its LogRecord."""
+    env = dict(env or {})
+    env_hash = _EnvHash(env)
+    with self._Locked():
+      self._EnsureOpen()
+      self._count += 1
+      command_id = '%d-%d' % (os.getpid(), self._count)
+      if env_hash not in self._envs_written:
+        self._envs_written.add(env_hash)
+        self._AppendIndex({'type': 'env', 'hash': env_hash, 'env': env})
+      self._AppendIndex({'type': 'start', 'id': command_id,
+                         'argv': list(argv), 'cwd': cwd,
+                         'env_hash': env_hash, 'start_time': time.time()})
+    return LogRecord(self, command_id)
+
+  def Append(self, command_id, data):
+    """Appends output of a command."""
+    if not data:
+      return
+    with self._Locked():
+      self._EnsureOpen()
+      if os.fstat(self._segment_fd).st_size >= self.segment_bytes:
+        self._Rotate()
+      _WriteFully(self._segment_fd, data)
+      # O_APPEND leaves the offset at the end of our write.
+      end = os.lseek(self._segment_fd, 0, os.SEEK_CUR)
+      self._AppendIndex({'type': 'chunk', 'id': command_id,
+                         'segment': self._segment_number,
+                         'offset': end - len(data), 'length': len(data)})
+
+  def Log(self, record):
+    """Appends a record to the index."""
+    with self._Locked():
+      self._EnsureOpen()
+      self._AppendIndex(record)
+
+  def _Rotate(self):
+    """Seals the active segment and enforces the budget, lock held."""
+    sealed = self._segment_number
+    os.close(self._segment_fd)
+    self._segment_fd = None
+    if self.compress:
+      path = self._Path(_SegmentName(sealed))
+      tmp_path = path + '.gz.tmp'
+      with open(path, 'rb') as src:
+        with gzip.GzipFile(tmp_path, 'wb', compresslevel=1) as dst:
+          shutil.copyfileobj(src, dst)
+      os.rename(tmp_path, self._Path(_SegmentName(sealed, compressed=True)))
+      os.unlink(path)
+    self._segment_number = sealed + 1
+    self._segment_fd = _OpenAppend(self._Path(_SegmentName(sealed + 1)))
+    self._EnforceBudget()
+
+  def _EnforceBudget(self):
+    segments = self._Segments()
+    sizes = dict((n, os.path.getsize(self._Path(name)))
+                 for n, name in segments.items())
+    total = sum(sizes.values()) + os.fstat(self._index_fd).st_size
+    dropped = set()
+    for number in sorted(segments):
+      if total <= self.budget_bytes or number == self._segment_number:
+        break
+      os.unlink(self._Path(segments[number]))
+      total -= sizes[number]
+      dropped.add(number)
+      self._AppendIndex({'type': 'drop', 'segment': number})
+    if dropped:
+      self._CompactIndex()
+
+  def _CompactIndex(self):
+    """Rewrites the index without chunks of dropped segments, lock held."""
+    dropped = set()
+    kept = []
+    with open(self._Path(INDEX_NAME), 'rb') as f:
+      lines = f.readlines()
+    records = [json.loads(line) for line in lines if line.strip()]
+    for record in records:
+      if record['type'] == 'drop':
+        dropped.add(record['segment'])
+    truncated = set()
+    for line, record in zip([l for l in lines if l.strip()], records):
+      if record['type'] == 'chunk' and record['segment'] in dropped:
+        if record['id'] not in truncated:
+          truncated.add(record['id'])
+          kept.append((json.dumps({'type': 'truncated', 'id': record['id']},
+                                  sort_keys=True) + '\n').encode('utf-8'))
+        continue
+      kept.append(line)
+    tmp_path = self._Path(INDEX_NAME + '.tmp')
+    with open(tmp_path, 'wb') as f:
+      f.writelines(kept)
+    os.rename(tmp_path, self._Path(INDEX_NAME))
+    os.close(self._index_fd)
+    self._index_fd = _OpenAppend(self._Path(INDEX_NAME))
+
+  def Close(self):
+    for fd in (self._segment_fd, self._index_fd, self._lock_fd):
+      if fd is not None:
+        os.close(fd)
+    self._segment_fd = self._index_fd = self._lock_fd = None
+
+  # Reader API.
+
+  def _ReadIndex(self):
+    with open(self._Path(INDEX_NAME), 'rb') as f:
+      for line in f:
+        if line.strip():
+          yield json.loads(line.decode('utf-8'))
+
+  def Commands(self):
+    """Returns a list of dicts describing each command, in start order.
+
+    Each dict has the keys of its start record plus end_time, exit_code,
+    bytes (output bytes logged) and truncated (output was evicted).
+    """
+    commands = {}
+    order = []
+    dropped = set()
+    for record in self._ReadIndex():
+      kind = record['type']
+      if kind == 'start':
+        command = dict(record, end_time=None, exit_code=None, bytes=0,
+                       truncated=False)
+        del command['type']
+        commands[record['id']] = command
+        order.append(record['id'])
+      elif kind == 'drop':
+        dropped.add(record['segment'])
+      elif record.get('id') in commands:
+        command = commands[record['id']]
+        if kind == 'chunk':
+          command['bytes'] += record['length']
+          command.setdefault('_segments', set()).add(record['segment'])
+        elif kind == 'end':
+          command['end_time'] = record['end_time']
+          if record['exit_code'] is not None:
+            command['exit_code'] = record['exit_code']
+        elif kind == 'exit':
+          command['exit_code'] = record['exit_code']
+        elif kind == 'truncated':
+          command['truncated'] = True
+    result = []
+    for command_id in order:
+      command = commands[command_id]
+      segments = command.pop('_segments', set())
+      command['truncated'] = command['truncated'] or bool(segments & dropped)
+      result.append(command)
+    return result
+
+  def Environment(self, env_hash):
+    """Returns the environment with the given hash, or None."""
+    for record in self._ReadIndex():
+      if record['type'] == 'env' and record['hash'] == env_hash:
+        return record['env']
+    return None
+
+  def ReadOutput(self, command_id):
+    """Returns the (interleaved stdout and stderr) output of a command.
+
+    Output in evicted segments is skipped.
+    """
+    chunks = [r for r in self._ReadIndex()
+              if r['type'] == 'chunk' and r['id'] == command_id]
+    segments = self._Segments()
+    output = []
+    decompressed = {}
+    for chunk in chunks:
+      name = segments.get(chunk['segment'])
+      if name is None:
+        continue
+      offset, length = chunk['offset'], chunk['length']
+      if name.endswith('.gz'):
+        if name not in decompressed:
+          with gzip.open(self._Path(name), 'rb') as f:
+            decompressed[name] = f.read()
+        output.append(decompressed[name][offset:offset + length])
+      else:
+        with open(self._Path(name), 'rb') as f:
+          f.seek(offset)
+          output.append(f.read(length))
+    return b''.join(output)
+
+
+class LogRecord(object):
+  """The log of one command, shared by its output streams.
+
+  Supports the Write / Release interface of the logs common's tee streams
+  write to.
+  """
+
+  def __init__(self, store, command_id, users=2):
+    self.store = store
+    self.command_id = command_id
+    self.task = None
+    self._users = users
+    self._lock = threading.Lock()
+    self._exit_logged = False
+    self._ended = False
+
+  @property
+  def name(self):
+    return '%s#%s' % (self.store.directory, self.command_id)
+
+  def Write(self, data):
+    try:
+      self.store.Append(self.command_id, data)
+    except (IOError, OSError) as e:
+      # losing logs must not break the command.
+      logging.warning('Cannot write to log store %s: %s', self.name, e)
+
+  def Release(self):
+    """Called by each stream once it is done, the last one ends the record."""
+    with self._lock:
+      self._users -= 1
+      if self._users:
+        return
+      exit_code = self.task.poll() if self.task is not None else None
+      self._ended = True
+      self._exit_logged = exit_code is not None
+    self._Log({'type': 'end', 'id': self.command_id,
+               'end_time': time.time(), 'exit_code': exit_code})
+
+  def Finish(self, exit_code):
+    """Records the exit code if the end record could not."""
+    with self._lock:
+      if not self._ended or self._exit_logged:
+        return
+      self._exit_logged = True
+    self._Log({'type': 'exit', 'id': self.command_id,
+               'exit_code': exit_code})
+
+  def _Log(self, record):
+    try:
+      self.store.Log(record)
+    except (IOError, OSError) as e:
+      # Release runs on the output pump thread, which must keep going.
+      logging.warning('Cannot write to log store %s: %s', self.name, e)
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def GetLogStore(directory, **kwargs):
+  """Returns the process wide LogStore for directory."""
+  with _stores_lock:
+    if directory not in _stores:
+      _stores[directory] = LogStore(directory, **kwargs)
+    return _stores[directory]
@@ -0,0 +1,128 @@
+# Copyright 2018 The Android Open Source Project. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for tools.android.emulator.log_store."""
+
+import os
+import shutil
+import tempfile
+
+from google.apputils import basetest as googletest
+from tools.android.emulator import log_store
+
+
+class LogStoreTest(googletest.TestCase):
+
+  def setUp(self):
+    super(LogStoreTest, self).setUp()
+    self.directory = tempfile.mkdtemp()
+
+  def tearDown(self):
+    super(LogStoreTest, self).tearDown()
+    shutil.rmtree(self.directory)
+
+  def _Run(self, store, argv, chunks, exit_code=0):
+    record = store.Begin(argv, '/cwd', {'A': 'b'})
+    for chunk in chunks:
+      record.Write(chunk)
+    record.Release()
+    record.Release()
+    record.Finish(exit_code)
+    return record.command_id
+
+  def testRoundTrip(self):
+    store = log_store.LogStore(self.directory)
+    first = self._Run(store, ['/bin/a', '1'], [b'hello ', b'world\n'])
+    second = self._Run(store, ['/bin/b'], [b'other'], exit_code=3)
+
+    self.assertEquals(b'hello world\n', store.ReadOutput(first))
+    self.assertEquals(b'other', store.ReadOutput(second))
+    commands = store.Commands()
+    self.assertEquals([['/bin/a', '1'], ['/bin/b']],
+                      [c['argv'] for c in commands])
+    self.assertEquals([0, 3], [c['exit_code'] for c in commands])
+    self.assertEquals([12, 5], [c['bytes'] for c in commands])
+    self.assertEquals('/cwd', commands[0]['cwd'])
+    self.assertEquals({'A': 'b'}, store.Environment(commands[0]['env_hash']))
+    # the environment is only written once.
+    with open(os.path.join(self.directory, log_store.INDEX_NAME)) as f:
+      self.assertEquals(1, f.read().count('"type": "env"'))
+
+  def testInterleavedCommands(self):
+    store = log_store.LogStore(self.directory)
+    a = store.Begin(['a'], '/', {})
+    b = store.Begin(['b'], '/', {})
+    a.Write(b'a1')
+    b.Write(b'b1')
+    a.Write(b'a2')
+    self.assertEquals(b'a1a2', store.ReadOutput(a.command_id))
+    self.assertEquals(b'b1', store.ReadOutput(b.command_id))
+
+  def testEndRecordErrorsAreLogged(self):
+    store = log_store.LogStore(self.directory)
+    record = store.Begin(['a'], '/', {})
+
+    def FailingLog(unused_record):
+      raise OSError(28, 'No space left on device')
+
+    store.Log = FailingLog
+    record.Release()
+    record.Release()
+    record.Finish(0)
+
+  def testRotationCompresses(self):
+    store = log_store.LogStore(self.directory, segment_bytes=10)
+    command_id = self._Run(store, ['a'], [b'0123456789', b'abcdefghij', b'x'])
+    names = sorted(os.listdir(self.directory))
+    self.assertIn('segment-000000.log.gz', names)
+    self.assertIn('segment-000001.log.gz', names)
+    self.assertIn('segment-000002.log', names)
+    self.assertEquals(b'0123456789abcdefghijx', store.ReadOutput(command_id))
+
+  def testBudgetEvictsOldestSegments(self):
+    store = log_store.LogStore(self.directory, segment_bytes=1000,
+                               budget_bytes=3000, compress=False)
+    old = self._Run(store, ['old'], [b'o' * 1000])
+    new = self._Run(store, ['new'], [b'n' * 1000] * 4)
+    self.assertNotIn('segment-000000.log', os.listdir(self.directory))
+    commands = dict((c['argv'][0], c) for c in store.Commands())
+    self.assertTrue(commands['old']['truncated'])
+    self.assertEquals(b'', store.ReadOutput(old))
+    self.assertTrue(store.ReadOutput(new).startswith(b'n'))
+    total = sum(os.path.getsize(os.path.join(self.directory, n))
+                for n in os.listdir(self.directory))
+    # the budget is enforced on rotation, the active segment may fill first.
+    self.assertLess(total, 3000 + 2 * 1000)
+
+  def testSharedBetweenProcesses(self):
+    store = log_store.LogStore(self.directory, segment_bytes=100)
+    pid = os.fork()
+    if not pid:
+      for i in range(50):
+        self._Run(store, ['child'], [b'c' * 10 + b'%d' % i])
+      os._exit(0)  # pylint: disable=protected-access
+    for i in range(50):
+      self._Run(store, ['parent'], [b'p' * 10 + b'%d' % i])
+    self.assertEquals((pid, 0), os.waitpid(pid, 0))
+
+    reader = log_store.LogStore(self.directory)
+    commands = reader.Commands()
+    self.assertEquals(100, len(commands))
+    for command in commands:
+      output = reader.ReadOutput(command['id'])
+      self.assertEquals(command['argv'][0][0] * 10, output[:10].decode())
+
+
+if __name__ == '__main__':
+  googletest.main()
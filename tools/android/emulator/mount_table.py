@@ -0,0 +1,171 @@
+# Copyright 2018 The Android Open Source Project. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A short lived cache of the device's mount table.
+
+The output of `mount` is parsed into MountEntry tuples, from either format:
+
+  /dev/block/vdb /cache ext4 rw,nosuid,nodev 0 0          (toolbox)
+  /dev/block/vdb on /cache type ext4 (rw,nosuid,nodev)    (toybox)
+
+and kept for a few seconds, so the checks of one boot poll iteration share
+one `mount`. Commands which change mounts (mount with arguments, umount,
+start, stop) are passed to NoteCommand, which drops the cache. Callers which
+run `mount` themselves, e.g. batched after an umount, hand its output to
+Update.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import re
+import threading
+import time
+
+MountEntry = collections.namedtuple('MountEntry',
+                                    ['device', 'mount_point', 'fstype',
+                                     'options'])
+
+_TOYBOX_RE = re.compile(r'^(\S+) on (\S+) type (\S+) \((.*)\)$')
+_INVALIDATING_COMMAND_RE = re.compile(
+    r'(?:^|[;&|(]\s*)(?:mount\s+[^\s;&|]|umount\b|start\b|stop\b)')
+
+
+def ParseMounts(output):
+  """Returns the MountEntry tuples in the output of mount, in order."""
+  entries = []
+  for line in output.splitlines():
+    line = line.strip()
+    match = _TOYBOX_RE.match(line)
+    if match:
+      device, mount_point, fstype, options = match.groups()
+    else:
+      fields = line.split()
+      if len(fields) < 4:
+        continue
+      device, mount_point, fstype, options = fields[:4]
+    entries.append(MountEntry(device, mount_point, fstype,
+                              tuple(options.split(','))))
+  return entries
+
+
+class MountTable(object):
+  """Caches the device's mounts for ttl_seconds.
+
+  Counters() tells how many times mount was run and how many reads the cache
+  served.
+  """
+
+  def __init__(self, exec_on_device, ttl_seconds=2.0, clock=time.time):
+    """Constructor.
+
+    Args:
+      exec_on_device: runs a command (a list of args) on the device and returns
+        its stdout.
+      ttl_seconds: how long the mounts are served from the cache.
+      clock: the time source.
+    """
+    self._exec_on_device = exec_on_device
+    self._ttl_seconds = ttl_seconds
+    self._clock = clock
+    self._lock = threading.Lock()
+    self._output = None
+    self._entries = None
+    self._fetch_time = None
+    self._counters = dict.fromkeys(['fetches', 'updates', 'hits',
+                                    'invalidations'], 0)
+
+  def Entries(self):
+    """Returns the MountEntry tuples, in mount order."""
+    with self._lock:
+      if (self._fetch_time is not None and
+          0 <= self._clock() - self._fetch_time < self._ttl_seconds):
+        self._counters['hits'] += 1
+        return list(self._entries)
+    output = self._exec_on_device(['mount'])
+    with self._lock:
+      self._counters['fetches'] += 1
+      self._Set(output)
+      return list(self._entries)
+
+  def Output(self):
+    """Returns the text of the mount table, for logging."""
+    self.Entries()
+    with self._lock:
+      return self._output
+
+  def Find(self, mount_point):
+    """Returns the MountEntry mounted at mount_point, or None.
+
+    Of several mounts at the same point, the last one shadows the others.
+    """
+    found = None
+    for entry in self.Entries():
+      if entry.mount_point == mount_point:
+        found = entry
+    return found
+
+  def IsMounted(self, path):
+    """Whether something is mounted at or below path, or path is mounted.
+
+    A path which is mounted elsewhere (the source of a bind or fuse mount)
+    counts as mounted.
+    """
+    below = path.rstrip('/') + '/'
+    for entry in self.Entries():
+      if (entry.mount_point == path or entry.device == path or
+          entry.mount_point.startswith(below)):
+        return True
+    return False
+
+  def IsReadOnly(self, mount_point):
+    """Whether mount_point is mounted read only, None if it is not mounted."""
+    entry = self.Find(mount_point)
+    if not entry:
+      return None
+    return 'ro' in entry.options
+
+  def FsType(self, mount_point):
+    """The filesystem type of mount_point, None if it is not mounted."""
+    entry = self.Find(mount_point)
+    return entry.fstype if entry else None
+
+  def Update(self, output):
+    """Replaces the cache with output, of a mount the caller ran."""
+    with self._lock:
+      self._counters['updates'] += 1
+      self._Set(output)
+
+  def Invalidate(self):
+    """Drops the cached mounts."""
+    with self._lock:
+      self._counters['invalidations'] += 1
+      self._fetch_time = None
+
+  def NoteCommand(self, commandline):
+    """Drops the cache if commandline may change mounts."""
+    if _INVALIDATING_COMMAND_RE.search(commandline):
+      self.Invalidate()
+
+  def Counters(self):
+    """Returns a copy of the counters."""
+    with self._lock:
+      return dict(self._counters)
+
+  def _Set(self, output):
+    self._output = output
+    self._entries = ParseMounts(output)
+    self._fetch_time = self._clock()
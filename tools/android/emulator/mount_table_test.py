@@ -0,0 +1,116 @@
+# Copyright 2018 The Android Open Source Project. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for tools.android.emulator.mount_table."""
+
+from google.apputils import basetest as googletest
+from tools.android.emulator import mount_table
+
+TOOLBOX_MOUNTS = """rootfs / rootfs ro,relatime 0 0
+tmpfs /dev tmpfs rw,nosuid,relatime,mode=755 0 0
+/dev/block/vda /system ext4 ro,relatime,data=ordered 0 0
+/dev/block/vdb /cache ext4 rw,nosuid,nodev,noatime 0 0
+/dev/block/vdc /data ext4 rw,nosuid,nodev,noatime 0 0
+/dev/fuse /storage/emulated/legacy fuse rw,nosuid,nodev,relatime 0 0
+"""
+
+TOYBOX_MOUNTS = """/dev/root on / type ext4 (ro,seclabel,relatime)
+/dev/block/vdc on /data type ext4 (rw,seclabel,nosuid,nodev,noatime)
+/data/media on /mnt/runtime/default/emulated type sdcardfs (rw,nosuid)
+/dev/block/vdb on /cache type ext4 (ro,seclabel,nosuid,nodev)
+"""
+
+
+class FakeDevice(object):
+
+  def __init__(self, output):
+    self.output = output
+    self.commands = 0
+
+  def ExecOnDevice(self, args):
+    assert args == ['mount'], args
+    self.commands += 1
+    return self.output
+
+
+class MountTableTest(googletest.TestCase):
+
+  def setUp(self):
+    super(MountTableTest, self).setUp()
+    self.now = [100.0]
+    self.device = FakeDevice(TOOLBOX_MOUNTS)
+    self.mounts = mount_table.MountTable(
+        self.device.ExecOnDevice, ttl_seconds=2, clock=lambda: self.now[0])
+
+  def testParseMounts(self):
+    entries = mount_table.ParseMounts(TOOLBOX_MOUNTS)
+    self.assertEquals(6, len(entries))
+    self.assertEquals(
+        mount_table.MountEntry('/dev/block/vdb', '/cache', 'ext4',
+                               ('rw', 'nosuid', 'nodev', 'noatime')),
+        entries[3])
+    entries = mount_table.ParseMounts(TOYBOX_MOUNTS)
+    self.assertEquals(
+        mount_table.MountEntry('/dev/block/vdb', '/cache', 'ext4',
+                               ('ro', 'seclabel', 'nosuid', 'nodev')),
+        entries[3])
+
+  def testHelpers(self):
+    self.assertTrue(self.mounts.IsMounted('/data'))
+    self.assertTrue(self.mounts.IsMounted('/storage'))
+    self.assertFalse(self.mounts.IsMounted('/sdcard'))
+    self.assertFalse(self.mounts.IsMounted('/dat'))
+    self.assertTrue(self.mounts.IsReadOnly('/system'))
+    self.assertFalse(self.mounts.IsReadOnly('/data'))
+    self.assertIsNone(self.mounts.IsReadOnly('/sdcard'))
+    self.assertEquals('fuse', self.mounts.FsType('/storage/emulated/legacy'))
+    self.assertIsNone(self.mounts.FsType('/storage'))
+    # all of them from one mount.
+    self.assertEquals(1, self.device.commands)
+
+    self.device.output = TOYBOX_MOUNTS
+    self.mounts.Invalidate()
+    self.assertTrue(self.mounts.IsReadOnly('/cache'))
+    self.assertTrue(self.mounts.IsMounted('/data/media'))
+    self.assertEquals(2, self.device.commands)
+
+  def testExpiresAndInvalidates(self):
+    self.mounts.Entries()
+    self.now[0] += 1
+    self.mounts.Entries()
+    self.assertEquals(1, self.device.commands)
+    self.now[0] += 1
+    self.mounts.Entries()
+    self.assertEquals(2, self.device.commands)
+
+    for command in ['umount /data', 'mount -o ro,remount /system', 'stop']:
+      self.mounts.NoteCommand(command)
+      self.mounts.Entries()
+    self.assertEquals(5, self.device.commands)
+    for command in ['mount', 'mount || true', 'getprop']:
+      self.mounts.NoteCommand(command)
+      self.mounts.Entries()
+    self.assertEquals(5, self.device.commands)
+
+  def testUpdate(self):
+    self.mounts.NoteCommand('umount /cache')
+    self.mounts.Update(TOYBOX_MOUNTS)
+    self.assertEquals('sdcardfs',
+                      self.mounts.FsType('/mnt/runtime/default/emulated'))
+    self.assertEquals(0, self.device.commands)
+    self.assertTrue(self.mounts.Output().startswith('/dev/root on /'))
+
+
+if __name__ == '__main__':
+  googletest.main()
@@ -0,0 +1,246 @@
+# Copyright 2018 The Android Open Source Project. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Resource accounting of the subprocesses the launcher starts.
+
+process_backend registers every process it creates with the registry and
+completes the record with the resource usage os.wait4 reports when the
+process is reaped. common adds the bytes logged and the retry number.
+
+The registry can be queried in process (Records, Summary) and is written as
+json to --process_accounting_json when the launcher exits:
+
+  {"records": [{"command": [...], "name": "adb shell", "wall_seconds": ...,
+                "user_seconds": ..., "sys_seconds": ..., "max_rss_kb": ...,
+                "log_bytes": ..., "retries": ..., "exit_status": ...}, ...],
+   "summary": [{"name": "adb shell", "count": ..., ...}, ...]}
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import atexit
+import json
+import os
+import threading
+import time
+
+from absl import flags
+from absl import logging
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string('process_accounting_json',
+                    os.path.join(os.environ['TEST_UNDECLARED_OUTPUTS_DIR'],
+                                 'process_accounting.json')
+                    if os.environ.get('TEST_UNDECLARED_OUTPUTS_DIR') else None,
+                    'Where the resource usage of every subprocess is written '
+                    'when the launcher exits. Nothing is written if empty.')
+
+# adb is one binary with many commands, they are accounted for separately.
+_MULTI_COMMAND_TOOLS = frozenset(['adb'])
+
+
+def CommandName(args):
+  """Returns the name a command is accounted under.
+
+  The basename of the binary, followed by the subcommand for tools such as
+  adb ('adb shell', 'adb push').
+
+  Args:
+    args: the command line, a list or a shell string.
+
+  Returns:
+    A short name for the command.
+  """
+  if not isinstance(args, (list, tuple)):
+    args = args.split()
+  if not args:
+    return ''
+  name = os.path.basename(args[0])
+  if name in _MULTI_COMMAND_TOOLS:
+    rest = iter(args[1:])
+    for arg in rest:
+      if arg in ('-s', '-H', '-P', '-L'):
+        next(rest, None)
+      elif not arg.startswith('-'):
+        return '%s %s' % (name, arg)
+  return name
+
+
+class ProcessRecord(object):
+  """The resources used by one subprocess.
+
+  Attributes:
+    command: the command line.
+    name: the name the command is accounted under, see CommandName.
+    pid: the process id.
+    start_time: when the process was created.
+    end_time: when it was reaped, None while it runs.
+    exit_status: the returncode, None while it runs.
+    user_seconds: user cpu time, None if unknown.
+    sys_seconds: system cpu time, None if unknown.
+    max_rss_kb: peak resident set size, None if unknown.
+    log_bytes: output written to the command log.
+    retries: the number of attempts before this one.
+  """
+
+  def __init__(self, command, pid, start_time):
+    self.command = list(command) if isinstance(command, (list, tuple)) else [
+        command]
+    self.name = CommandName(command)
+    self.pid = pid
+    self.start_time = start_time
+    self.end_time = None
+    self.exit_status = None
+    self.user_seconds = None
+    self.sys_seconds = None
+    self.max_rss_kb = None
+    self.log_bytes = 0
+    self.retries = 0
+
+  @property
+  def wall_seconds(self):
+    if self.end_time is None:
+      return None
+    return self.end_time - self.start_time
+
+  def Finish(self, exit_status, rusage, end_time):
+    """Completes the record once the process was reaped.
+
+    Args:
+      exit_status: the returncode of the process.
+      rusage: [optional] the resource usage returned by os.wait4.
+      end_time: when the process was reaped.
+    """
+    if self.end_time is not None:
+      return
+    self.end_time = end_time
+    self.exit_status = exit_status
+    if rusage is not None:
+      self.user_seconds = rusage.ru_utime
+      self.sys_seconds = rusage.ru_stime
+      self.max_rss_kb = rusage.ru_maxrss
+
+  def ToDict(self):
+    return {
+        'command': self.command,
+        'name': self.name,
+        'pid': self.pid,
+        'start_time': self.start_time,
+        'wall_seconds': self.wall_seconds,
+        'user_seconds': self.user_seconds,
+        'sys_seconds': self.sys_seconds,
+        'max_rss_kb': self.max_rss_kb,
+        'log_bytes': self.log_bytes,
+        'retries': self.retries,
+        'exit_status': self.exit_status,
+    }
+
+
+class Registry(object):
+  """Holds a ProcessRecord for every subprocess started."""
+
+  def __init__(self, clock=time.time):
+    self._clock = clock
+    self._records = []
+    self._lock = threading.Lock()
+
+  def Start(self, command, pid):
+    """Registers a process which was just created, returns its record."""
+    record = ProcessRecord(command, pid, self._clock())
+    with self._lock:
+      self._records.append(record)
+    return record
+
+  def Finish(self, record, exit_status, rusage=None):
+    record.Finish(exit_status, rusage, self._clock())
+
+  def Records(self, name=None):
+    """Returns the records, optionally only those accounted under name."""
+    with self._lock:
+      records = list(self._records)
+    if name is not None:
+      records = [r for r in records if r.name == name]
+    return records
+
+  def Summary(self):
+    """Totals per command name, the most wall time first.
+
+    Returns:
+      A list of dicts with the name, count, failures (non zero exits),
+      running (not yet reaped), retries, wall_seconds, user_seconds,
+      sys_seconds, log_bytes and the largest max_rss_kb of the commands.
+    """
+    totals = {}
+    for record in self.Records():
+      total = totals.setdefault(record.name, {
+          'name': record.name, 'count': 0, 'failures': 0, 'running': 0,
+          'retries': 0, 'wall_seconds': 0.0, 'user_seconds': 0.0,
+          'sys_seconds': 0.0, 'max_rss_kb': 0, 'log_bytes': 0})
+      total['count'] += 1
+      total['retries'] += record.retries
+      total['log_bytes'] += record.log_bytes
+      if record.end_time is None:
+        total['running'] += 1
+        continue
+      if record.exit_status:
+        total['failures'] += 1
+      total['wall_seconds'] += record.wall_seconds
+      total['user_seconds'] += record.user_seconds or 0
+      total['sys_seconds'] += record.sys_seconds or 0
+      total['max_rss_kb'] = max(total['max_rss_kb'], record.max_rss_kb or 0)
+    return sorted(totals.values(), key=lambda t: -t['wall_seconds'])
+
+  def Dump(self, path):
+    """Writes the records and the summary to path as json."""
+    with open(path, 'w') as f:
+      json.dump({'records': [r.ToDict() for r in self.Records()],
+                 'summary': self.Summary()}, f, indent=1, sort_keys=True)
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def GetRegistry():
+  """Returns the process wide Registry, dumped at exit."""
+  global _registry
+  with _registry_lock:
+    if _registry is None:
+      _registry = Registry()
+      atexit.register(_DumpAtExit, _registry, os.getpid())
+    return _registry
+
+
+def _DumpAtExit(registry, owner_pid):
+  # forked children (eg the emulator watchdog) must not replace our dump.
+  if os.getpid() != owner_pid:
+    return
+  try:
+    path = FLAGS.process_accounting_json
+  except flags.UnparsedFlagAccessError:
+    return
+  if not path:
+    return
+  try:
+    registry.Dump(path)
+  except (IOError, OSError) as e:
+    logging.warning('Cannot write process accounting to %s: %s', path, e)
+    return
+  for total in registry.Summary()[:10]:
+    logging.info('%-24s x%-4d wall %8.2fs cpu %8.2fs', total['name'],
+                 total['count'], total['wall_seconds'],
+                 total['user_seconds'] + total['sys_seconds'])
@@ -0,0 +1,126 @@
+# Copyright 2018 The Android Open Source Project. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for tools.android.emulator.process_accounting."""
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+from google.apputils import basetest as googletest
+from tools.android.emulator import process_accounting
+from tools.android.emulator import process_backend
+
+
+class FakeUsage(object):
+
+  def __init__(self, utime, stime, maxrss):
+    self.ru_utime = utime
+    self.ru_stime = stime
+    self.ru_maxrss = maxrss
+
+
+class ProcessAccountingTest(googletest.TestCase):
+
+  def testCommandName(self):
+    self.assertEquals('tar', process_accounting.CommandName(
+        ['/bin/tar', '-xzf', 'a.tar.gz']))
+    self.assertEquals('adb shell', process_accounting.CommandName(
+        ['/x/adb', '-s', 'localhost:5555', 'shell', 'getprop']))
+    self.assertEquals('lsof', process_accounting.CommandName('lsof -ni:5555'))
+
+  def testSummary(self):
+    now = [100.0]
+    registry = process_accounting.Registry(clock=lambda: now[0])
+    first = registry.Start(['adb', 'shell', 'ls'], 1)
+    second = registry.Start(['adb', 'shell', 'ps'], 2)
+    tar = registry.Start(['tar', '-x'], 3)
+    running = registry.Start(['sleep', '10'], 4)
+    now[0] = 101.0
+    registry.Finish(first, 0, FakeUsage(0.5, 0.25, 1000))
+    second.retries = 1
+    second.log_bytes = 10
+    now[0] = 103.0
+    registry.Finish(second, 1, FakeUsage(0.5, 0.25, 3000))
+    now[0] = 110.0
+    registry.Finish(tar, 0)
+
+    self.assertEquals(3.0, second.wall_seconds)
+    self.assertIsNone(running.wall_seconds)
+    self.assertEquals([first, second], registry.Records('adb shell'))
+    summary = registry.Summary()
+    self.assertEquals(['tar', 'adb shell', 'sleep'],
+                      [s['name'] for s in summary])
+    adb = summary[1]
+    self.assertEquals(2, adb['count'])
+    self.assertEquals(1, adb['failures'])
+    self.assertEquals(1, adb['retries'])
+    self.assertEquals(10, adb['log_bytes'])
+    self.assertEquals(4.0, adb['wall_seconds'])
+    self.assertEquals(1.0, adb['user_seconds'])
+    self.assertEquals(3000, adb['max_rss_kb'])
+    self.assertEquals(1, summary[2]['running'])
+
+    path = tempfile.NamedTemporaryFile(delete=False).name
+    registry.Dump(path)
+    with open(path) as f:
+      dumped = json.load(f)
+    os.unlink(path)
+    self.assertEquals(4, len(dumped['records']))
+    self.assertEquals(['adb', 'shell', 'ls'], dumped['records'][0]['command'])
+    self.assertEquals(summary, dumped['summary'])
+
+  def testBackendsAccountWithWait4(self):
+    busy = ['/bin/sh', '-c', 'i=0; while [ $i -lt 20000 ]; do i=$((i+1)); '
+            'done; exit 2']
+    for backend in ['popen', 'posix_spawn', 'fork_server']:
+      proc = process_backend.Popen(busy, backend=backend,
+                                   stdout=subprocess.PIPE)
+      proc.communicate()
+      record = proc.accounting
+      self.assertIn(record, process_accounting.GetRegistry().Records('sh'))
+      self.assertEquals(2, record.exit_status, backend)
+      self.assertEquals(proc.pid, record.pid)
+      self.assertGreater(record.wall_seconds, 0)
+      self.assertGreater(record.user_seconds + record.sys_seconds, 0, backend)
+      self.assertGreater(record.max_rss_kb, 0, backend)
+
+  def testPollAccounts(self):
+    proc = process_backend.Popen(['true'], backend='popen')
+    while proc.poll() is None:
+      pass
+    self.assertEquals(0, proc.accounting.exit_status)
+    self.assertIsNotNone(proc.accounting.max_rss_kb)
+
+  def testWaitAccounts(self):
+    proc = process_backend.Popen(['sleep', '0.2'], backend='popen')
+    if sys.version_info[0] >= 3:
+      self.assertRaises(subprocess.TimeoutExpired, proc.wait, 0.01)
+      self.assertIsNone(proc.accounting.exit_status)
+      self.assertEquals(0, proc.wait(5))
+    else:
+      self.assertEquals(0, proc.wait())
+    self.assertEquals(0, proc.accounting.exit_status)
+    self.assertIsNotNone(proc.accounting.max_rss_kb)
+
+  def testCheckOutput(self):
+    self.assertEquals(b'hi\n', process_backend.CheckOutput(['echo', 'hi']))
+    self.assertRaises(subprocess.CalledProcessError,
+                      process_backend.CheckCall, ['false'])
+
+
+if __name__ == '__main__':
+  googletest.main()
@@ -0,0 +1,659 @@
+# Copyright 2018 The Android Open Source Project. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Switchable process creation for the launcher's hot spawn paths.
+
+subprocess.Popen forks the whole launcher, whose address space holds
+protobufs, crypto libraries and large buffers, so every adb call pays for
+copying its page tables. This module can instead create processes with
+os.posix_spawn, or ask a small fork server (a fresh interpreter started
+once) to fork and exec on our behalf when setup such as a working directory
+or a new session is needed.
+
+Popen() returns a subprocess.Popen for the 'popen' backend and an object
+with the same basic interface (pid, stdin, stdout, stderr, returncode, poll,
+wait, communicate, send_signal, terminate, kill) otherwise. Either way
+processes are reaped with os.wait4 and recorded in the
+process_accounting registry, their record is the accounting attribute.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import errno
+import fcntl
+import json
+import os
+import select
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+
+from absl import flags
+from absl import logging
+
+from tools.android.emulator import process_accounting
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_enum('spawn_backend', 'popen',
+                  ['popen', 'posix_spawn', 'fork_server'],
+                  'How subprocesses are created. popen forks the launcher. '
+                  'posix_spawn uses os.posix_spawn when possible and the '
+                  'fork server otherwise. fork_server always asks a small '
+                  'pre-started process to fork and exec.')
+
+# Popen arguments the other backends understand, anything else falls back to
+# subprocess.Popen.
+_SUPPORTED_KWARGS = frozenset(['stdin', 'stdout', 'stderr', 'env', 'cwd',
+                               'close_fds', 'start_new_session'])
+
+_DEVNULL = getattr(subprocess, 'DEVNULL', -3)
+
+_READ_SIZE = 64 << 10
+_PIPE_BUF = getattr(select, 'PIPE_BUF', 512)
+
+_MAXFD = getattr(subprocess, 'MAXFD', None) or os.sysconf('SC_OPEN_MAX')
+
+# The process which imported this module. Forked children (eg the emulator
+# watchdog) must be the parent of what they spawn, they never use the server.
+_owner_pid = os.getpid()
+
+
+# The fields of os.wait4's resource usage the fork server reports.
+_Usage = collections.namedtuple('_Usage', ['ru_utime', 'ru_stime',
+                                           'ru_maxrss'])
+
+
+def _SetCloseOnExec(fd):
+  flags_ = fcntl.fcntl(fd, fcntl.F_GETFD)
+  fcntl.fcntl(fd, fcntl.F_SETFD, flags_ | fcntl.FD_CLOEXEC)
+
+
+def _ReturnCode(status):
+  if os.WIFSIGNALED(status):
+    return -os.WTERMSIG(status)
+  return os.WEXITSTATUS(status)
+
+
+def _CanPosixSpawn(cwd, start_new_session):
+  if not hasattr(os, 'posix_spawnp'):
+    return False
+  if start_new_session and not hasattr(os, 'POSIX_SPAWN_SETSID'):
+    return False
+  return not cwd or os.path.realpath(cwd) == os.path.realpath(os.getcwd())
+
+
+def Popen(args, backend=None, **kwargs):
+  """Creates a process with the configured backend.
+
+  Args:
+    args: the command line, args[0] is looked up on PATH.
+    backend: [optional] overrides --spawn_backend.
+    **kwargs: subprocess.Popen arguments.
+
+  Returns:
+    A subprocess.Popen or a Popen-like object.
+
+  Raises:
+    OSError: if the command could not be executed.
+  """
+  backend = backend or FLAGS.spawn_backend
+  if backend == 'popen' or not set(kwargs).issubset(_SUPPORTED_KWARGS):
+    return _AccountedPopen(args, **kwargs)
+
+  cwd = kwargs.get('cwd')
+  start_new_session = kwargs.get('start_new_session', False)
+  if backend == 'posix_spawn' and _CanPosixSpawn(cwd, start_new_session):
+    return _PosixSpawnProcess(args, **kwargs)
+  server = GetForkServer()
+  if server:
+    return server.Spawn(args, **kwargs)
+  return _AccountedPopen(args, **kwargs)
+
+
+def CheckCall(args, **kwargs):
+  """subprocess.check_call, creating the process with Popen()."""
+  returncode = Popen(args, **kwargs).wait()
+  if returncode:
+    raise subprocess.CalledProcessError(returncode, args)
+  return 0
+
+
+def CheckOutput(args, **kwargs):
+  """subprocess.check_output, creating the process with Popen()."""
+  proc = Popen(args, stdout=subprocess.PIPE, **kwargs)
+  output, _ = proc.communicate()
+  if proc.returncode:
+    raise subprocess.CalledProcessError(proc.returncode, args, output=output)
+  return output
+
+
+def _Wait4(pid, options):
+  """os.wait4, retried on EINTR. Returns (pid, status, rusage)."""
+  while True:
+    try:
+      return os.wait4(pid, options)
+    except OSError as e:
+      if e.errno != errno.EINTR:
+        raise
+
+
+def _StartAccounting(proc, args):
+  proc.accounting = process_accounting.GetRegistry().Start(args, proc.pid)
+
+
+def _FinishAccounting(proc, rusage):
+  if getattr(proc, 'accounting', None):
+    process_accounting.GetRegistry().Finish(proc.accounting, proc.returncode,
+                                            rusage)
+
+
+class _AccountedPopen(subprocess.Popen):
+  """subprocess.Popen which reaps with os.wait4 to account for the child.
+
+  poll() and wait() reap the child themselves and set returncode. Popen's
+  own reaping, through private methods whose signatures change between
+  python versions, is only left to Popen.__del__ at interpreter exit, when
+  the child is reaped unaccounted.
+  """
+
+  def __init__(self, args, **kwargs):
+    # poll() from one thread must not reap while wait() does in another.
+    self._reap_lock = threading.Lock()
+    super(_AccountedPopen, self).__init__(args, **kwargs)
+    _StartAccounting(self, args)
+
+  def _Reap(self, block):
+    """Sets returncode if the child exited, waiting for it if block."""
+    try:
+      pid, status, rusage = _Wait4(self.pid, 0 if block else os.WNOHANG)
+    except OSError as e:
+      if e.errno != errno.ECHILD:
+        raise
+      # reaped by someone else, status is lost.
+      pid, status, rusage = self.pid, 0, None
+    if pid == self.pid:
+      self.returncode = _ReturnCode(status)
+      _FinishAccounting(self, rusage)
+
+  def poll(self):
+    if self.returncode is None and self._reap_lock.acquire(False):
+      try:
+        if self.returncode is None:
+          self._Reap(block=False)
+      finally:
+        self._reap_lock.release()
+    return self.returncode
+
+  def wait(self, timeout=None):  # pylint: disable=arguments-differ
+    """Waits for the child, like Popen.wait (timeout is python 3 only)."""
+    if timeout is None:
+      with self._reap_lock:
+        while self.returncode is None:
+          self._Reap(block=True)
+      return self.returncode
+    deadline = time.time() + timeout
+    delay = 0.0005
+    while self.poll() is None:
+      remaining = deadline - time.time()
+      if remaining <= 0:
+        raise subprocess.TimeoutExpired(self.args, timeout)  # pylint: disable=no-member
+      time.sleep(min(delay, remaining))
+      delay = min(delay * 2, 0.05)
+    return self.returncode
+
+
+class _Stdio(object):
+  """Maps Popen stdin/stdout/stderr arguments to child and parent fds."""
+
+  def __init__(self, stdin, stdout, stderr):
+    # fds to become the child's 0, 1 and 2 (None: inherit ours).
+    self.child_fds = [None, None, None]
+    self.parent_files = [None, None, None]
+    self.stderr_to_stdout = False
+    self._to_close = []
+    for target, spec in enumerate((stdin, stdout, stderr)):
+      if spec is None:
+        continue
+      if spec == subprocess.PIPE:
+        read_fd, write_fd = os.pipe()
+        _SetCloseOnExec(read_fd)
+        _SetCloseOnExec(write_fd)
+        if target == 0:
+          child_fd, parent_fd, mode = read_fd, write_fd, 'wb'
+        else:
+          child_fd, parent_fd, mode = write_fd, read_fd, 'rb'
+        self.parent_files[target] = os.fdopen(parent_fd, mode)
+        self._to_close.append(child_fd)
+      elif target == 2 and spec == subprocess.STDOUT:
+        # the child's stdout, once it has been redirected.
+        child_fd = 1
+        self.stderr_to_stdout = True
+      elif spec == _DEVNULL:
+        child_fd = os.open(os.devnull, os.O_RDWR)
+        _SetCloseOnExec(child_fd)
+        self._to_close.append(child_fd)
+      elif isinstance(spec, int):
+        child_fd = spec
+      else:
+        child_fd = spec.fileno()
+      self.child_fds[target] = child_fd
+
+  def CloseChildEnds(self):
+    for fd in self._to_close:
+      os.close(fd)
+    self._to_close = []
+
+  def CloseParentEnds(self):
+    for f in self.parent_files:
+      if f:
+        f.close()
+
+
+class _Process(object):
+  """The Popen-like part shared by the posix_spawn and fork server backends."""
+
+  def __init__(self, args, stdio):
+    self.args = args
+    self.pid = None
+    self.returncode = None
+    self.stdin, self.stdout, self.stderr = stdio.parent_files
+
+  def _Reap(self, block):
+    """Sets returncode if the process exited, waiting for it if block."""
+    raise NotImplementedError()
+
+  def _Exited(self, status, rusage):
+    self.returncode = _ReturnCode(status)
+    _FinishAccounting(self, rusage)
+
+  def poll(self):
+    if self.returncode is None:
+      self._Reap(block=False)
+    return self.returncode
+
+  def wait(self):
+    while self.returncode is None:
+      self._Reap(block=True)
+    return self.returncode
+
+  def send_signal(self, sig):
+    if self.poll() is None:
+      try:
+        os.kill(self.pid, sig)
+      except OSError as e:
+        if e.errno != errno.ESRCH:
+          raise
+
+  def terminate(self):
+    self.send_signal(signal.SIGTERM)
+
+  def kill(self):
+    self.send_signal(signal.SIGKILL)
+
+  def communicate(self, input=None):  # pylint: disable=redefined-builtin
+    """Writes input to stdin, reads stdout and stderr until EOF and waits.
+
+    Args:
+      input: data to write to stdin, which is closed afterwards.
+
+    Returns:
+      A pair (stdout, stderr), None for streams that are not pipes.
+    """
+    outputs = dict((f, []) for f in (self.stdout, self.stderr) if f)
+    PumpPipes(self.stdin, input,
+              [(f, chunks.append) for f, chunks in outputs.items()])
+    self.wait()
+    return tuple(b''.join(outputs[f]) if f in outputs else None
+                 for f in (self.stdout, self.stderr))
+
+
+def PumpPipes(stdin, data, readers):
+  """Feeds data to stdin while draining output pipes until they close.
+
+  Args:
+    stdin: [optional] a pipe file to write data to, closed once written.
+    data: [optional] the data to write.
+    readers: a list of (pipe file, f(chunk)) of outputs to drain, each chunk
+      read is given to its f. The pipes are closed at EOF.
+  """
+  poller = select.poll()
+  files = {}
+  if stdin:
+    if data:
+      fd = stdin.fileno()
+      files[fd] = (stdin, memoryview(data), None)
+      poller.register(fd, select.POLLOUT)
+    else:
+      stdin.close()
+  for f, sink in readers:
+    files[f.fileno()] = (f, None, sink)
+    poller.register(f.fileno(), select.POLLIN)
+
+  while files:
+    try:
+      events = poller.poll()
+    except (IOError, OSError, select.error) as e:
+      if e.args[0] == errno.EINTR:
+        continue
+      raise
+    for fd, _ in events:
+      f, pending_input, sink = files[fd]
+      if pending_input is not None:
+        try:
+          # POLLOUT promises room for PIPE_BUF bytes without blocking.
+          written = os.write(fd, pending_input[:_PIPE_BUF])
+        except OSError as e:
+          if e.errno != errno.EPIPE:
+            raise
+          written = len(pending_input)
+        pending_input = pending_input[written:]
+        if len(pending_input):
+          files[fd] = (f, pending_input, None)
+          continue
+      else:
+        chunk = os.read(fd, _READ_SIZE)
+        if chunk:
+          sink(chunk)
+          continue
+      poller.unregister(fd)
+      del files[fd]
+      f.close()
+
+
+class _PosixSpawnProcess(_Process):
+  """A child created with os.posix_spawnp."""
+
+  def __init__(self, args, stdin=None, stdout=None, stderr=None, env=None,
+               cwd=None, close_fds=True, start_new_session=False):
+    del cwd, close_fds  # cwd is the current directory, fds are CLOEXEC.
+    stdio = _Stdio(stdin, stdout, stderr)
+    super(_PosixSpawnProcess, self).__init__(args, stdio)
+    file_actions = [(os.POSIX_SPAWN_DUP2, fd, target)
+                    for target, fd in enumerate(stdio.child_fds)
+                    if fd is not None]
+    kwargs = {}
+    if start_new_session:
+      kwargs['setsid'] = True
+    try:
+      self.pid = os.posix_spawnp(
+          args[0], args, os.environ if env is None else env,
+          file_actions=file_actions, **kwargs)
+    except:
+      stdio.CloseParentEnds()
+      raise
+    finally:
+      stdio.CloseChildEnds()
+    _StartAccounting(self, args)
+
+  def _Reap(self, block):
+    try:
+      pid, status, rusage = _Wait4(self.pid, 0 if block else os.WNOHANG)
+    except OSError as e:
+      if e.errno != errno.ECHILD:
+        raise
+      # reaped by someone else, status is lost.
+      pid, status, rusage = self.pid, 0, None
+    if pid == self.pid:
+      self._Exited(status, rusage)
+
+
+class _ForkServerProcess(_Process):
+  """A child of the fork server, its exit status arrives on a socket."""
+
+  def __init__(self, args, stdio, status_sock):
+    super(_ForkServerProcess, self).__init__(args, stdio)
+    self._status_sock = status_sock
+    self._buffer = b''
+    kind, values = self._ReadMessage(block=True)
+    if kind == 'error':
+      stdio.CloseParentEnds()
+      self._status_sock.close()
+      raise OSError(values[0], '%s: %s' % (os.strerror(values[0]), args[0]))
+    self.pid = values[0]
+    _StartAccounting(self, args)
+
+  def _ReadMessage(self, block):
+    """Returns the next (kind, [int]) from the server or None."""
+    while b'\n' not in self._buffer:
+      if not block:
+        readable, _, _ = select.select([self._status_sock], [], [], 0)
+        if not readable:
+          return None
+      data = self._status_sock.recv(128)
+      if not data:
+        raise OSError(errno.EPIPE, 'fork server went away')
+      self._buffer += data
+    line, self._buffer = self._buffer.split(b'\n', 1)
+    fields = line.decode('ascii').split()
+    return fields[0], [int(f) for f in fields[1:]]
+
+  def _Reap(self, block):
+    message = self._ReadMessage(block)
+    if message:
+      status, utime_us, stime_us, maxrss = message[1]
+      self._status_sock.close()
+      self._Exited(status, _Usage(utime_us / 1e6, stime_us / 1e6, maxrss))
+
+
+def _SendFd(sock, fd):
+  # multiprocessing knows how to pass fds over unix sockets on python 2 and 3.
+  from multiprocessing import reduction  # pylint: disable=g-import-not-at-top
+  reduction.send_handle(sock, fd, None)
+
+
+def _RecvFd(sock):
+  from multiprocessing import reduction  # pylint: disable=g-import-not-at-top
+  return reduction.recv_handle(sock)
+
+
+class ForkServer(object):
+  """Client of a fork server process.
+
+  Each request sends the command as length prefixed json followed by the
+  child's stdin, stdout, stderr (ours for inherited ones) and a socket on
+  which the server replies 'pid <n>' or 'error <errno>' and later
+  'exit <wait status> <user cpu us> <sys cpu us> <max rss kb>'.
+  """
+
+  def __init__(self):
+    parent_sock, child_sock = socket.socketpair(socket.AF_UNIX,
+                                                socket.SOCK_STREAM)
+    _SetCloseOnExec(parent_sock.fileno())
+    script = os.path.abspath(__file__)
+    if script.endswith('.pyc'):
+      script = script[:-1]
+    # The control socket becomes the server's stdin, close_fds hides the rest.
+    self._server = subprocess.Popen(
+        [sys.executable, script, '--fork_server'],
+        stdin=child_sock.fileno(), close_fds=True)
+    child_sock.close()
+    self._sock = parent_sock
+    self._lock = threading.Lock()
+
+  @property
+  def pid(self):
+    return self._server.pid
+
+  def Spawn(self, args, stdin=None, stdout=None, stderr=None, env=None,
+            cwd=None, close_fds=True, start_new_session=False):
+    """Forks and execs args in the server, returning a Popen-like object."""
+    del close_fds  # the server always closes everything but stdio.
+    stdio = _Stdio(stdin, stdout, stderr)
+    status_sock, server_status_sock = socket.socketpair(socket.AF_UNIX,
+                                                        socket.SOCK_STREAM)
+    request = json.dumps({
+        'args': list(args),
+        'env': dict(os.environ if env is None else env),
+        'cwd': cwd,
+        'setsid': bool(start_new_session),
+    }).encode('utf-8')
+    fds = [target if fd is None else fd
+           for target, fd in enumerate(stdio.child_fds)]
+    if stdio.stderr_to_stdout:
+      fds[2] = fds[1]
+    try:
+      with self._lock:
+        self._sock.sendall(struct.pack('!I', len(request)) + request)
+        for fd in fds:
+          _SendFd(self._sock, fd)
+        _SendFd(self._sock, server_status_sock.fileno())
+    except:
+      stdio.CloseParentEnds()
+      status_sock.close()
+      raise
+    finally:
+      server_status_sock.close()
+      stdio.CloseChildEnds()
+    return _ForkServerProcess(args, stdio, status_sock)
+
+  def Close(self):
+    self._sock.close()
+    self._server.wait()
+
+
+_fork_server = None
+_fork_server_lock = threading.Lock()
+
+
+def GetForkServer():
+  """Returns the process wide ForkServer, None in forked children."""
+  global _fork_server
+  if os.getpid() != _owner_pid:
+    return None
+  with _fork_server_lock:
+    if _fork_server is None:
+      _fork_server = ForkServer()
+      logging.info('Started fork server %s', _fork_server.pid)
+    return _fork_server
+
+
+def _RecvExactly(sock, size):
+  data = b''
+  while len(data) < size:
+    chunk = sock.recv(size - len(data))
+    if not chunk:
+      return None
+    data += chunk
+  return data
+
+
+def _ForkAndExec(request, fds, status_sock):
+  """Forks the child described by request, returning its pid."""
+  error_read, error_write = os.pipe()
+  _SetCloseOnExec(error_write)
+  pid = os.fork()
+  if pid == 0:
+    try:
+      os.close(error_read)
+      if request['setsid']:
+        os.setsid()
+      if request['cwd']:
+        os.chdir(request['cwd'])
+      for target, fd in enumerate(fds):
+        os.dup2(fd, target)
+      os.closerange(3, error_write)
+      os.closerange(error_write + 1, _MAXFD)
+      os.execvpe(request['args'][0], request['args'], request['env'])
+    except OSError as e:
+      os.write(error_write, str(e.errno or errno.ENOEXEC).encode('ascii'))
+    finally:
+      os._exit(255)  # pylint: disable=protected-access
+  os.close(error_write)
+  error = b''
+  while True:
+    chunk = os.read(error_read, 16)
+    if not chunk:
+      break
+    error += chunk
+  os.close(error_read)
+  if error:
+    os.waitpid(pid, 0)
+    status_sock.sendall(b'error ' + error + b'\n')
+    status_sock.close()
+    return None
+  status_sock.sendall(b'pid %d\n' % pid)
+  return pid
+
+
+def _ServeForkRequests(control):
+  """The fork server loop, returns once the launcher closes control."""
+  wake_read, wake_write = os.pipe()
+  for fd in (wake_read, wake_write):
+    fcntl.fcntl(fd, fcntl.F_SETFL,
+                fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+    _SetCloseOnExec(fd)
+  signal.signal(signal.SIGCHLD, lambda unused_sig, unused_frame: None)
+  signal.set_wakeup_fd(wake_write)
+
+  children = {}
+  while True:
+    try:
+      readable, _, _ = select.select([control, wake_read], [], [])
+    except (IOError, OSError, select.error) as e:
+      if e.args[0] == errno.EINTR:
+        continue
+      raise
+    if wake_read in readable:
+      try:
+        os.read(wake_read, 512)
+      except OSError:
+        pass
+    while children:
+      try:
+        pid, status, rusage = os.wait4(-1, os.WNOHANG)
+      except OSError:
+        break
+      if not pid:
+        break
+      status_sock = children.pop(pid, None)
+      if status_sock:
+        try:
+          status_sock.sendall(b'exit %d %d %d %d\n' % (
+              status, int(rusage.ru_utime * 1e6), int(rusage.ru_stime * 1e6),
+              rusage.ru_maxrss))
+        except (IOError, OSError):
+          pass
+        status_sock.close()
+    if control in readable:
+      header = _RecvExactly(control, 4)
+      if header is None:
+        return
+      request = json.loads(_RecvExactly(control, struct.unpack('!I',
+                                                               header)[0]))
+      fds = [_RecvFd(control) for _ in range(3)]
+      status_fd = _RecvFd(control)
+      status_sock = socket.fromfd(status_fd, socket.AF_UNIX,
+                                  socket.SOCK_STREAM)
+      os.close(status_fd)
+      try:
+        pid = _ForkAndExec(request, fds, status_sock)
+      finally:
+        for fd in fds:
+          os.close(fd)
+      if pid:
+        children[pid] = status_sock
+
+
+if __name__ == '__main__':
+  if sys.argv[1:] == ['--fork_server']:
+    _ServeForkRequests(socket.fromfd(0, socket.AF_UNIX, socket.SOCK_STREAM))
+    sys.exit(0)
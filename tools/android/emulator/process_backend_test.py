@@ -0,0 +1,90 @@
+# Copyright 2018 The Android Open Source Project. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for tools.android.emulator.process_backend, using real processes."""
+
+import os
+import signal
+import subprocess
+import tempfile
+
+from google.apputils import basetest as googletest
+from tools.android.emulator import process_backend
+
+
+class ProcessBackendTest(googletest.TestCase):
+
+  def _Backends(self):
+    return ['popen', 'posix_spawn', 'fork_server']
+
+  def testCommunicate(self):
+    for backend in self._Backends():
+      proc = process_backend.Popen(
+          ['/bin/sh', '-c', 'cat; echo err >&2; exit 3'],
+          backend=backend, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+          stderr=subprocess.PIPE)
+      out, err = proc.communicate(b'x' * 100000)
+      self.assertEquals(100000, len(out), backend)
+      self.assertEquals(b'err\n', err, backend)
+      self.assertEquals(3, proc.returncode, backend)
+
+  def testStderrToStdoutAndEnv(self):
+    for backend in self._Backends():
+      proc = process_backend.Popen(
+          ['/bin/sh', '-c', 'echo $FOO; echo err >&2'],
+          backend=backend, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+          env={'FOO': 'bar', 'PATH': os.environ['PATH']})
+      out, err = proc.communicate()
+      self.assertEquals(b'bar\nerr\n', out, backend)
+      self.assertIsNone(err)
+
+  def testCwdAndFileOutput(self):
+    cwd = tempfile.mkdtemp()
+    for backend in self._Backends():
+      with tempfile.TemporaryFile() as output:
+        proc = process_backend.Popen(['pwd'], backend=backend, stdout=output,
+                                     cwd=cwd)
+        self.assertEquals(0, proc.wait())
+        output.seek(0)
+        self.assertEquals(os.path.realpath(cwd),
+                          os.path.realpath(output.read().strip().decode()))
+    os.rmdir(cwd)
+
+  def testKill(self):
+    for backend in self._Backends():
+      proc = process_backend.Popen(['sleep', '100'], backend=backend)
+      self.assertIsNone(proc.poll())
+      proc.kill()
+      self.assertEquals(-signal.SIGKILL, proc.wait(), backend)
+
+  def testMissingBinary(self):
+    for backend in self._Backends():
+      self.assertRaises(OSError, process_backend.Popen,
+                        ['/does/not/exist'], backend=backend)
+
+  def testUnsupportedArgumentsUsePopen(self):
+    proc = process_backend.Popen(['true'], backend='fork_server',
+                                 preexec_fn=lambda: None)
+    self.assertIsInstance(proc, subprocess.Popen)
+    proc.wait()
+
+  def testForkServerNotUsedInForkedChild(self):
+    pid = os.fork()
+    if not pid:
+      os._exit(0 if process_backend.GetForkServer() is None else 1)  # pylint: disable=protected-access
+    self.assertEquals((pid, 0), os.waitpid(pid, 0))
+
+
+if __name__ == '__main__':
+  googletest.main()
@@ -0,0 +1,187 @@
+# Copyright 2018 The Android Open Source Project. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""The device's process list, parsed from ps and indexed.
+
+Both ps flavours put the name last and USER PID PPID VSIZE (VSZ) RSS first:
+
+  USER     PID   PPID  VSIZE  RSS     WCHAN    PC         NAME        (toolbox)
+  root      1     0     8904   776   c02ced7f 0805d2c6 S /init
+  USER           PID  PPID     VSZ    RSS WCHAN            ADDR S NAME (toybox)
+  root             1     0   18092   2400 SyS_epoll_wait      0 S init
+
+Toolbox has a state column its header does not name, so the leading columns
+are taken by their header position and the name from the end of the line.
+
+ProcessTableCache keeps a ProcessTable for a few seconds, so the checks of
+one boot poll iteration share one ps.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import os
+import re
+import threading
+import time
+
+ProcessRecord = collections.namedtuple('ProcessRecord',
+                                       ['user', 'pid', 'ppid', 'vsize', 'rss',
+                                        'name'])
+
+_LEADING_COLUMNS = {
+    'USER': 'user',
+    'PID': 'pid',
+    'PPID': 'ppid',
+    'VSIZE': 'vsize',
+    'VSZ': 'vsize',
+    'RSS': 'rss',
+}
+_INT_FIELDS = ('pid', 'ppid', 'vsize', 'rss')
+# commands which start or end processes.
+_INVALIDATING_COMMAND_RE = re.compile(
+    r'(?:^|[;&|(]\s*)(?:kill|start|stop|am|setprop)\b')
+
+
+class ProcessTable(object):
+  """A snapshot of the device's processes, indexed by name, pid and ppid."""
+
+  def __init__(self, records, output=''):
+    self.output = output
+    self._records = list(records)
+    self._by_pid = {}
+    self._by_name = collections.defaultdict(list)
+    self._by_ppid = collections.defaultdict(list)
+    for record in self._records:
+      self._by_pid[record.pid] = record
+      self._by_name[record.name].append(record)
+      base_name = os.path.basename(record.name)
+      if base_name != record.name:
+        self._by_name[base_name].append(record)
+      self._by_ppid[record.ppid].append(record)
+
+  def Records(self):
+    """Returns the processes, in the order of ps."""
+    return list(self._records)
+
+  def Get(self, pid):
+    """Returns the process with pid, or None."""
+    return self._by_pid.get(pid)
+
+  def Named(self, name):
+    """Returns the processes called name, or whose path ends in name."""
+    return list(self._by_name.get(name, ()))
+
+  def IsRunning(self, name):
+    """Whether a process called name (see Named) is running."""
+    return bool(self._by_name.get(name))
+
+  def Children(self, pid):
+    """Returns the processes whose parent is pid."""
+    return list(self._by_ppid.get(pid, ()))
+
+  def NameContains(self, fragments):
+    """Returns the processes whose name contains any of fragments."""
+    return [r for r in self._records
+            if [f for f in fragments if f in r.name]]
+
+
+def ParsePs(output):
+  """Returns the ProcessTable of the output of ps."""
+  lines = [line for line in output.splitlines() if line.strip()]
+  if not lines:
+    return ProcessTable([], output)
+  header = lines[0].split()
+  positions = dict((_LEADING_COLUMNS[column], i)
+                   for i, column in enumerate(header)
+                   if column in _LEADING_COLUMNS)
+  records = []
+  for line in lines[1:]:
+    fields = line.split()
+    if len(fields) <= max(positions.values() or [0]):
+      continue
+    values = dict((key, fields[i]) for key, i in positions.items())
+    try:
+      for key in _INT_FIELDS:
+        values[key] = int(values.get(key, 0))
+    except ValueError:
+      continue
+    records.append(ProcessRecord(user=values.get('user', ''),
+                                 name=fields[-1],
+                                 **dict((k, values[k]) for k in _INT_FIELDS)))
+  return ProcessTable(records, output)
+
+
+class ProcessTableCache(object):
+  """Caches the device's ProcessTable for ttl_seconds.
+
+  Counters() tells how many times ps was run and how many reads the cache
+  served.
+  """
+
+  def __init__(self, exec_on_device, ps_command=('ps',), ttl_seconds=2.0,
+               clock=time.time):
+    """Constructor.
+
+    Args:
+      exec_on_device: runs a command (a list of args) on the device and returns
+        its stdout.
+      ps_command: the command which lists every process, or a function
+        returning it.
+      ttl_seconds: how long the table is served from the cache.
+      clock: the time source.
+    """
+    self._exec_on_device = exec_on_device
+    self._ps_command = ps_command
+    self._ttl_seconds = ttl_seconds
+    self._clock = clock
+    self._lock = threading.Lock()
+    self._table = None
+    self._fetch_time = None
+    self._counters = dict.fromkeys(['fetches', 'hits', 'invalidations'], 0)
+
+  def Get(self):
+    """Returns the ProcessTable, running ps if the cached one is stale."""
+    with self._lock:
+      if (self._fetch_time is not None and
+          0 <= self._clock() - self._fetch_time < self._ttl_seconds):
+        self._counters['hits'] += 1
+        return self._table
+    ps_command = self._ps_command
+    if callable(ps_command):
+      ps_command = ps_command()
+    table = ParsePs(self._exec_on_device(list(ps_command)))
+    with self._lock:
+      self._counters['fetches'] += 1
+      self._table = table
+      self._fetch_time = self._clock()
+      return table
+
+  def Invalidate(self):
+    """Drops the cached table."""
+    with self._lock:
+      self._counters['invalidations'] += 1
+      self._fetch_time = None
+
+  def NoteCommand(self, commandline):
+    """Drops the cache if commandline may start or end processes."""
+    if _INVALIDATING_COMMAND_RE.search(commandline):
+      self.Invalidate()
+
+  def Counters(self):
+    """Returns a copy of the counters."""
+    with self._lock:
+      return dict(self._counters)
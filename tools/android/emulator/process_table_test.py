@@ -0,0 +1,92 @@
+# Copyright 2018 The Android Open Source Project. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for tools.android.emulator.process_table."""
+
+from google.apputils import basetest as googletest
+from tools.android.emulator import process_table
+
+TOOLBOX_PS = """USER     PID   PPID  VSIZE  RSS     WCHAN    PC         NAME
+root      1     0     8904   776   c02ced7f 0805d2c6 S /init
+root      2     0     0      0     c024d2a5 00000000 S kthreadd
+system    1234  1100  1066624 97712 ffffffff b76e6b75 S system_server
+root      1500  1     4800   300   c02ced7f 0805d2c6 S /data/local/tmp/pipe_traversal
+root      1501  1500  9000   900   c02ced7f 0805d2c6 S app_process
+u0_a20    1600  1100  700000 50000 ffffffff b76e6b75 S com.android.launcher3
+"""
+
+TOYBOX_PS = """USER           PID  PPID     VSZ    RSS WCHAN            ADDR S NAME
+root             1     0   18092   2400 SyS_epoll_wait      0 S init
+root             2     0       0      0 kthreadd            0 S [kthreadd]
+system        1700   900 1234567 120000 SyS_epoll_wait      0 S system_server
+shell         2000  1999   10000   3000 0                   0 R ps
+"""
+
+
+class ProcessTableTest(googletest.TestCase):
+
+  def testParseToolbox(self):
+    table = process_table.ParsePs(TOOLBOX_PS)
+    self.assertEquals(6, len(table.Records()))
+    self.assertEquals(
+        process_table.ProcessRecord('system', 1234, 1100, 1066624, 97712,
+                                    'system_server'),
+        table.Get(1234))
+    self.assertTrue(table.IsRunning('system_server'))
+    self.assertFalse(table.IsRunning('system'))
+    self.assertEquals([1500], [p.pid for p in table.Named('pipe_traversal')])
+    self.assertEquals([1501], [p.pid for p in table.Children(1500)])
+    self.assertEquals([1600], [p.pid for p in table.NameContains(
+        ['com.android.launcher', 'com.android.tv'])])
+    self.assertEquals(0, table.Get(2).vsize)
+
+  def testParseToybox(self):
+    table = process_table.ParsePs(TOYBOX_PS)
+    self.assertEquals(4, len(table.Records()))
+    self.assertEquals('[kthreadd]', table.Get(2).name)
+    self.assertEquals(900, table.Named('system_server')[0].ppid)
+    self.assertEquals('shell', table.Get(2000).user)
+
+  def testParseGarbage(self):
+    self.assertEquals([], process_table.ParsePs('').Records())
+    self.assertEquals([], process_table.ParsePs(
+        'USER PID PPID NAME\nerror: permission denied\n').Records())
+
+  def testCache(self):
+    now = [100.0]
+    commands = []
+
+    def ExecOnDevice(args):
+      commands.append(args)
+      return TOOLBOX_PS
+
+    cache = process_table.ProcessTableCache(
+        ExecOnDevice, ps_command=lambda: ['ps', '-A'], ttl_seconds=2,
+        clock=lambda: now[0])
+    self.assertIs(cache.Get(), cache.Get())
+    self.assertEquals([['ps', '-A']], commands)
+    for command in ['kill -9 1501', 'am start -a X', 'stop', 'setprop a b']:
+      cache.NoteCommand(command)
+      cache.Get()
+    self.assertEquals(5, len(commands))
+    cache.NoteCommand('pm path android')
+    cache.Get()
+    now[0] += 2
+    cache.Get()
+    self.assertEquals(6, len(commands))
+    self.assertEquals(6, cache.Counters()['fetches'])
+
+
+if __name__ == '__main__':
+  googletest.main()
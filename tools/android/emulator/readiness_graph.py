@@ -0,0 +1,379 @@
+# Copyright 2018 The Android Open Source Project. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Runs readiness checks as a graph of steps, independent ones concurrently.
+
+A Step is a check retried until it passes, with the steps it depends on:
+
+  graph = ReadinessGraph([
+      Step('system_server', CheckSystemServer),
+      Step('package_manager', CheckPm, deps=['system_server']),
+      Step('boot_completed', CheckBootProp, deps=['system_server']),
+      Step('launcher', CheckLauncher,
+           deps=['package_manager', 'boot_completed']),
+  ], stopwatch, sleep_interval=1)
+  graph.Run(deadline)
+
+Every step whose dependencies passed is attempted in a thread of its own, so
+package_manager and boot_completed above are polled side by side. Monitors
+run between the rounds of the scheduler once the step they follow passed.
+A step fails the whole graph by raising, by returning a message from its
+failure policy or when it runs out of time; Run then stops the other steps
+and raises. Timeline() tells when each step started, passed and how many
+attempts it took.
+
+Code called by the checks tells by InStep() that it runs on a step thread. It
+must not tear down what the other steps use there, but raise, and leave that
+to the thread calling Run once the steps stopped.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import threading
+import time
+
+from absl import logging
+
+# How long Run waits for the steps still attempting, after the graph failed.
+_STOP_SECONDS = 10
+# The name of the thread attempting a step.
+THREAD_NAME_FORMAT = 'readiness-%s'
+
+PASSED = 'passed'
+SKIPPED = 'skipped'
+FAILED = 'failed'
+STOPPED = 'stopped'
+
+_local = threading.local()
+
+StepTiming = collections.namedtuple('StepTiming',
+                                    ['name', 'start', 'end', 'attempts',
+                                     'outcome'])
+
+
+class ReadinessError(Exception):
+  """The graph could not pass all its steps."""
+
+  def __init__(self, message, step=None):
+    super(ReadinessError, self).__init__(message)
+    self.step = step
+
+
+class StepFailedError(ReadinessError):
+  """A step's failure policy gave up on it."""
+
+
+class DeadlineExceededError(ReadinessError):
+  """The graph ran out of time or attempts."""
+
+
+def InStep():
+  """Whether the calling thread is attempting a step of a ReadinessGraph."""
+  return getattr(_local, 'step', None) is not None
+
+
+class Step(object):
+  """A readiness check and how it is retried."""
+
+  def __init__(self, name, check_fn, deps=(), check_tag=None, sleep_tag=None,
+               enabled=None, before_attempt=None, failure_policy=None,
+               on_pass=None, sleep_after_failure=None, timeout_seconds=None,
+               details=None):
+    """Constructor.
+
+    Args:
+      name: names the step in deps, the timeline and errors.
+      check_fn: returns whether the step passed, may raise to fail the graph.
+      deps: names of the steps which have to pass first.
+      check_tag: the stopwatch tag check_fn is charged to.
+      sleep_tag: the stopwatch tag the sleep after a failed check is charged
+        to.
+      enabled: [optional] called once the deps passed, the step is skipped if
+        it returns False.
+      before_attempt: [optional] called with the number of failed attempts
+        before each attempt.
+      failure_policy: [optional] called with the number of failed attempts
+        after each failed attempt. Returns a message to fail the graph with,
+        or None to retry.
+      on_pass: [optional] called once the step passed, before its dependents
+        start.
+      sleep_after_failure: [optional] called before an attempt, returns
+        whether to sleep if it fails. For checks which wait by themselves.
+      timeout_seconds: [optional] fails the graph if the step does not pass
+        this long after its first attempt.
+      details: logged before each attempt.
+    """
+    self.name = name
+    self.check_fn = check_fn
+    self.deps = tuple(deps)
+    self.check_tag = check_tag or name
+    self.sleep_tag = sleep_tag or '%s_FAIL_SLEEP' % self.check_tag
+    self.enabled = enabled
+    self.before_attempt = before_attempt
+    self.failure_policy = failure_policy
+    self.on_pass = on_pass
+    self.sleep_after_failure = sleep_after_failure
+    self.timeout_seconds = timeout_seconds
+    self.details = details or 'Checking %s.' % name
+
+
+class _Monitor(object):
+
+  def __init__(self, fn, after):
+    self.fn = fn
+    self.after = after
+
+
+class ReadinessGraph(object):
+  """Runs Steps in dependency order, each as soon as it can."""
+
+  def __init__(self, steps, stopwatch=None, sleep_interval=1, poller=None,
+               clock=time.time):
+    """Constructor.
+
+    Args:
+      steps: the Steps, in any order.
+      stopwatch: [optional] a stopwatch.StopWatch the checks and sleeps are
+        charged to. Concurrent steps overlap, so other timers keep running.
+      sleep_interval: the pause between the attempts of a step.
+      poller: [optional] a boot_history.AdaptivePoller to pace the attempts.
+      clock: the time source of the timeline.
+
+    Raises:
+      ValueError: if a step depends on a step which is not in the graph, or
+        the steps depend on each other in a cycle.
+    """
+    self._steps = collections.OrderedDict((s.name, s) for s in steps)
+    self._stopwatch = stopwatch
+    self._sleep_interval = sleep_interval
+    self._poller = poller
+    self._clock = clock
+    self._monitors = []
+    self._condition = threading.Condition()
+    self._stop = threading.Event()
+    self._stopwatch_lock = threading.Lock()
+    self._threads = {}
+    self._attempts = collections.defaultdict(int)
+    self._start = {}
+    self._end = {}
+    self._outcome = {}
+    self._error = None
+    for step in self._steps.values():
+      for dep in step.deps:
+        if dep not in self._steps:
+          raise ValueError('%s depends on unknown step %s' % (step.name, dep))
+    self._CheckAcyclic()
+
+  def _CheckAcyclic(self):
+    visiting, visited = set(), set()
+
+    def Visit(name, path):
+      if name in visited:
+        return
+      if name in visiting:
+        raise ValueError('Steps depend on each other: %s' %
+                         ' -> '.join(path + [name]))
+      visiting.add(name)
+      for dep in self._steps[name].deps:
+        Visit(dep, path + [name])
+      visiting.discard(name)
+      visited.add(name)
+
+    for name in self._steps:
+      Visit(name, [])
+
+  def AddMonitor(self, fn, after=None):
+    """Calls fn between scheduler rounds, once the step after passed.
+
+    Monitors run on the thread calling Run. They fail the graph by raising.
+    """
+    self._monitors.append(_Monitor(fn, after))
+
+  def Passed(self, name):
+    """Whether step name passed (or was skipped)."""
+    with self._condition:
+      return self._outcome.get(name) in (PASSED, SKIPPED)
+
+  def Attempts(self):
+    """Returns the number of attempts made by all steps."""
+    with self._condition:
+      return sum(self._attempts.values())
+
+  def Pending(self):
+    """Returns the names of the steps which did not pass yet, in order."""
+    with self._condition:
+      return [name for name in self._steps if name not in self._outcome]
+
+  def Timeline(self):
+    """Returns a StepTiming per step started, by start time."""
+    with self._condition:
+      timings = [StepTiming(name, self._start[name],
+                            self._end.get(name), self._attempts[name],
+                            self._outcome.get(name))
+                 for name in self._start]
+    return sorted(timings, key=lambda timing: timing.start)
+
+  def Run(self, deadline=None, max_attempts=None, watchdog=None):
+    """Runs the steps until all of them passed.
+
+    Args:
+      deadline: [optional] the time by which all steps have to pass.
+      max_attempts: [optional] how many attempts a single step may make.
+      watchdog: [optional] called every round, e.g. to make sure the device
+        is still alive. Fails the graph by raising.
+
+    Raises:
+      DeadlineExceededError: if the deadline or max_attempts was exceeded.
+      StepFailedError: if a step's failure policy or timeout gave up.
+      Exception: whatever a step, monitor or the watchdog raised.
+    """
+    try:
+      while True:
+        with self._condition:
+          if self._error:
+            raise self._error
+          if len(self._outcome) == len(self._steps):
+            return
+          ready = [s for s in self._steps.values()
+                   if s.name not in self._start and
+                   all(self._outcome.get(dep) in (PASSED, SKIPPED)
+                       for dep in s.deps)]
+        for step in ready:
+          self._Launch(step)
+        try:
+          self._RaiseStepError()
+          if watchdog:
+            watchdog()
+          for monitor in self._monitors:
+            if monitor.after is None or self.Passed(monitor.after):
+              monitor.fn()
+          self._CheckLimits(deadline, max_attempts)
+        except Exception:  # pylint: disable=broad-except
+          # a failed step explains what follows from it, e.g. the watchdog
+          # finding the device dead the step gave up on.
+          self._RaiseStepError()
+          raise
+        with self._condition:
+          if not self._error and len(self._outcome) < len(self._steps):
+            # wakes up early as soon as a step passes.
+            self._condition.wait(self._sleep_interval)
+    finally:
+      self._StopAll()
+
+  def _RaiseStepError(self):
+    with self._condition:
+      error = self._error
+    if error:
+      raise error
+
+  def _CheckLimits(self, deadline, max_attempts):
+    now = self._clock()
+    with self._condition:
+      if deadline is not None and now > deadline:
+        raise DeadlineExceededError(
+            'Not ready in time, waiting for: %s' % ', '.join(
+                n for n in self._steps if n not in self._outcome))
+      for name, attempts in self._attempts.items():
+        if max_attempts is not None and attempts > max_attempts:
+          raise DeadlineExceededError(
+              '%s did not pass in %d attempts' % (name, attempts), name)
+        step = self._steps[name]
+        if (step.timeout_seconds is not None and
+            name not in self._outcome and
+            now - self._start[name] > step.timeout_seconds):
+          raise StepFailedError('%s did not pass in %ss' % (
+              name, step.timeout_seconds), name)
+
+  def _Launch(self, step):
+    with self._condition:
+      self._start[step.name] = self._clock()
+    if step.enabled and not step.enabled():
+      logging.info('Skipping %s.', step.name)
+      self._Finish(step, SKIPPED)
+      return
+    thread = threading.Thread(target=self._Attempt, args=(step,),
+                              name=THREAD_NAME_FORMAT % step.name)
+    thread.daemon = True
+    self._threads[step.name] = thread
+    thread.start()
+
+  def _Finish(self, step, outcome, error=None):
+    with self._condition:
+      self._end[step.name] = self._clock()
+      self._outcome[step.name] = outcome
+      if error and not self._error:
+        self._error = error
+      self._condition.notify_all()
+
+  def _Charge(self, tag, fn, *args):
+    if not self._stopwatch:
+      return fn(*args)
+    with self._stopwatch_lock:
+      self._stopwatch.start(tag, stop_others=False)
+    try:
+      return fn(*args)
+    finally:
+      with self._stopwatch_lock:
+        self._stopwatch.stop(tag)
+
+  def _Attempt(self, step):
+    """Retries step until it passes, fails or the graph stops."""
+    failures = 0
+    _local.step = step.name
+    try:
+      while not self._stop.is_set():
+        if step.before_attempt:
+          step.before_attempt(failures)
+        sleep = True
+        if step.sleep_after_failure:
+          sleep = step.sleep_after_failure()
+        logging.info(step.details)
+        with self._condition:
+          self._attempts[step.name] += 1
+        if self._poller:
+          self._poller.Attempt(step.check_tag)
+        if self._Charge(step.check_tag, step.check_fn):
+          if self._poller:
+            self._poller.Done(step.check_tag)
+          if step.on_pass:
+            step.on_pass()
+          self._Finish(step, PASSED)
+          return
+        failures += 1
+        if step.failure_policy:
+          message = step.failure_policy(failures)
+          if message:
+            self._Finish(step, FAILED, StepFailedError(message, step.name))
+            return
+        if sleep:
+          interval = self._sleep_interval
+          if self._poller:
+            interval = self._poller.NextSleep(step.check_tag)
+          self._Charge(step.sleep_tag, self._stop.wait, interval)
+      self._Finish(step, STOPPED)
+    except Exception as e:  # pylint: disable=broad-except
+      if not self._stop.is_set():
+        logging.exception('%s failed.', step.name)
+      self._Finish(step, FAILED, e)
+    finally:
+      _local.step = None
+
+  def _StopAll(self):
+    self._stop.set()
+    deadline = time.time() + _STOP_SECONDS
+    for thread in self._threads.values():
+      thread.join(max(0, deadline - time.time()))
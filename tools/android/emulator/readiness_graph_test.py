@@ -0,0 +1,195 @@
+# Copyright 2018 The Android Open Source Project. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for tools.android.emulator.readiness_graph."""
+
+import threading
+import time
+
+from google.apputils import basetest as googletest
+from tools.android.emulator import readiness_graph
+
+Step = readiness_graph.Step
+
+
+class FakeStopWatch(object):
+
+  def __init__(self):
+    self.running = set()
+    self.counters = {}
+
+  def start(self, timer, stop_others=True):
+    assert not stop_others
+    assert timer not in self.running, timer
+    self.running.add(timer)
+    self.counters[timer] = self.counters.get(timer, 0) + 1
+
+  def stop(self, timer):
+    self.running.remove(timer)
+
+
+def PassesAfter(failures):
+  attempts = []
+
+  def Check():
+    attempts.append(1)
+    return len(attempts) > failures
+  return Check
+
+
+class ReadinessGraphTest(googletest.TestCase):
+
+  def _Graph(self, steps, **kwargs):
+    kwargs.setdefault('sleep_interval', 0.01)
+    return readiness_graph.ReadinessGraph(steps, **kwargs)
+
+  def testDependencyOrderAndTimeline(self):
+    order = []
+
+    def Check(name):
+      def Fn():
+        order.append(name)
+        return True
+      return Fn
+
+    stopwatch = FakeStopWatch()
+    graph = self._Graph([
+        Step('launcher', Check('launcher'), deps=['pm', 'boot']),
+        Step('pm', Check('pm'), deps=['system_server']),
+        Step('boot', PassesAfter(2), deps=['system_server'],
+             check_tag='BOOT'),
+        Step('system_server', Check('system_server')),
+    ], stopwatch=stopwatch)
+    graph.Run(deadline=time.time() + 30)
+    self.assertEquals(['system_server', 'pm', 'launcher'], order)
+    timeline = graph.Timeline()
+    self.assertEquals('system_server', timeline[0].name)
+    self.assertEquals('launcher', timeline[-1].name)
+    self.assertEquals(
+        {'system_server': 1, 'pm': 1, 'boot': 3, 'launcher': 1},
+        dict((t.name, t.attempts) for t in timeline))
+    for timing in timeline:
+      self.assertEquals(readiness_graph.PASSED, timing.outcome)
+      self.assertLessEqual(timing.start, timing.end)
+    self.assertEquals(6, graph.Attempts())
+    self.assertEquals(3, stopwatch.counters['BOOT'])
+    self.assertEquals(2, stopwatch.counters['BOOT_FAIL_SLEEP'])
+    self.assertEquals(set(), stopwatch.running)
+    self.assertEquals([], graph.Pending())
+
+  def testIndependentStepsOverlap(self):
+    started = [threading.Event(), threading.Event()]
+
+    def WaitsForOther(i):
+      def Check():
+        started[i].set()
+        return started[1 - i].wait(10)
+      return Check
+
+    graph = self._Graph([Step('a', WaitsForOther(0)),
+                         Step('b', WaitsForOther(1))])
+    graph.Run(deadline=time.time() + 30)
+    self.assertEquals([1, 1], [t.attempts for t in graph.Timeline()])
+
+  def testHooks(self):
+    before = []
+    monitored = []
+    graph = self._Graph([
+        Step('boot', PassesAfter(3), before_attempt=before.append,
+             on_pass=lambda: before.append('passed')),
+        Step('launcher', lambda: self.fail('skipped'), deps=['boot'],
+             enabled=lambda: False),
+        Step('after', lambda: True, deps=['launcher']),
+    ])
+    graph.AddMonitor(lambda: monitored.append(graph.Passed('boot')),
+                     after='boot')
+    graph.Run()
+    self.assertEquals([0, 1, 2, 3, 'passed'], before)
+    self.assertTrue(monitored)
+    self.assertTrue(all(monitored))
+    self.assertEquals(readiness_graph.SKIPPED,
+                      dict((t.name, t.outcome)
+                           for t in graph.Timeline())['launcher'])
+    self.assertTrue(graph.Passed('after'))
+
+  def testFailurePolicy(self):
+    never = threading.Event()
+    graph = self._Graph([
+        Step('sdcard', lambda: False,
+             failure_policy=lambda n: 'mount issues' if n > 2 else None),
+        Step('slow', never.is_set),
+        Step('after', lambda: True, deps=['sdcard']),
+    ])
+    with self.assertRaises(readiness_graph.StepFailedError) as e:
+      graph.Run()
+    self.assertEquals('sdcard', e.exception.step)
+    self.assertEquals('mount issues', str(e.exception))
+    outcomes = dict((t.name, (t.outcome, t.attempts))
+                    for t in graph.Timeline())
+    self.assertEquals((readiness_graph.FAILED, 3), outcomes['sdcard'])
+    self.assertEquals(readiness_graph.STOPPED, outcomes['slow'][0])
+    self.assertNotIn('after', outcomes)
+
+  def testCheckRaises(self):
+    def Check():
+      raise IOError('adb died')
+    graph = self._Graph([Step('adb', Check)])
+    self.assertRaises(IOError, graph.Run)
+
+  def testLimits(self):
+    graph = self._Graph([Step('never', lambda: False)])
+    self.assertRaises(readiness_graph.DeadlineExceededError, graph.Run,
+                      deadline=time.time() + 0.1)
+    graph = self._Graph([Step('never', lambda: False)])
+    with self.assertRaises(readiness_graph.DeadlineExceededError) as e:
+      graph.Run(max_attempts=3)
+    self.assertEquals('never', e.exception.step)
+    graph = self._Graph([Step('never', lambda: False, timeout_seconds=0.1)])
+    self.assertRaises(readiness_graph.StepFailedError, graph.Run)
+
+  def testWatchdog(self):
+    def Watchdog():
+      raise RuntimeError('emulator died')
+    graph = self._Graph([Step('never', lambda: False)])
+    self.assertRaises(RuntimeError, graph.Run, watchdog=Watchdog)
+
+  def testStepErrorBeforeWatchdog(self):
+    in_step = []
+
+    def Check():
+      in_step.append(readiness_graph.InStep())
+      raise readiness_graph.StepFailedError('adb failed')
+
+    def Watchdog():
+      # the step killed the emulator before giving up.
+      while graph.Pending():
+        time.sleep(0.01)
+      raise RuntimeError('emulator died')
+    graph = self._Graph([Step('adb', Check)])
+    self.assertRaises(readiness_graph.StepFailedError, graph.Run,
+                      watchdog=Watchdog)
+    self.assertEquals([True], in_step)
+    self.assertFalse(readiness_graph.InStep())
+
+  def testBadGraphs(self):
+    self.assertRaises(ValueError, readiness_graph.ReadinessGraph,
+                      [Step('a', None, deps=['b'])])
+    self.assertRaises(ValueError, readiness_graph.ReadinessGraph,
+                      [Step('a', None, deps=['c']),
+                       Step('b', None, deps=['a']),
+                       Step('c', None, deps=['b'])])
+
+
+if __name__ == '__main__':
+  googletest.main()
@@ -0,0 +1,83 @@
+# Copyright 2018 The Android Open Source Project. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmarks the process creation backends of process_backend.
+
+Spawns a trivial command repeatedly with each backend, the way ExecOnDevice
+does (stdout and stderr piped, communicate), while the benchmark holds a
+configurable amount of touched memory to mimic a loaded launcher.
+
+  bazel run //tools/android/emulator:spawn_benchmark -- --ballast_mb=1024
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import subprocess
+import time
+
+from absl import app
+from absl import flags
+
+from tools.android.emulator import process_backend
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_integer('iterations', 200, 'Processes spawned per backend.')
+flags.DEFINE_integer('ballast_mb', 512, 'Memory held (and touched) by the '
+                     'benchmark while spawning.')
+flags.DEFINE_list('backends', ['popen', 'posix_spawn', 'fork_server'],
+                  'Backends to compare.')
+flags.DEFINE_list('command', ['/bin/true'], 'The command to spawn.')
+
+
+def _Percentile(sorted_values, fraction):
+  index = min(len(sorted_values) - 1, int(len(sorted_values) * fraction))
+  return sorted_values[index]
+
+
+def TimeBackend(backend, command, iterations):
+  """Returns the sorted per spawn wall times of a backend in seconds."""
+  # Warm up, which also starts the fork server outside of the measurement.
+  process_backend.Popen(command, backend=backend, stdout=subprocess.PIPE,
+                        stderr=subprocess.PIPE, close_fds=True).communicate()
+  times = []
+  for _ in range(iterations):
+    start = time.time()
+    proc = process_backend.Popen(command, backend=backend,
+                                 stdout=subprocess.PIPE,
+                                 stderr=subprocess.PIPE, close_fds=True)
+    proc.communicate()
+    times.append(time.time() - start)
+  return sorted(times)
+
+
+def main(unused_argv):
+  ballast = bytearray(FLAGS.ballast_mb << 20)
+  for i in range(0, len(ballast), 4096):
+    ballast[i] = 1
+
+  print('%-12s %10s %10s %10s %10s' % ('backend', 'mean ms', 'p50 ms',
+                                       'p95 ms', 'spawns/s'))
+  for backend in FLAGS.backends:
+    times = TimeBackend(backend, FLAGS.command, FLAGS.iterations)
+    mean = sum(times) / len(times)
+    print('%-12s %10.3f %10.3f %10.3f %10.1f' % (
+        backend, mean * 1000, _Percentile(times, 0.5) * 1000,
+        _Percentile(times, 0.95) * 1000, 1 / mean))
+
+
+if __name__ == '__main__':
+  app.run(main)
@@ -0,0 +1,193 @@
+# Copyright 2018 The Android Open Source Project. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Copies the images a launch stages, moving as few bytes as it can.
+
+Staged images are mostly sparse and many GB large, and the emulator only
+writes a small part of them. Copy tries, in order:
+
+  reflink            the FICLONE ioctl, the copy shares all the blocks of the
+                     source until either is written (btrfs, xfs).
+  copy_file_range    the data extents of the source, found with SEEK_DATA and
+                     SEEK_HOLE, copied in the kernel; holes stay holes.
+  sparse             the data extents read and written here, skipping blocks
+                     of zeros.
+
+and returns which one it used with the bytes it actually moved.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import ctypes
+import errno
+import fcntl
+import os
+import stat
+
+from absl import logging
+
+# linux/fs.h FICLONE: _IOW(0x94, 9, int)
+_FICLONE = 0x40049409
+# unistd.h, not in os before python 3.3.
+_SEEK_DATA = getattr(os, 'SEEK_DATA', 3)
+_SEEK_HOLE = getattr(os, 'SEEK_HOLE', 4)
+_CHUNK = 1 << 20
+
+REFLINK = 'reflink'
+COPY_FILE_RANGE = 'copy_file_range'
+SPARSE = 'sparse'
+
+# the errors of a filesystem or kernel that cannot, rather than of the copy.
+_UNSUPPORTED = (errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.ENOTTY,
+                errno.EINVAL, errno.EBADF, errno.EPERM)
+
+CopyResult = collections.namedtuple('CopyResult', ['strategy', 'bytes_moved'])
+
+
+def _LibcCopyFileRange():
+  """Returns copy_file_range(2) of the libc with the signature of python 3."""
+  try:
+    fn = ctypes.CDLL(None, use_errno=True).copy_file_range
+  except (OSError, AttributeError):
+    return None
+  fn.argtypes = [ctypes.c_int, ctypes.POINTER(ctypes.c_longlong),
+                 ctypes.c_int, ctypes.POINTER(ctypes.c_longlong),
+                 ctypes.c_size_t, ctypes.c_uint]
+  fn.restype = ctypes.c_ssize_t
+
+  def CopyFileRange(src, dst, count, offset_src, offset_dst):
+    moved = fn(src, ctypes.byref(ctypes.c_longlong(offset_src)), dst,
+               ctypes.byref(ctypes.c_longlong(offset_dst)), count, 0)
+    if moved < 0:
+      e = ctypes.get_errno()
+      raise OSError(e, os.strerror(e))
+    return moved
+  return CopyFileRange
+
+
+_copy_file_range = getattr(os, 'copy_file_range', None) or _LibcCopyFileRange()
+
+
+def Reflink(src, dst):
+  """Clones src to dst sharing its blocks, returns whether the fs could."""
+  with open(src, 'rb') as s:
+    fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+      fcntl.ioctl(fd, _FICLONE, s.fileno())
+      return True
+    except (IOError, OSError):
+      return False
+    finally:
+      os.close(fd)
+
+
+def _Extents(fd, size):
+  """Yields the (start, end) of the data of the file, all of it if unknown."""
+  offset = 0
+  while offset < size:
+    try:
+      start = os.lseek(fd, offset, _SEEK_DATA)
+      end = os.lseek(fd, start, _SEEK_HOLE)
+    except OSError as e:
+      if e.errno == errno.ENXIO:
+        return  # only a hole beyond offset.
+      if offset == 0 and e.errno == errno.EINVAL:
+        yield 0, size  # the fs does not know its holes.
+        return
+      raise
+    yield start, min(end, size)
+    offset = end
+
+
+def _CopyFileRange(src_fd, dst_fd, extents):
+  moved = 0
+  for start, end in extents:
+    offset = start
+    while offset < end:
+      n = _copy_file_range(src_fd, dst_fd, min(end - offset, 1 << 30),
+                           offset, offset)
+      if n == 0:
+        break  # the source shrank.
+      offset += n
+      moved += n
+  return moved
+
+
+def _SparseCopy(src_fd, dst_fd, extents):
+  zeros = b'\0' * _CHUNK
+  moved = 0
+  for start, end in extents:
+    offset = start
+    os.lseek(src_fd, start, os.SEEK_SET)
+    while offset < end:
+      chunk = os.read(src_fd, min(end - offset, _CHUNK))
+      if not chunk:
+        break
+      if chunk != zeros[:len(chunk)]:
+        os.lseek(dst_fd, offset, os.SEEK_SET)
+        while chunk:
+          written = os.write(dst_fd, chunk)
+          moved += written
+          chunk = chunk[written:]
+      offset = os.lseek(src_fd, 0, os.SEEK_CUR)
+  return moved
+
+
+def Copy(src, dst):
+  """Copies src to dst as cheaply as the filesystems allow.
+
+  Symbolic links are dereferenced, and dst gets the permission bits of src
+  like shutil.copy.
+
+  Args:
+    src: the source file.
+    dst: the destination file, replaced if it exists.
+
+  Returns:
+    A CopyResult, of the strategy used and of the bytes moved, 0 for a
+    reflink.
+  """
+  st = os.stat(src)
+  if Reflink(src, dst):
+    result = CopyResult(REFLINK, 0)
+  else:
+    src_fd = os.open(src, os.O_RDONLY)
+    try:
+      dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+      try:
+        # the size first, what is not written after stays a hole.
+        os.ftruncate(dst_fd, st.st_size)
+        extents = list(_Extents(src_fd, st.st_size))
+        result = None
+        if _copy_file_range:
+          try:
+            result = CopyResult(COPY_FILE_RANGE,
+                                _CopyFileRange(src_fd, dst_fd, extents))
+          except OSError as e:
+            if e.errno not in _UNSUPPORTED:
+              raise
+            # the extents copied so far are just written again.
+        if not result:
+          result = CopyResult(SPARSE, _SparseCopy(src_fd, dst_fd, extents))
+      finally:
+        os.close(dst_fd)
+    finally:
+      os.close(src_fd)
+  os.chmod(dst, stat.S_IMODE(st.st_mode))
+  logging.info('Copied %s to %s by %s, %d of %d bytes moved.', src, dst,
+               result.strategy, result.bytes_moved, st.st_size)
+  return result
@@ -0,0 +1,104 @@
+# Copyright 2018 The Android Open Source Project. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for tools.android.emulator.staging_copy."""
+
+import errno
+import os
+import shutil
+import stat
+import tempfile
+
+from google.apputils import basetest as googletest
+from tools.android.emulator import staging_copy
+
+_MB = 1 << 20
+
+
+class StagingCopyTest(googletest.TestCase):
+
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    # 16MB with data at 0 and 8MB only.
+    self.src = os.path.join(self.dir, 'system.img')
+    with open(self.src, 'wb') as f:
+      f.write(b'a' * 4096)
+      f.seek(8 * _MB)
+      f.write(b'b' * 4096)
+      f.truncate(16 * _MB)
+    os.chmod(self.src, 0o640)
+    self.dst = os.path.join(self.dir, 'copy.img')
+    self._reflink = staging_copy.Reflink
+    self._copy_file_range = staging_copy._copy_file_range
+
+  def tearDown(self):
+    staging_copy.Reflink = self._reflink
+    staging_copy._copy_file_range = self._copy_file_range
+    shutil.rmtree(self.dir)
+
+  def _NoReflink(self):
+    staging_copy.Reflink = lambda src, dst: False
+
+  def _Read(self, path):
+    with open(path, 'rb') as f:
+      return f.read()
+
+  def testCopies(self):
+    result = staging_copy.Copy(self.src, self.dst)
+    self.assertEquals(self._Read(self.src), self._Read(self.dst))
+    self.assertEquals(0o640, stat.S_IMODE(os.stat(self.dst).st_mode))
+    self.assertLessEqual(result.bytes_moved, 16 * _MB)
+
+  def testSparseKeepsHoles(self):
+    self._NoReflink()
+    staging_copy._copy_file_range = None
+    result = staging_copy.Copy(self.src, self.dst)
+    self.assertEquals(staging_copy.SPARSE, result.strategy)
+    self.assertEquals(8192, result.bytes_moved)
+    self.assertEquals(self._Read(self.src), self._Read(self.dst))
+    self.assertLess(os.stat(self.dst).st_blocks * 512, 16 * _MB)
+
+  def testCopyFileRangeMovesTheExtents(self):
+    if not self._copy_file_range:
+      return
+    self._NoReflink()
+    result = staging_copy.Copy(self.src, self.dst)
+    if result.strategy == staging_copy.SPARSE:
+      return  # the fs has no copy_file_range.
+    self.assertEquals(staging_copy.COPY_FILE_RANGE, result.strategy)
+    self.assertLess(result.bytes_moved, 16 * _MB)
+    self.assertEquals(self._Read(self.src), self._Read(self.dst))
+
+  def testUnsupportedCopyFileRangeFallsBack(self):
+    self._NoReflink()
+
+    def CrossDevice(*unused_args):
+      raise OSError(errno.EXDEV, 'cross device')
+    staging_copy._copy_file_range = CrossDevice
+    result = staging_copy.Copy(self.src, self.dst)
+    self.assertEquals(staging_copy.SPARSE, result.strategy)
+    self.assertEquals(self._Read(self.src), self._Read(self.dst))
+
+  def testDereferencesAndReplaces(self):
+    link = os.path.join(self.dir, 'link.img')
+    os.symlink(self.src, link)
+    with open(self.dst, 'wb') as f:
+      f.write(b'c' * (20 * _MB))
+    staging_copy.Copy(link, self.dst)
+    self.assertFalse(os.path.islink(self.dst))
+    self.assertEquals(self._Read(self.src), self._Read(self.dst))
+
+
+if __name__ == '__main__':
+  googletest.main()
@@ -0,0 +1,647 @@
+# Copyright 2018 The Android Open Source Project. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Extracts single members of .tar.gz archives without inflating all of it.
+
+`tar -xzf archive --no-anchored cache.img` inflates the whole gzip stream,
+the members before cache.img and the ones after it. An Index remembers, for
+one archive:
+
+  members       where the data of every file starts in the tar stream, its
+                size and, for sparse files, where its segments go.
+  checkpoints   every span bytes of the tar stream, at a deflate block
+                boundary, the compressed offset and the 32K of tar stream
+                before it; inflating can start there (as in zlib's zran.c).
+
+ExtractMember seeks to the last checkpoint before the member and inflates
+only up to its end. The index of an archive is made the first time a member
+is extracted from it, in the same pass, and kept in index_dir under the
+path, size, mtime and inode of the archive.
+
+zlib's inflatePrime and inflateSetDictionary are not in the zlib module of
+python 2, libz is called through ctypes. Without libz, Available() is False
+and callers extract with tar.
+
+Members may be plain files, old GNU sparse files (tar -S) or pax 1.0
+sparse files; long names may be GNU or pax. Other sparse formats raise
+UnsupportedError.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import ctypes
+import ctypes.util
+import hashlib
+import json
+import os
+import struct
+import tempfile
+import zlib
+
+from absl import logging
+
+_MAGIC = b'TGZI1\n'
+_BLOCK = 512
+_WINSIZE = 32768
+_CHUNK = 1 << 16
+_OUT_CHUNK = 1 << 18
+# The zero blocks left as holes, as cp --sparse=always would.
+_HOLE_GRAIN = 4096
+# The tar stream between two checkpoints, the most inflated to no avail.
+SPAN = 4 << 20
+
+# zlib.h
+_Z_NO_FLUSH = 0
+_Z_BLOCK = 5
+_Z_OK = 0
+_Z_STREAM_END = 1
+_Z_BUF_ERROR = -5
+# gzip header, raw deflate.
+_GZIP_WINDOW_BITS = 15 + 32
+_RAW_WINDOW_BITS = -15
+
+_REGULAR_TYPES = (b'0', b'\0', b'7')
+
+Member = collections.namedtuple('Member', ['name', 'offset', 'size', 'mode',
+                                           'segments'])
+Checkpoint = collections.namedtuple('Checkpoint', ['out', 'in_', 'bits',
+                                                   'window'])
+
+
+class Error(Exception):
+  """The archive cannot be read with an index."""
+
+
+class UnsupportedError(Error):
+  """The member is stored in a way the extractor does not know."""
+
+
+class _ZStream(ctypes.Structure):
+  _fields_ = [
+      ('next_in', ctypes.c_void_p),
+      ('avail_in', ctypes.c_uint),
+      ('total_in', ctypes.c_ulong),
+      ('next_out', ctypes.c_void_p),
+      ('avail_out', ctypes.c_uint),
+      ('total_out', ctypes.c_ulong),
+      ('msg', ctypes.c_char_p),
+      ('state', ctypes.c_void_p),
+      ('zalloc', ctypes.c_void_p),
+      ('zfree', ctypes.c_void_p),
+      ('opaque', ctypes.c_void_p),
+      ('data_type', ctypes.c_int),
+      ('adler', ctypes.c_ulong),
+      ('reserved', ctypes.c_ulong),
+  ]
+
+
+def _LoadLibz():
+  for name in (ctypes.util.find_library('z'), 'libz.so.1'):
+    if not name:
+      continue
+    try:
+      lib = ctypes.CDLL(name)
+    except OSError:
+      continue
+    stream = ctypes.POINTER(_ZStream)
+    lib.zlibVersion.restype = ctypes.c_char_p
+    lib.inflateInit2_.argtypes = [stream, ctypes.c_int, ctypes.c_char_p,
+                                  ctypes.c_int]
+    lib.inflate.argtypes = [stream, ctypes.c_int]
+    lib.inflateEnd.argtypes = [stream]
+    lib.inflatePrime.argtypes = [stream, ctypes.c_int, ctypes.c_int]
+    lib.inflateSetDictionary.argtypes = [stream, ctypes.c_char_p,
+                                         ctypes.c_uint]
+    return lib
+  return None
+
+
+_libz = _LoadLibz()
+
+
+def Available():
+  """Whether members can be extracted here, libz was found."""
+  return _libz is not None
+
+
+class _Inflater(object):
+  """Inflates a file from where it is positioned, output chunk by chunk."""
+
+  def __init__(self, f, window_bits, out_size):
+    self._f = f
+    self._strm = _ZStream()
+    self._in = ctypes.create_string_buffer(_CHUNK)
+    self._out = ctypes.create_string_buffer(out_size)
+    self._out_size = out_size
+    self.total_in = 0
+    self.total_out = 0
+    ret = _libz.inflateInit2_(ctypes.byref(self._strm), window_bits,
+                              _libz.zlibVersion(), ctypes.sizeof(_ZStream))
+    if ret != _Z_OK:
+      raise Error('inflateInit2 failed: %d' % ret)
+    self._strm.avail_out = 0
+
+  def Close(self):
+    _libz.inflateEnd(ctypes.byref(self._strm))
+
+  def Prime(self, bits, value):
+    _libz.inflatePrime(ctypes.byref(self._strm), bits, value)
+
+  def SetDictionary(self, window):
+    ret = _libz.inflateSetDictionary(ctypes.byref(self._strm), window,
+                                     len(window))
+    if ret != _Z_OK:
+      raise Error('inflateSetDictionary failed: %d' % ret)
+
+  @property
+  def at_block_end(self):
+    """Whether the last Inflate(_Z_BLOCK) stopped between deflate blocks."""
+    return bool(self._strm.data_type & 128) and not self._strm.data_type & 64
+
+  @property
+  def bits(self):
+    """The bits of the last byte read which belong to the next block."""
+    return self._strm.data_type & 7
+
+  def Window(self):
+    """Returns the last 32K inflated, the out buffer being circular."""
+    pos = self._out_size - self._strm.avail_out
+    base = ctypes.addressof(self._out)
+    if self.total_out < self._out_size:
+      return ctypes.string_at(base, pos)
+    return (ctypes.string_at(base + pos, self._out_size - pos) +
+            ctypes.string_at(base, pos))
+
+  def Inflate(self, flush):
+    """Inflates some more, returns the output, None at the stream end."""
+    strm = self._strm
+    if not strm.avail_in:
+      data = self._f.read(_CHUNK)
+      if not data:
+        raise Error('truncated archive at %d' % self.total_in)
+      ctypes.memmove(self._in, data, len(data))
+      strm.next_in = ctypes.addressof(self._in)
+      strm.avail_in = len(data)
+    if not strm.avail_out:
+      strm.next_out = ctypes.addressof(self._out)
+      strm.avail_out = self._out_size
+    pos = self._out_size - strm.avail_out
+    avail_in, avail_out = strm.avail_in, strm.avail_out
+    ret = _libz.inflate(ctypes.byref(strm), flush)
+    if ret not in (_Z_OK, _Z_STREAM_END, _Z_BUF_ERROR):
+      raise Error('inflate failed: %d %s' % (ret, strm.msg))
+    produced = avail_out - strm.avail_out
+    self.total_in += avail_in - strm.avail_in
+    self.total_out += produced
+    if ret == _Z_STREAM_END and not produced:
+      return None
+    return ctypes.string_at(ctypes.addressof(self._out) + pos, produced)
+
+
+class _Stream(object):
+  """The tar stream, read from the chunks of an inflater."""
+
+  def __init__(self, chunks):
+    self._chunks = chunks
+    self._buf = b''
+    self.pos = 0
+
+  def _Fill(self, n):
+    while len(self._buf) < n:
+      chunk = next(self._chunks, None)
+      if chunk is None:
+        break
+      self._buf += chunk
+
+  def Read(self, n):
+    self._Fill(n)
+    data, self._buf = self._buf[:n], self._buf[n:]
+    self.pos += len(data)
+    if len(data) < n:
+      raise Error('truncated tar stream at %d' % self.pos)
+    return data
+
+  def Pieces(self, n):
+    """Yields the next n bytes in pieces."""
+    while n:
+      if not self._buf:
+        self._Fill(1)
+        if not self._buf:
+          raise Error('truncated tar stream at %d' % self.pos)
+      piece, self._buf = self._buf[:n], self._buf[n:]
+      self.pos += len(piece)
+      n -= len(piece)
+      yield piece
+
+
+def _Padded(size):
+  return (size + _BLOCK - 1) // _BLOCK * _BLOCK
+
+
+def _Number(field):
+  """Returns a numeric header field, octal or base-256."""
+  field = bytearray(field)
+  if field and field[0] & 0x80:
+    value = field[0] & 0x7f
+    for byte in field[1:]:
+      value = value << 8 | byte
+    return value
+  digits = bytes(field).split(b'\0', 1)[0].strip()
+  return int(digits, 8) if digits else 0
+
+
+def _String(field):
+  return field.split(b'\0', 1)[0].decode('utf-8', 'replace')
+
+
+def _PaxRecords(data):
+  records = {}
+  while data:
+    length, rest = data.split(b' ', 1)
+    record = rest[:int(length) - len(length) - 2]
+    key, value = record.split(b'=', 1)
+    records[key.decode('utf-8')] = value.decode('utf-8', 'replace')
+    data = data[int(length):]
+  return records
+
+
+def _GnuSparseMap(header, stream):
+  """Returns the segments of an old GNU sparse member, reading extensions."""
+  segments = []
+
+  def Add(block, count):
+    for i in range(count):
+      offset = _Number(block[i * 24:i * 24 + 12])
+      length = _Number(block[i * 24 + 12:i * 24 + 24])
+      if not offset and not length:
+        break
+      segments.append((offset, length))
+  Add(header[386:482], 4)
+  extended = bytearray(header)[482]
+  while extended:
+    block = stream.Read(_BLOCK)
+    Add(block[:504], 21)
+    extended = bytearray(block)[504]
+  return segments
+
+
+def _Pax10SparseMap(stream):
+  """Reads the map before the data of a pax 1.0 sparse member."""
+  data = b''
+  numbers = []
+  while True:
+    data += stream.Read(_BLOCK)
+    numbers = data.split(b'\n')
+    if len(numbers) > 1:
+      count = int(numbers[0])
+      if len(numbers) > 2 * count + 1:
+        break
+  values = [int(n) for n in numbers[1:2 * count + 1]]
+  return list(zip(values[::2], values[1::2])), len(data)
+
+
+def _Members(stream):
+  """Yields the Members of the tar stream, positioned at their data.
+
+  The caller consumes the data (member.offset is stream.pos) or not; the
+  next iteration skips what is left of it.
+  """
+  pax = {}
+  long_name = None
+  while True:
+    header = stream.Read(_BLOCK)
+    if header == b'\0' * _BLOCK:
+      return
+    kind = header[156:157]
+    size = _Number(header[124:136])
+    if kind in (b'L', b'x', b'g', b'K'):
+      data = b''.join(stream.Pieces(_Padded(size)))[:size]
+      if kind == b'L':
+        long_name = _String(data)
+      elif kind == b'x':
+        pax = _PaxRecords(data)
+      continue
+    name = _String(header[0:100])
+    if header[257:263] == b'ustar\0':
+      prefix = _String(header[345:500])
+      if prefix:
+        name = prefix + '/' + name
+    name = pax.get('path', long_name or name)
+    size = int(pax.get('size', size))
+    mode = _Number(header[100:108]) & 0o7777
+    stored = size
+    segments = [(0, size)]
+    if kind == b'S':
+      segments = _GnuSparseMap(header, stream)
+      size = _Number(header[483:495])
+    elif 'GNU.sparse.major' in pax or 'GNU.sparse.map' in pax:
+      if (pax.get('GNU.sparse.major'), pax.get('GNU.sparse.minor')) != (
+          '1', '0'):
+        segments = None  # pax 0.x sparse.
+      else:
+        name = pax.get('GNU.sparse.name', name)
+        segments, map_size = _Pax10SparseMap(stream)
+        stored -= map_size
+        size = int(pax['GNU.sparse.realsize'])
+    pax, long_name = {}, None
+    end = stream.pos + _Padded(stored)
+    if kind in _REGULAR_TYPES or kind == b'S':
+      yield Member(name, stream.pos, size, mode, segments)
+    for _ in stream.Pieces(end - stream.pos):
+      pass
+
+
+def Matches(name, entry):
+  """Whether member name is entry to tar --no-anchored."""
+  name = name[2:] if name.startswith('./') else name
+  return name == entry or name.endswith('/' + entry)
+
+
+class _SparseWriter(object):
+  """Writes the stored data of a member to its place in dst, skipping zeros."""
+
+  def __init__(self, dst, member):
+    if member.segments is None:
+      raise UnsupportedError('%s: unsupported sparse format' % member.name)
+    self._member = member
+    self._fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    os.ftruncate(self._fd, member.size)
+    self._dst = dst
+
+  def Write(self, pieces):
+    """Writes the member data, given as pieces of the tar stream."""
+    zeros = b'\0' * _OUT_CHUNK
+    segments = iter(self._member.segments)
+    offset, left = 0, 0
+    for piece in pieces:
+      while piece:
+        while not left:
+          offset, left = next(segments)
+        n = min(left, len(piece))
+        if piece[:n] != zeros[:n]:
+          self._WriteData(offset, piece[:n], zeros)
+        piece = piece[n:]
+        offset += n
+        left -= n
+
+  def _WriteData(self, offset, data, zeros):
+    """Writes data at offset but for its runs of _HOLE_GRAIN zeros."""
+    hole = zeros[:_HOLE_GRAIN]
+    pos = 0
+    while pos < len(data):
+      start = len(data) - len(data[pos:].lstrip(b'\0'))
+      if start == len(data):
+        return
+      end = data.find(hole, start)
+      end = len(data) if end < 0 else end
+      self._Write(offset + start, data[start:end])
+      pos = end
+
+  def _Write(self, offset, data):
+    os.lseek(self._fd, offset, os.SEEK_SET)
+    written = 0
+    while written < len(data):
+      written += os.write(self._fd, data[written:])
+
+  def Close(self):
+    os.close(self._fd)
+    os.chmod(self._dst, self._member.mode or 0o644)
+
+
+def _StoredSize(member):
+  return sum(length for _, length in member.segments)
+
+
+class Index(object):
+  """The members and inflate checkpoints of one archive."""
+
+  def __init__(self, members, checkpoints, span=SPAN):
+    self.members = members
+    self.checkpoints = checkpoints
+    self.span = span
+
+  def Find(self, entry):
+    """Returns the member tar would extract for entry, the last matching."""
+    found = [m for m in self.members if Matches(m.name, entry)]
+    if not found:
+      raise KeyError('%s not in the archive' % entry)
+    return found[-1]
+
+  def Save(self, path):
+    """Writes the index to path atomically."""
+    windows = []
+    offset = 0
+    points = []
+    for point in self.checkpoints:
+      window = zlib.compress(point.window)
+      points.append([point.out, point.in_, point.bits, offset, len(window)])
+      windows.append(window)
+      offset += len(window)
+    meta = json.dumps({
+        'span': self.span,
+        'members': [list(m) for m in self.members],
+        'checkpoints': points,
+    }).encode('utf-8')
+    directory = os.path.dirname(path)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp')
+    try:
+      with os.fdopen(fd, 'wb') as f:
+        f.write(_MAGIC + struct.pack('>Q', len(meta)) + meta)
+        for window in windows:
+          f.write(window)
+      os.rename(tmp_path, path)
+    except:
+      os.remove(tmp_path)
+      raise
+
+  @classmethod
+  def Load(cls, path):
+    """Reads the index at path.
+
+    Raises:
+      IOError: if the file cannot be read.
+      Error: if it is not an index, or a truncated or corrupt one.
+    """
+    with open(path, 'rb') as f:
+      if f.read(len(_MAGIC)) != _MAGIC:
+        raise Error('%s: not an index' % path)
+      header = f.read(8)
+      content = f.read()
+    try:
+      meta_length, = struct.unpack('>Q', header)
+      meta = json.loads(content[:meta_length].decode('utf-8'))
+      blob = content[meta_length:]
+      members = [Member(name, offset, size, mode,
+                        [tuple(s) for s in segments] if segments is not None
+                        else None)
+                 for name, offset, size, mode, segments in meta['members']]
+      checkpoints = [Checkpoint(out, in_, bits,
+                                zlib.decompress(blob[start:start + length]))
+                     for out, in_, bits, start, length in meta['checkpoints']]
+      return cls(members, checkpoints, meta['span'])
+    except (struct.error, ValueError, KeyError, TypeError, zlib.error) as e:
+      raise Error('%s: corrupt index: %s' % (path, e))
+
+
+def _Scan(f, span, on_member):
+  """Inflates the archive once, returns its Index.
+
+  Args:
+    f: the archive, at its start.
+    span: the tar stream between checkpoints.
+    on_member: called with each Member, returns a _SparseWriter for its data
+      or None to skip it.
+  """
+  inflater = _Inflater(f, _GZIP_WINDOW_BITS, _WINSIZE)
+  checkpoints = []
+
+  def Chunks():
+    last = None
+    while True:
+      if inflater.at_block_end and (
+          last is None or inflater.total_out - last > span):
+        checkpoints.append(Checkpoint(inflater.total_out, inflater.total_in,
+                                      inflater.bits, inflater.Window()))
+        last = inflater.total_out
+      chunk = inflater.Inflate(_Z_BLOCK)
+      if chunk is None:
+        return
+      if chunk:
+        yield chunk
+
+  try:
+    stream = _Stream(Chunks())
+    members = []
+    for member in _Members(stream):
+      members.append(member)
+      writer = on_member(member)
+      if writer:
+        try:
+          writer.Write(stream.Pieces(_StoredSize(member)))
+        finally:
+          writer.Close()
+  finally:
+    inflater.Close()
+  return Index(members, checkpoints, span)
+
+
+def Build(archive, span=SPAN):
+  """Returns the Index of archive, inflating all of it."""
+  with open(archive, 'rb') as f:
+    return _Scan(f, span, lambda member: None)
+
+
+def _ReadMember(f, index, member, writer):
+  """Inflates member from the last checkpoint before it into writer."""
+  point = None
+  for candidate in index.checkpoints:
+    if candidate.out > member.offset:
+      break
+    point = candidate
+  if point is None:
+    raise Error('no checkpoint before %d' % member.offset)
+  f.seek(point.in_ - (1 if point.bits else 0))
+  inflater = _Inflater(f, _RAW_WINDOW_BITS, _OUT_CHUNK)
+  try:
+    if point.bits:
+      byte = bytearray(f.read(1))[0]
+      inflater.Prime(point.bits, byte >> (8 - point.bits))
+    if point.window:
+      inflater.SetDictionary(point.window)
+
+    def Chunks():
+      while True:
+        chunk = inflater.Inflate(_Z_NO_FLUSH)
+        if chunk is None:
+          return
+        if chunk:
+          yield chunk
+    stream = _Stream(Chunks())
+    stream.pos = point.out
+    for _ in stream.Pieces(member.offset - point.out):
+      pass
+    writer.Write(stream.Pieces(_StoredSize(member)))
+  finally:
+    inflater.Close()
+
+
+def IndexPath(archive, index_dir):
+  """Where the index of archive is kept, by its path, size, mtime and inode."""
+  st = os.stat(archive)
+  key = hashlib.sha1(('%s:%d:%d:%d:%d' % (
+      os.path.realpath(archive), st.st_size, int(st.st_mtime * 1e9),
+      st.st_ino, st.st_dev)).encode('utf-8')).hexdigest()
+  return os.path.join(index_dir, key + '.idx')
+
+
+def ExtractMember(archive, entry, dst, index_dir, span=SPAN):
+  """Extracts member entry of archive to dst, like tar -xzSf --no-anchored.
+
+  The first extraction from an archive inflates all of it and keeps its
+  index in index_dir; the next ones start at the checkpoint before entry.
+
+  Args:
+    archive: a .tar.gz file.
+    entry: the name of the member, matched as tar --no-anchored does.
+    dst: the file the member is written to.
+    index_dir: where the indexes are kept.
+    span: the tar stream between checkpoints of a new index.
+
+  Returns:
+    Whether the index was there.
+
+  Raises:
+    Error: if the archive or the member cannot be read this way.
+    KeyError: if entry is not in the archive.
+  """
+  if not Available():
+    raise Error('libz not found')
+  path = IndexPath(archive, index_dir)
+  try:
+    index = Index.Load(path)
+  except (IOError, OSError, Error):
+    index = None
+  with open(archive, 'rb') as f:
+    if index:
+      member = index.Find(entry)
+      writer = _SparseWriter(dst, member)
+      try:
+        _ReadMember(f, index, member, writer)
+      finally:
+        writer.Close()
+      return True
+
+    found = []
+
+    def OnMember(member):
+      if not Matches(member.name, entry):
+        return None
+      found.append(member)
+      return _SparseWriter(dst, member)
+    index = _Scan(f, span, OnMember)
+  if not found:
+    raise KeyError('%s not in %s' % (entry, archive))
+  if not os.path.isdir(index_dir):
+    try:
+      os.makedirs(index_dir)
+    except OSError:
+      pass
+  try:
+    index.Save(path)
+  except (IOError, OSError) as e:
+    logging.warning('Cannot keep the index of %s: %s', archive, e)
+  return False
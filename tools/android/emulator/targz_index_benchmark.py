@@ -0,0 +1,137 @@
+# Copyright 2018 The Android Open Source Project. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmarks extracting one member of a .tar.gz, tar against targz_index.
+
+Extracts --entry from --archive, or from a generated archive of system,
+vendor and userdata images, in three ways:
+
+  tar        tar -xzSf --no-anchored, what the launcher did.
+  indexing   targz_index.ExtractMember without an index, which makes it.
+  indexed    targz_index.ExtractMember with the index.
+
+and prints the median wall time and the disk space of the output:
+
+  bazel run //tools/android/emulator:targz_index_benchmark -- \\
+      --archive=/path/to/system_images.tar.gz --entry=system.img
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+
+from absl import app
+from absl import flags
+
+from tools.android.emulator import targz_index
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string('archive', None, 'The .tar.gz to extract from. A '
+                    'generated one by default.')
+flags.DEFINE_string('entry', 'userdata.img', 'The member to extract.')
+flags.DEFINE_integer('image_mb', 64, 'The size of each generated image.')
+flags.DEFINE_integer('iterations', 3, 'How often each way is timed.')
+
+# The generated images, the one asked for last as in the system images.
+_IMAGES = ('system.img', 'vendor.img', 'userdata.img')
+# Of every MB of the generated images, this much is data, the rest holes.
+_DATA_PER_MB = 256 << 10
+
+
+def MakeArchive(directory, image_mb):
+  """Writes a .tar.gz of partly sparse, partly compressible images."""
+  source = os.path.join(directory, 'images')
+  os.makedirs(source)
+  rand = random.Random(0)
+  words = [b'%08x' % rand.getrandbits(32) for _ in range(4096)]
+  for name in _IMAGES:
+    with open(os.path.join(source, name), 'wb') as f:
+      f.truncate(image_mb << 20)
+      for mb in range(0, image_mb, 2):
+        f.seek(mb << 20)
+        f.write(b''.join(rand.choice(words) for _ in range(
+            _DATA_PER_MB // 8)))
+  archive = os.path.join(directory, 'images.tar.gz')
+  subprocess.check_call(['tar', '-czSf', archive, '-C', source] +
+                        list(_IMAGES))
+  shutil.rmtree(source)
+  return archive
+
+
+def _Tar(archive, entry, dst):
+  working_dir = tempfile.mkdtemp(dir=os.path.dirname(dst))
+  try:
+    subprocess.check_call(['tar', '-xzSf', archive, '--no-same-owner', '-C',
+                           working_dir, '--no-anchored', entry])
+    shutil.move(os.path.join(working_dir, entry), dst)
+  finally:
+    shutil.rmtree(working_dir, ignore_errors=True)
+
+
+def _Median(values):
+  values = sorted(values)
+  return values[len(values) // 2]
+
+
+def TimeWays(archive, entry, work_dir, iterations):
+  """Returns {way: (median seconds, output KB on disk)}."""
+  index_dir = os.path.join(work_dir, 'index')
+  dst = os.path.join(work_dir, 'dst')
+
+  def Indexing():
+    shutil.rmtree(index_dir, ignore_errors=True)
+    os.makedirs(index_dir)
+    targz_index.ExtractMember(archive, entry, dst, index_dir)
+
+  ways = [
+      ('tar', lambda: _Tar(archive, entry, dst)),
+      ('indexing', Indexing),
+      ('indexed', lambda: targz_index.ExtractMember(archive, entry, dst,
+                                                    index_dir)),
+  ]
+  results = {}
+  for way, extract in ways:
+    seconds = []
+    for _ in range(iterations):
+      if os.path.exists(dst):
+        os.remove(dst)
+      start = time.time()
+      extract()
+      seconds.append(time.time() - start)
+    results[way] = (_Median(seconds), os.stat(dst).st_blocks // 2)
+  return results
+
+
+def main(unused_argv):
+  work_dir = tempfile.mkdtemp(prefix='targz_index_benchmark')
+  try:
+    archive = FLAGS.archive or MakeArchive(work_dir, FLAGS.image_mb)
+    results = TimeWays(archive, FLAGS.entry, work_dir, FLAGS.iterations)
+  finally:
+    shutil.rmtree(work_dir, ignore_errors=True)
+  print('%-10s %10s %12s' % ('way', 'wall s', 'on disk KB'))
+  for way in ('tar', 'indexing', 'indexed'):
+    print('%-10s %10.3f %12d' % ((way,) + results[way]))
+
+
+if __name__ == '__main__':
+  app.run(main)
@@ -0,0 +1,145 @@
+# Copyright 2018 The Android Open Source Project. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for tools.android.emulator.targz_index."""
+
+import io
+import os
+import random
+import shutil
+import subprocess
+import tarfile
+import tempfile
+
+from google.apputils import basetest as googletest
+from tools.android.emulator import targz_index
+
+_SPAN = 1 << 16
+
+
+class TargzIndexTest(googletest.TestCase):
+
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.index_dir = os.path.join(self.dir, 'index')
+    os.mkdir(self.index_dir)
+    rand = random.Random(42)
+    # Incompressible enough for the members to span checkpoints.
+    self.contents = dict(
+        (name, bytearray(rand.getrandbits(8) for _ in range(size)))
+        for name, size in [('first.img', 300000), ('second.img', 200000),
+                           ('third.img', 5000)])
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def _Read(self, path):
+    with open(path, 'rb') as f:
+      return f.read()
+
+  def _Archive(self, members, fmt=tarfile.GNU_FORMAT):
+    archive = os.path.join(self.dir, 'archive.tar.gz')
+    tar = tarfile.open(archive, 'w:gz', format=fmt)
+    for name, content in members:
+      info = tarfile.TarInfo(name)
+      info.size = len(content)
+      info.mode = 0o640
+      tar.addfile(info, io.BytesIO(bytes(content)))
+    tar.close()
+    return archive
+
+  def _Extract(self, archive, entry):
+    dst = os.path.join(self.dir, 'dst')
+    found = targz_index.ExtractMember(archive, entry, dst, self.index_dir,
+                                      span=_SPAN)
+    return found, self._Read(dst)
+
+  def testExtractsThenUsesTheIndex(self):
+    archive = self._Archive(
+        ('./images/' + name, content)
+        for name, content in sorted(self.contents.items()))
+    self.assertEquals((False, bytes(self.contents['second.img'])),
+                      self._Extract(archive, 'second.img'))
+    self.assertEquals((True, bytes(self.contents['third.img'])),
+                      self._Extract(archive, 'third.img'))
+    self.assertEquals((True, bytes(self.contents['first.img'])),
+                      self._Extract(archive, 'images/first.img'))
+    self.assertEquals(0o640, os.stat(os.path.join(self.dir, 'dst')).st_mode &
+                      0o777)
+    index = targz_index.Index.Load(
+        targz_index.IndexPath(archive, self.index_dir))
+    self.assertGreater(len(index.checkpoints), 2)
+
+  def testLongNames(self):
+    name = 'd' * 120 + '/system.img'
+    for fmt in (tarfile.GNU_FORMAT, tarfile.PAX_FORMAT):
+      archive = self._Archive([(name, self.contents['third.img'])], fmt)
+      self.assertEquals(bytes(self.contents['third.img']),
+                        self._Extract(archive, 'system.img')[1])
+      os.remove(archive)
+
+  def testMatchesLikeNoAnchored(self):
+    self.assertTrue(targz_index.Matches('./cache.img', 'cache.img'))
+    self.assertTrue(targz_index.Matches('a/b/cache.img', 'b/cache.img'))
+    self.assertFalse(targz_index.Matches('a/xcache.img', 'cache.img'))
+    archive = self._Archive([('cache.img', b'old'), ('x/cache.img', b'new')])
+    self.assertEquals(b'new', self._Extract(archive, 'cache.img')[1])
+    self.assertEquals(b'new', self._Extract(archive, 'cache.img')[1])
+    self.assertRaises(KeyError, self._Extract, archive, 'system.img')
+
+  def testSparseMembersLikeTar(self):
+    source = os.path.join(self.dir, 'source')
+    os.mkdir(source)
+    image = os.path.join(source, 'sparse.img')
+    with open(image, 'wb') as f:
+      f.truncate(8 << 20)
+      for offset in (0, 3 << 20, (8 << 20) - 5000):
+        f.seek(offset)
+        f.write(bytes(self.contents['third.img']))
+    for flags in (['--format=gnu'],
+                  ['--format=posix', '--sparse-version=1.0']):
+      archive = os.path.join(self.dir, 'sparse.tar.gz')
+      subprocess.check_call(['tar', '-czSf', archive, '-C', source] + flags +
+                            ['sparse.img'])
+      for _ in range(2):
+        _, content = self._Extract(archive, 'sparse.img')
+        self.assertEquals(self._Read(image), content)
+      self.assertLess(os.stat(os.path.join(self.dir, 'dst')).st_blocks * 512,
+                      1 << 20)
+      os.remove(archive)
+
+  def testBrokenIndexIsRebuilt(self):
+    archive = self._Archive([('cache.img', self.contents['third.img'])])
+    self._Extract(archive, 'cache.img')
+    with open(targz_index.IndexPath(archive, self.index_dir), 'wb') as f:
+      f.write(b'garbage')
+    self.assertEquals((False, bytes(self.contents['third.img'])),
+                      self._Extract(archive, 'cache.img'))
+    self.assertTrue(self._Extract(archive, 'cache.img')[0])
+
+  def testTruncatedIndexIsRebuilt(self):
+    archive = self._Archive([('cache.img', self.contents['third.img'])])
+    self._Extract(archive, 'cache.img')
+    path = targz_index.IndexPath(archive, self.index_dir)
+    content = self._Read(path)
+    for length in (len(content) // 2, 12):
+      with open(path, 'wb') as f:
+        f.write(content[:length])
+      self.assertRaises(targz_index.Error, targz_index.Index.Load, path)
+      self.assertEquals((False, bytes(self.contents['third.img'])),
+                        self._Extract(archive, 'cache.img'))
+
+
+if __name__ == '__main__':
+  googletest.main()
@@ -0,0 +1,224 @@
+# Copyright 2018 The Android Open Source Project. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Runs the work before a launch as a graph of tasks on a pool of threads.
+
+A Task is a function run once, after the tasks it depends on:
+
+  graph = TaskGraph([
+      Task('EXTRACT_SYSTEM_IMAGE', ExtractSystem),
+      Task('MODIFY_SYSTEM_IMAGE', ModifySystem,
+           deps=['EXTRACT_SYSTEM_IMAGE']),
+      Task('REPACK_RAMDISK', RepackRamdisk),
+  ], stopwatch, workers=4)
+  graph.Run()
+
+A free worker takes the first task, in the order given, whose dependencies
+are done; so the image extractions, which wait for tar and the disk, overlap
+the ramdisk repack, which keeps a cpu busy with gzip. The first task to raise
+fails the graph: no other task starts, Run waits for the running ones and
+raises the error. Timeline() tells when and on which worker each task ran,
+CriticalPath() the chain of tasks the length of Run came down to.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import threading
+import time
+
+from absl import logging
+
+# The name of the worker threads, by their index.
+THREAD_NAME_FORMAT = 'prelaunch-%d'
+
+DONE = 'done'
+FAILED = 'failed'
+
+TaskTiming = collections.namedtuple('TaskTiming',
+                                    ['name', 'start', 'end', 'worker',
+                                     'outcome'])
+
+
+class Task(object):
+  """A function of the graph and the tasks it waits for."""
+
+  def __init__(self, name, fn, deps=()):
+    """Constructor.
+
+    Args:
+      name: names the task in deps, the timeline and the stopwatch.
+      fn: does the work, called without arguments.
+      deps: names of the tasks which have to be done first.
+    """
+    self.name = name
+    self.fn = fn
+    self.deps = tuple(deps)
+
+
+class TaskGraph(object):
+  """Runs Tasks in dependency order on a fixed number of threads."""
+
+  def __init__(self, tasks, stopwatch=None, workers=4, clock=time.time):
+    """Constructor.
+
+    Args:
+      tasks: the Tasks, the ones to start first first.
+      stopwatch: [optional] a stopwatch.StopWatch each task is charged to,
+        under its name. Concurrent tasks overlap, so other timers keep
+        running.
+      workers: the number of tasks run at a time.
+      clock: the time source of the timeline.
+
+    Raises:
+      ValueError: if a task depends on a task which is not in the graph, or
+        the tasks depend on each other in a cycle.
+    """
+    self._tasks = collections.OrderedDict((t.name, t) for t in tasks)
+    self._stopwatch = stopwatch
+    self._workers = max(1, workers)
+    self._clock = clock
+    self._condition = threading.Condition()
+    self._stopwatch_lock = threading.Lock()
+    self._ready = []
+    self._waiting = {}
+    self._running = 0
+    self._timings = {}
+    self._error = None
+    for task in self._tasks.values():
+      for dep in task.deps:
+        if dep not in self._tasks:
+          raise ValueError('%s depends on unknown task %s' % (task.name, dep))
+    self._CheckAcyclic()
+
+  def _CheckAcyclic(self):
+    visiting, visited = set(), set()
+
+    def Visit(name, path):
+      if name in visited:
+        return
+      if name in visiting:
+        raise ValueError('Tasks depend on each other: %s' %
+                         ' -> '.join(path + [name]))
+      visiting.add(name)
+      for dep in self._tasks[name].deps:
+        Visit(dep, path + [name])
+      visiting.discard(name)
+      visited.add(name)
+
+    for name in self._tasks:
+      Visit(name, [])
+
+  def Run(self):
+    """Runs all the tasks, returns once they are done.
+
+    Raises:
+      the error of the first task which failed.
+    """
+    with self._condition:
+      self._ready = [name for name, task in self._tasks.items()
+                     if not task.deps]
+      self._waiting = dict((name, set(task.deps))
+                           for name, task in self._tasks.items() if task.deps)
+    threads = [threading.Thread(target=self._Work, args=(i,),
+                                name=THREAD_NAME_FORMAT % i)
+               for i in range(min(self._workers, len(self._tasks)))]
+    for thread in threads:
+      thread.daemon = True
+      thread.start()
+    for thread in threads:
+      thread.join()
+    if self._error:
+      raise self._error  # pylint: disable=raising-bad-type
+
+  def _Next(self):
+    """Waits for and takes the next ready task, None once there is none."""
+    with self._condition:
+      while True:
+        if self._error:
+          return None
+        if self._ready:
+          self._running += 1
+          return self._tasks[self._ready.pop(0)]
+        if not self._running:
+          return None  # the rest wait for a failed task, or there is none.
+        self._condition.wait()
+
+  def _Work(self, worker):
+    while True:
+      task = self._Next()
+      if not task:
+        return
+      start = self._clock()
+      outcome = FAILED
+      try:
+        self._Charge(task)
+        outcome = DONE
+      except Exception as e:  # pylint: disable=broad-except
+        logging.exception('Task %s failed.', task.name)
+        with self._condition:
+          self._error = self._error or e
+      finally:
+        with self._condition:
+          self._running -= 1
+          self._timings[task.name] = TaskTiming(task.name, start,
+                                                self._clock(), worker,
+                                                outcome)
+          if outcome == DONE:
+            self._Release(task.name)
+          self._condition.notify_all()
+
+  def _Release(self, name):
+    """Makes the tasks which only waited for name ready, condition held."""
+    for waiter in [n for n in self._tasks if n in self._waiting]:
+      deps = self._waiting[waiter]
+      deps.discard(name)
+      if not deps:
+        del self._waiting[waiter]
+        self._ready.append(waiter)
+
+  def _Charge(self, task):
+    if not self._stopwatch:
+      return task.fn()
+    with self._stopwatch_lock:
+      self._stopwatch.start(task.name, stop_others=False)
+    try:
+      return task.fn()
+    finally:
+      with self._stopwatch_lock:
+        self._stopwatch.stop(task.name)
+
+  def Timeline(self):
+    """Returns a TaskTiming per task run, by start time."""
+    with self._condition:
+      return sorted(self._timings.values(), key=lambda t: (t.start, t.name))
+
+  def CriticalPath(self):
+    """Returns the TaskTimings of the chain the run waited on, first first.
+
+    The chain ends with the task which finished last and steps back to the
+    dependency each task waited for the longest.
+    """
+    with self._condition:
+      if not self._timings:
+        return []
+      path = [max(self._timings.values(), key=lambda t: (t.end, t.name))]
+      while True:
+        deps = [self._timings[dep] for dep in self._tasks[path[-1].name].deps
+                if dep in self._timings]
+        if not deps:
+          return list(reversed(path))
+        path.append(max(deps, key=lambda t: (t.end, t.name)))
@@ -0,0 +1,131 @@
+# Copyright 2018 The Android Open Source Project. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for tools.android.emulator.task_graph."""
+
+import threading
+import time
+
+from google.apputils import basetest as googletest
+from google.apputils import stopwatch
+from tools.android.emulator import task_graph
+
+Task = task_graph.Task
+
+
+class TaskGraphTest(googletest.TestCase):
+
+  def setUp(self):
+    super(TaskGraphTest, self).setUp()
+    self.ran = []
+    self.lock = threading.Lock()
+
+  def _Record(self, name, seconds=0):
+    def Run():
+      time.sleep(seconds)
+      with self.lock:
+        self.ran.append(name)
+    return Run
+
+  def testRunsAfterDeps(self):
+    graph = task_graph.TaskGraph([
+        Task('modify', self._Record('modify'), deps=['system']),
+        Task('system', self._Record('system', 0.1)),
+        Task('ramdisk', self._Record('ramdisk')),
+    ], workers=2)
+    graph.Run()
+    self.assertLess(self.ran.index('system'), self.ran.index('modify'))
+    self.assertEquals(3, len(graph.Timeline()))
+    self.assertEquals(set([task_graph.DONE]),
+                      set(t.outcome for t in graph.Timeline()))
+
+  def testIndependentTasksOverlap(self):
+    started = []
+    go = threading.Event()
+
+    def Wait(name):
+      def Run():
+        started.append(name)
+        if len(started) == 2:
+          go.set()
+        self.assertTrue(go.wait(5))
+      return Run
+    graph = task_graph.TaskGraph([Task('a', Wait('a')), Task('b', Wait('b'))],
+                                 workers=2)
+    graph.Run()
+    timeline = graph.Timeline()
+    self.assertNotEquals(timeline[0].worker, timeline[1].worker)
+
+  def testWorkersBoundConcurrency(self):
+    running = [0]
+    peak = [0]
+
+    def Run():
+      with self.lock:
+        running[0] += 1
+        peak[0] = max(peak[0], running[0])
+      time.sleep(0.05)
+      with self.lock:
+        running[0] -= 1
+    graph = task_graph.TaskGraph([Task(str(i), Run) for i in range(6)],
+                                 workers=2)
+    graph.Run()
+    self.assertEquals(2, peak[0])
+
+  def testFailureStopsTheGraph(self):
+    def Fail():
+      raise IOError('tar failed')
+    graph = task_graph.TaskGraph([
+        Task('system', Fail),
+        Task('modify', self._Record('modify'), deps=['system']),
+    ], workers=2)
+    self.assertRaises(IOError, graph.Run)
+    self.assertEquals([], self.ran)
+    self.assertEquals([('system', task_graph.FAILED)],
+                      [(t.name, t.outcome) for t in graph.Timeline()])
+
+  def testCriticalPath(self):
+    graph = task_graph.TaskGraph([
+        Task('system', self._Record('system', 0.1)),
+        Task('cache', self._Record('cache')),
+        Task('modify', self._Record('modify', 0.05), deps=['system', 'cache']),
+        Task('ports', self._Record('ports')),
+    ], workers=4)
+    graph.Run()
+    self.assertEquals(['system', 'modify'],
+                      [t.name for t in graph.CriticalPath()])
+
+  def testChargesTheStopwatch(self):
+    timer = stopwatch.StopWatch()
+    timer.start('STAGE_DATA')
+    graph = task_graph.TaskGraph([Task('a', self._Record('a')),
+                                  Task('b', self._Record('b'))], timer)
+    graph.Run()
+    timer.stop('STAGE_DATA')
+    self.assertEquals(1, timer.counters['a'])
+    self.assertEquals(1, timer.counters['b'])
+    self.assertEquals(1, timer.counters['STAGE_DATA'])
+
+  def testUnknownDep(self):
+    self.assertRaises(ValueError, task_graph.TaskGraph,
+                      [Task('a', self._Record('a'), deps=['b'])])
+
+  def testCycle(self):
+    self.assertRaises(ValueError, task_graph.TaskGraph,
+                      [Task('a', self._Record('a'), deps=['b']),
+                       Task('b', self._Record('b'), deps=['a'])])
+
+
+if __name__ == '__main__':
+  googletest.main()
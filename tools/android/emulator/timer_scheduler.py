@@ -0,0 +1,299 @@
+# Copyright 2018 The Android Open Source Project. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A process wide timer heap for subprocess deadlines.
+
+Rather than a threading.Timer (a thread) per timed command, all timers live in
+one heap served by a single daemon thread. Callbacks run on that thread and
+must not block: signal a process, set a flag or wake a thread which does the
+slow part. An adb command, which can hang, would hold up every other timer.
+
+  handle = GetTimerScheduler().TerminateAfter(task, 30)
+  task.communicate()
+  handle.Cancel()
+
+TerminateAfter implements the kill escalation used for timed out commands:
+SIGTERM, then SIGKILL if the process is still around after a grace period.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import atexit
+import errno
+import heapq
+import itertools
+import os
+import signal
+import threading
+import time
+
+from absl import flags
+from absl import logging
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_float('subprocess_kill_grace_seconds', 5.0,
+                   'How long a timed out command has to exit after SIGTERM '
+                   'before it is sent SIGKILL.')
+
+
+def _GraceSeconds():
+  try:
+    return FLAGS.subprocess_kill_grace_seconds
+  except flags.UnparsedFlagAccessError:
+    return FLAGS['subprocess_kill_grace_seconds'].default
+
+
+class TimerHandle(object):
+  """A scheduled callback.
+
+  Attributes:
+    deadline: when the callback is due next.
+    fired: the number of times the callback ran.
+    cancelled: whether Cancel was called, even if after the callback ran.
+  """
+
+  def __init__(self, scheduler, deadline, interval, fn, args, kwargs):
+    self.deadline = deadline
+    self.fired = 0
+    self.cancelled = False
+    self._scheduler = scheduler
+    self._interval = interval
+    self._fn = fn
+    self._args = args
+    self._kwargs = kwargs
+
+  @property
+  def pending(self):
+    """Whether the callback may still run."""
+    return not self.cancelled and (self._interval is not None or
+                                   not self.fired)
+
+  def Cancel(self):
+    """Cancels the callback, returns True if it had not run yet."""
+    return self._scheduler.Cancel(self)
+
+  def _Run(self):
+    try:
+      return self._fn(*self._args, **self._kwargs)
+    except Exception:  # pylint: disable=broad-except
+      logging.exception('Timer callback %s failed.', self._fn)
+      return None
+
+
+class TimerScheduler(object):
+  """Runs callbacks at deadlines, from a single daemon thread.
+
+  The thread is started with the first timer. Counters() reports how many
+  timers were scheduled, cancelled and fired, and how many commands timed
+  out, were terminated and had to be killed.
+  """
+
+  def __init__(self, clock=time.time):
+    self._clock = clock
+    self._heap = []
+    self._sequence = itertools.count()
+    self._condition = threading.Condition()
+    self._thread = None
+    self._stopped = False
+    self._counters = dict.fromkeys(['scheduled', 'cancelled', 'fired',
+                                    'timeouts', 'terminated', 'killed'], 0)
+
+  def Schedule(self, delay, fn, *args, **kwargs):
+    """Calls fn(*args, **kwargs) in delay seconds, returns a TimerHandle."""
+    return self._Add(delay, None, fn, args, kwargs)
+
+  def SchedulePeriodic(self, interval, fn, *args, **kwargs):
+    """Calls fn every interval seconds until it returns False or is cancelled.
+
+    Args:
+      interval: seconds between calls, the first call is interval from now.
+      fn: the callback.
+      *args: passed to fn.
+      **kwargs: passed to fn.
+
+    Returns:
+      A TimerHandle.
+    """
+    return self._Add(interval, interval, fn, args, kwargs)
+
+  def TerminateAfter(self, task, timeout_seconds, on_timeout=None,
+                     grace_seconds=None):
+    """Times out task after timeout_seconds.
+
+    Args:
+      task: a process, with returncode, send_signal() and kill().
+      timeout_seconds: how long the task may run.
+      on_timeout: [optional] called with the task at the deadline instead of
+        Terminate.
+      grace_seconds: see Terminate.
+
+    Returns:
+      A TimerHandle, to be cancelled once the task completed.
+    """
+    return self.Schedule(timeout_seconds, self._TimedOut, task, on_timeout,
+                         grace_seconds)
+
+  def Terminate(self, task, grace_seconds=None):
+    """Sends SIGTERM to task and SIGKILL if it did not exit after a grace.
+
+    Args:
+      task: a process, with returncode, send_signal() and kill().
+      grace_seconds: how long the task has to exit after SIGTERM, defaults to
+        --subprocess_kill_grace_seconds.
+    """
+    if grace_seconds is None:
+      grace_seconds = _GraceSeconds()
+    if _Signal(task, signal.SIGTERM):
+      self._Count('terminated')
+      self.Schedule(grace_seconds, self._Kill, task)
+
+  def Cancel(self, handle):
+    with self._condition:
+      if handle.cancelled:
+        return False
+      handle.cancelled = True
+      if handle.fired and handle._interval is None:  # pylint: disable=protected-access
+        return False
+      self._counters['cancelled'] += 1
+      # the entry stays in the heap and is skipped when it comes due.
+      self._condition.notify()
+      return True
+
+  def Counters(self):
+    """Returns a copy of the counters."""
+    with self._condition:
+      return dict(self._counters)
+
+  def Pending(self):
+    """The number of timers which may still run."""
+    with self._condition:
+      return len([h for _, _, h in self._heap if h.pending])
+
+  def Stop(self, timeout=None):
+    """Ends the timer thread, pending timers never fire.
+
+    Args:
+      timeout: [optional] how long to wait for a running timer to return.
+    """
+    with self._condition:
+      self._stopped = True
+      self._condition.notify()
+      thread = self._thread
+    if thread and thread is not threading.current_thread():
+      thread.join(timeout)
+
+  def _Count(self, name):
+    with self._condition:
+      self._counters[name] += 1
+
+  def _TimedOut(self, task, on_timeout, grace_seconds):
+    if task.returncode is not None:
+      return
+    self._Count('timeouts')
+    logging.info('Command %s timed out.', getattr(task, 'args', task))
+    if on_timeout:
+      on_timeout(task)
+    else:
+      self.Terminate(task, grace_seconds)
+
+  def _Kill(self, task):
+    if _Signal(task, signal.SIGKILL):
+      self._Count('killed')
+
+  def _Add(self, delay, interval, fn, args, kwargs):
+    with self._condition:
+      handle = TimerHandle(self, self._clock() + delay, interval, fn, args,
+                           kwargs)
+      heapq.heappush(self._heap, (handle.deadline, next(self._sequence),
+                                  handle))
+      self._counters['scheduled'] += 1
+      if self._thread is None:
+        self._thread = threading.Thread(target=self._Serve,
+                                        name='TimerScheduler')
+        self._thread.daemon = True
+        self._thread.start()
+      self._condition.notify()
+      return handle
+
+  def _NextDue(self):
+    """Waits for and pops the next due handle, with the condition held."""
+    while not self._stopped:
+      while self._heap and self._heap[0][2].cancelled:
+        heapq.heappop(self._heap)
+      if not self._heap:
+        self._condition.wait()
+        continue
+      wait = self._heap[0][0] - self._clock()
+      if wait > 0:
+        self._condition.wait(wait)
+        continue
+      handle = heapq.heappop(self._heap)[2]
+      handle.fired += 1
+      self._counters['fired'] += 1
+      return handle
+    return None
+
+  def _Serve(self):
+    while True:
+      with self._condition:
+        handle = self._NextDue()
+      if handle is None:
+        return
+      repeat = handle._Run()  # pylint: disable=protected-access
+      if handle._interval is None:  # pylint: disable=protected-access
+        continue
+      with self._condition:
+        if repeat is False:
+          handle._interval = None  # pylint: disable=protected-access
+        elif not handle.cancelled:
+          handle.deadline = self._clock() + handle._interval  # pylint: disable=protected-access
+          heapq.heappush(self._heap, (handle.deadline, next(self._sequence),
+                                      handle))
+
+
+def _Signal(task, sig):
+  """Signals task if it is still running, returns whether it was signalled."""
+  if task.returncode is not None:
+    return False
+  try:
+    if sig == signal.SIGKILL:
+      task.kill()
+    else:
+      task.send_signal(sig)
+  except OSError as e:
+    if e.errno != errno.ESRCH:
+      raise
+    return False
+  return True
+
+
+_scheduler = None
+_scheduler_pid = None
+_scheduler_lock = threading.Lock()
+
+
+def GetTimerScheduler():
+  """Returns the process wide TimerScheduler."""
+  global _scheduler, _scheduler_pid
+  with _scheduler_lock:
+    # the thread does not survive a fork, children get their own scheduler.
+    if _scheduler is None or _scheduler_pid != os.getpid():
+      _scheduler = TimerScheduler()
+      _scheduler_pid = os.getpid()
+      # before the modules the thread uses are torn down.
+      atexit.register(_scheduler.Stop, 1.0)
+    return _scheduler
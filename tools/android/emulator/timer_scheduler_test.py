@@ -0,0 +1,159 @@
+# Copyright 2018 The Android Open Source Project. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for tools.android.emulator.timer_scheduler."""
+
+import os
+import signal
+import threading
+import time
+
+from google.apputils import basetest as googletest
+from tools.android.emulator import timer_scheduler
+
+
+class FakeTask(object):
+
+  def __init__(self, exit_on=()):
+    self.returncode = None
+    self.signals = []
+    self._exit_on = exit_on
+    self.exited = threading.Event()
+
+  def send_signal(self, sig):
+    self.signals.append(sig)
+    if sig in self._exit_on:
+      self.returncode = -sig
+      self.exited.set()
+
+  def kill(self):
+    self.send_signal(signal.SIGKILL)
+
+
+class TimerSchedulerTest(googletest.TestCase):
+
+  def setUp(self):
+    super(TimerSchedulerTest, self).setUp()
+    self.scheduler = timer_scheduler.TimerScheduler()
+
+  def tearDown(self):
+    self.scheduler.Stop(5)
+    super(TimerSchedulerTest, self).tearDown()
+
+  def testRunsInDeadlineOrder(self):
+    ran = []
+    done = threading.Event()
+    self.scheduler.Schedule(0.2, lambda: (ran.append(2), done.set()))
+    self.scheduler.Schedule(0.1, ran.append, 1)
+    self.assertTrue(done.wait(5))
+    self.assertEquals([1, 2], ran)
+    self.assertEquals(2, self.scheduler.Counters()['fired'])
+
+  def testCancel(self):
+    ran = []
+    done = threading.Event()
+    handle = self.scheduler.Schedule(0.1, ran.append, 1)
+    self.assertTrue(handle.Cancel())
+    self.assertFalse(handle.Cancel())
+    self.scheduler.Schedule(0.2, done.set)
+    self.assertTrue(done.wait(5))
+    self.assertEquals([], ran)
+    self.assertEquals(0, self.scheduler.Pending())
+    counters = self.scheduler.Counters()
+    self.assertEquals(1, counters['cancelled'])
+    self.assertEquals(1, counters['fired'])
+
+  def testCancelAfterFiring(self):
+    done = threading.Event()
+    handle = self.scheduler.Schedule(0, done.set)
+    self.assertTrue(done.wait(5))
+    self.assertFalse(handle.Cancel())
+    self.assertTrue(handle.cancelled)
+    self.assertEquals(1, handle.fired)
+
+  def testPeriodic(self):
+    calls = []
+    done = threading.Event()
+
+    def Tick():
+      calls.append(1)
+      if len(calls) == 3:
+        done.set()
+        return False
+      return True
+
+    handle = self.scheduler.SchedulePeriodic(0.05, Tick)
+    self.assertTrue(done.wait(5))
+    time.sleep(0.2)
+    self.assertEquals(3, handle.fired)
+    self.assertFalse(handle.pending)
+
+  def testTerminateAfter_exitsOnTerm(self):
+    task = FakeTask(exit_on=(signal.SIGTERM,))
+    self.scheduler.TerminateAfter(task, 0.05, grace_seconds=0.05)
+    self.assertTrue(task.exited.wait(5))
+    self.assertEquals([signal.SIGTERM], task.signals)
+    counters = self.scheduler.Counters()
+    self.assertEquals(1, counters['timeouts'])
+    self.assertEquals(1, counters['terminated'])
+
+  def testTerminateAfter_escalatesToKill(self):
+    task = FakeTask(exit_on=(signal.SIGKILL,))
+    self.scheduler.TerminateAfter(task, 0.05, grace_seconds=0.05)
+    self.assertTrue(task.exited.wait(5))
+    self.assertEquals([signal.SIGTERM, signal.SIGKILL], task.signals)
+    self.assertEquals(1, self.scheduler.Counters()['killed'])
+
+  def testTerminateAfter_customTimeout(self):
+    task = FakeTask()
+    timed_out = threading.Event()
+    self.scheduler.TerminateAfter(task, 0.05,
+                                  on_timeout=lambda t: timed_out.set())
+    self.assertTrue(timed_out.wait(5))
+    self.assertEquals([], task.signals)
+
+  def testTerminateAfter_completedTask(self):
+    task = FakeTask()
+    task.returncode = 0
+    done = threading.Event()
+    self.scheduler.TerminateAfter(task, 0)
+    self.scheduler.Schedule(0.1, done.set)
+    self.assertTrue(done.wait(5))
+    self.assertEquals([], task.signals)
+    self.assertEquals(0, self.scheduler.Counters()['timeouts'])
+
+  def testStopEndsTheThread(self):
+    ran = []
+    done = threading.Event()
+    self.scheduler.Schedule(0, done.set)
+    self.assertTrue(done.wait(5))
+    self.scheduler.Schedule(0.2, ran.append, 1)
+    self.scheduler.Stop(5)
+    self.assertFalse(self.scheduler._thread.is_alive())  # pylint: disable=protected-access
+    self.assertEquals([], ran)
+
+  def testForkedChildGetsOwnScheduler(self):
+    parent = timer_scheduler.GetTimerScheduler()
+    self.assertIs(parent, timer_scheduler.GetTimerScheduler())
+    pid = os.fork()
+    if not pid:
+      child = timer_scheduler.GetTimerScheduler()
+      done = threading.Event()
+      child.Schedule(0, done.set)
+      os._exit(0 if child is not parent and done.wait(5) else 1)  # pylint: disable=protected-access
+    self.assertEquals((pid, 0), os.waitpid(pid, 0))
+
+
+if __name__ == '__main__':
+  googletest.main()
@@ -35,9 +35,9 @@ from absl import flags
 from google.protobuf import text_format
 from tools.android.emulator import resources
 
-from tools.android.emulator import common
 from tools.android.emulator import emulated_device
 from tools.android.emulator import emulator_meta_data_pb2
+from tools.android.emulator import file_prefetcher
 from tools.android.emulator import reporting
 
 
@@ -1073,13 +1073,7 @@ def _EnsureFilesCached(pathss):
   Args:
     pathss: A list where each element can be a str or a list of str.
   """
-  for paths in pathss:
-    if paths:
-      if type(paths) is str:
-        paths = (paths,)
-      for path in paths:
-        if path and type(path) is str:
-          common.EnsureFileCached(path)
+  file_prefetcher.PrefetchFiles(pathss)
 
 
 def main(unused_argv):